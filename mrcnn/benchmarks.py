@@ -0,0 +1,1132 @@
+"""
+Mask R-CNN
+Micro-benchmarks for the data and evaluation pipelines, COCO dataset loading, the heatmap
+graph layers and the heatmap file store.
+
+Each benchmark_xxx() function builds seeded synthetic inputs, times the current
+implementation against its replacement, checks both give the same results and
+returns a list of result dicts (one per input size). benchmark_imports() checks the import
+time and memory budgets of the NumPy-only modules, and benchmark_logging() that a default
+level FCN data generator step writes nothing to the console.
+
+benchmark_utils() times the mrcnn.utils box, mask and anchor primitives on their own. Its
+results can be saved as a baseline (--save_baseline) and later runs compared against it
+(--baseline): a case whose median time is over the baseline by more than --threshold is
+reported as a regression and the run exits with status 1. Baselines are per machine.
+
+Usage:
+    python -m mrcnn.benchmarks rpn_targets map heatmaps heatmap_store sparse_heatmaps nms detection_graph function_cache coco_index imports logging utils
+    python -m mrcnn.benchmarks utils --save_baseline utils_baseline.json
+    python -m mrcnn.benchmarks utils --baseline utils_baseline.json --threshold 0.25
+"""
+import sys, json, time, timeit, argparse, platform, pprint
+import numpy as np
+
+from   mrcnn.config  import Config
+
+pp = pprint.PrettyPrinter(indent=2, width=100)
+
+
+class BenchmarkConfig(Config):
+    '''
+    COCO sized configuration (1024 x 1024 images, 261888 anchors)
+    '''
+    NAME        = "benchmark"
+    NUM_CLASSES = 1 + 80
+
+
+class HeatmapBenchmarkConfig(Config):
+    '''
+    COCO classes on 512 x 512 images (128 x 128 heatmaps)
+    '''
+    NAME          = "heatmap_benchmark"
+    NUM_CLASSES   = 1 + 80
+    IMAGE_MIN_DIM = 512
+    IMAGE_MAX_DIM = 512
+    VERBOSE       = 0
+
+
+class ModelBenchmarkConfig(Config):
+    '''
+    Settings ModelBase.__init__() expects in an inference mode model
+    '''
+    NAME          = "model_benchmark"
+    TRAINING_PATH = None
+    VERBOSE       = 0
+
+
+##------------------------------------------------------------------------------------
+## Helpers
+##------------------------------------------------------------------------------------
+def time_function(fn, repeats = 5, number = 1):
+    '''
+    Time fn() - returns the best and median time per call in seconds.
+    '''
+    times = timeit.repeat(fn, repeat = repeats, number = number)
+    times = np.array(times) / number
+    return {'best': float(np.min(times)), 'median': float(np.median(times))}
+
+    
+def random_boxes(count, image_size, min_size = 8, max_size = 512, seed = 0):
+    '''
+    Seeded random boxes [count, (y1, x1, y2, x2)] (int32) inside an image_size x image_size image
+    '''
+    rs   = np.random.RandomState(seed)
+    hw   = rs.randint(min_size, max_size, (count, 2))
+    y1x1 = rs.randint(0, image_size - min_size, (count, 2))
+    y2x2 = np.minimum(y1x1 + hw, image_size)
+    return np.hstack([y1x1, y2x2]).astype(np.int32)
+
+    
+def display_results(title, results):
+    print()
+    print(title)
+    print('-' * len(title))
+    for res in results:
+        print('  '.join(['{}: {}'.format(k, '{:.6f}'.format(v) if isinstance(v, float) else v) for k,v in res.items()]))
+    print()
+
+
+##------------------------------------------------------------------------------------
+## build_rpn_targets vs AnchorTargetBuilder
+##------------------------------------------------------------------------------------
+def benchmark_rpn_targets(config = None, gt_counts = (1, 7, 20, 50, 100), repeats = 5):
+    '''
+    Compare datagen.build_rpn_targets() with AnchorTargetBuilder.build() on COCO-sized
+    GT box counts. Verifies both return identical rpn_match / rpn_bbox.
+    '''
+    from mrcnn.datagen import build_rpn_targets, AnchorTargetBuilder
+    
+    config      = config or BenchmarkConfig()
+    rpn_targets = AnchorTargetBuilder.from_config(config)
+    anchors     = rpn_targets.anchors
+    image_shape = config.IMAGE_SHAPE
+    results     = []
+    
+    for gt_count in gt_counts:
+        gt_boxes     = random_boxes(gt_count, config.IMAGE_MAX_DIM, seed = gt_count)
+        gt_class_ids = np.random.RandomState(gt_count).randint(1, config.NUM_CLASSES, gt_count).astype(np.int32)
+        
+        np.random.seed(gt_count)
+        ref_match, ref_bbox = build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config)
+        np.random.seed(gt_count)
+        new_match, new_bbox = rpn_targets.build(gt_class_ids, gt_boxes)
+        assert np.array_equal(ref_match, new_match), "rpn_match mismatch for {} gt boxes".format(gt_count)
+        assert np.allclose(ref_bbox, new_bbox), "rpn_bbox mismatch for {} gt boxes".format(gt_count)
+        
+        ref = time_function(lambda: build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config), repeats)
+        new = time_function(lambda: rpn_targets.build(gt_class_ids, gt_boxes), repeats)
+        results.append({'anchors'       : anchors.shape[0],
+                        'gt_boxes'      : gt_count, 
+                        'build_rpn_targets': ref['median'], 
+                        'AnchorTargetBuilder': new['median'], 
+                        'speedup'       : ref['median'] / new['median']})
+    return results
+
+    
+##------------------------------------------------------------------------------------
+## mAP tables: get_avg_precision_at_iou_orig vs get_avg_precision_at_ious
+##------------------------------------------------------------------------------------
+def random_map_data(image_count, max_gt = 10, max_pred = 30, score_keys = ('scores',), image_size = 128, seed = 0):
+    '''
+    Seeded gt_boxes / pr_boxes dictionaries in the format used by calculate_map, 
+    with predictions jittered around the GT boxes plus random false positives.
+    '''
+    rs     = np.random.RandomState(seed)
+    gt_dict, pr_dict = {}, {}
+    for i in range(image_count):
+        gt_boxes = random_boxes(rs.randint(1, max_gt + 1), image_size, 4, image_size // 3, seed = seed * 100003 + i)
+        pr_count = rs.randint(0, max_pred + 1)
+        src      = gt_boxes[rs.randint(0, gt_boxes.shape[0], pr_count)]
+        jitter   = rs.randint(-4, 5, (pr_count, 4))
+        pr_boxes = np.clip(src + jitter, 0, image_size)
+        pr_boxes[:, 2:] = np.maximum(pr_boxes[:, 2:], pr_boxes[:, :2])
+        fp       = rs.rand(pr_count) < 0.3
+        pr_boxes[fp] = random_boxes(int(fp.sum()), image_size, 4, image_size // 3, seed = seed * 100003 + i + 1)
+        
+        key = 'image_{:05d}'.format(i)
+        gt_dict[key] = {'boxes': gt_boxes.tolist(), 'class_ids': [1] * gt_boxes.shape[0]}
+        pr_dict[key] = {'boxes': pr_boxes.astype(np.float64).tolist(), 'class_ids': [1] * pr_count}
+        for score_key in score_keys:
+            pr_dict[key][score_key] = np.round(rs.rand(pr_count), 4).tolist()
+    return gt_dict, pr_dict
+
+
+def benchmark_map(image_counts = (50, 200), score_keys = ('mrcnn_score_orig', 'fcn_score_0'), iou_thresholds = None, repeats = 1):
+    '''
+    Time a full mAP table (all score keys x IoU thresholds) computed with the original 
+    per-threshold get_avg_precision_at_iou_orig() and with get_avg_precision_at_ious(). 
+    Verifies both produce the same average precisions.
+    '''
+    from mrcnn.calculate_map import get_avg_precision_at_iou_orig, get_avg_precision_at_ious
+    
+    if iou_thresholds is None:
+        iou_thresholds = [np.round(thr, 2) for thr in np.arange(0.20, 0.95, 0.05)]
+    results = []
+    
+    for image_count in image_counts:
+        gt_dict, pr_dict = random_map_data(image_count, score_keys = score_keys, seed = image_count)
+        
+        def run_orig():
+            return {key: {thr: get_avg_precision_at_iou_orig(gt_dict, pr_dict, thr, key) for thr in iou_thresholds} 
+                    for key in score_keys}
+        def run_new():
+            return get_avg_precision_at_ious(gt_dict, pr_dict, iou_thresholds, score_keys)
+            
+        ref, new = run_orig(), run_new()
+        for key in score_keys:
+            for thr in iou_thresholds:
+                assert ref[key][thr]['avg_prec'] == new[key][thr]['avg_prec'], "avg_prec mismatch {} {}".format(key, thr)
+        
+        ref_time = time_function(run_orig, repeats)
+        new_time = time_function(run_new, repeats)
+        results.append({'images'        : image_count,
+                        'score_keys'    : len(score_keys),
+                        'iou_thresholds': len(iou_thresholds), 
+                        'orig'          : ref_time['median'], 
+                        'batched'       : new_time['median'], 
+                        'speedup'       : ref_time['median'] / new_time['median']})
+    return results
+
+##------------------------------------------------------------------------------------
+## CHM / FCN scoring heatmap graphs: tf.map_fn versions vs heatmap_kernels versions
+##------------------------------------------------------------------------------------
+def random_pred_tensor(config, box_count, rois_per_class, seed = 0):
+    '''
+    Seeded per-class box tensor in the build_pr_tensor() layout: 
+    [batch, num_classes, rois_per_class, (y1, x1, y2, x2, class_id, score, sequence_id, normalized score)]
+    '''
+    rs         = np.random.RandomState(seed)
+    image_size = config.IMAGE_MAX_DIM
+    in_tensor  = np.zeros([config.BATCH_SIZE, config.NUM_CLASSES, rois_per_class, 8], dtype = np.float32)
+    for b in range(config.BATCH_SIZE):
+        boxes   = random_boxes(box_count, image_size, 8, image_size // 2, seed = seed * 1000 + b).astype(np.float32)
+        boxes   = np.clip(boxes + rs.rand(box_count, 4), 0, image_size)
+        classes = rs.randint(1, config.NUM_CLASSES, box_count)
+        rows    = np.zeros(config.NUM_CLASSES, dtype = np.int32)
+        for i, (box, class_id) in enumerate(zip(boxes, classes)):
+            if rows[class_id] == rois_per_class:
+                continue
+            in_tensor[b, class_id, rows[class_id]] = np.hstack([box, class_id, rs.rand(), box_count - i, 0])
+            rows[class_id] += 1
+    normalizer = np.maximum(in_tensor[..., 5].max(axis = -1, keepdims = True), 1.0e-15)
+    in_tensor[..., 7] = in_tensor[..., 5] / normalizer
+    return in_tensor
+
+
+def random_pred_tensor_inf(config, box_count, rois_per_class, seed = 0):
+    '''
+    random_pred_tensor() in the build_predictions_inference() layout: 
+    [batch, num_classes, rois_per_class, (y1, x1, y2, x2, class_id, score, det_type, sequence_id, normalized score)]
+    '''
+    in_tensor = random_pred_tensor(config, box_count, rois_per_class, seed = seed)
+    det_type  = (in_tensor[..., 4:5] > 0).astype(np.float32)
+    return np.concatenate([in_tensor[..., :6], det_type, in_tensor[..., 6:]], axis = -1)
+
+
+def benchmark_heatmaps(config = None, box_counts = (10, 50, 100), rois_per_class = 32, repeats = 5):
+    '''
+    Time the map_fn based heatmap graphs (build_pr_heatmap_orig, build_gt_heatmap_orig,
+    build_heatmap_inference_orig, fcn_scoring_graph_orig) against the vectorized versions 
+    built on mrcnn.heatmap_kernels. Verifies both produce the same heatmaps and scores.
+    '''
+    import tensorflow as tf
+    from mrcnn.chm_layer          import build_pr_heatmap_orig, build_pr_heatmap
+    from mrcnn.chm_layer_inf      import build_heatmap_inference_orig, build_heatmap_inference
+    from mrcnn.chm_layer_tgt      import build_gt_heatmap_orig, build_gt_heatmap
+    from mrcnn.fcn_scoring_layer  import fcn_scoring_graph_orig, fcn_scoring_graph
+
+    config  = config or HeatmapBenchmarkConfig()
+    grid_h, grid_w = config.IMAGE_SHAPE[:2] // config.HEATMAP_SCALE_FACTOR
+    results = []
+
+    graph = tf.Graph()
+    with graph.as_default():
+        in_tensor  = tf.placeholder(tf.float32, [config.BATCH_SIZE, config.NUM_CLASSES, rois_per_class, 8])
+        inf_tensor = tf.placeholder(tf.float32, [config.BATCH_SIZE, config.NUM_CLASSES, rois_per_class, 9])
+        fcn_hm     = tf.placeholder(tf.float32, [config.BATCH_SIZE, grid_h, grid_w, config.NUM_CLASSES])
+        pr_scores  = tf.placeholder(tf.float32, [config.BATCH_SIZE, config.NUM_CLASSES, rois_per_class, 23])
+        layers     = {
+            'chm_pr'     : (build_pr_heatmap_orig(in_tensor, config, names = ['pr_orig']),
+                            build_pr_heatmap     (in_tensor, config, names = ['pr_new'])),
+            'chm_gt'     : (build_gt_heatmap_orig(in_tensor, config, names = ['gt_orig']),
+                            build_gt_heatmap     (in_tensor, config, names = ['gt_new'])),
+            'chm_inf'    : (build_heatmap_inference_orig(inf_tensor, config, names = ['inf_orig']),
+                            build_heatmap_inference     (inf_tensor, config, names = ['inf_new'])),
+            'fcn_scoring': (fcn_scoring_graph_orig([fcn_hm, pr_scores], config, 'training'),
+                            fcn_scoring_graph     ([fcn_hm, pr_scores], config, 'training')),
+        }
+
+        with tf.Session(graph = graph) as sess:
+            for box_count in box_counts:
+                feed = {in_tensor : random_pred_tensor    (config, box_count, rois_per_class, seed = box_count),
+                        inf_tensor: random_pred_tensor_inf(config, box_count, rois_per_class, seed = box_count)}
+                feed[pr_scores] = sess.run(layers['chm_pr'][0][1], feed)
+                feed[fcn_hm]    = sess.run(layers['chm_pr'][0][0], feed)
+
+                for name, (ref_op, new_op) in sorted(layers.items()):
+                    ref, new = sess.run([list(ref_op), list(new_op)] if isinstance(ref_op, tuple) else [[ref_op], [new_op]], feed)
+                    for ref_out, new_out in zip(ref, new):
+                        assert np.allclose(ref_out, new_out, rtol = 1.0e-4, atol = 1.0e-4, equal_nan = True), \
+                            "{} mismatch for {} boxes".format(name, box_count)
+                    ref_time = time_function(lambda: sess.run(ref_op, feed), repeats)
+                    new_time = time_function(lambda: sess.run(new_op, feed), repeats)
+                    results.append({'layer'     : name,
+                                    'boxes'     : box_count,
+                                    'orig'      : ref_time['median'], 
+                                    'vectorized': new_time['median'], 
+                                    'speedup'   : ref_time['median'] / new_time['median']})
+    return results
+
+##------------------------------------------------------------------------------------
+## Heatmap files: hm_*.npz files vs sharded heatmap store
+##------------------------------------------------------------------------------------
+def random_heatmap_data(config, active_classes = 4, boxes_per_class = 10, seed = 0):
+    '''
+    Seeded heatmap dict in the hm_*.npz layout: [H, W, NUM_CLASSES] heatmaps and 
+    [NUM_CLASSES, DETECTION_MAX_INSTANCES, 23] scores, populated for a few classes only.
+    '''
+    rs       = np.random.RandomState(seed)
+    grid_h, grid_w = config.IMAGE_SHAPE[:2] // config.HEATMAP_SCALE_FACTOR
+    classes  = rs.choice(np.arange(1, config.NUM_CLASSES), active_classes, replace = False)
+    data     = {'input_image_meta': np.arange(12 + config.NUM_CLASSES, dtype = np.int32) + seed}
+    for key in ['pr', 'gt']:
+        hm     = np.zeros((grid_h, grid_w, config.NUM_CLASSES), dtype = np.float32)
+        scores = np.zeros((config.NUM_CLASSES, config.DETECTION_MAX_INSTANCES, 23), dtype = np.float32)
+        hm[:, :, classes] = rs.rand(grid_h, grid_w, active_classes)
+        scores[classes, :boxes_per_class] = rs.rand(active_classes, boxes_per_class, 23)
+        data[key + '_hm_norm']   = hm
+        data[key + '_hm_scores'] = scores
+    data['coco_info'] = np.array([seed, 'COCO_train2014_{:012d}.jpg'.format(seed)])
+    return data
+
+
+def benchmark_heatmap_store(config = None, image_counts = (100, 500), shard_size = 100, reads = 100, repeats = 3):
+    '''
+    Random access read throughput of np.load(hm_*.npz) (the HeatmapDataset.load_image_heatmap 
+    loader) vs HeatmapStore.read() on a store built with convert_npz_files(). 
+    Verifies the store returns the npz contents (heatmaps to float16 precision).
+    '''
+    import tempfile, shutil, os
+    from mrcnn.heatmap_store import HeatmapStore, convert_npz_files
+
+    config  = config or HeatmapBenchmarkConfig()
+    results = []
+    keys    = ['input_image_meta', 'pr_hm_norm', 'pr_hm_scores', 'gt_hm_norm', 'gt_hm_scores']
+
+    for image_count in image_counts:
+        tmp_dir = tempfile.mkdtemp(prefix = 'heatmap_store_')
+        try:
+            npz_dir, store_dir = os.path.join(tmp_dir, 'npz'), os.path.join(tmp_dir, 'store')
+            os.makedirs(npz_dir)
+            for coco_id in range(1, image_count + 1):
+                np.savez_compressed(os.path.join(npz_dir, 'hm_{:012d}.npz'.format(coco_id)), 
+                                    **random_heatmap_data(config, seed = coco_id))
+            convert_npz_files(npz_dir, store_dir, shard_size = shard_size, verbose = 0)
+            store    = HeatmapStore(store_dir)
+            read_ids = np.random.RandomState(image_count).randint(1, image_count + 1, reads)
+
+            def read_npz():
+                for coco_id in read_ids:
+                    loaddata = np.load(os.path.join(npz_dir, 'hm_{:012d}.npz'.format(coco_id)))
+                    [loaddata[key] for key in keys]
+            def read_store():
+                for coco_id in read_ids:
+                    store.read(coco_id)
+
+            for coco_id in read_ids[:10]:
+                ref, new = np.load(os.path.join(npz_dir, 'hm_{:012d}.npz'.format(coco_id))), store.read(coco_id)
+                for key in keys:
+                    assert np.allclose(ref[key], new[key], atol = 1.0e-3), "{} mismatch for image {}".format(key, coco_id)
+                assert np.array_equal(ref['coco_info'], new['coco_info']), "coco_info mismatch for image {}".format(coco_id)
+
+            npz_size   = sum(os.path.getsize(os.path.join(npz_dir, f)) for f in os.listdir(npz_dir))
+            store_size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(store_dir) for f in files)
+            ref_time   = time_function(read_npz, repeats)
+            new_time   = time_function(read_store, repeats)
+            results.append({'images'        : image_count,
+                            'npz_MB'        : npz_size / 2**20,
+                            'store_MB'      : store_size / 2**20,
+                            'npz_reads/s'   : reads / ref_time['median'], 
+                            'store_reads/s' : reads / new_time['median'], 
+                            'speedup'       : ref_time['median'] / new_time['median']})
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+    return results
+
+##------------------------------------------------------------------------------------
+## Sparse predicted heatmaps: memory per image of dense pr_hm vs box parameters
+##------------------------------------------------------------------------------------
+def benchmark_sparse_heatmaps(config = None, box_counts = (5, 20, 50), rois_per_class = 32, repeats = 5):
+    '''
+    Memory per image of the dense pr_hm [h, w, NUM_CLASSES] vs the active class planes and
+    the non-zero pr_hm_scores rows (box parameters) used with SPARSE_PR_HEATMAPS, and the 
+    time to rebuild a batch of pr_hm from pr_hm_scores in the FCN graph. Verifies the
+    heatmaps rebuilt by heatmap_kernels.heatmaps_from_scores() and utils.pr_heatmap_from_scores()
+    match the CHM layer heatmaps.
+    '''
+    import tensorflow as tf
+    from mrcnn.chm_layer        import build_pr_heatmap
+    from mrcnn.heatmap_kernels  import heatmaps_from_scores
+    from mrcnn.utils            import pr_heatmap_from_scores
+
+    config  = config or HeatmapBenchmarkConfig()
+    grid_h, grid_w = config.IMAGE_SHAPE[:2] // config.HEATMAP_SCALE_FACTOR
+    results = []
+
+    graph = tf.Graph()
+    with graph.as_default():
+        in_tensor = tf.placeholder(tf.float32, [config.BATCH_SIZE, config.NUM_CLASSES, rois_per_class, 8])
+        pr_hm, pr_scores = build_pr_heatmap(in_tensor, config, names = ['pr_hm'])
+        rebuilt   = heatmaps_from_scores(pr_scores, config.HEATMAP_SCALE_FACTOR, grid_h, grid_w)
+
+        with tf.Session(graph = graph) as sess:
+            for box_count in box_counts:
+                feed = {in_tensor: random_pred_tensor(config, box_count, rois_per_class, seed = box_count)}
+                hm, scores, new_hm = sess.run([pr_hm, pr_scores, rebuilt], feed)
+                assert np.allclose(hm, new_hm, atol = 1.0e-5), "rebuilt heatmap mismatch for {} boxes".format(box_count)
+                assert np.allclose(hm[0], pr_heatmap_from_scores(scores[0], config.HEATMAP_SCALE_FACTOR, (grid_h, grid_w)), 
+                                   atol = 1.0e-5), "numpy rebuilt heatmap mismatch for {} boxes".format(box_count)
+
+                active_planes = np.count_nonzero(np.any(hm != 0, axis = (1,2)))
+                box_rows      = np.count_nonzero(np.any(scores != 0, axis = -1))
+                rebuild_time  = time_function(lambda: sess.run(rebuilt, {pr_scores: scores}), repeats)
+                results.append({'boxes'             : box_count,
+                                'pr_hm_KB'          : hm[0].nbytes / 1024,
+                                'pr_hm_scores_KB'   : scores[0].nbytes / 1024,
+                                'active_planes_KB'  : active_planes * (grid_h * grid_w * 4 + 2) / config.BATCH_SIZE / 1024,
+                                'box_rows_KB'       : box_rows * (scores.shape[-1] * 4 + 8) / config.BATCH_SIZE / 1024,
+                                'rebuild_per_image' : rebuild_time['median'] / config.BATCH_SIZE})
+    return results
+
+##------------------------------------------------------------------------------------
+## Detection refinement / NMS: per image, per class loop vs batched NMS
+##------------------------------------------------------------------------------------
+def random_detection_inputs(config, rois_per_image, clusters = 20, seed = 0):
+    '''
+    Seeded DetectionInferenceLayer inputs: rois [batch, N, 4] (normalized, clustered so NMS has
+    work to do), mrcnn_class [batch, N, NUM_CLASSES], mrcnn_bbox [batch, N, NUM_CLASSES, 4] and 
+    image windows [batch, 4]
+    '''
+    rs      = np.random.RandomState(seed)
+    shape   = (config.BATCH_SIZE, rois_per_image)
+    centers = rs.rand(config.BATCH_SIZE, clusters, 2) * 0.8 + 0.1
+    centers = centers[np.arange(config.BATCH_SIZE)[:, None], rs.randint(0, clusters, shape)] + rs.randn(*shape, 2) * 0.02
+    hw      = rs.rand(*shape, 2) * 0.2 + 0.02
+    rois    = np.clip(np.concatenate([centers - hw / 2, centers + hw / 2], axis = -1), 0, 1).astype(np.float32)
+    logits  = rs.randn(*shape, config.NUM_CLASSES) * 2
+    logits[..., 1:6] += 3
+    probs   = np.exp(logits) / np.exp(logits).sum(axis = -1, keepdims = True)
+    deltas  = (rs.randn(*shape, config.NUM_CLASSES, 4) * 0.1).astype(np.float32)
+    windows = np.tile(np.array([[config.IMAGE_MAX_DIM // 8, 0, config.IMAGE_MAX_DIM * 7 // 8, config.IMAGE_MAX_DIM]]), 
+                      (config.BATCH_SIZE, 1))
+    return rois, probs.astype(np.float32), deltas, windows
+
+
+def benchmark_nms(config = None, rois_counts = (300, 1000), repeats = 5):
+    '''
+    Compare the DetectionInferenceLayer refinement with a per image refine_detections_orig() loop
+    (per class non_max_suppression_orig calls) vs refine_detections_batch() (one batched NMS over all 
+    images and classes). Verifies both keep the same detections, and that batch_non_max_suppression
+    keeps the same boxes as per group non_max_suppression_orig calls when scores are tied.
+    '''
+    from mrcnn.detect_inf_layer import refine_detections_orig, refine_detections_batch
+    from mrcnn.utils            import batch_non_max_suppression, non_max_suppression_orig
+
+    config  = config or BenchmarkConfig()
+    results = []
+    
+    ## tied scores: the kept set depends on the tie order of each group's ranking
+    for seed in range(50):
+        rs        = np.random.RandomState(seed)
+        count     = rs.randint(1, 200)
+        boxes     = random_boxes(count, 128, 8, 64, seed = seed)
+        scores    = rs.randint(0, 4, count).astype(np.float32) / 4
+        group_ids = rs.randint(0, 4, count)
+        expected  = []
+        for group in np.unique(group_ids):
+            ixs = np.flatnonzero(group_ids == group)
+            expected.extend(ixs[non_max_suppression_orig(boxes[ixs], scores[ixs], config.DETECTION_NMS_THRESHOLD)])
+        keep = batch_non_max_suppression(boxes, scores, config.DETECTION_NMS_THRESHOLD, group_ids = group_ids)
+        assert sorted(keep) == sorted(expected), "kept boxes mismatch for tied scores, seed {}".format(seed)
+        
+    for rois_count in rois_counts:
+        rois, probs, deltas, windows = random_detection_inputs(config, rois_count, seed = rois_count)
+
+        def run_orig():
+            detections = np.zeros((config.BATCH_SIZE, config.DETECTION_MAX_INSTANCES, 7), dtype = np.float32)
+            for b in range(config.BATCH_SIZE):
+                d = refine_detections_orig(rois[b], probs[b], deltas[b], windows[b], config)
+                detections[b, :d.shape[0]] = d
+            return detections
+        def run_new():
+            return refine_detections_batch(rois, probs, deltas, windows, config)
+
+        assert np.array_equal(run_orig(), run_new()), "detections mismatch for {} rois".format(rois_count)
+        ref_time = time_function(run_orig, repeats)
+        new_time = time_function(run_new, repeats)
+        results.append({'batch'     : config.BATCH_SIZE,
+                        'rois'      : rois_count,
+                        'orig'      : ref_time['median'], 
+                        'batched'   : new_time['median'], 
+                        'speedup'   : ref_time['median'] / new_time['median']})
+    return results
+
+##------------------------------------------------------------------------------------
+## Detection layers: NumPy (py_func) paths vs DETECTION_GRAPH graph paths
+##------------------------------------------------------------------------------------
+def random_evaluation_inputs(config, gt_count, seed = 0):
+    '''
+    Seeded DetectionEvaluateLayer inputs: gt_class_ids [batch, MAX_GT_INSTANCES] (gt_count boxes
+    of a few classes, so classes have several GT boxes, a crowd box and zero padding), gt_bboxes
+    [batch, MAX_GT_INSTANCES, 4] (the first box of each image centered, so its flipped FP box is
+    shrunk) and class_pred_stats with 'avg' and 'pct' (1st / 2nd / 3rd quantile) class scores
+    '''
+    rs           = np.random.RandomState(seed)
+    image_size   = config.IMAGE_MAX_DIM
+    gt_class_ids = np.zeros((config.BATCH_SIZE, config.MAX_GT_INSTANCES), dtype = np.int32)
+    gt_bboxes    = np.zeros((config.BATCH_SIZE, config.MAX_GT_INSTANCES, 4), dtype = np.int32)
+    for b in range(config.BATCH_SIZE):
+        classes = rs.choice(np.arange(1, config.NUM_CLASSES), max(gt_count // 4, 1), replace = False)
+        gt_class_ids[b, :gt_count]     = rs.choice(classes, gt_count)
+        gt_class_ids[b, gt_count]      = -classes[0]
+        gt_bboxes[b, :gt_count + 1]    = random_boxes(gt_count + 1, image_size, 8, image_size // 2, seed = seed * 1000 + b)
+        gt_bboxes[b, 0]                = [image_size // 4, image_size // 4, image_size * 3 // 4, image_size * 3 // 4 - 2]
+    class_pred_stats = {'avg': (rs.rand(config.NUM_CLASSES) * 0.6 + 0.3).tolist(),
+                        'pct': (0.3 + np.cumsum(rs.rand(config.NUM_CLASSES, 3) * 0.2 + 0.02, axis = 1)).tolist()}
+    return gt_class_ids, gt_bboxes, class_pred_stats
+
+
+def evaluation_class_scores(gt_class_ids, config, class_pred_stats):
+    '''
+    Class score (before noise) add_evaluation_detections_1 / 2 / 3 give the TP and FP rows of
+    each GT box: the class average (method 1), or the class 3rd quantile for the first q3_count
+    GT boxes of the class and the 1st quantile for the others (methods 2, 3)
+    '''
+    scores = np.zeros(gt_class_ids.shape)
+    for i, class_id in enumerate(gt_class_ids):
+        if class_id <= 0:
+            continue
+        if config.EVALUATE_METHOD == 1:
+            scores[i] = class_pred_stats['avg'][class_id]
+            continue
+        class_count = np.sum(gt_class_ids == class_id)
+        class_rank  = np.sum(gt_class_ids[:i] == class_id)
+        q3_count    = class_count // 2 if config.EVALUATE_METHOD == 2 else class_count - class_count // 2
+        scores[i]   = class_pred_stats['pct'][class_id][2 if class_rank < q3_count else 0]
+    return scores
+
+
+def benchmark_detection_graph(config = None, rois_counts = (300, 1000), gt_counts = (10, 50), repeats = 5):
+    '''
+    Compare the DETECTION_GRAPH graph paths of the detection layers with their NumPy paths, on
+    the same seeded inputs run in one session:
+
+    inference:      refine_detections_graph() vs refine_detections_batch(). The detections must
+                    be equal, except for box coordinates rounded to the neighbouring pixel where
+                    the refined coordinate is at x.5 (see the refine_detections_graph() docstring).
+    evaluate_<m>:   add_evaluation_detections_graph() vs add_evaluation_detections_<m>, for
+                    EVALUATE_METHOD 1, 2 and 3. The score noise is drawn by different random
+                    generators, so rows are compared in (tp_ind, box, class_id) order: boxes,
+                    class ids and tp_ind must be equal, and the scores of both paths within
+                    +/- 0.001 of the class score of their GT box.
+    '''
+    import tensorflow as tf
+    from mrcnn.utils             import apply_box_deltas_np
+    from mrcnn.detect_inf_layer  import refine_detections_batch, refine_detections_graph
+    from mrcnn.detect_eval_layer import (add_evaluation_detections_1, add_evaluation_detections_2,
+                                         add_evaluation_detections_3, add_evaluation_detections_graph)
+
+    config  = config or BenchmarkConfig()
+    results = []
+    evaluate_methods = {1: add_evaluation_detections_1, 2: add_evaluation_detections_2, 3: add_evaluation_detections_3}
+    evaluate_method  = config.EVALUATE_METHOD
+
+    def unrounded_boxes(rois, probs, deltas, windows):
+        ## refine_detections_batch() steps 1-6, without the final rounding
+        num_classes     = probs.shape[-1]
+        class_ids       = np.argmax(probs, axis = -1).reshape(-1)
+        deltas_specific = deltas.reshape(-1, num_classes, 4)[np.arange(class_ids.shape[0]), class_ids]
+        refined_rois    = apply_box_deltas_np(rois.reshape(-1, 4), deltas_specific * config.BBOX_STD_DEV)
+        height, width   = config.IMAGE_SHAPE[:2]
+        refined_rois   *= np.array([height, width, height, width])
+        window          = np.repeat(windows, probs.shape[1], axis = 0)
+        refined_rois    = np.maximum(np.minimum(refined_rois, window[:, [2,3,2,3]]), window[:, [0,1,0,1]])
+        return refined_rois.reshape(probs.shape[:2] + (4,))
+
+    def check_inference(ref, new, rois, probs, deltas, windows):
+        assert np.array_equal(ref[..., 4:], new[..., 4:]), "class ids / scores mismatch"
+        diff = np.argwhere(ref[..., :4] != new[..., :4])
+        if not len(diff):
+            return 0
+        assert np.abs(ref[..., :4] - new[..., :4]).max() <= 1, "boxes differ by more than one pixel"
+        boxes = unrounded_boxes(rois, probs, deltas, windows)
+        for b, r, c in diff:
+            ## the ROI of the detection: same class and score, same box before rounding
+            roi = np.flatnonzero((np.argmax(probs[b], axis = -1) == ref[b, r, 4]) & (np.max(probs[b], axis = -1) == ref[b, r, 5]) &
+                                 np.all(np.rint(boxes[b]) == ref[b, r, :4], axis = -1))
+            assert len(roi) and np.abs(np.abs(np.modf(boxes[b, roi[0], c])[0]) - 0.5) < 1.0e-3, \
+                "box coordinate {} of detection {} differs but is not at x.5".format(c, r)
+        return len(diff)
+
+    def check_evaluation(ref, new, gt_class_ids, class_pred_stats):
+        class_scores = evaluation_class_scores(gt_class_ids, config, class_pred_stats)
+        ref, new     = [d[d[:, 4] > 0] for d in (ref, new)]
+        ref, new     = [d[np.lexsort(d[:, [4, 3, 2, 1, 0, 6]].T)] for d in (ref, new)]
+        assert ref.shape == new.shape, "row count mismatch: {} vs {}".format(ref.shape, new.shape)
+        assert np.array_equal(ref[:, [0, 1, 2, 3, 4, 6]], new[:, [0, 1, 2, 3, 4, 6]]), "boxes / class ids / tp_ind mismatch"
+        ## scores of the rows of each class and tp_ind, against the class scores of its GT boxes
+        for class_id in np.unique(ref[:, 4]).astype(np.int32):
+            expected = np.sort(class_scores[gt_class_ids == class_id])
+            for tp_ind in (1, -1):
+                rows = (ref[:, 4] == class_id) & (ref[:, 6] == tp_ind)
+                for d in (ref, new):
+                    assert np.all(np.abs(np.sort(d[rows, 5]) - expected) <= 0.001 + 1.0e-6), \
+                        "scores of class {} not within 0.001 of the class score".format(class_id)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        rois_in      = tf.placeholder(tf.float32, [config.BATCH_SIZE, None, 4])
+        probs_in     = tf.placeholder(tf.float32, [config.BATCH_SIZE, None, config.NUM_CLASSES])
+        deltas_in    = tf.placeholder(tf.float32, [config.BATCH_SIZE, None, config.NUM_CLASSES, 4])
+        windows_in   = tf.placeholder(tf.int32,   [config.BATCH_SIZE, 4])
+        gt_class_in  = tf.placeholder(tf.int32,   [config.BATCH_SIZE, config.MAX_GT_INSTANCES])
+        gt_bboxes_in = tf.placeholder(tf.int32,   [config.BATCH_SIZE, config.MAX_GT_INSTANCES, 4])
+        inference_op = refine_detections_graph(rois_in, probs_in, deltas_in, windows_in, config)
+
+        with tf.Session(graph = graph) as sess:
+            for rois_count in rois_counts:
+                rois, probs, deltas, windows = random_detection_inputs(config, rois_count, seed = rois_count)
+                feed = {rois_in: rois, probs_in: probs, deltas_in: deltas, windows_in: windows}
+
+                def run_numpy():
+                    return refine_detections_batch(rois, probs, deltas, windows, config)
+                def run_graph():
+                    return sess.run(inference_op, feed)
+
+                rounding = check_inference(run_numpy(), run_graph(), rois, probs, deltas, windows)
+                ref_time = time_function(run_numpy, repeats)
+                new_time = time_function(run_graph, repeats)
+                results.append({'path'      : 'inference',
+                                'inputs'    : rois_count,
+                                'numpy'     : ref_time['median'],
+                                'graph'     : new_time['median'],
+                                'speedup'   : ref_time['median'] / new_time['median'],
+                                'rounding'  : rounding})
+
+            try:
+                for method, build_evaluation_detections in sorted(evaluate_methods.items()):
+                    config.EVALUATE_METHOD = method
+                    for gt_count in gt_counts:
+                        gt_class_ids, gt_bboxes, class_pred_stats = random_evaluation_inputs(config, gt_count, seed = gt_count)
+                        evaluate_op = add_evaluation_detections_graph(gt_class_in, gt_bboxes_in, config, class_pred_stats)
+                        feed = {gt_class_in: gt_class_ids, gt_bboxes_in: gt_bboxes}
+
+                        def run_numpy():
+                            detections = np.zeros((config.BATCH_SIZE, config.DETECTION_MAX_INSTANCES, 7), dtype = np.float32)
+                            for b in range(config.BATCH_SIZE):
+                                d, _ = build_evaluation_detections(gt_class_ids[b], gt_bboxes[b], config, class_pred_stats)
+                                detections[b, :d.shape[0]] = d
+                            return detections
+                        def run_graph():
+                            return sess.run(evaluate_op, feed)
+
+                        ref, new = run_numpy(), run_graph()
+                        for b in range(config.BATCH_SIZE):
+                            check_evaluation(ref[b], new[b], gt_class_ids[b], class_pred_stats)
+                        ref_time = time_function(run_numpy, repeats)
+                        new_time = time_function(run_graph, repeats)
+                        results.append({'path'      : 'evaluate_{}'.format(method),
+                                        'inputs'    : gt_count,
+                                        'numpy'     : ref_time['median'],
+                                        'graph'     : new_time['median'],
+                                        'speedup'   : ref_time['median'] / new_time['median']})
+            finally:
+                config.EVALUATE_METHOD = evaluate_method
+    return results
+
+
+##------------------------------------------------------------------------------------
+## CocoDataset.load_coco(): annotation JSON (cold) vs on-disk annotation index (warm)
+##------------------------------------------------------------------------------------
+def random_coco_annotations(image_count, max_anns = 8, seed = 0):
+    '''
+    Seeded COCO style instances annotation dict: 80 classes, polygon and (10%) crowd RLE instances
+    '''
+    rs     = np.random.RandomState(seed)
+    images = [{'id': 1000 + i, 'file_name': 'COCO_val2014_{:012d}.jpg'.format(1000 + i),
+               'width': 640, 'height': 480} for i in range(image_count)]
+    annotations = []
+    for image in images:
+        for _ in range(rs.randint(0, max_anns + 1)):
+            if rs.rand() < 0.1:
+                segmentation = {'counts': rs.randint(0, 500, 40).tolist(), 'size': [480, 640]}
+            else:
+                segmentation = [np.round(rs.uniform(0, 480, 2 * rs.randint(4, 30)), 2).tolist()]
+            annotations.append({'segmentation': segmentation,
+                                'area'        : float(np.round(rs.uniform(10, 5.0e4), 3)),
+                                'iscrowd'     : int(isinstance(segmentation, dict)),
+                                'image_id'    : image['id'],
+                                'bbox'        : np.round(rs.uniform(0, 400, 4), 2).tolist(),
+                                'category_id' : int(rs.randint(1, 81)),
+                                'id'          : len(annotations) + 1})
+    categories = [{'id': i, 'name': 'class_{}'.format(i), 'supercategory': 'none'} for i in range(1, 81)]
+    return {'images': images, 'annotations': annotations, 'categories': categories}
+
+
+def _proc_status_mb(field):
+    with open('/proc/self/status') as infile:
+        for line in infile:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+
+
+def _load_coco_child(dataset_dir, index_cache):
+    '''
+    One load_coco() in a fresh process: returns (seconds, peak RSS growth in MB). The peak
+    is reset (Linux clear_refs) after the imports, so only the load itself is measured.
+    '''
+    import resource
+    from mrcnn.coco import CocoDataset
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        rss_start, peak_rss = _proc_status_mb('VmRSS'), lambda: _proc_status_mb('VmHWM')
+    except (IOError, OSError):
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        peak_rss  = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    dataset   = CocoDataset()
+    start     = time.perf_counter()
+    dataset.load_coco(dataset_dir, 'val', index_cache = index_cache)
+    elapsed   = time.perf_counter() - start
+    return elapsed, peak_rss() - rss_start
+
+
+def benchmark_coco_index(image_counts = (2000, 10000), repeats = 3):
+    '''
+    Time and peak memory of CocoDataset.load_coco() parsing the annotation JSON with 
+    pycocotools (cold) vs rebuilding the dataset from its coco_index (warm). Each load 
+    runs in a new process, so the peak RSS is that of the load alone. Verifies both
+    build the same image and class registry.
+    '''
+    import tempfile, shutil, os, json, multiprocessing, contextlib, io
+    from mrcnn.coco import CocoDataset
+
+    ctx     = multiprocessing.get_context('spawn')
+    results = []
+    for image_count in image_counts:
+        tmp_dir = tempfile.mkdtemp(prefix = 'coco_index_')
+        try:
+            annotations = random_coco_annotations(image_count, seed = image_count)
+            os.makedirs(os.path.join(tmp_dir, 'annotations'))
+            with open(os.path.join(tmp_dir, 'annotations', 'instances_val2014.json'), 'w') as outfile:
+                json.dump(annotations, outfile)
+
+            datasets = []
+            for index_cache in (False, True, True):
+                dataset = CocoDataset()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    dataset.load_coco(tmp_dir, 'val', index_cache = index_cache)
+                datasets.append(dataset)
+            ## datasets[1] builds the index, datasets[2] reads it
+            assert datasets[0].image_info == datasets[2].image_info, "image_info mismatch for {} images".format(image_count)
+            assert datasets[0].class_info == datasets[2].class_info, "class_info mismatch for {} images".format(image_count)
+
+            with ctx.Pool(1, maxtasksperchild = 1) as pool:
+                cold = [pool.apply(_load_coco_child, (tmp_dir, False)) for _ in range(repeats)]
+            with ctx.Pool(1, maxtasksperchild = 1) as pool:
+                warm = [pool.apply(_load_coco_child, (tmp_dir, True)) for _ in range(repeats)]
+            cold_time, cold_rss = np.median(cold, axis = 0)
+            warm_time, warm_rss = np.median(warm, axis = 0)
+            results.append({'images'        : image_count,
+                            'annotations'   : len(annotations['annotations']),
+                            'cold'          : float(cold_time),
+                            'warm'          : float(warm_time),
+                            'speedup'       : float(cold_time / warm_time),
+                            'cold_peak_MB'  : float(cold_rss),
+                            'warm_peak_MB'  : float(warm_rss)})
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+    return results
+
+
+##------------------------------------------------------------------------------------
+## Import time and memory of the NumPy-only modules
+##------------------------------------------------------------------------------------
+## packages that must not be loaded by importing the modules below (see lazy_modules)
+HEAVY_MODULES  = ('tensorflow', 'keras', 'scipy', 'skimage', 'matplotlib', 'pandas', 'seaborn', 
+                  'IPython', 'PIL', 'cv2', 'h5py', 'pycocotools', 'xhtml2pdf')
+
+## module : (import seconds, RSS growth MB) budget, measured on top of an interpreter with numpy loaded
+IMPORT_BUDGETS = {'mrcnn.config'          : (0.5, 20),
+                  'mrcnn.utils'           : (0.5, 20),
+                  'mrcnn.dataset'         : (0.5, 20),
+                  'mrcnn.datagen'         : (0.5, 20),
+                  'mrcnn.calculate_map'   : (0.5, 20),
+                  'mrcnn.visualize'       : (0.5, 20),
+                  'mrcnn.detection_cache' : (0.5, 20),
+                  'mrcnn.heatmap_store'   : (0.5, 20),
+                  'mrcnn.coco_index'      : (0.5, 20),
+                  'mrcnn.checkpoint_sweep': (0.5, 20)}
+
+_IMPORT_PROBE = """
+import sys, time, json, importlib
+import numpy
+def rss_mb():
+    with open('/proc/self/status') as infile:
+        return [int(l.split()[1]) / 1024 for l in infile if l.startswith('VmRSS:')][0]
+rss_start, start = rss_mb(), time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'rss_MB': rss_mb() - rss_start,
+                  'heavy'  : [m for m in json.loads(sys.argv[2]) if m in sys.modules]}))
+"""
+
+def benchmark_imports(budgets = None, repeats = 3):
+    '''
+    Import time and RSS growth of each module of budgets ({module: (seconds, MB)}, default
+    IMPORT_BUDGETS), each import in a new interpreter. Fails if a module loads one of the
+    HEAVY_MODULES or goes over its budget (best of repeats).
+    '''
+    import os, json, subprocess
+
+    budgets  = budgets or IMPORT_BUDGETS
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env      = dict(os.environ, PYTHONPATH = os.pathsep.join([root_dir, os.environ.get('PYTHONPATH', '')]))
+    results  = []
+
+    for module, (max_seconds, max_rss) in sorted(budgets.items()):
+        runs = []
+        for _ in range(repeats):
+            output = subprocess.check_output([sys.executable, '-c', _IMPORT_PROBE, module, json.dumps(HEAVY_MODULES)],
+                                             env = env, cwd = root_dir)
+            runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        seconds = min(r['seconds'] for r in runs)
+        rss     = min(r['rss_MB']  for r in runs)
+        assert not runs[0]['heavy'], "{} imports {}".format(module, ', '.join(runs[0]['heavy']))
+        assert seconds <= max_seconds, "{} import time {:.3f}s over budget {:.3f}s".format(module, seconds, max_seconds)
+        assert rss <= max_rss, "{} import RSS {:.1f}MB over budget {:.1f}MB".format(module, rss, max_rss)
+        results.append({'module'    : module,
+                        'seconds'   : seconds,
+                        'budget_s'  : float(max_seconds),
+                        'rss_MB'    : rss,
+                        'budget_MB' : float(max_rss)})
+    return results
+
+
+##------------------------------------------------------------------------------------
+## Console output and cost of disabled log calls in the FCN input pipeline
+##------------------------------------------------------------------------------------
+class HeatmapNpzDataset(object):
+    '''
+    In-memory stand-in for the heatmap datasets read by datagen_fcn.load_heatmap_npz()
+    '''
+
+    def __init__(self, config, image_count = 8, seed = 0):
+        rs = np.random.RandomState(seed)
+        hm_shape  = tuple(config.FCN_INPUT_SHAPE) + (config.NUM_CLASSES,)
+        scores    = (config.NUM_CLASSES, config.DETECTION_PER_CLASS, 11)
+        self.image_ids  = np.arange(image_count)
+        self.image_info = [{'id': i, 'path': 'image_{}.jpg'.format(i), 'heatmap_path': 'heatmap_{}.npz'.format(i)}
+                           for i in range(image_count)]
+        self.images     = rs.randint(0, 255, (image_count,) + tuple(config.IMAGE_SHAPE)).astype(np.uint8)
+        self.heatmap    = {'gt_hm_norm'      : rs.rand(*hm_shape).astype(np.float32),
+                           'gt_hm_scores'    : rs.rand(*scores).astype(np.float32),
+                           'pr_hm_norm'      : rs.rand(*hm_shape).astype(np.float32),
+                           'pr_hm_scores'    : rs.rand(*scores).astype(np.float32)}
+        self.image_meta = np.zeros((1 + 3 + 4 + config.NUM_CLASSES,), dtype = np.int32)
+
+    def load_image(self, image_id):
+        return self.images[image_id]
+
+    def load_image_heatmap(self, image_id):
+        heatmap_data = dict(self.heatmap)
+        heatmap_data['input_image_meta'] = self.image_meta.copy()
+        return heatmap_data
+
+
+def benchmark_logging(config = None, batches = 20, calls = 10000, repeats = 5):
+    '''
+    Runs fcn_data_generator() batches on an in-memory heatmap dataset at the default log
+    level and fails if they write anything to the console; checks the same batches do log
+    with mrcnn.datagen_fcn at DEBUG level. Times a per batch message as print() (to a
+    buffer), as a disabled logger.debug() call and as a disabled utils.log() call.
+    '''
+    import io, logging, contextlib
+    import mrcnn.utils as utils
+    from mrcnn.datagen_fcn import fcn_data_generator
+    from mrcnn.logs        import get_logger
+
+    config    = config or HeatmapBenchmarkConfig()
+    dataset   = HeatmapNpzDataset(config)
+    generator = fcn_data_generator(dataset, config, shuffle = True, batch_size = 1)
+    next(generator)
+    datagen_logger = get_logger('mrcnn.datagen_fcn')
+    assert not datagen_logger.isEnabledFor(logging.DEBUG), "mrcnn.datagen_fcn logs DEBUG messages at the default level"
+
+    console = io.StringIO()
+    with contextlib.redirect_stdout(console):
+        for _ in range(batches):
+            next(generator)
+    assert console.getvalue() == '', "{} default level batches wrote to the console:\n{}".format(batches, console.getvalue()[:500])
+
+    level = datagen_logger.level
+    datagen_logger.setLevel(logging.DEBUG)
+    try:
+        debug_console = io.StringIO()
+        with contextlib.redirect_stdout(debug_console):
+            next(generator)
+    finally:
+        datagen_logger.setLevel(level)
+    assert 'load_heatmap_npz()' in debug_console.getvalue(), "no DEBUG output from mrcnn.datagen_fcn"
+
+    image    = dataset.images[0]
+    image_id = 3
+    def print_calls():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(calls):
+                print(' Image shape        : ', image.shape, image.dtype, image_id)
+    def debug_calls():
+        for _ in range(calls):
+            datagen_logger.debug(' Image shape        : %s %s %s', image.shape, image.dtype, image_id)
+    def log_calls():
+        for _ in range(calls):
+            utils.log(' Image', image, logger = datagen_logger, level = logging.DEBUG)
+
+    print_time = time_function(print_calls, repeats)['median'] / calls
+    debug_time = time_function(debug_calls, repeats)['median'] / calls
+    log_time   = time_function(log_calls  , repeats)['median'] / calls
+    return [{'batches'          : batches,
+             'console_chars'    : len(console.getvalue()),
+             'debug_chars'      : len(debug_console.getvalue()),
+             'print'            : print_time,
+             'disabled_debug'   : debug_time,
+             'disabled_log'     : log_time,
+             'speedup'          : print_time / debug_time}]
+
+
+##------------------------------------------------------------------------------------
+## ModelBase.get_layer_outputs(): new KB.function per call vs cached backend function
+##------------------------------------------------------------------------------------
+def benchmark_function_cache(config = None, depths = (4, 16), calls = 20, repeats = 5):
+    '''
+    Per call latency of ModelBase.get_layer_outputs() on a small dense Keras model, building
+    a new KB.function on every call (FUNCTION_CACHE_SIZE = 0) vs the LRU cache of
+    compiled backend functions. Verifies both return the same layer outputs.
+    '''
+    import keras.backend as KB
+    import keras.layers  as KL
+    import keras.models  as KM
+    from mrcnn.model_base import ModelBase
+
+    config     = config or ModelBenchmarkConfig()
+    cache_size = config.FUNCTION_CACHE_SIZE
+    results    = []
+    
+    for depth in depths:
+        KB.clear_session()
+        x = input_layer = KL.Input(shape = [64], name = 'input')
+        outputs = []
+        for i in range(depth):
+            x = KL.Dense(64, activation = 'relu', name = 'dense_{}'.format(i))(x)
+            outputs.append(x)
+        model = ModelBase('inference', config)
+        model.keras_model = KM.Model(input_layer, outputs, name = 'benchmark')
+        model_input = [np.random.RandomState(depth).rand(8, 64).astype(np.float32)]
+        requested   = list(range(depth))
+
+        def run_calls(cache_size):
+            config.FUNCTION_CACHE_SIZE = cache_size
+            return [model.get_layer_outputs(model_input, requested, verbose = False) for _ in range(calls)]
+
+        for ref_out, new_out in zip(run_calls(0)[-1], run_calls(16)[-1]):
+            assert np.allclose(ref_out, new_out), "layer output mismatch for depth {}".format(depth)
+        ref_time = time_function(lambda: run_calls(0) , repeats)
+        new_time = time_function(lambda: run_calls(16), repeats)
+        results.append({'layers'    : depth,
+                        'uncached'  : ref_time['median'] / calls, 
+                        'cached'    : new_time['median'] / calls, 
+                        'speedup'   : ref_time['median'] / new_time['median'],
+                        'hits'      : model.function_cache_hits,
+                        'misses'    : model.function_cache_misses})
+    KB.clear_session()
+    config.FUNCTION_CACHE_SIZE = cache_size
+    return results
+
+
+##------------------------------------------------------------------------------------
+## mrcnn.utils box, mask and anchor primitives
+##------------------------------------------------------------------------------------
+def random_masks(bboxes, image_size):
+    '''
+    Instance masks [image_size, image_size, count] (bool): an ellipse inscribed in each box
+    '''
+    mask = np.zeros((image_size, image_size, len(bboxes)), dtype = bool)
+    for i, (y1, x1, y2, x2) in enumerate(bboxes):
+        yy, xx = np.ogrid[y1:y2, x1:x2]
+        cy, cx = (y1 + y2 - 1) / 2, (x1 + x2 - 1) / 2
+        ry, rx = max((y2 - y1) / 2, 1), max((x2 - x1) / 2, 1)
+        mask[y1:y2, x1:x2, i] = ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    return mask
+
+
+def benchmark_utils(config = None, gt_count = 100, proposal_count = 1000, repeats = 5):
+    '''
+    Time per call of the mrcnn.utils primitives used by the data generators and detection
+    post-processing, on seeded inputs of COCO training sizes: the 261888 anchors of
+    config, gt_count GT boxes and masks on 1024 x 1024 images, proposal_count proposals.
+
+    One result per case: {'case': 'function inputs', 'best', 'median'} (seconds per call);
+    'case' is the key compared against a baseline (see compare_baseline()).
+    '''
+    import mrcnn.utils as utils
+
+    config      = config or BenchmarkConfig()
+    image_size  = int(config.IMAGE_SHAPE[0])
+    rs          = np.random.RandomState(0)
+    anchors     = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+                                                 config.BACKBONE_SHAPES, config.BACKBONE_STRIDES,
+                                                 config.RPN_ANCHOR_STRIDE)
+    gt_boxes    = random_boxes(gt_count, image_size, min_size = 16, seed = 1)
+    proposals   = random_boxes(proposal_count, image_size, seed = 2).astype(np.float32)
+    scores      = rs.rand(proposal_count).astype(np.float32)
+    gt_masks    = random_masks(gt_boxes, image_size)
+    gt_bboxes   = utils.extract_bboxes(gt_masks)
+    mini_masks  = utils.minimize_mask(gt_bboxes, gt_masks, config.MINI_MASK_SHAPE)
+    image       = rs.randint(0, 255, (480, 640, 3)).astype(np.uint8)
+    areas       = lambda boxes: (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    anchor_area, proposal_area = areas(anchors), areas(proposals)
+
+    ## sanity checks of the inputs / outputs the timings are taken on
+    assert anchors.shape == (261888, 4) or config.IMAGE_SHAPE[0] != 1024, "unexpected anchor count {}".format(anchors.shape)
+    assert np.array_equal(gt_bboxes, gt_boxes), "extract_bboxes() differs from the mask boxes"
+    assert utils.compute_overlaps(anchors, gt_boxes).shape == (anchors.shape[0], gt_count)
+    assert utils.expand_mask(gt_bboxes, mini_masks, gt_masks.shape).shape == gt_masks.shape
+    assert utils.resize_image(image, config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM, config.IMAGE_PADDING)[0].shape == tuple(config.IMAGE_SHAPE)
+
+    cases = [
+        ('compute_overlaps {}x{}'.format(len(anchors), gt_count),
+            lambda: utils.compute_overlaps(anchors, gt_boxes), 1),
+        ('compute_overlaps {}x{}'.format(proposal_count, gt_count),
+            lambda: utils.compute_overlaps(proposals, gt_boxes), 10),
+        ('compute_iou 1x{}'.format(len(anchors)),
+            lambda: utils.compute_iou(gt_boxes[0], anchors, areas(gt_boxes[:1])[0], anchor_area), 5),
+        ('compute_iou 1x{}'.format(proposal_count),
+            lambda: utils.compute_iou(proposals[0], proposals, proposal_area[0], proposal_area), 100),
+        ('non_max_suppression {}'.format(proposal_count),
+            lambda: utils.non_max_suppression(proposals, scores, 0.7), 5),
+        ('extract_bboxes {}x{}^2'.format(gt_count, image_size),
+            lambda: utils.extract_bboxes(gt_masks), 1),
+        ('minimize_mask {}x{}^2'.format(gt_count, image_size),
+            lambda: utils.minimize_mask(gt_bboxes, gt_masks, config.MINI_MASK_SHAPE), 1),
+        ('expand_mask {}x{}^2'.format(gt_count, image_size),
+            lambda: utils.expand_mask(gt_bboxes, mini_masks, gt_masks.shape), 1),
+        ('resize_image 480x640->{}'.format(image_size),
+            lambda: utils.resize_image(image, config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM, config.IMAGE_PADDING), 5),
+        ('box_refinement 1x1',
+            lambda: utils.box_refinement(proposals[0], gt_boxes[0]), 1000),
+        ('generate_pyramid_anchors {}'.format(len(anchors)),
+            lambda: utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+                                                   config.BACKBONE_SHAPES, config.BACKBONE_STRIDES,
+                                                   config.RPN_ANCHOR_STRIDE), 1),
+    ]
+    results = []
+    for case, fn, number in cases:
+        timing = time_function(fn, repeats, number)
+        results.append({'case': case, 'best': timing['best'], 'median': timing['median']})
+    return results
+
+
+##------------------------------------------------------------------------------------
+## Baselines: median time of each result with a 'case' key
+##------------------------------------------------------------------------------------
+BASELINE_VERSION = 1
+
+def save_baseline(filename, results):
+    '''
+    results:        {benchmark name: list of result dicts}
+    '''
+    baseline = {'version'   : BASELINE_VERSION,
+                'time'      : time.time(),
+                'platform'  : platform.platform(),
+                'python'    : platform.python_version(),
+                'numpy'     : np.__version__,
+                'results'   : {name: {r['case']: r['median'] for r in res if 'case' in r}
+                               for name, res in results.items()}}
+    with open(filename, 'w') as outfile:
+        json.dump(baseline, outfile, indent = 1)
+
+
+def compare_baseline(filename, results, threshold = 0.25):
+    '''
+    Compare the median times of results ({benchmark name: list of result dicts}) with the
+    baseline in filename. Adds 'baseline' and 'change' (relative to the baseline) to the
+    results found in the baseline.
+
+    Returns the comparison rows {'benchmark', 'case', 'median', 'baseline', 'change', 
+    'regression'}, regression set where change > threshold
+    '''
+    with open(filename, 'r') as infile:
+        baseline = json.load(infile)
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError('compare_baseline: unsupported baseline version {} in {}'.format(baseline.get('version'), filename))
+
+    rows = []
+    for name, res in results.items():
+        cases = baseline['results'].get(name, {})
+        for r in res:
+            if r.get('case') not in cases:
+                continue
+            r['baseline'] = cases[r['case']]
+            r['change']   = r['median'] / r['baseline'] - 1.0
+            rows.append({'benchmark' : name,
+                         'case'      : r['case'],
+                         'median'    : r['median'],
+                         'baseline'  : r['baseline'],
+                         'change'    : r['change'],
+                         'regression': r['change'] > threshold})
+    return rows
+
+    
+BENCHMARKS = {
+    'rpn_targets'   : benchmark_rpn_targets,
+    'map'           : benchmark_map,
+    'heatmaps'      : benchmark_heatmaps,
+    'heatmap_store' : benchmark_heatmap_store,
+    'sparse_heatmaps': benchmark_sparse_heatmaps,
+    'nms'           : benchmark_nms,
+    'detection_graph': benchmark_detection_graph,
+    'function_cache': benchmark_function_cache,
+    'coco_index'    : benchmark_coco_index,
+    'imports'       : benchmark_imports,
+    'logging'       : benchmark_logging,
+    'utils'         : benchmark_utils,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run mrcnn micro-benchmarks')
+    parser.add_argument('benchmarks', nargs='*', default = sorted(BENCHMARKS), 
+                        help='Benchmarks to run: {}'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--repeats', type=int, default=5, help='Timing repeats per measurement')
+    parser.add_argument('--baseline', default=None, help='compare median times with this baseline file')
+    parser.add_argument('--save_baseline', default=None, help='save median times as a baseline file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='slow down over the baseline reported as regression (default=0.25)')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.benchmarks:
+        results[name] = BENCHMARKS[name](repeats = args.repeats)
+        display_results(name, results[name])
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+        print(' Baseline written to ', args.save_baseline)
+    if args.baseline:
+        rows = compare_baseline(args.baseline, results, args.threshold)
+        display_results('baseline comparison ({})'.format(args.baseline), rows)
+        regressions = [r for r in rows if r['regression']]
+        if regressions:
+            print(' {} regression(s) over {:.0%}: {}'.format(len(regressions), args.threshold, 
+                   ', '.join(['{} {}'.format(r['benchmark'], r['case']) for r in regressions])))
+            sys.exit(1)
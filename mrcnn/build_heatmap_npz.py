@@ -25,6 +25,7 @@ from mrcnn.datagen        import data_generator, load_image_gt
 from mrcnn.coco           import CocoDataset, CocoConfig, CocoInferenceConfig, evaluate_coco, build_coco_results
 from mrcnn.prep_notebook  import mrcnn_coco_train, prep_coco_dataset
 from mrcnn.utils          import Paths
+from mrcnn.heatmap_store  import HeatmapStoreWriter
                                 
 pp = pprint.PrettyPrinter(indent=2, width=100)
 np.set_printoptions(linewidth=100,precision=4,threshold=1000, suppress = True)
@@ -37,13 +38,20 @@ def build_heatmap_files(
           dataset, 
           iterations        = 5,
           start_from        = 0, 
-          dest_path         = None):
+          dest_path         = None,
+          heatmap_store     = None):
    
     '''
     train_dataset:  Training Dataset objects.
+    heatmap_store:  HeatmapStoreWriter. If provided, heatmaps are added to the store 
+                    instead of being written to individual hm_*.npz files in dest_path.
+                    When iterations * BATCH_SIZE wraps around the dataset, images come
+                    again: the hm_*.npz file is rewritten, and the store writer must be
+                    opened with duplicates = 'replace' (or 'skip') to do the same.
 
     '''
     assert mrcnn_model.mode == "trainfcn", "Create model in training mode."
+    batch_size = mrcnn_model.config.BATCH_SIZE
     log("Starting for  {} iterations - batch size of each iteration: {}".format(iterations, batch_size))
     log(" Output destination: {}".format(dest_path))
     tr_generator= data_generator(dataset, mrcnn_model.config, 
@@ -90,13 +98,20 @@ def build_heatmap_files(
             print('  output: {}  image_id: {}  coco_image_id: {} coco_filename: {} output file: {}'.format(
                             i, image_id, coco_image_id, coco_filename, filename))
 #             print('  output file: ',os.path.join(dest_path, filename))
-            np.savez_compressed(os.path.join(dest_path, filename), 
-                             input_image_meta=train_batch_x[1][i], 
-                             pr_hm_norm   = results[0][i],
+            ## SPARSE_PR_HEATMAPS: pr_hm_norm is not written, the FCN rebuilds it from pr_hm_scores
+            pr_hm_norm = None if mrcnn_model.config.SPARSE_PR_HEATMAPS else results[0][i]
+            if heatmap_store is not None:
+                heatmap_store.add(coco_image_id, coco_filename, train_batch_x[1][i], 
+                                  pr_hm_norm, results[1][i], results[2][i], results[3][i])
+                continue
+            heatmap_data = dict(input_image_meta=train_batch_x[1][i], 
                              pr_hm_scores = results[1][i],
                              gt_hm_norm   = results[2][i],
                              gt_hm_scores = results[3][i],
                              coco_info    = np.array([coco_image_id, coco_filename])    )        
+            if pr_hm_norm is not None:
+                heatmap_data['pr_hm_norm'] = pr_hm_norm
+            np.savez_compressed(os.path.join(dest_path, filename), **heatmap_data)
         tm_stop= time.time()            
         print(' ==> Elapsed time {:.4f}s #        of items in results: {} '.format(tm_stop - tm_start,len(train_batch_x)))
 
@@ -153,6 +168,19 @@ if __name__ == '__main__':
                         metavar="<last epoch ran>",
                         help='Starting image index -1 or n to start from image n+1')
                         
+    parser.add_argument('--store', required=False,
+                        default=False, action='store_true',
+                        help='Write heatmaps to a sharded heatmap store in output_dir instead of hm_*.npz files')
+
+    parser.add_argument('--append', required=False,
+                        default=False, action='store_true',
+                        help='Add the heatmaps to the existing heatmap store in output_dir (with --store)')
+
+    parser.add_argument('--shard_size', required=False,
+                        default=1000, type = int,
+                        metavar="<shard size>",
+                        help='Number of images in each heatmap store shard (default=1000)')
+                        
     parser.add_argument('--sysout', required=False,
                         choices=['SCREEN', 'FILE'],
                         default='screen', type=str.upper,
@@ -170,6 +198,7 @@ if __name__ == '__main__':
     print("    Iterations         : ", args.iterations)
     print("    Start from image # : ", args.start_from)
     print("    Batch Size         : ", args.batch_size)
+    print("    Heatmap store      : ", args.store, '  shard size: ', args.shard_size, '  append: ', args.append)
     print("    Sysout             : ", args.sysout)
  
     if args.sysout == 'FILE':
@@ -250,8 +279,16 @@ if __name__ == '__main__':
     ##--------------------------------------------------------------------------------
     ## Call build routine
     ##--------------------------------------------------------------------------------
-    build_heatmap_files(mrcnn_model, dataset, iterations= iterations, 
-                        start_from = start_from, dest_path = dest_path)
+    ## Images already in the store are replaced, as the hm_*.npz files are rewritten. The store
+    ## writer only writes the last shard and the index if build_heatmap_files() completes
+    if args.store:
+        with HeatmapStoreWriter(dest_path, shard_size = args.shard_size, append = args.append, 
+                                duplicates = 'replace') as heatmap_store:
+            build_heatmap_files(mrcnn_model, dataset, iterations= iterations, 
+                                start_from = start_from, dest_path = dest_path, heatmap_store = heatmap_store)
+    else:
+        build_heatmap_files(mrcnn_model, dataset, iterations= iterations, 
+                            start_from = start_from, dest_path = dest_path)
 
     end_time = datetime.now().strftime("%m-%d-%Y @ %H:%M:%S")
     
@@ -23,13 +23,18 @@ import os
 import time
 import math
 import pprint 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import seaborn as sns
+from   mrcnn.lazy_modules import LazyModule
+
+## plotting / table packages are imported on first use, see lazy_modules
+def set_plot_style():
+    sns.set_style('white')
+    sns.set_context('poster')
+
+plt = LazyModule('matplotlib.pyplot', on_load = set_plot_style)
+pd  = LazyModule('pandas')
+sns = LazyModule('seaborn')
 
-sns.set_style('white')
-sns.set_context('poster')
 pp = pprint.PrettyPrinter(indent=2, width=100)
 COLORS = [
     '#1f77b4', '#aec7e8', '#ff7f0e', '#ffbb78', '#2ca02c',
@@ -201,9 +206,12 @@ def get_model_scores_map(pred_boxes, score_key):
     return model_scores_map
 
     
-def get_avg_precision_at_iou(gt_boxes, pr_boxes, iou_thr=0.5, score_key = 'scores'):
+def get_avg_precision_at_iou_orig(gt_boxes, pr_boxes, iou_thr=0.5, score_key = 'scores'):
     """Calculates average precision at given IoU threshold.
 
+    Original implementation, recomputing the image results for every score threshold.
+    Kept as the reference for get_avg_precision_at_iou().
+
     Args:
         gt_boxes (list of list of floats): list of locations of ground truth
             objects as [xmin, ymin, xmax, ymax]
@@ -320,6 +328,220 @@ def get_avg_precision_at_iou(gt_boxes, pr_boxes, iou_thr=0.5, score_key = 'score
         'prec_at_rec'   : prec_at_rec }
 
 
+def calc_iou_matrix(pred_boxes, gt_boxes):
+    """Vectorized calc_iou_individual: IoU of every predicted box with every ground truth box
+
+    Args:
+        pred_boxes (array or list of lists): [n_pred, (y1, x1, y2, x2)]
+        gt_boxes (array or list of lists)  : [n_gt, (y1, x1, y2, x2)]
+
+    Returns:
+        np.array: [n_pred, n_gt] IoU values, identical to calling calc_iou_individual()
+            on each pair of boxes
+
+    Raises:
+        AssertionError: if a box is obviously malformed
+    """
+    pred_boxes = np.asarray(pred_boxes).reshape(-1, 4)
+    gt_boxes   = np.asarray(gt_boxes).reshape(-1, 4)
+    if pred_boxes.shape[0] == 0 or gt_boxes.shape[0] == 0:
+        return np.zeros((pred_boxes.shape[0], gt_boxes.shape[0]))
+
+    y1_p, x1_p, y2_p, x2_p = [pred_boxes[:, i:i+1] for i in range(4)]
+    y1_t, x1_t, y2_t, x2_t = [gt_boxes[:, i] for i in range(4)]
+    
+    if np.any((x1_p > x2_p) | (y1_p > y2_p)):
+        raise AssertionError("Prediction box is malformed? pred boxes: {}".format(pred_boxes))
+    if np.any((x1_t > x2_t) | (y1_t > y2_t)):
+        raise AssertionError("Ground Truth box is malformed? true boxes: {}".format(gt_boxes))
+
+    disjoint = (x2_t < x1_p) | (x2_p < x1_t) | (y2_t < y1_p) | (y2_p < y1_t)
+    
+    inter_area    = (np.minimum(x2_t, x2_p) - np.maximum(x1_t, x1_p) + 1) * \
+                    (np.minimum(y2_t, y2_p) - np.maximum(y1_t, y1_p) + 1)
+    true_box_area = (x2_t - x1_t + 1) * (y2_t - y1_t + 1)
+    pred_box_area = (x2_p - x1_p + 1) * (y2_p - y1_p + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = inter_area / (true_box_area + pred_box_area - inter_area)
+    iou[disjoint] = 0.0
+    return iou
+
+
+def get_single_image_tp_counts(iou_matrix, iou_thr):
+    """Number of true positives of a single image, for every number of kept predictions.
+
+    Predictions (rows of iou_matrix) are in ascending score order. For k = 0..n_pred
+    the k highest scoring predictions (the last k rows) are kept, and matched to the 
+    ground truth boxes exactly as get_single_image_results() does: candidate pairs 
+    with IoU > iou_thr are visited in descending IoU order and matched greedily.
+
+    Args:
+        iou_matrix (np.array): [n_pred, n_gt] IoU matrix, rows in ascending score order
+        iou_thr (float): value of IoU to consider as threshold for a true prediction.
+
+    Returns:
+        np.array: [n_pred + 1] true positive count when keeping the top k predictions 
+    """
+    n_pred, n_gt = iou_matrix.shape
+    tp_counts    = np.zeros([n_pred + 1], dtype=np.int64)
+    if n_pred == 0 or n_gt == 0:
+        return tp_counts
+
+    candidates = iou_matrix > iou_thr
+    for k in range(1, n_pred + 1):
+        start = n_pred - k
+        # a prediction without candidate pairs leaves the matching unchanged
+        if not candidates[start].any():
+            tp_counts[k] = tp_counts[k-1]
+            continue
+        # pairs in the same (row-major) order get_single_image_results() builds them 
+        pred_idx, gt_idx = np.nonzero(candidates[start:])
+        args_desc = np.argsort(iou_matrix[start:][pred_idx, gt_idx])[::-1]
+        
+        gt_matched   = np.zeros([n_gt], dtype=bool)
+        pred_matched = np.zeros([k], dtype=bool)
+        for idx in args_desc:
+            gt, pr = gt_idx[idx], pred_idx[idx]
+            if not gt_matched[gt] and not pred_matched[pr]:
+                gt_matched[gt]   = True
+                pred_matched[pr] = True
+        tp_counts[k] = gt_matched.sum()
+    return tp_counts
+
+    
+def build_iou_matrices(gt_boxes, pr_boxes):
+    """IoU matrix of each image, to be shared between AP computations.
+
+    Returns:
+        dict: calc_iou_matrix(pr_boxes[img_id]['boxes'], gt_boxes[img_id]['boxes']) 
+            for each img_id in gt_boxes, rows in the original prediction order
+    """
+    return {img_id: calc_iou_matrix(pr_boxes[img_id]['boxes'], gt_boxes[img_id]['boxes'])
+            for img_id in gt_boxes.keys() if img_id in pr_boxes}
+
+    
+def get_avg_precision_at_iou(gt_boxes, pr_boxes, iou_thr=0.5, score_key = 'scores', iou_matrices = None):
+    """Calculates average precision at given IoU threshold.
+
+    Sort-once version of get_avg_precision_at_iou_orig(), returning identical results.
+    See get_avg_precision_at_ious().
+
+    Args:
+        gt_boxes (dict): dict of dicts of 'boxes' - locations of ground truth
+            objects as [ymin, xmin, ymax, xmax]
+        pr_boxes (dict): dict of dicts of 'boxes' and score_key - locations of 
+            predicted objects as [ymin, xmin, ymax, xmax], and their scores
+        iou_thr (float): value of IoU to consider as threshold for a
+            true prediction.
+        score_key (str): key of the prediction scores in pr_boxes
+        iou_matrices (dict): optional, precomputed build_iou_matrices(gt_boxes, pr_boxes)
+
+    Returns:
+        dict: avg precision as well as summary info about the PR curve
+
+        Keys:
+            'avg_prec' (float): average precision for this IoU threshold
+            'precisions' (list of floats): precision value for the given
+                model_threshold
+            'recall' (list of floats): recall value for given
+                model_threshold
+            'models_thrs' (list of floats): model threshold value that
+                precision and recall were computed for.
+    """
+    return get_avg_precision_at_ious(gt_boxes, pr_boxes, [iou_thr], [score_key], iou_matrices)[score_key][iou_thr]
+
+    
+def get_avg_precision_at_ious(gt_boxes, pr_boxes, iou_thresholds, score_keys, iou_matrices = None):
+    """Calculates average precision for several IoU thresholds and score keys at once.
+
+    The IoU matrix of each image is computed once (or taken from iou_matrices) and 
+    shared by all score keys and IoU thresholds. For each score key and IoU threshold, 
+    the true positive count of each image is found for every number of kept (highest
+    scoring) predictions. All detections are then sorted globally by score, and the 
+    precision / recall at every score threshold are derived from cumulative sums, 
+    for all IoU thresholds together.
+    
+    The results are identical to calling get_avg_precision_at_iou_orig() for each 
+    (score_key, iou_thr) pair.
+
+    Args:
+        gt_boxes (dict): dict of dicts of 'boxes' 
+        pr_boxes (dict): dict of dicts of 'boxes' and the score keys
+        iou_thresholds (list of floats): IoU thresholds 
+        score_keys (list of str): keys of the prediction scores in pr_boxes
+        iou_matrices (dict): optional, precomputed build_iou_matrices(gt_boxes, pr_boxes)
+
+    Returns:
+        dict: results[score_key][iou_thr] is the dict returned by get_avg_precision_at_iou()
+    """
+    if iou_matrices is None:
+        iou_matrices = build_iou_matrices(gt_boxes, pr_boxes)
+    
+    total_gt = sum([len(gt_boxes[img_id]['boxes']) for img_id in gt_boxes.keys()])
+    img_ids  = [img_id for img_id in gt_boxes.keys() if img_id in pr_boxes]
+    results  = {}
+    
+    for score_key in score_keys:
+        all_scores = [score for val in pr_boxes.values() for score in val[score_key]]
+        model_thrs = sorted(set(all_scores))[:-1]
+        
+        det_scores = []
+        det_tp     = []
+        for img_id in img_ids:
+            scores = pr_boxes[img_id][score_key]
+            if len(scores) == 0:
+                continue
+            arg_sort   = np.argsort(scores)   
+            iou_matrix = iou_matrices[img_id][arg_sort]
+            
+            ## true positives gained by each detection, in descending score order
+            det_scores.append(np.asarray(scores, dtype=np.float64)[arg_sort][::-1])
+            det_tp.append(np.stack([np.diff(get_single_image_tp_counts(iou_matrix, iou_thr)) 
+                                    for iou_thr in iou_thresholds]))
+
+        if det_scores:
+            det_scores = np.concatenate(det_scores)
+            det_tp     = np.concatenate(det_tp, axis = 1)
+        else:
+            det_scores = np.zeros([0])
+            det_tp     = np.zeros([len(iou_thresholds), 0], dtype=np.int64)
+
+        ## Sort all detections by score (highest first) and accumulate: [iou_thresholds, detections + 1]
+        order      = np.argsort(-det_scores, kind='mergesort')
+        cum_tp     = np.concatenate([np.zeros([len(iou_thresholds), 1], dtype=np.int64), 
+                                     np.cumsum(det_tp[:, order], axis = 1)], axis = 1)
+        asc_scores = det_scores[order][::-1]
+        
+        ## detections kept at each score threshold are those with score > threshold
+        kept       = len(asc_scores) - np.searchsorted(asc_scores, np.array(model_thrs, dtype=np.float64), side='right')
+        true_pos   = cum_tp[:, kept]
+        
+        precisions = np.zeros(true_pos.shape)
+        recalls    = np.zeros(true_pos.shape)
+        np.divide(true_pos, kept, out = precisions, where = kept > 0)
+        if total_gt > 0:
+            recalls = true_pos / total_gt
+        
+        results[score_key] = {}
+        for i, iou_thr in enumerate(iou_thresholds):
+            prec_at_rec = []
+            for recall_level in np.linspace(0.0, 1.0, 11):
+                try:
+                    args = np.argwhere(recalls[i] >= recall_level).flatten()
+                    prec = max(precisions[i][args])
+                except ValueError:
+                    prec = 0.0
+                prec_at_rec.append(prec)
+
+            results[score_key][iou_thr] = {
+                'avg_prec'      : np.mean(prec_at_rec),
+                'precisions'    : precisions[i],
+                'recalls'       : recalls[i],
+                'model_thrs'    : list(model_thrs),
+                'prec_at_rec'   : prec_at_rec }
+    return results
+
+    
 def plot_pr_curve(
     precisions, recalls, category='Not Supplied', label=None, color=None, ax=None):
     """Simple plotting helper function"""
@@ -539,19 +761,16 @@ def build_mAP_data_structure_by_class(gt_boxes_class, pr_boxes_class, class_ids,
 #     class_ids = [1,2,3,4,5,6]
 #     scores    = ['scores', 'mrcnn_score_orig', 'mrcnn_score_norm']
     
+    iou_thresholds = [np.round(thr, 2) for thr in iou_thresholds]
+    
     for class_id in class_ids:
-        # mAP_data[class_id] = {}
-        class_by_score_data = {}
         print(  'class_id: {:3d}  '.format(class_id))
+        ## IoUs are computed once per image and shared by all score keys and IoU thresholds
+        class_by_score_data = get_avg_precision_at_ious(gt_boxes_class[class_id], pr_boxes_class[class_id], 
+                                                        iou_thresholds, scores)
         for score_key in scores:
-            mAP_by_iou_thr_data = {}
-            for idx, thr in enumerate(iou_thresholds):
-                iou_thr = np.round(thr, 2)
-                # print(  'class_id: {:3d}   idx {:2d}   iou_thr: {:.2f}  score_key: {:20s}'.format(class_id, idx, iou_thr, score_key))
-                outp = get_avg_precision_at_iou(gt_boxes_class[class_id], pr_boxes_class[class_id], iou_thr=iou_thr, score_key = score_key)
-                outp['iou'] = iou_thr
-                mAP_by_iou_thr_data[iou_thr] = outp
-            class_by_score_data[score_key] = mAP_by_iou_thr_data
+            for iou_thr in iou_thresholds:
+                class_by_score_data[score_key][iou_thr]['iou'] = iou_thr
 
         mAP_data[class_id] = class_by_score_data
     return mAP_data
@@ -597,16 +816,13 @@ def build_mAP_data_structure_combined(gt_boxes, pr_boxes, scores, iou_thresholds
     if iou_thresholds is None :
         iou_thresholds = np.arange(0.20, 0.95, 0.05)
 
+    iou_thresholds = [np.round(thr, 2) for thr in iou_thresholds]
+    
+    ## IoUs are computed once per image and shared by all score keys and IoU thresholds
+    mAP_data = get_avg_precision_at_ious(gt_boxes, pr_boxes, iou_thresholds, scores)
     for score_key in scores:
-        mAP_by_iou_thr_data = {}
-        # print(  ' score_key: {:20s} '.format(score_key))
-        for idx, thr in enumerate(iou_thresholds):
-            iou_thr = np.round(thr, 2)
-            print(  ' score_key: {:20s}    iou_thr: {:.2f}  (idx {:2d})  '.format(score_key,iou_thr,idx))
-            outp = get_avg_precision_at_iou(gt_boxes, pr_boxes, iou_thr=iou_thr, score_key = score_key)
-            outp['iou'] = iou_thr
-            mAP_by_iou_thr_data[iou_thr] = outp
-        mAP_data[score_key] = mAP_by_iou_thr_data
+        for iou_thr in iou_thresholds:
+            mAP_data[score_key][iou_thr]['iou'] = iou_thr
 
 
     return mAP_data
@@ -0,0 +1,243 @@
+"""
+Mask R-CNN
+Checkpoint index of a training log directory
+
+ModelBase.find_last() used to list every run folder and sort the weight file names found
+in it. Each log directory now keeps a small JSON manifest of the weight files written
+into it, updated by IndexedModelCheckpoint as Keras saves them:
+
+    log_dir/checkpoints.json        {'version' : 1,
+                                     'monitor' : 'val_loss',  'mode' : 'min',
+                                     'latest'  : 'fcn_0042.h5',
+                                     'best'    : 'fcn_0040.h5',
+                                     'checkpoints': [{'epoch': 40, 'filename': 'fcn_0040.h5',
+                                                      'value': 0.1234, 'time': 1541001234.5}, ...]}
+
+File names are relative to the log directory, so a run folder can be moved or copied
+as a whole. Log directories written before the index existed have no manifest, and
+find_last() falls back to listing their files.
+
+Checkpoints of one training run often share most of their layer values (layers frozen
+during a training phase). ModelBase.load_weights_diff() hashes each layer as it reads it
+and only assigns the layers that differ from the weights currently in the model. The
+layer digests are kept in layer_digests.json of the file's directory, so a later load
+of the same file does not read the unchanged layers at all. weights_file_digest() is the
+digest of the whole file, from its path, size and modification time.
+
+Usage:
+    python -m mrcnn.checkpoint_index  /path/to/log_dir     (build or rebuild the manifest)
+"""
+import os, re, json, time, hashlib, argparse
+import numpy as np
+import keras
+
+INDEX_FILE    = 'checkpoints.json'
+INDEX_VERSION = 1
+DIGESTS_FILE  = 'layer_digests.json'
+EPOCH_REGEX   = re.compile(r'.*_(\d{4})\.h5$')
+
+
+class CheckpointIndex(object):
+    '''
+    Manifest of the checkpoint files in one log directory
+    '''
+
+    def __init__(self, log_dir, monitor = None, mode = 'min'):
+        self.log_dir     = log_dir
+        self.monitor     = monitor
+        self.mode        = mode
+        self.latest      = None
+        self.best        = None
+        self.checkpoints = []
+
+    @classmethod
+    def load(cls, log_dir):
+        '''
+        Returns the index of log_dir, or None if log_dir has no (readable) manifest
+        '''
+        try:
+            with open(os.path.join(log_dir, INDEX_FILE), 'r') as infile:
+                manifest = json.load(infile)
+        except (IOError, OSError, ValueError):
+            return None
+        if manifest.get('version') != INDEX_VERSION:
+            return None
+        index = cls(log_dir, manifest.get('monitor'), manifest.get('mode', 'min'))
+        index.latest      = manifest.get('latest')
+        index.best        = manifest.get('best')
+        index.checkpoints = manifest.get('checkpoints', [])
+        return index
+
+    @classmethod
+    def build(cls, log_dir, prefix = '', monitor = None, mode = 'min'):
+        '''
+        Builds the index of an existing log directory from its file names (no monitored values)
+        '''
+        index = cls(log_dir, monitor, mode)
+        for filename in sorted(os.listdir(log_dir)):
+            regex_match = EPOCH_REGEX.match(filename)
+            if regex_match and filename.startswith(prefix):
+                index.add(filename, int(regex_match.group(1)),
+                          timestamp = os.path.getmtime(os.path.join(log_dir, filename)), save = False)
+        index.save()
+        return index
+
+    def path(self, filename):
+        return None if filename is None else os.path.join(self.log_dir, filename)
+
+    def latest_path(self):
+        return self.path(self.latest)
+
+    def best_path(self):
+        return self.path(self.best if self.best is not None else self.latest)
+
+    def add(self, filename, epoch, value = None, timestamp = None, save = True):
+        '''
+        Record a checkpoint file written for epoch; value is the monitored quantity, if any
+        '''
+        filename = os.path.basename(filename)
+        entry = {'epoch'   : int(epoch),
+                 'filename': filename,
+                 'value'   : None if value is None else float(value),
+                 'time'    : time.time() if timestamp is None else timestamp}
+        self.checkpoints = [c for c in self.checkpoints if c['filename'] != filename] + [entry]
+        self.update(save)
+        return entry
+
+    def prune(self, save = True):
+        '''
+        Drop checkpoints whose files no longer exist; returns the number dropped
+        '''
+        count = len(self.checkpoints)
+        self.checkpoints = [c for c in self.checkpoints if os.path.isfile(self.path(c['filename']))]
+        if len(self.checkpoints) != count:
+            self.update(save)
+        return count - len(self.checkpoints)
+
+    def update(self, save = True):
+        '''
+        Recompute the latest and best checkpoints
+        '''
+        self.checkpoints.sort(key = lambda c: (c['epoch'], c['filename']))
+        self.latest = self.checkpoints[-1]['filename'] if self.checkpoints else None
+
+        scored = [c for c in self.checkpoints if c['value'] is not None]
+        select = min if self.mode == 'min' else max
+        self.best = select(scored, key = lambda c: c['value'])['filename'] if scored else None
+        if save:
+            self.save()
+
+    def save(self):
+        manifest = {'version'    : INDEX_VERSION,
+                    'monitor'    : self.monitor,
+                    'mode'       : self.mode,
+                    'latest'     : self.latest,
+                    'best'       : self.best,
+                    'checkpoints': self.checkpoints}
+        tmp_filename = os.path.join(self.log_dir, INDEX_FILE + '.tmp')
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(manifest, outfile, indent = 1)
+        os.replace(tmp_filename, os.path.join(self.log_dir, INDEX_FILE))
+
+    def display(self):
+        print(' Checkpoint index: {}  monitor: {} ({})  checkpoints: {}'.format(
+               self.log_dir, self.monitor, self.mode, len(self.checkpoints)))
+        print('    latest: {}   best: {}'.format(self.latest, self.best))
+
+
+##------------------------------------------------------------------------------------
+## Keras callback
+##------------------------------------------------------------------------------------
+class IndexedModelCheckpoint(keras.callbacks.ModelCheckpoint):
+    '''
+    keras ModelCheckpoint that also records each weight file it writes in the checkpoint
+    index of the file's directory. Arguments are those of ModelCheckpoint.
+    '''
+
+    def on_epoch_end(self, epoch, logs = None):
+        logs     = logs or {}
+        filepath = self.filepath.format(epoch = epoch + 1, **logs)
+        before   = os.stat(filepath).st_mtime_ns if os.path.exists(filepath) else None
+
+        super(IndexedModelCheckpoint, self).on_epoch_end(epoch, logs)
+
+        if not os.path.exists(filepath) or os.stat(filepath).st_mtime_ns == before:
+            return
+        log_dir = os.path.dirname(filepath)
+        index   = CheckpointIndex.load(log_dir)
+        if index is None:
+            index = CheckpointIndex.build(log_dir)
+        index.monitor = self.monitor
+        index.mode    = 'min' if self.monitor_op == np.less else 'max'
+        index.add(filepath, epoch + 1, logs.get(self.monitor))
+
+
+##------------------------------------------------------------------------------------
+## Per layer content digests of weight files
+##------------------------------------------------------------------------------------
+def _digests_cache(filepath):
+    '''
+    DIGESTS_FILE of the directory of filepath, file name and key (size, modification time) of filepath
+    '''
+    log_dir, filename = os.path.split(os.path.abspath(filepath))
+    stat = os.stat(filepath)
+    return os.path.join(log_dir, DIGESTS_FILE), filename, [stat.st_size, stat.st_mtime]
+
+
+def load_layer_digests(filepath):
+    '''
+    Layer digests (utils.layer_digest()) of weight file filepath kept in DIGESTS_FILE of
+    its directory, or {} if none are kept or the file changed since (size, modification
+    time). May hold only the layers a model read from the file.
+    '''
+    cache_filename, filename, key = _digests_cache(filepath)
+    try:
+        with open(cache_filename, 'r') as infile:
+            entry = json.load(infile).get(filename)
+    except (IOError, OSError, ValueError):
+        entry = None
+    if entry is not None and entry['key'] == key:
+        return entry['digests']
+    return {}
+
+
+def save_layer_digests(filepath, digests):
+    '''
+    Keep the layer digests of weight file filepath in DIGESTS_FILE of its directory
+    '''
+    cache_filename, filename, key = _digests_cache(filepath)
+    ## the cache is shared by sweep worker processes: re-read before writing, and
+    ## write to a private temp file. A lost entry is recomputed on next use.
+    try:
+        with open(cache_filename, 'r') as infile:
+            cache = json.load(infile)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    cache[filename] = {'key': key, 'digests': digests}
+    try:
+        tmp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(cache, outfile)
+        os.replace(tmp_filename, cache_filename)
+    except (IOError, OSError):
+        pass
+
+
+def weights_file_digest(filepath):
+    '''
+    Digest of a weight file from its path, size and modification time, without reading it.
+    The one definition of the file digest chained into ModelBase.weights_digest by
+    load_weights() and load_weights_diff(), so both loaders give the same digest for the
+    same file.
+    '''
+    stat = os.stat(filepath)
+    return hashlib.sha1('{}|{}|{}'.format(os.path.abspath(filepath), stat.st_size, stat.st_mtime).encode('utf-8')).hexdigest()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the checkpoint index of a training log directory')
+    parser.add_argument('log_dir', help='log directory holding xxxx_nnnn.h5 weight files')
+    parser.add_argument('--prefix', default='', help='only index files starting with prefix (e.g. fcn)')
+    args = parser.parse_args()
+
+    CheckpointIndex.build(args.log_dir, prefix = args.prefix).display()
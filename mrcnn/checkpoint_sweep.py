@@ -0,0 +1,310 @@
+"""
+Mask R-CNN
+Checkpoint sweep evaluation of FCN weight files
+
+The MRCNN detections (evaluate mode) do not depend on the FCN weights, so they are
+computed once per image and kept in a DetectionCache. Each FCN checkpoint is then evaluated
+against the cached detections, batching images through FCN.detect(). Checkpoints can
+be fanned out over worker processes, each holding its own FCN model.
+
+    cache_mrcnn_evaluations()   Run MRCNN evaluate over a list of images, cache results
+    evaluate_fcn_checkpoint()   Run FCN detection + per image AP calcs for one weight file
+    run_checkpoint_sweep()      Evaluate a list of weight files, saving All_APResults
+                                after each completed checkpoint
+"""
+import os, time, copy, pickle, multiprocessing
+import numpy as np
+
+import mrcnn.utils as utils
+from   mrcnn.calculate_map import update_map_dictionaries
+from   mrcnn.detection_cache import DetectionCache
+
+##------------------------------------------------------------------------------------
+## Score columns used in the per-image AP calculations (see update_map_dictionaries)
+##------------------------------------------------------------------------------------
+orig_score = 5
+norm_score = 8
+alt_scr_0  = 11
+alt_scr_1  = 14   # in MRCNN alt_scr_1 ans alt_scr_2 are the same
+alt_scr_2  = 20
+
+AP_RESULT_KEYS = ['MRCNN_AP_Orig', 'MRCNN_AP_0', 'FCN_AP_0', 'MRCNN_AP_1', 'FCN_AP_1', 'MRCNN_AP_2', 'FCN_AP_2']
+
+
+##------------------------------------------------------------------------------------
+## MRCNN detection cache
+##------------------------------------------------------------------------------------
+def cache_mrcnn_evaluations(mrcnn_model, dataset, image_ids, detection_cache, verbose = 0):
+    '''
+    Make sure the MRCNN (evaluate mode) results of image_ids are in detection_cache.
+    Images are processed config.BATCH_SIZE at a time, a batch that fails in MRCNN is
+    reported and its images are dropped from the evaluation.
+
+    Returns:
+    --------
+    List of image ids with cached results
+    '''
+    batch_size = mrcnn_model.config.BATCH_SIZE
+    todo_ids   = [i for i in image_ids if not detection_cache.contains(detection_cache.image_id_key(dataset, i))]
+    print(' MRCNN cache: {} images requested, {} already cached, {} to run'.format(
+            len(image_ids), len(image_ids) - len(todo_ids), len(todo_ids)))
+
+    failed_ids = set()
+    start_time = time.time()
+
+    for start in range(0, len(todo_ids), batch_size):
+        batch_ids = list(todo_ids[start : start + batch_size])
+        if verbose and start % 25 == 0:
+            print('==> MRCNN evaluate for image_ids : ', batch_ids)
+        try:
+            detection_cache.evaluate(mrcnn_model, dataset, batch_ids)
+        except Exception as e :
+            print('\n failure on mrcnn predict image ids: {} '.format(batch_ids))
+            print('\n Exception information:')
+            print(str(e))
+            failed_ids.update(batch_ids)
+
+    print(' MRCNN cache complete - {} images in {:.2f} secs, {} failures'.format(
+            len(todo_ids), time.time() - start_time, len(failed_ids)))
+    return [i for i in image_ids if i not in failed_ids]
+
+
+##------------------------------------------------------------------------------------
+## Per checkpoint evaluation
+##------------------------------------------------------------------------------------
+def build_class_dict(class_ids, class_names):
+    class_dict = []
+    for a,b in zip(class_ids, class_names):
+        class_dict.append({'id'   : int(a),
+                           'name' : b,
+                           'scores': [],
+                           'bboxes': [],
+                           'mrcnn_score_orig' : [],
+                           'mrcnn_score_norm' : [],
+                           'mrcnn_score_0' : [],
+                           'mrcnn_score_1' : [],
+                           'mrcnn_score_2' : [],
+                           'fcn_score_0' : [],
+                           'fcn_score_1' : [],
+                           'fcn_score_2' : [],
+                          })
+    return class_dict
+
+
+def compute_image_aps(r):
+    '''
+    VOC-Style AP @ IoU=0.5 for one image, for each of the AP_RESULT_KEYS score variants
+    '''
+    args = (r['gt_bboxes'], r['gt_class_ids'], r["molded_rois"], r["class_ids"])
+    scores = {'MRCNN_AP_Orig' : r["pr_scores"][:,orig_score],
+              'MRCNN_AP_0'    : r["pr_scores"][:,alt_scr_0],
+              'FCN_AP_0'      : r["fcn_scores"][:,alt_scr_0],
+              'MRCNN_AP_1'    : r["pr_scores"][:,alt_scr_1],
+              'FCN_AP_1'      : r["fcn_scores"][:,alt_scr_1],
+              'MRCNN_AP_2'    : r["pr_scores"][:,alt_scr_2],
+              'FCN_AP_2'      : r["fcn_scores"][:,alt_scr_2]}
+
+    return {key: utils.compute_ap(*args, scores[key])[0] for key in AP_RESULT_KEYS}
+
+
+def evaluate_fcn_checkpoint(fcn_model, weights_file, detection_cache, cache_keys, class_dict, verbose = 0):
+    '''
+    Load weights_file into fcn_model (differential load, see ModelBase.load_weights_diff)
+    and run FCN detection on the MRCNN results stored
+    under cache_keys in detection_cache, fcn_model.config.BATCH_SIZE images per FCN.detect() call. The FCN graph
+    is built for a fixed batch size, so the last batch is padded with its last image
+    and the padded results are dropped.
+
+    Returns:
+    --------
+    APResult                    dict with Filename, Epochs and the per-image AP lists
+    class_dict, gt_dict, pr_dict  as built by calculate_map.update_map_dictionaries
+    '''
+    ## only layers that changed since the previously evaluated checkpoint are transferred
+    fcn_model.load_model_weights(weights_file, differential = True, verbose = verbose)
+
+    batch_size = fcn_model.config.BATCH_SIZE
+    epochs   = os.path.basename(weights_file).split('_')[1].replace('.h5','')
+    gt_dict  = {}
+    pr_dict  = {}
+    APResult = {key: [] for key in AP_RESULT_KEYS}
+    start_time = time.time()
+
+    for start in range(0, len(cache_keys), batch_size):
+        results = [detection_cache.load(key) for key in cache_keys[start : start + batch_size]]
+        padded  = results + [results[-1]] * (batch_size - len(results))
+
+        fcn_input_hm          = fcn_model.stack_pr_heatmaps(padded)
+        fcn_input_hm_scores   = np.stack([r['pr_hm_scores'] for r in padded] )
+        fcn_input_image_metas = np.stack([r['image_meta'] for r in padded] )
+        fcn_results = fcn_model.detect([fcn_input_hm, fcn_input_hm_scores, fcn_input_image_metas], verbose = 0)
+
+        for r, fcn_r in zip(results, fcn_results):
+            r.update(fcn_r)
+            gt_dict, pr_dict, class_dict = update_map_dictionaries([r], gt_dict, pr_dict, class_dict)
+            for key, AP in compute_image_aps(r).items():
+                APResult[key].append(AP)
+
+        if verbose:
+            print('==> Epoch {} - AP calculated for {} images'.format(epochs, start + len(results)))
+
+    print('AP Calcs complete for epoch:', epochs , ' Weight file:', weights_file,
+          ' Images: ', len(cache_keys), ' Time: {:.2f} secs'.format(time.time() - start_time))
+    APResult['Filename'] = weights_file
+    APResult['Epochs']   = epochs
+
+    return APResult, class_dict, gt_dict, pr_dict
+
+
+##------------------------------------------------------------------------------------
+## Worker process routines
+##------------------------------------------------------------------------------------
+_worker_state = {}
+
+def _sweep_worker_init(fcn_config, arch, detection_cache, cache_keys, class_dict, batch_size):
+    '''
+    Builds a private FCN model (inference mode) in each worker process, with the
+    graph built for batches of batch_size images
+    '''
+    import tensorflow as tf
+    import keras.backend as KB
+    import mrcnn.model_fcn as fcn_modellib
+
+    ## let several worker processes share the same GPU
+    session_config = tf.ConfigProto()
+    session_config.gpu_options.allow_growth = True
+    KB.set_session(tf.Session(config = session_config))
+    KB.set_learning_phase(0)
+
+    fcn_config = copy.copy(fcn_config)
+    fcn_config.BATCH_SIZE     = batch_size
+    fcn_config.IMAGES_PER_GPU = batch_size
+
+    _worker_state['fcn_model']  = fcn_modellib.FCN(mode = 'inference', arch = arch, config = fcn_config)
+    _worker_state['detection_cache'] = detection_cache
+    _worker_state['cache_keys'] = cache_keys
+    _worker_state['class_dict'] = class_dict
+
+
+def _sweep_worker_run(weights_file):
+    return evaluate_fcn_checkpoint(_worker_state['fcn_model'], weights_file,
+                                   _worker_state['detection_cache'],
+                                   _worker_state['cache_keys'],
+                                   copy.deepcopy(_worker_state['class_dict']))
+
+
+##------------------------------------------------------------------------------------
+## Save / display routines
+##------------------------------------------------------------------------------------
+def save_pickle(obj, filename):
+    '''
+    Write obj to a temp file and rename it over filename, so an interrupted run never
+    leaves a truncated results file behind.
+    '''
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as outfile:
+        pickle.dump(obj, outfile)
+    os.replace(tmp_filename, filename)
+
+
+def save_checkpoint_results(save_path, file_prefix, image_count, APResult, class_dict, gt_dict, pr_dict):
+    epochs = APResult['Epochs']
+    cls_info_file = file_prefix+'_cls_info_epoch'+epochs+'_'+str(image_count)
+    pr_boxes_file = file_prefix+'_pr_bboxes_epoch'+epochs+'_'+str(image_count)
+    gt_boxes_file = file_prefix+'_gt_bboxes_epoch'+epochs+'_'+str(image_count)
+    print(' ***  Save to :', cls_info_file,' -- ', pr_boxes_file,' -- ', gt_boxes_file)
+
+    save_pickle(class_dict, os.path.join(save_path, cls_info_file+'.pkl'))
+    save_pickle(gt_dict   , os.path.join(save_path, gt_boxes_file+'.pkl'))
+    save_pickle(pr_dict   , os.path.join(save_path, pr_boxes_file+'.pkl'))
+
+
+def display_checkpoint_results(APResult, limits = (10,50,100,250,500)):
+    np_format = {}
+    np_format['float'] = lambda x: "%10.4f" % x
+    np_format['int']   = lambda x: "%10d" % x
+    np.set_printoptions(linewidth=195, precision=4, floatmode='fixed', threshold =10000, formatter = np_format)
+
+    epochs = APResult['Epochs']
+    print()
+    print('After {} training epochs.\nWeight file: {}'.format(epochs, APResult['Filename']))
+    print()
+    print("{:6s} {:^10s} {:>13s} {:>13s} {:>13s} {:>13s} {:>13s} {:>13s} {:>13s}".format("Images", "Epochs", *AP_RESULT_KEYS))
+    print('-'*116)
+    for LIMIT in limits:
+        print("{:<6d} {:^10s} {:13.5f} {:13.5f} {:13.5f} {:13.5f} {:13.5f} {:13.5f} {:13.5f}".format(LIMIT, epochs,
+                *[np.mean(APResult[key][:LIMIT]) for key in AP_RESULT_KEYS]))
+
+
+##------------------------------------------------------------------------------------
+## Checkpoint sweep driver
+##------------------------------------------------------------------------------------
+def run_checkpoint_sweep(fcn_model, mrcnn_model, dataset, image_ids, weights_files,
+                         save_path, results_file, file_prefix = 'eval', cache_dir = None,
+                         All_APResults = None, workers = 0, batch_size = 16, verbose = 0):
+    '''
+    Evaluate a list of FCN weight files against the same set of images.
+
+    MRCNN detections are computed once into a DetectionCache in cache_dir (default
+    save_path/mrcnn_cache) and reused for every checkpoint, and by later sweeps with the
+    same MRCNN weights and configuration. With workers > 0 checkpoints are evaluated in parallel, each worker
+    process building its own FCN model for batches of batch_size images; otherwise 
+    fcn_model is used in-process with its configured BATCH_SIZE.
+
+    All_APResults is saved to save_path/results_file.pkl as each checkpoint completes
+    (in completion order), checkpoints already present in All_APResults are skipped.
+
+    Returns:
+    --------
+    All_APResults               {weights_file : APResult}
+    '''
+    if All_APResults is None:
+        All_APResults = {}
+    if cache_dir is None:
+        cache_dir = os.path.join(save_path, 'mrcnn_cache')
+
+    todo_files = []
+    for weights_file in weights_files:
+        if weights_file in All_APResults:
+            print(' weights file ', weights_file, ' already evaluated, skipping...')
+        elif not os.path.isfile(weights_file):
+            print(' weights file ', weights_file, ' not found, going to next one...')
+        else:
+            todo_files.append(weights_file)
+    if not todo_files:
+        return All_APResults
+
+    detection_cache = DetectionCache(cache_dir, mrcnn_model)
+    image_ids  = cache_mrcnn_evaluations(mrcnn_model, dataset, image_ids, detection_cache, verbose = verbose)
+    cache_keys = [detection_cache.image_id_key(dataset, image_id) for image_id in image_ids]
+    class_dict = build_class_dict(dataset.class_ids, dataset.class_names)
+    results_filename = os.path.join(save_path, results_file+'.pkl')
+
+    def save_result(result):
+        APResult, cls_dict, gt_dict, pr_dict = result
+        All_APResults[APResult['Filename']] = APResult
+        save_pickle(All_APResults, results_filename)
+        print(' ***  Saved AP_results for epoch:',  APResult['Epochs'], ' Weight file:', APResult['Filename'])
+        print('      to ----> ', save_path,'    Filename: ', results_file)
+        save_checkpoint_results(save_path, file_prefix, len(image_ids), APResult, cls_dict, gt_dict, pr_dict)
+        display_checkpoint_results(APResult)
+
+    if workers <= 0:
+        for weights_file in todo_files:
+            save_result(evaluate_fcn_checkpoint(fcn_model, weights_file, detection_cache, cache_keys,
+                                                copy.deepcopy(class_dict), verbose = verbose))
+    else:
+        ## TF sessions do not survive a fork - start workers with a clean interpreter
+        ctx  = multiprocessing.get_context('spawn')
+        pool = ctx.Pool(min(workers, len(todo_files)),
+                        initializer = _sweep_worker_init,
+                        initargs    = (fcn_model.config, fcn_model.arch, detection_cache, cache_keys, class_dict, batch_size))
+        try:
+            for result in pool.imap_unordered(_sweep_worker_run, todo_files):
+                save_result(result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    return All_APResults
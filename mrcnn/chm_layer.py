@@ -18,6 +18,8 @@ import tensorflow.contrib.util as tfc
 
 from mrcnn.utils   import logt
 import mrcnn.utils as utils
+import mrcnn.heatmap_kernels as hmk
+import mrcnn.stage_timer as stage_timer
 
 
 def normalize_scores(x, low = 0.0, high = 1.0, verbose = 0):
@@ -175,7 +177,8 @@ def clip_heatmap(input_list):
 
     
 ##-----------------------------------------------------------------------------------------------------------
-##  build_pr_heatmap : Build gaussian heatmaps using pred_tensor
+##  build_pr_heatmap_orig : Build gaussian heatmaps using pred_tensor
+##      tf.map_fn version - replaced by build_pr_heatmap (below), kept for reference and benchmarks
 ##-----------------------------------------------------------------------------------------------------------  
 ##  v3: In this version we replace the score generation routine from build_hm_score_v2 which operated over 
 ##      The complete bounding box area, to build_hm_score_v3, which calculates the score in a method similar to what 
@@ -205,7 +208,7 @@ def clip_heatmap(input_list):
 ##                  - area of bounding box in pixes
 ##                  - (sum of heatmap in masked area) * (bbox per-class normalized score from in_tensor)
 ##------------------------------------------------------------------------------------------------------------
-def build_pr_heatmap(in_tensor, config, names = None):
+def build_pr_heatmap_orig(in_tensor, config, names = None):
     '''
     input:
     -------
@@ -480,6 +483,86 @@ def build_pr_heatmap(in_tensor, config, names = None):
     return   gauss_heatmap_sum, gauss_scores  
     
     
+##-----------------------------------------------------------------------------------------------------------
+##  build_pr_heatmap : Build gaussian heatmaps using pred_tensor - vectorized
+##-----------------------------------------------------------------------------------------------------------  
+##  Same outputs as build_pr_heatmap_orig, without the per-box tf.map_fn passes and the
+##  [batch, classes, rois, h, w] scatter (see mrcnn/heatmap_kernels.py):
+##   - Gaussians are built as outer products of per-axis densities
+##   - box-masked scores are read from summed area tables
+##   - per-class heatmaps are accumulated with unsorted_segment_sum
+##------------------------------------------------------------------------------------------------------------
+def build_pr_heatmap(in_tensor, config, names = None):
+    '''
+    input:
+    -------
+    pred_tensor:        [ Bsz, Num_Classes, Num_Rois, 8: 
+                            {y1, x1, y2, x2, class_id, score, sequence_id, score normalized per class}]
+                        
+    output:
+    -------
+        pr_heatmap      (None,  Heatmap-height, Heatmap_width, num_classes)
+        pr_scores       (None, num_classes, 200, 23) 
+                        (same columns as build_pr_heatmap_orig)
+    '''
+    verbose         = config.VERBOSE
+    batch_size      = config.BATCH_SIZE
+    num_classes     = config.NUM_CLASSES  
+    heatmap_scale   = config.HEATMAP_SCALE_FACTOR
+    grid_h, grid_w  = config.IMAGE_SHAPE[:2] // heatmap_scale    
+    rois_per_image  = (in_tensor.shape)[2]  
+    scores_shape    = [batch_size, num_classes, rois_per_image, 3]
+
+    if verbose:
+        print('\n ')
+        print('  > build_pr_heatmap() for : ', names )
+        print('    in_tensor shape        : ', in_tensor.shape)       
+        print('    num bboxes per class   : ', rois_per_image )
+        print('    heatmap scale          : ', heatmap_scale, 'Dimensions:  w:', grid_w,' h:', grid_h)
+
+    ##-----------------------------------------------------------------------------    
+    ## Stack non_zero bboxes from in_tensor into pt2_dense 
+    ##-----------------------------------------------------------------------------
+    pt2_sum = tf.reduce_sum(tf.abs(in_tensor[:,:,:,:4]), axis=-1)
+    pt2_ind = tf.where(pt2_sum > 0)
+    pt2_dense = tf.gather_nd( in_tensor, pt2_ind)
+    logt('pt2_ind   ', pt2_ind, verbose = verbose)
+    logt('pt2_dense ', pt2_dense, verbose = verbose)
+
+    ##-----------------------------------------------------------------------------    
+    ## Per-class heatmaps (normalized) and dense scores 
+    ##-----------------------------------------------------------------------------
+    bboxes_scaled = pt2_dense[:,:4]/heatmap_scale
+    gauss_heatmap_sum, old_style_scores, alt_scores_1, alt_scores_2 = \
+        hmk.build_gaussian_heatmaps(bboxes_scaled, pt2_dense[:,7], pt2_ind, batch_size, num_classes, grid_h, grid_w)
+    logt('gauss_heatmap_sum ', gauss_heatmap_sum, verbose = verbose)
+
+    ##-----------------------------------------------------------------------------    
+    ## Scatter scores back to per-class tensors, normalize alt scores by class
+    ##-----------------------------------------------------------------------------
+    old_style_scores  = tf.scatter_nd(pt2_ind, old_style_scores, scores_shape, name = 'scores_scattered')
+    alt_scores_1      = tf.scatter_nd(pt2_ind, alt_scores_1, scores_shape, name = 'alt_scores_1')
+    alt_scores_1_norm = normalize_scores(alt_scores_1)
+    alt_scores_2      = tf.scatter_nd(pt2_ind, alt_scores_2, scores_shape, name = 'alt_scores_2')
+    alt_scores_2_norm = normalize_scores(alt_scores_2)
+    logt('old_style_scores  ', old_style_scores, verbose = verbose)
+    logt('alt_scores_1_norm ', alt_scores_1_norm, verbose = verbose)
+    logt('alt_scores_2_norm ', alt_scores_2_norm, verbose = verbose)
+
+    ##---------------------------------------------------------------------------------------------
+    ## Transpose heatmaps to shape required for FCN [batchsize , width, height, num_classes]
+    ## and append all scores to input score tensor
+    ##---------------------------------------------------------------------------------------------    
+    gauss_heatmap_sum = tf.transpose(gauss_heatmap_sum, [0,2,3,1], name = names[0])
+    gauss_scores      = tf.concat([in_tensor, old_style_scores, alt_scores_1, alt_scores_1_norm, alt_scores_2, alt_scores_2_norm],
+                                  axis = -1,name = names[0]+'_scores')
+    logt('reshaped heatmap ', gauss_heatmap_sum, verbose = verbose)
+    logt('    gauss_scores    : ', gauss_scores, verbose = verbose)
+    logt('    complete', verbose = verbose)
+
+    return   gauss_heatmap_sum, gauss_scores  
+    
+    
     
     
     
@@ -695,8 +778,10 @@ class CHMLayer(KE.Layer):
         logt('  mrcnn_bbox ',  mrcnn_bbox , verbose = verbose) 
         logt('  output_rois',  output_rois, verbose = verbose) 
          
-        pr_tensor   = build_pr_tensor(output_rois, mrcnn_class, mrcnn_bbox, self.config)
-        pr_hm, pr_hm_scores  = build_pr_heatmap(pr_tensor, self.config, names = ['pred_heatmap'])
+        def build_heatmaps(inputs):
+            pr_tensor   = build_pr_tensor(output_rois, mrcnn_class, mrcnn_bbox, self.config)
+            return build_pr_heatmap(pr_tensor, self.config, names = ['pred_heatmap'])
+        pr_hm, pr_hm_scores  = stage_timer.timed_graph('chm_layer', build_heatmaps, inputs)
         # pred_cls_cnt = KL.Lambda(lambda x: tf.count_nonzero(x[:,:,:,-1],axis = -1), name = 'pred_cls_count')(pred_tensor)        
 
         logt(' ', verbose = verbose) 
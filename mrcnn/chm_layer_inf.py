@@ -16,6 +16,8 @@ import keras.backend as KB
 import keras.layers as KL
 import keras.engine as KE
 import mrcnn.utils as utils
+import mrcnn.heatmap_kernels as hmk
+import mrcnn.stage_timer as stage_timer
 import tensorflow.contrib.util as tfc
 import pprint
 from mrcnn.chm_layer import build_hm_score_v2, build_hm_score_v3, clip_heatmap, normalize_scores
@@ -135,7 +137,7 @@ def build_predictions_inference(detected_rois, config):
             
               
 ##-----------------------------------------------------------------------------------------------------
-##  build_heatmap_inference()
+##  build_heatmap_inference_orig()  - tf.map_fn version, kept for reference and benchmarks
 ##
 ##  INPUTS :
 ##    pred_tensor        [ batch_size, num_classes, num_bboxes, 7 ] 
@@ -145,7 +147,7 @@ def build_predictions_inference(detected_rois, config):
 ##    inference mode         :   config.DETECTION_MAX_INSTANCES
 ##    
 ##-----------------------------------------------------------------------------------------------------          
-def build_heatmap_inference(in_tensor, config, names = None):
+def build_heatmap_inference_orig(in_tensor, config, names = None):
     '''
     input:
         pred_tensor      (None, num_classes, 200, 9)
@@ -410,6 +412,77 @@ def build_heatmap_inference(in_tensor, config, names = None):
     return   gauss_heatmap_sum, gauss_scores  
  
 
+##-----------------------------------------------------------------------------------------------------
+##  build_heatmap_inference() - vectorized
+##
+##  Same inputs / outputs as build_heatmap_inference_orig(), built with the shared kernels in
+##  mrcnn/heatmap_kernels.py instead of per-box tf.map_fn passes and a 5-D scatter.
+##-----------------------------------------------------------------------------------------------------          
+def build_heatmap_inference(in_tensor, config, names = None):
+    '''
+    input:
+        pred_tensor      (None, num_classes, 200, 9)
+                        [batchSz, Detection_Max_instance, (y1,x1,y2,x2, class, score, det_type, sequence_id, normalized_score)]
+                         
+    output:
+        pr_heatmap      (None,  Heatmap-height, Heatmap_width, num_classes)
+        pr_scores       (None, num_classes, 200, 24) 
+                        (same columns as build_heatmap_inference_orig)
+    '''
+    batch_size        = config.BATCH_SIZE
+    norm_score_column = 8
+    num_classes       = config.NUM_CLASSES 
+    heatmap_scale     = config.HEATMAP_SCALE_FACTOR
+    grid_h, grid_w    = config.IMAGE_SHAPE[:2] // heatmap_scale    
+    rois_per_image    = (in_tensor.shape)[2]  
+    scores_shape      = [batch_size, num_classes, rois_per_image, 3]
+
+    print('\n ')
+    print('  > build_inference_heatmap() for ', names )
+    print('    in_tensor shape        : ', in_tensor.shape)       
+    print('    num bboxes per class   : ', rois_per_image )
+    print('    heatmap scale        : ', heatmap_scale, 'Dimensions:  w:', grid_w,' h:', grid_h)
+
+    ##-----------------------------------------------------------------------------    
+    ## Stack non_zero bboxes from in_tensor into pt2_dense 
+    ##-----------------------------------------------------------------------------
+    pt2_sum = tf.reduce_sum(tf.abs(in_tensor[:,:,:,:4]), axis=-1)
+    pt2_ind = tf.where(pt2_sum > 0)
+    pt2_dense = tf.gather_nd( in_tensor, pt2_ind)
+    print('    pt2_ind shape  : ', pt2_ind.shape)
+    print('    pt2_dense shape: ', pt2_dense.get_shape())
+
+    ##-----------------------------------------------------------------------------    
+    ## Per-class heatmaps (normalized) and dense scores 
+    ##-----------------------------------------------------------------------------
+    bboxes_scaled = pt2_dense[:,:4]/heatmap_scale
+    gauss_heatmap_sum, old_style_scores, alt_scores_1, alt_scores_2 = \
+        hmk.build_gaussian_heatmaps(bboxes_scaled, pt2_dense[:, norm_score_column], pt2_ind, 
+                                    batch_size, num_classes, grid_h, grid_w)
+
+    ##-----------------------------------------------------------------------------    
+    ## Scatter scores back to per-class tensors, normalize alt scores by class
+    ##-----------------------------------------------------------------------------
+    old_style_scores  = tf.scatter_nd(pt2_ind, old_style_scores, scores_shape, name = 'scores_scattered')
+    alt_scores_1      = tf.scatter_nd(pt2_ind, alt_scores_1, scores_shape, name = 'alt_scores_1')
+    alt_scores_1_norm = normalize_scores(alt_scores_1)
+    alt_scores_2      = tf.scatter_nd(pt2_ind, alt_scores_2, scores_shape, name = 'alt_scores_2')
+    alt_scores_2_norm = normalize_scores(alt_scores_2)
+
+    ##---------------------------------------------------------------------------------------------
+    ## Transpose heatmaps to shape required for FCN [batchsize , width, height, num_classes]
+    ## and append all scores to input score tensor
+    ##---------------------------------------------------------------------------------------------
+    gauss_heatmap_sum = tf.transpose(gauss_heatmap_sum, [0,2,3,1], name = names[0])
+    gauss_scores      = tf.concat([in_tensor, old_style_scores, alt_scores_1, alt_scores_1_norm, alt_scores_2, alt_scores_2_norm],
+                                  axis = -1,name = names[0]+'_scores')
+    print('    reshaped heatmap   : ', gauss_heatmap_sum.shape,' Keras tensor ', KB.is_keras_tensor(gauss_heatmap_sum) )
+    print('    gauss_scores    : ', gauss_scores.shape, ' Keras tensor ', KB.is_keras_tensor(gauss_scores) )      
+    print('    complete')
+
+    return   gauss_heatmap_sum, gauss_scores  
+ 
+
 
 
 ##----------------------------------------------------------------------------------------------------------------------          
@@ -448,8 +521,10 @@ class CHMLayerInference(KE.Layer):
         print('  > CHM Inference Layer: call ', type(inputs), len(inputs))
         print('     detections.shape     :',  KB.int_shape(detections)) 
 
-        pred_tensor  = build_predictions_inference(detections, self.config)
-        pr_hm_norm, pr_hm_scores = build_heatmap_inference(pred_tensor, self.config, names = ['pred_heatmap'])
+        def build_heatmaps(detections):
+            pred_tensor  = build_predictions_inference(detections, self.config)
+            return [pred_tensor] + list(build_heatmap_inference(pred_tensor, self.config, names = ['pred_heatmap']))
+        pred_tensor, pr_hm_norm, pr_hm_scores = stage_timer.timed_graph('chm_layer', build_heatmaps, detections)
         # pred_cls_cnt = KL.Lambda(lambda x: tf.count_nonzero(x[:,:,:,-1],axis = -1), name = 'pred_cls_count')(pred_tensor)        
         print()
         print('    Output of CHMLayerInference: ')
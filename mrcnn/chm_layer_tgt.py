@@ -16,6 +16,7 @@ import keras.backend as KB
 import keras.layers as KL
 import keras.engine as KE
 import mrcnn.utils as utils
+import mrcnn.heatmap_kernels as hmk
 import tensorflow.contrib.util as tfc
 import pprint
 from   mrcnn.utils       import logt
@@ -122,7 +123,8 @@ def build_gt_tensor(gt_class_ids, norm_gt_bboxes, config):
     return  gt_tensor 
 
 ##-----------------------------------------------------------------------------------------------------------
-##  build_gt_heatmap : Build Ground Truth heatmaps using pred_gt_tensor
+##  build_gt_heatmap_orig : Build Ground Truth heatmaps using pred_gt_tensor
+##      tf.map_fn version - replaced by build_gt_heatmap (below), kept for reference and benchmarks
 ##------------------------------------------------------------------------------------------------------------
 ##  v2: in this version, 
 ##      For heatmap generation, prob_grid is passed through "clip_heatmap" which clips the gaussian distribution
@@ -146,7 +148,7 @@ def build_gt_tensor(gt_class_ids, norm_gt_bboxes, config):
 ##                  - area of bounding box in pixes
 ##                  - (sum of heatmap in masked area) * (bbox per-class normalized score from in_tensor)
 ##------------------------------------------------------------------------------------------------------------
-def build_gt_heatmap(in_tensor, config, names = None):
+def build_gt_heatmap_orig(in_tensor, config, names = None):
     verbose         = config.VERBOSE
     num_detections  = config.DETECTION_MAX_INSTANCES
     img_h, img_w    = config.IMAGE_SHAPE[:2]
@@ -380,6 +382,71 @@ def build_gt_heatmap(in_tensor, config, names = None):
     return   gauss_heatmap, gauss_scores  
 
         
+##-----------------------------------------------------------------------------------------------------------
+##  build_gt_heatmap : Build Ground Truth heatmaps using gt_tensor - vectorized
+##-----------------------------------------------------------------------------------------------------------  
+##  Same outputs as build_gt_heatmap_orig, built with the shared kernels in mrcnn/heatmap_kernels.py:
+##  box masks are outer products of per-axis masks, combined per class with unsorted_segment_max,
+##  and box-masked scores are read from summed area tables.
+##------------------------------------------------------------------------------------------------------------
+def build_gt_heatmap(in_tensor, config, names = None):
+    verbose         = config.VERBOSE
+    batch_size      = config.BATCH_SIZE
+    num_classes     = config.NUM_CLASSES  
+    heatmap_scale   = config.HEATMAP_SCALE_FACTOR
+    grid_h, grid_w  = config.IMAGE_SHAPE[:2] // heatmap_scale    
+    rois_per_image  = (in_tensor.shape)[2]  
+    scores_shape    = [batch_size, num_classes, rois_per_image, 3]
+
+    if verbose:
+        print('\n ')
+        print('  > build_heatmap() for ', names )
+        print('    in_tensor shape        : ', in_tensor.shape)       
+        print('    num bboxes per class   : ', rois_per_image )
+        print('    heatmap scale        : ', heatmap_scale, 'Dimensions:  w:', grid_w,' h:', grid_h)
+    
+    ##-----------------------------------------------------------------------------    
+    ## Stack non_zero bboxes from in_tensor into pt2_dense 
+    ##-----------------------------------------------------------------------------
+    pt2_sum = tf.reduce_sum(tf.abs(in_tensor[:,:,:,:4]), axis=-1)
+    pt2_ind = tf.where(pt2_sum > 0)
+    pt2_dense = tf.gather_nd( in_tensor, pt2_ind)
+    logt('pt2_ind   ', pt2_ind, verbose = verbose)
+    logt('pt2_dense ', pt2_dense, verbose = verbose)
+
+    ##-----------------------------------------------------------------------------    
+    ## Per-class 0/1 heatmaps and dense scores 
+    ##-----------------------------------------------------------------------------
+    pt2_dense_scaled = pt2_dense[:,:4]/heatmap_scale
+    gauss_heatmap, old_style_scores, alt_scores_1, alt_scores_2 = \
+        hmk.build_mask_heatmaps(pt2_dense_scaled, pt2_dense[:,7], pt2_ind, batch_size, num_classes, grid_h, grid_w)
+
+    ##-----------------------------------------------------------------------------    
+    ## Scatter scores back to per-class tensors, normalize alt scores by class
+    ##-----------------------------------------------------------------------------
+    old_style_scores  = tf.scatter_nd(pt2_ind, old_style_scores, scores_shape, name = 'scores_scattered')
+    alt_scores_1      = tf.scatter_nd(pt2_ind, alt_scores_1, scores_shape, name = 'alt_scores_1')
+    alt_scores_1_norm = normalize_scores(alt_scores_1)
+    alt_scores_2      = tf.scatter_nd(pt2_ind, alt_scores_2, scores_shape, name = 'alt_scores_2')
+    alt_scores_2_norm = normalize_scores(alt_scores_2)
+    logt('old_style_scores  ', old_style_scores, verbose = verbose)
+    logt('alt_scores_1_norm ', alt_scores_1_norm, verbose = verbose)
+    logt('alt_scores_2_norm ', alt_scores_2_norm, verbose = verbose)
+
+    ##--------------------------------------------------------------------------------------------
+    ##  Transpose tensor to [BatchSz, Height, Width, Num_Classes] and 
+    ##  append all scores to input score tensor 
+    ##--------------------------------------------------------------------------------------------
+    gauss_heatmap  = tf.transpose(gauss_heatmap,[0,2,3,1], name = names[0])
+    gauss_scores   = tf.concat([in_tensor, old_style_scores, alt_scores_1, alt_scores_1_norm, alt_scores_2, alt_scores_2_norm],
+                                axis = -1,name = names[0]+'_scores')
+    logt('gauss_heatmap  ', gauss_heatmap, verbose = verbose)
+    logt('gauss_scores', gauss_scores, verbose = verbose)
+    logt('complete    ', verbose = verbose)
+
+    return   gauss_heatmap, gauss_scores  
+
+        
 ##------------------------------------------------------------------------------------------------------------
 ##
 ##------------------------------------------------------------------------------------------------------------     
@@ -29,6 +29,8 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 
 import os
 import time
+import collections
+from   concurrent.futures import ThreadPoolExecutor
 import numpy as np
 # Download and install the Python COCO tools from https://github.com/waleedka/coco
 # That's a fork from the original https://github.com/pdollar/coco with a bug
@@ -41,6 +43,7 @@ from pycocotools.cocoeval import COCOeval
 from pycocotools          import mask as maskUtils
 import mrcnn.dataset  as dataset
 import mrcnn.utils    as utils
+from   mrcnn.coco_index import CocoIndex, coco_index_dir, is_coco_index, build_coco_index
 
 from   mrcnn.config   import Config
 from   mrcnn.datagen  import data_generator
@@ -99,6 +102,9 @@ class CocoConfig(Config):
     # Number of classes (including background)
     NUM_CLASSES = 1 + 80  # COCO has 80 classes
 
+    # Take GT boxes from the annotations instead of decoding the instance masks
+    USE_ANNOTATION_BBOXES = True
+
     
 class CocoInferenceConfig(CocoConfig):
     # Set batch size to 1 since we'll be running inference on
@@ -115,7 +121,8 @@ class CocoInferenceConfig(CocoConfig):
 class CocoDataset(dataset.Dataset):
     
     def load_coco(self, dataset_dir, subset, load_coco_classes=None,
-                  class_ids=None, class_map=None, return_coco=False, loadAnns = 'all_classes'):
+                  class_ids=None, class_map=None, return_coco=False, loadAnns = 'all_classes',
+                  index_cache = True, cache_dir = None):
         """Load a subset of the COCO dataset.
         dataset_dir:    The root directory of the COCO dataset.
         subset:         What to load (train, val, minival, val35k)
@@ -123,6 +130,11 @@ class CocoDataset(dataset.Dataset):
         class_map:      TODO: Not implemented yet. Supports maping classes from
                               different datasets to the same class ID.
         return_coco: If True, returns the COCO object.
+        index_cache:    Load classes, images and annotations from the on-disk index
+                        (see coco_index) of the annotation file and class filters when 
+                        there is one, otherwise build it. The annotation JSON is still 
+                        parsed when return_coco is True.
+        cache_dir:      Directory of the indexes (default dataset_dir/annotations/index_cache)
         """
         assert loadAnns in ['all_classes', 'active_only'], "loadAnns must be 'all_classes' or 'active_only' "
         if loadAnns == 'active_only':
@@ -146,7 +158,19 @@ class CocoDataset(dataset.Dataset):
             "val35k" :  "annotations/instances_valminusminival2014.json",
             "test"   :  "annotations/image_info_test2014.json"
         }
-        coco = COCO(os.path.join(dataset_dir, json_path_dict[subset]))
+        json_path = os.path.join(dataset_dir, json_path_dict[subset])
+        
+        index_dir = None
+        if index_cache:
+            if cache_dir is None:
+                cache_dir = os.path.join(dataset_dir, 'annotations', 'index_cache')
+            index_dir = coco_index_dir(cache_dir, json_path, class_ids, load_coco_classes, loadAnns)
+            if not return_coco and is_coco_index(index_dir):
+                self.load_coco_index(CocoIndex(index_dir), image_dir)
+                return
+                
+        coco = COCO(json_path)
+        filters = {'class_ids': class_ids, 'load_coco_classes': load_coco_classes, 'loadAnns': loadAnns}
         
         # Load all classes or a subset?
         if not class_ids:
@@ -154,11 +178,13 @@ class CocoDataset(dataset.Dataset):
             class_ids = sorted(coco.getCatIds())
 
         ## Add classes to the class_info dictionary - load classes using the Coco internal class id
+        classes = []
         for i in class_ids:
             cocoClassInfo = coco.loadCats(i)[0]
             img_count = len(coco.getImgIds(catIds=i))
             # print('num images: ', img_count)
             self.add_class("coco", i, cocoClassInfo["name"], cocoClassInfo["supercategory"], img_count = img_count)
+            classes.append([i, cocoClassInfo["name"], cocoClassInfo["supercategory"], img_count])
 
             
         # All images or a subset?
@@ -200,19 +226,50 @@ class CocoDataset(dataset.Dataset):
         annotation_classes = class_ids if loadAnns == 'all_classes' else self.active_ext_class_ids 
         
         ## Add images to the image_info dictionary
+        images = []
         for i in image_ids:
+            annotations = coco.loadAnns(coco.getAnnIds(imgIds=[i], catIds=annotation_classes, iscrowd=None))
             self.add_image(
                 "coco", 
                 image_id    = i,
                 path        = os.path.join(image_dir, coco.imgs[i]['file_name']),
                 width       = coco.imgs[i]["width"],
                 height      = coco.imgs[i]["height"],               
-                annotations = coco.loadAnns(coco.getAnnIds(imgIds=[i], catIds=annotation_classes, iscrowd=None))) 
+                annotations = annotations) 
+            images.append((i, coco.imgs[i]['file_name'], coco.imgs[i]["width"], coco.imgs[i]["height"], annotations))
+        
+        if index_dir is not None:
+            try:
+                build_coco_index(index_dir, json_path, classes, self.active_ext_class_ids, images, filters = filters)
+                print(' annotation index     : ', index_dir)
+            except (IOError, OSError) as e:
+                print(' annotation index not written to {} : {}'.format(index_dir, e))
         
         if return_coco:
             self.source_objs[subset] = coco
             return coco
 
+    def load_coco_index(self, index, image_dir):
+        """Add the classes and images of a CocoIndex, as load_coco() does from the
+        annotation file.
+        """
+        for class_id, name, supercategory, img_count in index.classes():
+            self.add_class("coco", class_id, name, supercategory, img_count = img_count)
+        self.active_ext_class_ids = sorted(index.active_class_ids())
+        
+        print(' image dir            : ', image_dir) 
+        print(' annotation index     : ', index.index_dir)
+        print(' number of images     : ', len(index))
+        
+        for image_id, file_name, width, height, annotations in index.images():
+            self.add_image(
+                "coco", 
+                image_id    = image_id,
+                path        = os.path.join(image_dir, file_name),
+                width       = width,
+                height      = height,               
+                annotations = annotations) 
+
     def load_mask(self, image_id):
         """Load instance masks for the given image.
 
@@ -270,6 +327,55 @@ class CocoDataset(dataset.Dataset):
             # super(self.__class__, self) is equivalent to super() 
             return super().load_mask(image_id)
 
+    def load_bboxes(self, image_id):
+        """Load instance bounding boxes for the given image, without decoding masks.
+
+        Boxes of regular instances are taken from the annotation 'bbox' field. For
+        crowd annotations the extents are computed from the RLE (maskUtils.toBbox), 
+        which does not require decoding the mask to a full resolution bitmap.
+        
+        Returns:
+        bboxes: [instance count, (y1, x1, y2, x2)] int32 boxes in original image
+            coordinates. (y2, x2) lay outside the box.
+        class_ids: a 1D array of class IDs of the instances (negative for crowds).
+        """
+        image_info = self.image_info[image_id]
+        height, width = image_info["height"], image_info["width"]
+        
+        bboxes    = []
+        class_ids = []
+        
+        for annotation in image_info["annotations"]:
+            class_id = self.map_source_class_id( "coco.{}".format(annotation['category_id']))
+            if not class_id:
+                continue
+                
+            if annotation['iscrowd']:
+                class_id *= -1
+                rle = self.annToRLE(annotation, height, width)
+                # annToMask() sometimes returns a smaller mask for crowds, in which case 
+                # load_mask() uses the whole image. Do the same here.
+                if list(rle['size']) != [height, width]:
+                    x, y, w, h = 0, 0, width, height
+                else:
+                    x, y, w, h = maskUtils.toBbox(rle)
+            else:
+                x, y, w, h = annotation['bbox']
+            
+            y1 = int(np.clip(np.round(y), 0, height))
+            x1 = int(np.clip(np.round(x), 0, width))
+            y2 = int(np.clip(np.round(y + h), 0, height))
+            x2 = int(np.clip(np.round(x + w), 0, width))
+            
+            # Some objects are so small that they're less than 1 pixel area
+            # and end up rounded out. Skip those objects.
+            if y2 <= y1 or x2 <= x1:
+                continue
+            bboxes.append([y1, x1, y2, x2])
+            class_ids.append(class_id)
+
+        return np.array(bboxes, dtype=np.int32).reshape(-1, 4), np.array(class_ids, dtype=np.int32)
+        
     def display_annotation_info(self, image_ids):
         if not isinstance(image_ids, list):
             image_ids = [image_ids]
@@ -328,8 +434,11 @@ class CocoDataset(dataset.Dataset):
 #  COCO Evaluation - Build Results
 ############################################################
 
-def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
+def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks = None):
     """Arrange resutls to match COCO specs in http://cocodataset.org/#format
+    
+    masks:  [H, W, N] instance masks, optional. Detections from MaskRCNN.detect() have
+            no masks, in which case no "segmentation" entries are produced.
     """
     # If no results, return an empty list
     if rois is None:
@@ -343,15 +452,15 @@ def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
             class_id = class_ids[i]
             score = scores[i]
             bbox = np.around(rois[i], 1)
-            mask = masks[:, :, i]
 
             result = {
                 "image_id": image_id,
                 "category_id": dataset.get_source_class_id(class_id, "coco"),
                 "bbox": [bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]],
                 "score": score,
-                "segmentation": maskUtils.encode(np.asfortranarray(mask))
             }
+            if masks is not None:
+                result["segmentation"] = maskUtils.encode(np.asfortranarray(masks[:, :, i]))
             results.append(result)
     return results
 
@@ -359,12 +468,23 @@ def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
 #  Evaluate Coco
 ############################################################
 
-def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=None):
+def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=None, loaders = 4, prefetch_batches = 2):
     """Runs official COCO evaluation.
     dataset:    A Dataset object with valiadtion data
     eval_type:  "bbox" or "segm" for bounding box or segmentation evaluation
     limit:      if not 0, it's the number of images to use for evaluation
+    loaders:    number of threads loading and molding images ahead of detection
+    prefetch_batches: number of batches loaded ahead of the batch being detected
+    
+    Pipelined: images are decoded and molded on a thread pool, detection runs on 
+    full batches of config.BATCH_SIZE images, and conversion of a batch to COCO 
+    results runs on a separate thread while the next batch is detected.
+    
+    Returns the per-stage timing dict, also printed after the COCOeval summary.
     """
+    if eval_type == "segm":
+        raise ValueError("evaluate_coco: MaskRCNN.detect() returns no masks, segm evaluation is not supported")
+    
     # Pick COCO images from the dataset
     image_ids = image_ids or dataset.image_ids
 
@@ -375,26 +495,75 @@ def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=Non
     # Get corresponding COCO image IDs.
     coco_image_ids = [dataset.image_info[id]["id"] for id in image_ids]
 
-    t_prediction = 0
+    batch_size = model.config.BATCH_SIZE
+    timings = {'load': 0.0, 'load_wait': 0.0, 'predict': 0.0, 'convert': 0.0, 'convert_wait': 0.0, 'cocoeval': 0.0}
     t_start = time.time()
 
-    results = []
-    for i, image_id in enumerate(image_ids):
-        # Load image
+    def load_and_mold(image_id):
+        t = time.time()
         image = dataset.load_image(image_id)
+        molded_inputs = model.mold_inputs([image])
+        return image, molded_inputs, time.time() - t
 
-        # Run detection
+    def convert(batch_coco_ids, batch_results):
         t = time.time()
-        r = model.detect([image], verbose=0)[0]
-        t_prediction += (time.time() - t)
-
-        # Convert results to COCO format
-        image_results = build_coco_results(dataset, coco_image_ids[i:i + 1],
-                                           r["rois"], r["class_ids"],
-                                           r["scores"], r["masks"])
-        results.extend(image_results)
+        batch_coco_results = []
+        for coco_image_id, r in zip(batch_coco_ids, batch_results):
+            batch_coco_results.extend(build_coco_results(dataset, [coco_image_id],
+                                                         r["rois"], r["class_ids"], r["scores"]))
+        return batch_coco_results, time.time() - t
+
+    batch_starts = list(range(0, len(image_ids), batch_size))
+    results      = []
+    
+    with ThreadPoolExecutor(max_workers = loaders) as load_pool, ThreadPoolExecutor(max_workers = 1) as convert_pool:
+        
+        # queue image loads prefetch_batches ahead of the batch being detected
+        load_futures = collections.deque()
+        next_load = 0
+        def submit_loads(limit):
+            nonlocal next_load
+            while next_load < min(limit, len(image_ids)):
+                load_futures.append(load_pool.submit(load_and_mold, image_ids[next_load]))
+                next_load += 1
+        submit_loads((prefetch_batches + 1) * batch_size)
+
+        convert_future = None
+        for start in batch_starts:
+            stop = min(start + batch_size, len(image_ids))
+            
+            t = time.time()
+            loaded = [load_futures.popleft().result() for _ in range(start, stop)]
+            timings['load_wait'] += time.time() - t
+            submit_loads(stop + (prefetch_batches + 1) * batch_size)
+            
+            images        = [l[0] for l in loaded]
+            molded_inputs = [np.concatenate([l[1][j] for l in loaded]) for j in range(3)]
+            timings['load'] += sum(l[2] for l in loaded)
+
+            # Run detection
+            t = time.time()
+            batch_results = model.detect_batch(images, verbose=0, molded_inputs = molded_inputs)
+            timings['predict'] += time.time() - t
+            
+            # Convert results to COCO format, overlapped with the next batch
+            if convert_future is not None:
+                t = time.time()
+                batch_coco_results, t_convert = convert_future.result()
+                timings['convert_wait'] += time.time() - t
+                timings['convert'] += t_convert
+                results.extend(batch_coco_results)
+            convert_future = convert_pool.submit(convert, coco_image_ids[start:stop], batch_results)
+
+        if convert_future is not None:
+            t = time.time()
+            batch_coco_results, t_convert = convert_future.result()
+            timings['convert_wait'] += time.time() - t
+            timings['convert'] += t_convert
+            results.extend(batch_coco_results)
 
     # Load results. This modifies results with additional attributes.
+    t = time.time()
     coco_results = coco.loadRes(results)
 
     # Evaluate
@@ -403,9 +572,19 @@ def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=Non
     cocoEval.evaluate()
     cocoEval.accumulate()
     cocoEval.summarize()
-
-    print("Prediction time: {}. Average {}/image".format(
-        t_prediction, t_prediction / len(image_ids)))
-    print("Total time: ", time.time() - t_start)
+    timings['cocoeval'] = time.time() - t
+    timings['total'] = time.time() - t_start
+
+    print()
+    print("Images: {}  Batch size: {}  Loader threads: {}".format(len(image_ids), batch_size, loaders))
+    print("Load + mold time : {:10.3f}  (summed over loader threads)   Main thread waiting on loads  : {:10.3f}".format(
+            timings['load'], timings['load_wait']))
+    print("Prediction time  : {:10.3f}  Average {:.4f}/image".format(
+            timings['predict'], timings['predict'] / max(len(image_ids), 1)))
+    print("Conversion time  : {:10.3f}  (converter thread)             Main thread waiting on converts: {:10.3f}".format(
+            timings['convert'], timings['convert_wait']))
+    print("COCOeval time    : {:10.3f}".format(timings['cocoeval']))
+    print("Total time       : {:10.3f}".format(timings['total']))
+    return timings
 
 
@@ -0,0 +1,179 @@
+"""
+Mask R-CNN
+On-disk image -> annotation index of a COCO annotation file
+
+CocoDataset.load_coco() parses the whole annotation JSON with pycocotools and queries
+the annotations of each image. The index keeps the result of one load_coco() call (classes,
+images and their annotations) in columnar .npy arrays, so that the next call with the same
+annotation file and class filters rebuilds the Dataset registry without reading the JSON:
+
+    index_dir/index.json            version, annotation file (path, size, mtime), filters,
+                                    class rows [id, name, supercategory, img_count], active
+                                    class ids, and the non-polygon (RLE) segmentations {row: rle}
+    index_dir/images.npy            [N, 3]   int64    coco image id, width, height
+    index_dir/file_names.npy        [N]      str      image file names
+    index_dir/ann_offsets.npy       [N+1]    int64    start of each image's annotation rows
+    index_dir/anns.npy              [M, 4]   int64    annotation id, image id, category id, iscrowd
+    index_dir/ann_floats.npy        [M, 5]   float64  area, bbox (x, y, w, h)
+    index_dir/poly_offsets.npy      [M+1]    int64    start of each annotation's polygon rows
+    index_dir/coord_offsets.npy     [P+1]    int64    start of each polygon's coordinates
+    index_dir/coords.npy            [K]      float64  polygon coordinates
+
+Index directories live in a cache directory, named by a digest of the annotation file path,
+size and mtime and of the class filters: an edited annotation file or a different filter
+gets a new index.
+
+Usage:
+    index_dir = coco_index_dir(cache_dir, json_path, class_ids, load_coco_classes, loadAnns)
+    if is_coco_index(index_dir):
+        index = CocoIndex(index_dir)
+"""
+import os, json, hashlib
+import numpy as np
+
+INDEX_FILE    = 'index.json'
+INDEX_VERSION = 1
+
+
+def coco_index_dir(cache_dir, json_path, class_ids = None, load_coco_classes = None, loadAnns = 'all_classes'):
+    '''
+    Index directory in cache_dir of one annotation file / class filter combination
+    '''
+    stat = os.stat(json_path)
+    key  = json.dumps([os.path.abspath(json_path), stat.st_size, stat.st_mtime,
+                       None if class_ids is None else sorted(int(i) for i in class_ids),
+                       None if load_coco_classes is None else sorted(int(i) for i in load_coco_classes),
+                       loadAnns])
+    name = os.path.splitext(os.path.basename(json_path))[0]
+    return os.path.join(cache_dir, '{}_{}'.format(name, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def is_coco_index(index_dir):
+    return os.path.isfile(os.path.join(index_dir, INDEX_FILE))
+
+
+##------------------------------------------------------------------------------------
+## Reader
+##------------------------------------------------------------------------------------
+class CocoIndex(object):
+    '''
+    Read access to a COCO annotation index
+    '''
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, INDEX_FILE), 'r') as infile:
+            self.index = json.load(infile)
+        if self.index['version'] != INDEX_VERSION:
+            raise ValueError('CocoIndex: unsupported index version {} in {}'.format(self.index['version'], index_dir))
+
+    def __len__(self):
+        return self.index['image_count']
+
+    def array(self, name):
+        return np.load(os.path.join(self.index_dir, name + '.npy'))
+
+    def classes(self):
+        '''
+        Returns [id, name, supercategory, img_count] of the classes, in load_coco() order
+        '''
+        return self.index['classes']
+
+    def active_class_ids(self):
+        return self.index['active_class_ids']
+
+    def images(self):
+        '''
+        Yields (coco image id, file name, width, height, annotations) of the indexed images,
+        annotations as the list of dicts returned by COCO.loadAnns()
+        '''
+        images        = self.array('images')
+        file_names    = self.array('file_names')
+        ann_offsets   = self.array('ann_offsets').tolist()
+        anns          = self.array('anns').tolist()
+        ann_floats    = self.array('ann_floats').tolist()
+        poly_offsets  = self.array('poly_offsets').tolist()
+        coord_offsets = self.array('coord_offsets').tolist()
+        coords        = self.array('coords')
+        rles          = self.index['rles']
+
+        for row, (image_id, width, height) in enumerate(images.tolist()):
+            annotations = []
+            for k in range(ann_offsets[row], ann_offsets[row+1]):
+                if str(k) in rles:
+                    segmentation = rles[str(k)]
+                else:
+                    segmentation = [coords[coord_offsets[p] : coord_offsets[p+1]].tolist()
+                                    for p in range(poly_offsets[k], poly_offsets[k+1])]
+                ann_id, ann_image_id, category_id, iscrowd = anns[k]
+                annotations.append({'segmentation': segmentation,
+                                    'area'        : ann_floats[k][0],
+                                    'iscrowd'     : iscrowd,
+                                    'image_id'    : ann_image_id,
+                                    'bbox'        : ann_floats[k][1:],
+                                    'category_id' : category_id,
+                                    'id'          : ann_id})
+            yield image_id, str(file_names[row]), width, height, annotations
+
+    def display(self):
+        print(' COCO index: {}  images: {}  annotation file: {}'.format(
+               self.index_dir, len(self), self.index['annotation_file']))
+
+
+##------------------------------------------------------------------------------------
+## Writer
+##------------------------------------------------------------------------------------
+def build_coco_index(index_dir, json_path, classes, active_class_ids, images, filters = None):
+    '''
+    Write the index of one load_coco() call into index_dir
+
+    classes:            list of [id, name, supercategory, img_count]
+    active_class_ids:   CocoDataset.active_ext_class_ids
+    images:             list of (coco image id, file name, width, height, annotations)
+    filters:            class filters, recorded in index.json for information
+
+    Returns a CocoIndex on the new index
+    '''
+    ann_offsets, anns, ann_floats = [0], [], []
+    poly_offsets, coord_offsets, coords, rles = [0], [0], [], {}
+
+    for image_id, file_name, width, height, annotations in images:
+        for ann in annotations:
+            segmentation = ann['segmentation']
+            if isinstance(segmentation, list):
+                for polygon in segmentation:
+                    coords.extend(polygon)
+                    coord_offsets.append(len(coords))
+            else:
+                rles[str(len(anns))] = segmentation
+            poly_offsets.append(len(coord_offsets) - 1)
+            anns.append([ann['id'], ann['image_id'], ann['category_id'], ann['iscrowd']])
+            ann_floats.append([ann['area']] + list(ann['bbox']))
+        ann_offsets.append(len(anns))
+
+    os.makedirs(index_dir, exist_ok = True)
+    arrays = {'images'       : np.array([[i[0], i[2], i[3]] for i in images], dtype = np.int64).reshape(-1, 3),
+              'file_names'   : np.array([i[1] for i in images], dtype = np.str_),
+              'ann_offsets'  : np.array(ann_offsets, dtype = np.int64),
+              'anns'         : np.array(anns, dtype = np.int64).reshape(-1, 4),
+              'ann_floats'   : np.array(ann_floats, dtype = np.float64).reshape(-1, 5),
+              'poly_offsets' : np.array(poly_offsets, dtype = np.int64),
+              'coord_offsets': np.array(coord_offsets, dtype = np.int64),
+              'coords'       : np.array(coords, dtype = np.float64)}
+    for name, array in arrays.items():
+        np.save(os.path.join(index_dir, name + '.npy'), array)
+
+    stat  = os.stat(json_path)
+    index = {'version'          : INDEX_VERSION,
+             'annotation_file'  : [os.path.abspath(json_path), stat.st_size, stat.st_mtime],
+             'filters'          : filters,
+             'image_count'      : len(images),
+             'classes'          : [[int(c[0]), c[1], c[2], int(c[3])] for c in classes],
+             'active_class_ids' : [int(i) for i in active_class_ids],
+             'rles'             : rles}
+    ## index.json is written last, so an interrupted build is never taken for an index
+    tmp_filename = os.path.join(index_dir, INDEX_FILE + '.tmp')
+    with open(tmp_filename, 'w') as outfile:
+        json.dump(index, outfile)
+    os.replace(tmp_filename, os.path.join(index_dir, INDEX_FILE))
+    return CocoIndex(index_dir)
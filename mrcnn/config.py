@@ -8,6 +8,7 @@ Written by Waleed Abdulla
 """
 
 import math
+import hashlib
 import numpy as np
 
 
@@ -136,6 +137,11 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Build the final detections (DetectionInferenceLayer / DetectionEvaluateLayer) in the
+    # TF graph instead of running the NumPy code in a tf.py_func. False keeps the NumPy
+    # path, e.g. to compare the outputs of both
+    DETECTION_GRAPH = False
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer
@@ -152,6 +158,35 @@ class Config(object):
     # the RPN. For example, to debug the classifier head without having to
     # train the RPN.
     USE_RPN_ROIS = True
+
+    # If True, and the dataset implements load_bboxes(), load_image_gt() takes the
+    # GT boxes directly from the dataset and resizes them analytically instead of
+    # decoding and resizing the instance masks
+    USE_ANNOTATION_BBOXES = False
+
+    # Input pipeline: number of worker processes used to prepare training batches.
+    # 0 runs the data generator in the consumer thread (datagen.data_generator),
+    # > 0 uses datagen.parallel_data_generator with a prefetch queue of
+    # DATAGEN_QUEUE_SIZE batches. DATAGEN_SEED makes the shuffling and augmentation
+    # reproducible (None: use the global numpy random state)
+    DATAGEN_WORKERS    = 0
+    DATAGEN_QUEUE_SIZE = 10
+    DATAGEN_SEED       = None
+
+    # FCN training (FCN.train_in_batches): MRCNN inference runs in a background thread,
+    # keeping up to FCN_INPUT_QUEUE_SIZE FCN input batches ready ahead of the FCN training
+    # step. 0 runs MRCNN inference and FCN training serially.
+    FCN_INPUT_QUEUE_SIZE = 2
+
+    # Number of compiled backend functions (KB.function) kept by ModelBase.get_backend_function()
+    # for get_layer_outputs() / run_graph(). 0 builds a new function on every call
+    FUNCTION_CACHE_SIZE = 16
+
+    # Record the wall time of the pipeline stages (data loading, molding, MRCNN predict, CHM 
+    # layer, detection refinement, FCN train_on_batch) - see stage_timer. FCN.train_in_batches()
+    # displays the per stage summary and writes it to stage_timings.json in the log directory
+    STAGE_TIMING = False
+
     LAST_EPOCH_RAN = 0
     EPOCHS_TO_RUN  = 0
     
@@ -161,6 +196,12 @@ class Config(object):
     DETECTION_PER_CLASS = 200
     # heatscale downscale factor (applied to IMAGE_MAX_DIM)
     HEATMAP_SCALE_FACTOR = 4
+    # Sparse predicted heatmaps: MRCNN detect() / evaluate() results and heatmap files 
+    # don't hold the dense pr_hm [h, w, NUM_CLASSES] grid, only pr_hm_scores, and the FCN
+    # rebuilds pr_hm from the pr_hm_scores boxes in its graph (pr_hm_scores is then its only 
+    # MRCNN heatmap input). Boxes that unmold_detections() drops as zero area in image 
+    # coordinates are not included in the rebuilt heatmap.
+    SPARSE_PR_HEATMAPS = False
 
     
     
@@ -192,3 +233,17 @@ class Config(object):
             if not a.startswith("__") and not callable(getattr(self, a)):
                 print("{:30} {}".format(a, getattr(self, a)))
         print("\n")
+
+    def digest(self, exclude = None):
+        """Returns a hex digest of the configuration values, leaving out the
+        attribute names in exclude. Used to key cached model outputs."""
+        exclude = set(exclude or [])
+        h = hashlib.sha1()
+        for a in dir(self):
+            if a.startswith("__") or a in exclude or callable(getattr(self, a)):
+                continue
+            value = getattr(self, a)
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            h.update("{}={!r};".format(a, value).encode('utf-8'))
+        return h.hexdigest()
@@ -20,6 +20,8 @@ import itertools
 import json
 import re
 import logging
+import collections
+import multiprocessing
 # from collections import OrderedDict
 import numpy as np
 
@@ -33,6 +35,7 @@ import numpy as np
 # import keras.models as KM
 
 import mrcnn.utils as utils
+from   mrcnn.stage_timer import timed
 
 ############################################################
 ##  Data Generator
@@ -40,6 +43,8 @@ import mrcnn.utils as utils
 """
 List of Modules:
    load_image_gt :          Load and return ground truth data for an image (image, mask, bboxes)
+
+   load_image_gt_bboxes:    Mask-free load_image_gt, for datasets providing load_bboxes()
    
    build_detection_targets: Generate targets for training Stage 2 classifier and mask heads.
                             This is not used in normal training. It's useful for debugging or to train
@@ -48,11 +53,16 @@ List of Modules:
    build_rpn_targets:       Given the anchors and GT boxes, compute overlaps and identify positive
                             anchors and deltas to refine them to match their corresponding GT boxes.
 
+   AnchorTargetBuilder:     Vectorized build_rpn_targets, with the anchor geometry computed once
+
    generate_random_rois:    Generates ROI proposals similar to what a region proposal network
                             would generate.
 
    data_generator:          A generator that returns images and corresponding target class ids,
                             bounding box deltas, and masks.
+
+   parallel_data_generator: Same as data_generator, with the per-image work done on a pool of
+                            worker processes and a bounded prefetch queue.
    
 """
 
@@ -60,6 +70,7 @@ List of Modules:
 ## LOAD_IMAGE_GT 
 ##----------------------------------------------------------------------
 
+@timed('load_image_gt')
 def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False):
     
     """
@@ -94,6 +105,10 @@ def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False)
     # print(' Load Image GT: ', image_id)
     # print('=========================')    
     image = dataset.load_image(image_id)
+
+    ## Mask-free path: datasets that can provide the GT boxes directly 
+    if config.USE_ANNOTATION_BBOXES and hasattr(dataset, 'load_bboxes'):
+        return load_image_gt_bboxes(dataset, config, image_id, image, augment=augment)
     
     mask, class_ids = dataset.load_mask(image_id)
 
@@ -143,6 +158,51 @@ def load_image_gt(dataset, config, image_id, augment=False, use_mini_mask=False)
     # return image, image_meta, class_ids, bbox, mask
     return image, image_meta, class_ids, bbox
 
+
+##----------------------------------------------------------------------
+## LOAD_IMAGE_GT_BBOXES 
+##----------------------------------------------------------------------
+def load_image_gt_bboxes(dataset, config, image_id, image, augment=False):
+    '''
+    Mask-free version of load_image_gt(). 
+    
+    The GT boxes are taken from dataset.load_bboxes() in original image coordinates,
+    and the resize scale, padding and horizontal flip are applied to the boxes 
+    analytically instead of to a full [H, W, instance_count] mask stack.
+
+    Inputs:
+    --------    
+    image:              [height, width, 3] image as returned by dataset.load_image()
+    augment:            If true, apply random horizontal flipping.
+
+    Returns:
+    ---------
+    Same as load_image_gt(): image, image_meta, class_ids, bbox
+    '''
+    bbox, class_ids = dataset.load_bboxes(image_id)
+
+    shape = image.shape
+    image, window, scale, padding = utils.resize_image(image,
+                                                       min_dim=config.IMAGE_MIN_DIM,
+                                                       max_dim=config.IMAGE_MAX_DIM,
+                                                       padding=config.IMAGE_PADDING)
+    bbox = utils.resize_bboxes(bbox, scale, padding)
+
+    # Random horizontal flips.
+    if augment:
+        if random.randint(0, 1):
+            image = np.fliplr(image)
+            non_zero = np.any(bbox > 0, axis = 1)
+            bbox[non_zero] = utils.flip_bbox(bbox[non_zero], (image.shape[1], image.shape[0]), flip_x = True)
+
+    active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
+    source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
+    active_class_ids[source_class_ids] = 1
+
+    image_meta = utils.compose_image_meta(image_id, shape, window, active_class_ids)
+
+    return image, image_meta, class_ids, bbox
+
     
 ##----------------------------------------------------------------------
 ## GENERATE_RANDOM_ROIS
@@ -536,6 +596,192 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     
     
     
+##----------------------------------------------------------------------
+## ANCHOR TARGET BUILDER
+##----------------------------------------------------------------------
+class AnchorTargetBuilder(object):
+    '''
+    Vectorized equivalent of build_rpn_targets().
+    
+    The anchor geometry (corners, areas, centers and sizes) is computed once 
+    when the builder is created and reused for every image. The anchor / GT box 
+    IoU matrix is computed by broadcasting (in cache sized blocks of anchors), 
+    and the deltas of all positive anchors are computed at once. 
+    
+    Given the same np.random state, build() returns the same rpn_match and rpn_bbox
+    as build_rpn_targets().
+    
+    Usage:
+    ------
+        rpn_targets         = AnchorTargetBuilder(anchors, config)
+        rpn_match, rpn_bbox = rpn_targets.build(gt_class_ids, gt_boxes)
+    '''
+    BLOCK_SIZE = 2048
+    
+    def __init__(self, anchors, config):
+        '''
+        anchors:            [num_anchors, (y1, x1, y2, x2)]
+        config:             The model config object
+        '''
+        self.anchors     = anchors
+        self.num_anchors = anchors.shape[0]
+        self.train_anchors_per_image = config.RPN_TRAIN_ANCHORS_PER_IMAGE
+        self.bbox_std_dev            = config.RPN_BBOX_STD_DEV
+
+        # Anchor corners as contiguous [num_anchors, 1] columns, ready for broadcasting 
+        self.y1 = np.ascontiguousarray(anchors[:, 0:1])
+        self.x1 = np.ascontiguousarray(anchors[:, 1:2])
+        self.y2 = np.ascontiguousarray(anchors[:, 2:3])
+        self.x2 = np.ascontiguousarray(anchors[:, 3:4])
+        
+        self.height   = anchors[:, 2] - anchors[:, 0]
+        self.width    = anchors[:, 3] - anchors[:, 1]
+        self.center_y = anchors[:, 0] + 0.5 * self.height
+        self.center_x = anchors[:, 1] + 0.5 * self.width
+        self.area     = (self.height * self.width)[:, np.newaxis]
+    
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Build the pyramid anchors defined by the config and the corresponding builder
+        '''
+        anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                 config.RPN_ANCHOR_RATIOS,
+                                                 config.BACKBONE_SHAPES,
+                                                 config.BACKBONE_STRIDES,
+                                                 config.RPN_ANCHOR_STRIDE)
+        return cls(anchors, config)
+        
+    def overlaps(self, boxes, start = 0, stop = None):
+        '''
+        IoU between the anchors [start:stop] and the given boxes, computed as a single broadcast.
+        
+        boxes:              [N, (y1, x1, y2, x2)]
+        
+        Returns:            [num_anchors, N] IoU matrix (same values as utils.compute_overlaps)
+        '''
+        by1, bx1, by2, bx2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        boxes_area = (by2 - by1) * (bx2 - bx1)
+        
+        h = np.minimum(self.y2[start:stop], by2) 
+        h -= np.maximum(self.y1[start:stop], by1)
+        np.maximum(h, 0, out = h)
+        w = np.minimum(self.x2[start:stop], bx2) 
+        w -= np.maximum(self.x1[start:stop], bx1)
+        np.maximum(w, 0, out = w)
+        intersection = np.multiply(w, h, out = h)
+        
+        union  = boxes_area + self.area[start:stop]
+        union -= intersection
+        return np.divide(intersection, union, out = union)
+
+    def match(self, boxes):
+        '''
+        Best matching box for each anchor, and best matching anchor for each box.
+        
+        The IoU matrix is computed in blocks of BLOCK_SIZE anchors, which keeps the
+        working set in cache and avoids the slow column-wise argmax over the full 
+        [num_anchors, N] matrix. Ties resolve to the lowest index, as np.argmax does.
+        
+        Returns:
+        --------
+        anchor_iou_argmax:  [num_anchors] index of the box with the highest IoU 
+        anchor_iou_max:     [num_anchors] highest IoU of each anchor 
+        box_iou_argmax:     [N] index of the anchor with the highest IoU 
+        '''
+        anchor_iou_argmax = np.empty([self.num_anchors], dtype=np.int64)
+        anchor_iou_max    = np.empty([self.num_anchors])
+        box_iou_argmax    = np.zeros([boxes.shape[0]], dtype=np.int64)
+        box_iou_max       = np.full([boxes.shape[0]], -1.0)
+        rows              = np.arange(self.BLOCK_SIZE)
+        
+        for start in range(0, self.num_anchors, self.BLOCK_SIZE):
+            stop     = min(start + self.BLOCK_SIZE, self.num_anchors)
+            overlaps = self.overlaps(boxes, start, stop)
+            
+            argmax = np.argmax(overlaps, axis=1)
+            anchor_iou_argmax[start:stop] = argmax
+            anchor_iou_max[start:stop]    = overlaps[rows[:stop - start], argmax]
+            
+            block_argmax = np.argmax(overlaps, axis=0)
+            block_max    = overlaps[block_argmax, np.arange(boxes.shape[0])]
+            better       = block_max > box_iou_max
+            box_iou_max[better]    = block_max[better]
+            box_iou_argmax[better] = block_argmax[better] + start
+            
+        return anchor_iou_argmax, anchor_iou_max, box_iou_argmax
+        
+    def build(self, gt_class_ids, gt_boxes):
+        '''
+        Given the GT boxes, compute overlaps with the anchors and identify positive
+        anchors and deltas to refine them to match their corresponding GT boxes.
+
+        Inputs:
+        --------
+        gt_class_ids:           [num_gt_boxes] Integer class IDs.
+        gt_boxes:               [num_gt_boxes, (y1, x1, y2, x2)]
+
+        Returns:
+        --------
+        rpn_match:              [N] (int32) matches between anchors and GT boxes.
+                                1 = positive anchor, -1 = negative anchor, 0 = neutral
+        rpn_bbox:               [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
+        '''
+        rpn_match = np.zeros([self.num_anchors], dtype=np.int32)
+        rpn_bbox  = np.zeros((self.train_anchors_per_image, 4))
+
+        # Handle COCO crowds: exclude anchors that intersect a crowd box
+        crowd_ix = np.where(gt_class_ids < 0)[0]
+        if crowd_ix.shape[0] > 0:
+            non_crowd_ix  = np.where(gt_class_ids > 0)[0]
+            crowd_boxes   = gt_boxes[crowd_ix]
+            gt_class_ids  = gt_class_ids[non_crowd_ix]
+            gt_boxes      = gt_boxes[non_crowd_ix]
+            _, crowd_iou_max, _ = self.match(crowd_boxes)
+            no_crowd_bool = (crowd_iou_max < 0.001)
+        else:
+            no_crowd_bool = np.ones([self.num_anchors], dtype=bool)
+
+        # Match anchors to GT Boxes (see build_rpn_targets()) 
+        anchor_iou_argmax, anchor_iou_max, gt_iou_argmax = self.match(gt_boxes)
+        rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+        rpn_match[gt_iou_argmax] = 1
+        rpn_match[anchor_iou_max >= 0.7] = 1
+
+        # Subsample to balance positive and negative anchors
+        ids   = np.where(rpn_match == 1)[0]
+        extra = len(ids) - (self.train_anchors_per_image // 2)
+        if extra > 0:
+            ids = np.random.choice(ids, extra, replace=False)
+            rpn_match[ids] = 0
+        
+        ids   = np.where(rpn_match == -1)[0]
+        extra = len(ids) - (self.train_anchors_per_image - np.sum(rpn_match == 1))
+        if extra > 0:
+            ids = np.random.choice(ids, extra, replace=False)
+            rpn_match[ids] = 0
+
+        # For positive anchors, compute shift and scale needed to transform them
+        # to match the corresponding GT boxes.
+        ids = np.where(rpn_match == 1)[0]
+        gt  = gt_boxes[anchor_iou_argmax[ids]]
+        
+        gt_h        = gt[:, 2] - gt[:, 0]
+        gt_w        = gt[:, 3] - gt[:, 1]
+        gt_center_y = gt[:, 0] + 0.5 * gt_h
+        gt_center_x = gt[:, 1] + 0.5 * gt_w
+        a_h         = self.height[ids]
+        a_w         = self.width[ids]
+
+        rpn_bbox[:ids.shape[0]] = np.stack([(gt_center_y - self.center_y[ids]) / a_h,
+                                            (gt_center_x - self.center_x[ids]) / a_w,
+                                            np.log(gt_h / a_h),
+                                            np.log(gt_w / a_w)], axis = 1) 
+        rpn_bbox[:ids.shape[0]] /= self.bbox_std_dev
+        
+        return rpn_match, rpn_bbox
+
+    
 ##----------------------------------------------------------------------
 ## DATA_GENERATOR
 ##----------------------------------------------------------------------
@@ -626,6 +872,7 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
                                              config.BACKBONE_SHAPES,        # [ 4X4, 8X8, 16X16, 32X32, 64X64]
                                              config.BACKBONE_STRIDES,       # [   4,   8,    16,    32,    64]
                                              config.RPN_ANCHOR_STRIDE)      #  1
+    rpn_targets = AnchorTargetBuilder(anchors, config)
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -656,7 +903,7 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
             #-----------------------------------------------------------------------           
             # RPN Targets to assist in training Region Proposal Network stage
             #-----------------------------------------------------------------------            
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors, gt_class_ids, gt_boxes, config)
+            rpn_match, rpn_bbox = rpn_targets.build(gt_class_ids, gt_boxes)
 
             #-----------------------------------------------------------------------           
             # IF random_rois <> 0 then we generate random  proposals 
@@ -766,8 +1013,213 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
                 raise
 
 
-                
-                
+
+
+##----------------------------------------------------------------------
+## LOAD_IMAGE_SAMPLE
+##----------------------------------------------------------------------
+def load_image_sample(dataset, config, image_id, rpn_targets, augment=False):
+    '''
+    Load and prepare all per-image inputs required for one batch slot of the
+    data generator: ground truth, RPN targets and the molded image.
+
+    Inputs:
+    -------
+    dataset:                The Dataset object to pick data from
+    config:                 The model config object
+    image_id:               Internal image id
+    rpn_targets:            AnchorTargetBuilder for the config's pyramid anchors
+    augment:                If True, applies image augmentation (horizontal flips)
+
+    Returns:
+    --------
+    None if the image has no instances, otherwise a tuple:
+    
+    molded_image:           [H, W, C] float32 image after mold_image()
+    image_meta:             [size of image meta]
+    rpn_match:              [num_anchors] Integer (1=positive anchor, -1=negative, 0=neutral)
+    rpn_bbox:               [RPN_TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
+    gt_class_ids:           [instance_count] (at most MAX_GT_INSTANCES)
+    gt_boxes:               [instance_count, (y1, x1, y2, x2)]
+    '''
+    image, image_meta, gt_class_ids, gt_boxes = \
+        load_image_gt(dataset, config, image_id, augment=augment, use_mini_mask=config.USE_MINI_MASK)
+
+    if not np.any(gt_class_ids > 0):
+        return None
+
+    rpn_match, rpn_bbox = rpn_targets.build(gt_class_ids, gt_boxes)
+
+    if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+        ids          = np.random.choice( np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+        gt_class_ids = gt_class_ids[ids]
+        gt_boxes     = gt_boxes[ids]
+
+    molded_image = utils.mold_image(image.astype(np.float32), config)
+    return molded_image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes
+
+
+##----------------------------------------------------------------------
+## PARALLEL_DATA_GENERATOR  - worker process functions
+##----------------------------------------------------------------------
+_worker_state = {}
+
+def _datagen_worker_init(dataset, config, augment):
+    '''
+    Pool initializer: keep the dataset, config and anchor targets in the worker process
+    so they are transferred once per worker rather than once per image.
+    '''
+    _worker_state['dataset'] = dataset
+    _worker_state['config']  = config
+    _worker_state['augment'] = augment
+    _worker_state['rpn_targets'] = AnchorTargetBuilder.from_config(config)
+
+def _datagen_worker_load(image_id, sample_seed):
+    '''
+    Load one image sample in a worker process. Both random number generators are 
+    reseeded with the sample seed, so the augmentation and anchor subsampling of
+    a sample do not depend on which worker picks it up.
+    '''
+    random.seed(sample_seed)
+    np.random.seed(sample_seed)
+    return load_image_sample(_worker_state['dataset'], _worker_state['config'], image_id, 
+                             _worker_state['rpn_targets'], augment = _worker_state['augment'])
+
+    
+##----------------------------------------------------------------------
+## PARALLEL_DATA_GENERATOR
+##----------------------------------------------------------------------
+def parallel_data_generator(dataset, config, shuffle=True, augment=True, batch_size=1, 
+                            image_index = -1, workers = 4, max_queue_size = 10, seed = None):
+    '''
+    Process-pool backed version of data_generator(). 
+    
+    load_image_gt(), RPN target generation and mold_image() are run for each image on 
+    one of <workers> processes. Samples are requested ahead of the consumer and held in
+    a bounded prefetch queue of at most max_queue_size batches, and handed back in 
+    image order, so the batches are identical regardless of the number of workers.
+    
+    Inputs:
+    -------
+    dataset:                The Dataset object to pick data from
+    config:                 The model config object
+    shuffle:                If True, shuffles the samples before every epoch
+    augment:                If True, applies image augmentation to images (currently only
+                            horizontal flips are supported)
+    batch_size:             How many images to return in each call
+    image_index             -1     : Start from beginning (or random position)
+                            n <> -1: start from item n+1 in the list when shuffle is False 
+    workers:                Number of worker processes 
+    max_queue_size:         Maximum number of batches prepared ahead of the consumer
+    seed:                   If not None, seeds the epoch shuffling and the per-image random 
+                            augmentation, making the generated sequence reproducible.
+                            If None, the global np.random state is used to draw seeds.
+                            
+    Returns:                A Python generator. Upon calling next() on it, the
+    --------                generator returns two lists, [inputs] and [outputs]:
+    
+    [Inputs] return list:
+    --------------------
+  0 batch_images:           [batch_sz, H, W, C]                                                
+  1 batch_image_meta:       [batch_sz, size of image meta]                                     
+  2 batch_rpn_match:        [batch_sz, N] Integer (1=positive anchor, -1=negative, 0=neutral)  
+  3 batch_rpn_bbox:         [batch_sz, N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.      
+  4 batch_gt_class_ids:     [batch_sz, MAX_GT_INSTANCES] Integer class IDs                     
+  5 batch_gt_boxes:         [batch_sz, MAX_GT_INSTANCES, (y1, x1, y2, x2)]                     
+
+    [Outputs] :             Empty list
+    '''
+    b           = 0  # batch item index
+    image_index = max(-1, image_index -1)
+    epoch       = 0
+    image_ids   = np.copy(dataset.image_ids)
+    error_count = 0
+    rng         = np.random.RandomState(seed) if seed is not None else np.random
+    prefetch    = max(1, max_queue_size) * batch_size
+    pending     = collections.deque()
+
+    def next_sample_seed(epoch, image_index):
+        if seed is None:
+            return np.random.randint(0, 2**31 - 1)
+        return hash((seed, epoch, image_index)) % (2**31 - 1)
+
+    pool = multiprocessing.Pool(processes = workers, 
+                                initializer = _datagen_worker_init, 
+                                initargs = (dataset, config, augment))
+    try:
+        while True:
+            #-----------------------------------------------------------------------           
+            # Top up the prefetch queue. Shuffle if at the start of an epoch.
+            #-----------------------------------------------------------------------            
+            while len(pending) < prefetch:
+                image_index = (image_index + 1) % len(image_ids)
+                if image_index == 0:
+                    epoch += 1 
+                    if shuffle:
+                        rng.shuffle(image_ids)
+                image_id = image_ids[image_index]
+                pending.append((image_id, pool.apply_async(_datagen_worker_load, 
+                                                          (image_id, next_sample_seed(epoch, image_index)))))
+
+            image_id, result = pending.popleft()
+            try:
+                sample = result.get()
+            except Exception:
+                # Log it and skip the image
+                logging.exception("Error processing image {}".format(dataset.image_info[image_id]))
+                error_count += 1
+                if error_count > 5:
+                    raise
+                continue
+
+            #-----------------------------------------------------------------------           
+            # Skip images that have no instances. 
+            #-----------------------------------------------------------------------            
+            if sample is None:
+                continue
+            molded_image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes = sample
+
+            #-----------------------------------------------------------------------
+            # Init batch arrays
+            #-----------------------------------------------------------------------
+            if b == 0:
+                batch_images      = np.zeros( (batch_size,) + molded_image.shape, dtype=np.float32)
+                batch_image_meta  = np.zeros( (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
+                batch_rpn_match   = np.zeros( [batch_size, rpn_match.shape[0], 1], dtype=rpn_match.dtype)
+                batch_rpn_bbox    = np.zeros( [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
+                batch_gt_class_ids= np.zeros( (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
+                batch_gt_boxes    = np.zeros( (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
+
+            #-----------------------------------------------------------------------    
+            # Add to batch
+            #-----------------------------------------------------------------------            
+            batch_images[b]                               = molded_image
+            batch_image_meta[b]                           = image_meta
+            batch_rpn_match[b]                            = rpn_match[:, np.newaxis]
+            batch_rpn_bbox[b]                             = rpn_bbox
+            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
+            batch_gt_boxes[b, :gt_boxes.shape[0]]         = gt_boxes
+            b += 1
+
+            #-----------------------------------------------------------------------            
+            # Batch full? send out inputs, outputs
+            #-----------------------------------------------------------------------            
+            if b >= batch_size:
+                inputs = [batch_images, 
+                          batch_image_meta, 
+                          batch_rpn_match, 
+                          batch_rpn_bbox,
+                          batch_gt_class_ids, 
+                          batch_gt_boxes 
+                         ]
+                outputs = []
+                yield inputs, outputs
+                b = 0
+    finally:
+        pool.terminate()
+        pool.join()
+
+    
 ##----------------------------------------------------------------------
 ## DATA_GENERATOR SIMULAION
 ##----------------------------------------------------------------------
@@ -823,6 +1275,7 @@ def data_gen_simulate(dataset, config, image_index):
                                              config.BACKBONE_SHAPES,        # [ 4X4, 8X8, 16X16, 32X32, 64X64]
                                              config.BACKBONE_STRIDES,       # [   4,   8,    16,    32,    64]
                                              config.RPN_ANCHOR_STRIDE)      #  1
+    rpn_targets = AnchorTargetBuilder(anchors, config)
 
     # Keras requires a generator to run indefinately.
     for img_idx in image_index:
@@ -846,7 +1299,7 @@ def data_gen_simulate(dataset, config, image_index):
             #-----------------------------------------------------------------------           
             # RPN Targets to assist in training Region Proposal Network stage
             #-----------------------------------------------------------------------            
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors, gt_class_ids, gt_boxes, config)
+            rpn_match, rpn_bbox = rpn_targets.build(gt_class_ids, gt_boxes)
 
             #-----------------------------------------------------------------------           
             # IF random_rois <> 0 then we generate random  proposals 
@@ -33,6 +33,10 @@ import numpy as np
 # import keras.models as KM
 
 import mrcnn.utils as utils
+from   mrcnn.logs import get_logger
+from   mrcnn.stage_timer import timed
+
+logger = get_logger(__name__)
 
 ############################################################
 ##  Data Generator
@@ -50,6 +54,7 @@ List of Modules:
 ## LOAD_HEATMAP_NPZ
 ##----------------------------------------------------------------------
 
+@timed('load_heatmap_npz')
 def load_heatmap_npz(dataset, config, image_id, augment=False):
     
     """
@@ -63,7 +68,7 @@ def load_heatmap_npz(dataset, config, image_id, augment=False):
     Returns:
     ---------
     image:              [height, width, 3]
-    pr_hm:              
+    pr_hm:              None with SPARSE_PR_HEATMAPS (not read from the heatmap file)
     pr_hm_scores:    
     gt_hm:      
     gt_hm_scores:               [instance_count, (y1, x1, y2, x2)]
@@ -78,18 +83,26 @@ def load_heatmap_npz(dataset, config, image_id, augment=False):
     heatmap_data  = dataset.load_image_heatmap(image_id)
     gt_hm         = heatmap_data['gt_hm_norm']
     gt_hm_scores  = heatmap_data['gt_hm_scores']
-    pr_hm         = heatmap_data['pr_hm_norm']
+    if config.SPARSE_PR_HEATMAPS:
+        pr_hm     = None
+    elif 'pr_hm_norm' in heatmap_data:
+        pr_hm     = heatmap_data['pr_hm_norm']
+    else:
+        raise ValueError('heatmap file {} holds no pr_hm_norm (built with SPARSE_PR_HEATMAPS), but the FCN '
+                         'expects dense pr_hm input - set SPARSE_PR_HEATMAPS in the FCN config'.format(
+                         dataset.image_info[image_id]['heatmap_path']))
     pr_hm_scores  = heatmap_data['pr_hm_scores']
     image_meta    = heatmap_data['input_image_meta']
-    print(' load_heatmap_npz() :  Load Image id: ', image_id, ' image_id in image_meta[]: ', image_meta[0], ' coco_id' ,
-                dataset.image_info[image_id]['id'])
-    print('     coco path: ', dataset.image_info[image_id]['path'])
-    print('  heatmap path: ', dataset.image_info[image_id]['heatmap_path'])
-    print('  image_meta[0] chaged from :', image_meta[0], ' to : ', image_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(' load_heatmap_npz() :  Load Image id: %s  image_id in image_meta[]: %s  coco_id %s',
+                     image_id, image_meta[0], dataset.image_info[image_id]['id'])
+        logger.debug('     coco path: %s', dataset.image_info[image_id]['path'])
+        logger.debug('  heatmap path: %s', dataset.image_info[image_id]['heatmap_path'])
+        logger.debug('  image_meta[0] chaged from : %s  to : %s', image_meta[0], image_id)
+        logger.debug(' Image shape        : %s %s %s %s', image.shape, image.dtype, np.min(image), np.max(image))
     image_meta[0] = image_id
     
     # print(  heatmap_data.keys())
-    print(' Image shape        : ', image.shape, image.dtype, np.min(image), np.max(image))
     # image, window, scale, padding = utils.resize_image(image,
     image, _ , _ , _  = utils.resize_image(image,
                                      min_dim=config.IMAGE_MIN_DIM,
@@ -204,7 +217,7 @@ def fcn_data_generator(dataset, config, shuffle=True, augment=True,
     #  image_index = -1  
 
     image_ids   = np.copy(dataset.image_ids)
-    print(' FCN DATAGEN starting image_index  ',image_index, 'len of image ids :', len(image_ids))
+    logger.info(' FCN DATAGEN starting image_index  %s len of image ids : %s', image_index, len(image_ids))
     error_count = 0
 
     # Keras requires a generator to run indefinately.
@@ -221,7 +234,7 @@ def fcn_data_generator(dataset, config, shuffle=True, augment=True,
             # Get GT bounding boxes and masks for image.
             #-----------------------------------------------------------------------            
             image_id = image_ids[image_index]
-            print('Image index: ', image_index, 'image_id: ', image_id)
+            logger.debug('Image index: %s image_id: %s', image_index, image_id)
             # image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
             image, pr_hm, pr_hm_scores, gt_hm, gt_hm_scores, image_meta = \
                 load_heatmap_npz(dataset, config, image_id, augment=augment)
@@ -240,7 +253,7 @@ def fcn_data_generator(dataset, config, shuffle=True, augment=True,
             if b == 0:
                 batch_images      = np.zeros( (batch_size,) + image.shape       , dtype=np.float32)
                 batch_image_meta  = np.zeros( (batch_size,) + image_meta.shape  , dtype=image_meta.dtype)
-                batch_pr_hm       = np.zeros( (batch_size,) + pr_hm.shape       , dtype=np.float32)
+                batch_pr_hm       = None if pr_hm is None else np.zeros( (batch_size,) + pr_hm.shape, dtype=np.float32)
                 batch_pr_hm_scores= np.zeros( (batch_size,) + pr_hm_scores.shape, dtype=np.float32)
                 batch_gt_hm       = np.zeros( (batch_size,) + gt_hm.shape       , dtype=np.float32)
                 batch_gt_hm_scores= np.zeros( (batch_size,) + gt_hm_scores.shape, dtype=np.float32)
@@ -250,7 +263,8 @@ def fcn_data_generator(dataset, config, shuffle=True, augment=True,
             #-----------------------------------------------------------------------            
             batch_images[b]                               = utils.mold_image(image.astype(np.float32), config)            
             batch_image_meta[b]                           = image_meta
-            batch_pr_hm[b]                                = pr_hm
+            if pr_hm is not None:
+                batch_pr_hm[b]                            = pr_hm
             batch_pr_hm_scores[b]                         = pr_hm_scores
             batch_gt_hm[b]                                = gt_hm
             batch_gt_hm_scores[b]                         = gt_hm_scores
@@ -267,6 +281,8 @@ def fcn_data_generator(dataset, config, shuffle=True, augment=True,
                           batch_gt_hm,       
                           batch_gt_hm_scores
                          ]
+                if batch_pr_hm is None:
+                    del inputs[1]
                 
                 outputs = []
 
@@ -278,7 +294,7 @@ def fcn_data_generator(dataset, config, shuffle=True, augment=True,
             raise
         except:
             # Log it and skip the image
-            logging.exception("Error processing image {}".format(
+            logger.exception("Error processing image {}".format(
                 dataset.image_info[image_id]))
             error_count += 1
             if error_count > 5:
@@ -361,7 +377,7 @@ def fcn_data_gen_simulate(dataset, config, image_index):
             if b == 0:
                 batch_images      = np.zeros( (batch_size,) + image.shape       , dtype=np.float32)
                 batch_image_meta  = np.zeros( (batch_size,) + image_meta.shape  , dtype=image_meta.dtype)
-                batch_pr_hm       = np.zeros( (batch_size,) + pr_hm.shape       , dtype=np.float32)
+                batch_pr_hm       = None if pr_hm is None else np.zeros( (batch_size,) + pr_hm.shape, dtype=np.float32)
                 batch_pr_hm_scores= np.zeros( (batch_size,) + pr_hm_scores.shape, dtype=np.float32)
                 batch_gt_hm       = np.zeros( (batch_size,) + gt_hm.shape       , dtype=np.float32)
                 batch_gt_hm_scores= np.zeros( (batch_size,) + gt_hm_scores.shape, dtype=np.float32)
@@ -371,7 +387,8 @@ def fcn_data_gen_simulate(dataset, config, image_index):
             #-----------------------------------------------------------------------            
             batch_images[b]                               = utils.mold_image(image.astype(np.float32), config)            
             batch_image_meta[b]                           = image_meta
-            batch_pr_hm[b]                                = pr_hm
+            if pr_hm is not None:
+                batch_pr_hm[b]                            = pr_hm
             batch_pr_hm_scores[b]                         = pr_hm_scores
             batch_gt_hm[b]                                = gt_hm
             batch_gt_hm_scores[b]                         = gt_hm_scores
@@ -389,6 +406,8 @@ def fcn_data_gen_simulate(dataset, config, image_index):
                           batch_gt_hm,       
                           batch_gt_hm_scores
                          ]
+                if batch_pr_hm is None:
+                    del inputs[1]
                 
                 outputs = []
                  
@@ -396,7 +415,7 @@ def fcn_data_gen_simulate(dataset, config, image_index):
             raise
         except:
             # Log it and skip the image
-            logging.exception("Error processing image {}".format(
+            logger.exception("Error processing image {}".format(
                 dataset.image_info[image_id]))
             error_count += 1
             if error_count > 5:
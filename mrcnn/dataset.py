@@ -8,8 +8,8 @@ Written by Waleed Abdulla
 """
 
 import numpy as np
-import skimage.color
-import skimage.io
+from   mrcnn.lazy_modules import LazyModule
+skimage = LazyModule('skimage', imports = ('skimage.color', 'skimage.io'))
 
 ############################################################
 #  Dataset
@@ -517,12 +517,116 @@ def add_evaluation_detections_1(gt_class_ids, gt_bboxes, config, class_pred_stat
         print(mod_detections[top_ids])
         print("\n MAX OVERLAP {:.5f}".format(max_overlap))
     
-    return mod_detections[top_ids], max_overlap    
-    
-    
-    
+    return mod_detections[top_ids], max_overlap
+
+
+def add_evaluation_detections_graph(gt_class_ids, gt_bboxes, config, class_pred_stats):
+    '''
+    TensorFlow graph version of add_evaluation_detections_1 / 2 / 3 (picked by
+    config.EVALUATE_METHOD) for a batch of images. Used by DetectionEvaluateLayer when
+    config.DETECTION_GRAPH is True.
+
+    Builds the same rows as the NumPy versions: every GT box with class > 0 (TP, ind +1)
+    and its flipped box (FP, ind -1, shrunk by 0.85 when its IoU with the GT box is > 0.80),
+    scored with the class average (method 1) or the class 3rd / 1st quantiles (methods 2, 3),
+    plus uniform noise. The noise is drawn by tf.random_uniform, so scores (and the order
+    of rows with close scores) are not the same as the NumPy versions. max_overlap is not
+    computed.
+
+    Inputs:
+    ------
+        gt_class_ids:   [batch, MAX_GT_INSTANCES]
+        gt_bboxes:      [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)] in image coordinates
+        config
+        class_pred_stats
+
+    Returns:
+    --------
+        detections      [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score, tp_ind)]
+                        sorted by decreasing score and zero padded
+    '''
+    height, width   = config.IMAGE_SHAPE[:2]
+    roi_count       = config.DETECTION_MAX_INSTANCES
+    scale           = 0.001
+
+    gt_class_ids    = tf.cast(gt_class_ids, tf.int32)
+    tp_bboxes       = tf.cast(gt_bboxes, tf.float32)
+    gt_mask         = gt_class_ids > 0
+    class_ids       = tf.where(gt_mask, gt_class_ids, tf.zeros_like(gt_class_ids))
+
+    ##----------------------------------------------------------------------------
+    ##  1.  FP boxes: flip_bbox(tp_bboxes, (height, width), flip_x = True, flip_y = True)
+    ##      (flip_bbox takes size as (width, height), y is flipped on width and x on height)
+    ##----------------------------------------------------------------------------
+    fp_bboxes       = tf.stack([width  - tp_bboxes[..., 2], height - tp_bboxes[..., 3],
+                                width  - tp_bboxes[..., 0], height - tp_bboxes[..., 1]], axis = -1)
+
+    def iou(box1, box2):
+        area1 = (box1[..., 2] - box1[..., 0]) * (box1[..., 3] - box1[..., 1])
+        area2 = (box2[..., 2] - box2[..., 0]) * (box2[..., 3] - box2[..., 1])
+        y1 = tf.maximum(box1[..., 0], box2[..., 0])
+        y2 = tf.minimum(box1[..., 2], box2[..., 2])
+        x1 = tf.maximum(box1[..., 1], box2[..., 1])
+        x2 = tf.minimum(box1[..., 3], box2[..., 3])
+        intersection = tf.maximum(x2 - x1, 0.0) * tf.maximum(y2 - y1, 0.0)
+        return intersection / (area1 + area2 - intersection)
+
+    ## Reduce FP boxes that overlap their GT box by more than 0.80
+    large_ious      = tf.expand_dims(iou(tp_bboxes, fp_bboxes) > 0.80, -1)
+    fp_bboxes       = tf.where(tf.tile(large_ious, [1, 1, 4]), tf.round(fp_bboxes * 0.85), fp_bboxes)
+
+    ##----------------------------------------------------------------------------
+    ##  2.  Class scores
+    ##----------------------------------------------------------------------------
+    if config.EVALUATE_METHOD == 1:
+        avg_scores  = np.array(class_pred_stats['avg'], dtype = np.float32)
+        orig_scores = tf.gather(avg_scores, class_ids)
+    else:
+        ## rank of each GT box among the GT boxes of its class, and number of GT boxes of its class
+        pct_scores  = np.array(class_pred_stats['pct'], dtype = np.float32)
+        same_class  = tf.logical_and(tf.equal(tf.expand_dims(class_ids, 2), tf.expand_dims(class_ids, 1)),
+                                     tf.expand_dims(gt_mask, 1))
+        same_class  = tf.cast(same_class, tf.int32)
+        class_count = tf.reduce_sum(same_class, axis = 2)
+        class_rank  = tf.reduce_sum(tf.matrix_band_part(same_class, -1, 0), axis = 2) - 1
+        if config.EVALUATE_METHOD == 2:
+            q3_count = class_count // 2
+        else:
+            q3_count = class_count - class_count // 2
+        orig_scores = tf.where(class_rank < q3_count, tf.gather(pct_scores[:, 2], class_ids),
+                                                      tf.gather(pct_scores[:, 0], class_ids))
+
+    def noisy_scores():
+        noise = tf.random_uniform(tf.shape(orig_scores), minval = -scale, maxval = scale)
+        noise = tf.round(noise * 10000.0) / 10000.0
+        return tf.clip_by_value(orig_scores + noise, 0.0, 1.0)
+
+    tp_scores       = noisy_scores()
+    fp_scores       = noisy_scores()
+
+    ##----------------------------------------------------------------------------
+    ##  3.  TP and FP rows, sorted by decreasing score, keep top DETECTION_MAX_INSTANCES
+    ##----------------------------------------------------------------------------
+    classes         = tf.expand_dims(tf.cast(class_ids, tf.float32), -1)
+    tp_ind          = tf.ones_like(classes)
+    mod_detections  = tf.concat([tf.concat([tp_bboxes, classes, tf.expand_dims(tp_scores, -1),  tp_ind], axis = -1),
+                                 tf.concat([fp_bboxes, classes, tf.expand_dims(fp_scores, -1), -tp_ind], axis = -1)], axis = 1)
+    valid           = tf.cast(tf.concat([gt_mask, gt_mask], axis = 1), tf.float32)
+
+    ## pad with roi_count invalid rows, so top_k always has roi_count rows to pick from
+    mod_detections  = tf.pad(mod_detections, [(0, 0), (0, roi_count), (0, 0)])
+    valid           = tf.pad(valid, [(0, 0), (0, roi_count)])
+    sort_scores     = tf.where(valid > 0, mod_detections[..., 5], -tf.ones_like(mod_detections[..., 5]))
+    _, top_ids      = tf.nn.top_k(sort_scores, k = roi_count)
+
+    batch_ids       = tf.tile(tf.expand_dims(tf.range(tf.shape(top_ids)[0]), 1), [1, roi_count])
+    top_ids         = tf.stack([batch_ids, top_ids], axis = -1)
+    top_valid       = tf.expand_dims(tf.gather_nd(valid, top_ids), -1)
+    return tf.gather_nd(mod_detections, top_ids) * top_valid
+
+
+
 
-        
 class DetectionEvaluateLayer(KE.Layer):
     '''
     Takes classified proposal boxes and their bounding box deltas and
@@ -567,6 +671,9 @@ class DetectionEvaluateLayer(KE.Layer):
         # logt('input_image_meta  ',  inputs[0], verbose = self.verbose) 
         logt('input_gt_class_ids',  inputs[0], verbose = self.verbose) 
         logt('input_gt_bboxes   ',  inputs[1], verbose = self.verbose)
+
+        if self.config.DETECTION_GRAPH:
+            return add_evaluation_detections_graph(inputs[0], inputs[1], self.config, self.class_pred_stats)
     
         def wrapper(gt_class_ids, gt_bboxes):
         # def wrapper(rois, mrcnn_class, mrcnn_bbox, image_meta, gt_class_ids, gt_bboxes):
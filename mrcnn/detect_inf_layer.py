@@ -12,7 +12,9 @@ import numpy as np
 import tensorflow as tf
 import keras.backend as KB
 import keras.engine as KE
-from mrcnn.utils import apply_box_deltas_np, non_max_suppression, logt
+import mrcnn.utils as utils
+import mrcnn.stage_timer as stage_timer
+from mrcnn.utils import apply_box_deltas_np, apply_box_deltas_tf, non_max_suppression_orig, batch_non_max_suppression, logt
 import pprint
 
 pp = pprint.PrettyPrinter(indent=2, width=100)
@@ -36,7 +38,7 @@ def clip_to_window(window, boxes):
     return boxes
 
 
-def refine_detections(rois, probs, deltas, window, config):
+def refine_detections_orig(rois, probs, deltas, window, config):
     '''
     Refine classified proposals and filter overlaps and return final detections.
 
@@ -129,8 +131,8 @@ def refine_detections(rois, probs, deltas, window, config):
         # print('pre_nms_scores.shape :', pre_nms_scores[ixs].shape)
         # pp.pprint(pre_nms_scores[ixs])    
         # Apply NMS
-        class_keep = non_max_suppression(pre_nms_rois[ixs], 
-                                         pre_nms_scores[ixs],
+        class_keep = non_max_suppression_orig(pre_nms_rois[ixs], 
+                                              pre_nms_scores[ixs],
                                          config.DETECTION_NMS_THRESHOLD)
         # Map indicies
         class_keep = keep[ixs[class_keep]]
@@ -163,6 +165,247 @@ def refine_detections(rois, probs, deltas, window, config):
     return result
 
 
+def refine_detections(rois, probs, deltas, window, config):
+    '''
+    Refine classified proposals and filter overlaps and return final detections.
+
+    Inputs:
+    ------
+        
+    rois:           rpn_rois    - [N, (y1, x1, y2, x2)] in normalized coordinates
+    
+                    passed from PROPOSAL_LAYER
+                                  
+    probs:          mrcnn_class - [N, num_classes]. Class probabilities.
+    deltas:         mrcnn_bbox  - [N, num_classes, (dy, dx, log(dh), log(dw))]. 
+                                  Class-specific bounding box deltas.
+                    
+                    passed from FPN_CLASSIFIER_GRAPH              
+    window:         
+    (y1, x1, y2, x2) in image coordinates. The part of the image
+                    that contains the image excluding the padding.
+
+    Returns:
+    --------
+    detections      [M, (y1, x1, y2, x2, class_id, score)]
+                    M - determined by DETECTION_MAX_INSTANCES
+                    
+                    detection bounding boxes -- these have had the corresponding 
+                    deltas applied, and their boundries clipped to the image window
+    '''
+
+    
+    ##----------------------------------------------------------------------------
+    ##  1. Find Class IDs with higest scores for each per ROI
+    ##----------------------------------------------------------------------------
+    class_ids       = np.argmax(probs, axis=1)
+    
+    ##----------------------------------------------------------------------------
+    ##  2. Get Class probability(score) and bbox delta of the top class of each ROI
+    ##----------------------------------------------------------------------------
+    class_scores    =  probs[np.arange(class_ids.shape[0]), class_ids]
+    deltas_specific = deltas[np.arange(deltas.shape[0])   , class_ids]
+    
+    ##----------------------------------------------------------------------------
+    ##  3. Apply bounding box delta to the corrsponding rpn_proposal
+    ##----------------------------------------------------------------------------
+    # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
+    refined_rois    = apply_box_deltas_np(rois, deltas_specific * config.BBOX_STD_DEV)
+    
+    ##----------------------------------------------------------------------------
+    ##  4. Convert the refined roi coordiates from normalized to NN image domain
+    ##  5.  Clip boxes to image window
+    ##  6.  Round and cast to int since we're deadling with pixels now
+    ##----------------------------------------------------------------------------
+    # TODO: better to keep them normalized until later   
+    height, width   = config.IMAGE_SHAPE[:2]
+    refined_rois   *= np.array([height, width, height, width])
+    refined_rois    = clip_to_window(window, refined_rois)
+    refined_rois    = np.rint(refined_rois).astype(np.int32)
+
+    ##----------------------------------------------------------------------------
+    ##  7.  TODO: Filter out boxes with zero area
+    ##----------------------------------------------------------------------------
+
+    ##----------------------------------------------------------------------------
+    ##  8.  Filter out background boxes
+    ##      keep : contains indices of non-zero elements in class_ids
+    ##      config.DETECTION_MIN_CONFIDENCE == 0 
+    ##      np.intersect: find indices into class_ids that satisfy:
+    ##        -  class_id     >  0 
+    ##        -  class_scores >=            config.DETECTION_MIN_CONFIDENCE (0.3)
+    ##----------------------------------------------------------------------------
+    keep = np.where(class_ids > 0)[0]
+    # Filter out low confidence boxes
+    if config.DETECTION_MIN_CONFIDENCE:
+        keep = np.intersect1d(keep, np.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[0])
+
+    ##----------------------------------------------------------------------------
+    ##  9.  Apply per-class NMS (all classes in one batch_non_max_suppression call)
+    ##----------------------------------------------------------------------------
+    pre_nms_class_ids = class_ids[keep]
+    pre_nms_scores    = class_scores[keep]
+    pre_nms_rois      = refined_rois[keep]
+    nms_keep          = batch_non_max_suppression(pre_nms_rois, pre_nms_scores, 
+                                                  config.DETECTION_NMS_THRESHOLD, group_ids = pre_nms_class_ids)
+    keep = np.sort(keep[nms_keep]).astype(np.int32)
+
+    ##----------------------------------------------------------------------------
+    ## 10.  Keep top detections
+    ##----------------------------------------------------------------------------
+    roi_count = config.DETECTION_MAX_INSTANCES
+    top_ids   = np.argsort(class_scores[keep])[::-1][:roi_count]
+    keep      = keep[top_ids]
+
+    ##----------------------------------------------------------------------------
+    ## 11.  Add a detect_ind = +1 to differentiate from false postives added in eval layer
+    ##----------------------------------------------------------------------------
+    detect_ind    = np.ones((top_ids.shape[0],1))
+ 
+
+    ##----------------------------------------------------------------------------
+    ## 11.  Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
+    ##      Coordinates are in image domain.
+    ##----------------------------------------------------------------------------
+    result = np.hstack((refined_rois[keep],
+                        class_ids   [keep][..., np.newaxis],
+                        class_scores[keep][..., np.newaxis],
+                        detect_ind))
+
+    return result
+
+
+def refine_detections_batch(rois, probs, deltas, windows, config):
+    '''
+    refine_detections() for all images of a batch at once. Per-class NMS runs for all images 
+    and classes in one batch_non_max_suppression() call.
+
+    Inputs:
+    ------
+    rois:           rpn_rois    - [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+    probs:          mrcnn_class - [batch, N, num_classes]. Class probabilities.
+    deltas:         mrcnn_bbox  - [batch, N, num_classes, (dy, dx, log(dh), log(dw))]. 
+    windows:        [batch, (y1, x1, y2, x2)] in image coordinates
+    
+    Returns:
+    --------
+    detections      [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score, detect_ind)]
+                    same rows as refine_detections() for each image, zero padded
+    '''
+    batch_size, num_rois, num_classes = probs.shape
+    roi_count       = config.DETECTION_MAX_INSTANCES
+    image_ids       = np.repeat(np.arange(batch_size), num_rois)
+    probs           = probs.reshape(-1, num_classes)
+    
+    ## 1-6. Top class, its score and refined box of each ROI, clipped to the image window  
+    class_ids       = np.argmax(probs, axis=1)
+    class_scores    = probs[np.arange(class_ids.shape[0]), class_ids]
+    deltas_specific = deltas.reshape(-1, num_classes, 4)[np.arange(class_ids.shape[0]), class_ids]
+    refined_rois    = apply_box_deltas_np(rois.reshape(-1, 4), deltas_specific * config.BBOX_STD_DEV)
+    
+    height, width   = config.IMAGE_SHAPE[:2]
+    refined_rois   *= np.array([height, width, height, width])
+    window          = windows[image_ids]
+    refined_rois    = np.maximum(np.minimum(refined_rois, window[:, [2,3,2,3]]), window[:, [0,1,0,1]])
+    refined_rois    = np.rint(refined_rois).astype(np.int32)
+
+    ## 8. Filter out background and low confidence boxes
+    keep_mask = class_ids > 0
+    if config.DETECTION_MIN_CONFIDENCE:
+        keep_mask &= class_scores >= config.DETECTION_MIN_CONFIDENCE
+    keep = np.flatnonzero(keep_mask)
+
+    ## 9. Per-image, per-class NMS
+    nms_keep = batch_non_max_suppression(refined_rois[keep], class_scores[keep], config.DETECTION_NMS_THRESHOLD, 
+                                         group_ids = image_ids[keep] * num_classes + class_ids[keep])
+    keep = keep[nms_keep]
+
+    ## 10. Keep top detections of each image: highest score first (ties: highest index first)
+    keep      = keep[np.lexsort((-keep, -class_scores[keep], image_ids[keep]))]
+    image_ix  = image_ids[keep]
+    rank      = np.arange(keep.shape[0]) - np.searchsorted(image_ix, image_ix)
+    keep, image_ix, rank = keep[rank < roi_count], image_ix[rank < roi_count], rank[rank < roi_count]
+
+    ## 11. Arrange output as [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score, detect_ind)]
+    detections = np.zeros((batch_size, roi_count, 7), dtype = np.float32)
+    detections[image_ix, rank, :4] = refined_rois[keep]
+    detections[image_ix, rank,  4] = class_ids[keep]
+    detections[image_ix, rank,  5] = class_scores[keep]
+    detections[image_ix, rank,  6] = 1
+    return detections
+
+
+def refine_detections_graph(rois, probs, deltas, windows, config):
+    '''
+    TensorFlow graph version of refine_detections_batch(), used by DetectionInferenceLayer
+    when config.DETECTION_GRAPH is True.
+
+    Per-class NMS runs as one tf.image.non_max_suppression() call per image: each box is
+    shifted by class_id * (max(height, width) + 1) pixels, so boxes of different classes
+    never overlap and are not suppressed by each other. NMS returns the kept boxes in
+    decreasing score order, so its first DETECTION_MAX_INSTANCES picks are the top detections.
+
+    Boxes are decoded in float32 (refine_detections() uses float64), so a coordinate close
+    to x.5 can round to the neighbouring pixel, and tied scores may come out in a different order.
+
+    Inputs:
+    ------
+    rois:           rpn_rois    - [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+    probs:          mrcnn_class - [batch, N, num_classes]. Class probabilities.
+    deltas:         mrcnn_bbox  - [batch, N, num_classes, (dy, dx, log(dh), log(dw))].
+    windows:        [batch, (y1, x1, y2, x2)] in image coordinates
+
+    Returns:
+    --------
+    detections      [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score, detect_ind)]
+    '''
+    roi_count       = config.DETECTION_MAX_INSTANCES
+    num_classes     = config.NUM_CLASSES
+    height, width   = config.IMAGE_SHAPE[:2]
+    class_offset    = float(max(height, width) + 1)
+
+    ## 1-3. Top class, its score and class specific bbox delta applied to each ROI
+    class_ids       = tf.argmax(probs, axis = -1, output_type = tf.int32)
+    class_scores    = tf.reduce_max(probs, axis = -1)
+    class_onehot    = tf.one_hot(class_ids, num_classes, dtype = tf.float32)
+    deltas_specific = tf.reduce_sum(deltas * tf.expand_dims(class_onehot, -1), axis = 2)
+    deltas_specific = deltas_specific * np.reshape(config.BBOX_STD_DEV, [1, 1, 4]).astype(np.float32)
+    refined_rois    = apply_box_deltas_tf(rois, deltas_specific)
+
+    ## 4-6. Image coordinates, clipped to the image window and rounded to pixels
+    refined_rois   *= np.array([height, width, height, width], dtype = np.float32)
+    windows         = tf.expand_dims(tf.cast(windows, tf.float32), 1)
+    low_vals        = tf.gather(windows, [0, 1, 0, 1], axis = -1)
+    high_vals       = tf.gather(windows, [2, 3, 2, 3], axis = -1)
+    refined_rois    = tf.round(tf.maximum(tf.minimum(refined_rois, high_vals), low_vals))
+
+    ## 8. Filter out background and low confidence boxes
+    keep_mask = class_ids > 0
+    if config.DETECTION_MIN_CONFIDENCE:
+        keep_mask = tf.logical_and(keep_mask, class_scores >= config.DETECTION_MIN_CONFIDENCE)
+
+    ## 9-11. Per-class NMS and top detections of each image
+    def nms(boxes, scores, class_ids, keep_mask):
+        keep      = tf.where(keep_mask)[:, 0]
+        pre_boxes = tf.gather(boxes, keep)
+        pre_class = tf.cast(tf.gather(class_ids, keep), tf.float32)
+        nms_keep  = tf.image.non_max_suppression(pre_boxes + tf.expand_dims(pre_class, -1) * class_offset,
+                                                 tf.gather(scores, keep),
+                                                 roi_count,
+                                                 config.DETECTION_NMS_THRESHOLD,
+                                                 name = 'detection_non_max_suppression')
+        keep      = tf.gather(keep, nms_keep)
+        scores    = tf.expand_dims(tf.gather(scores, keep), -1)
+        class_ids = tf.expand_dims(tf.cast(tf.gather(class_ids, keep), tf.float32), -1)
+        detections = tf.concat([tf.gather(boxes, keep), class_ids, scores, tf.ones_like(scores)], axis = -1)
+        # Pad with zeros if detections < DETECTION_MAX_INSTANCES
+        padding    = tf.maximum(roi_count - tf.shape(detections)[0], 0)
+        return tf.pad(detections, [(0, padding), (0, 0)])
+
+    return utils.batch_slice([refined_rois, class_scores, class_ids, keep_mask], nms,
+                              config.BATCH_SIZE, names = ['detections'])
+
+
 class DetectionInferenceLayer(KE.Layer):
     '''
     Takes classified proposal boxes and their bounding box deltas and
@@ -198,41 +441,18 @@ class DetectionInferenceLayer(KE.Layer):
         logt('mrcnn_class.shape ',  inputs[1], verbose = self.verbose) 
         logt('mrcnn_bboxes.shape',  inputs[2], verbose = self.verbose)
         logt('input_image_meta  ',  inputs[3], verbose = self.verbose) 
+
+        if self.config.DETECTION_GRAPH:
+            rois, mrcnn_class, mrcnn_bbox, image_meta = inputs
+            _, _, windows, _ = utils.parse_image_meta_graph(image_meta)
+            return refine_detections_graph(rois, mrcnn_class, mrcnn_bbox, windows, self.config)
     
         def wrapper(rois, mrcnn_class, mrcnn_bbox, image_meta):
             from mrcnn.utils import parse_image_meta
-            detections_batch = []
-            # logt('detection wrapper - rpn_proposals_roi  ',  rois       , verbose = self.verbose)
-            # logt('detection wrapper - mrcnn_class.shape  ',  mrcnn_class, verbose = self.verbose)
-            # logt('detection wrapper - mrcnn_bboxes.shape ',  mrcnn_bbox , verbose = self.verbose)
-            # logt('detection wrapper - image_meta         ',  image_meta , verbose = self.verbose)
-            # process item per item in batch 
-            
-            for b in range(self.config.BATCH_SIZE):
-                _, _, window, _ =  parse_image_meta(image_meta)
-
-                detections = refine_detections(rois[b], mrcnn_class[b], mrcnn_bbox[b], window[b], self.config)
-                # if self.verbose:
-                    # print('\n\n config.DETECTION_MAX_INSTANCES: ', self.config.DETECTION_MAX_INSTANCES)
-                    # print(' Detections shape:', detections.shape)
-                # print(detections)
-                
-                # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-                gap = self.config.DETECTION_MAX_INSTANCES - detections.shape[0]
-                assert gap >= 0
-                if gap > 0:
-                    detections = np.pad(detections, [(0, gap), (0, 0)], 'constant', constant_values=0)
-
-                detections_batch.append(detections)
-
-            # Stack detections and cast to float32
-            # TODO: track where float64 is introduced
-            detections_batch = np.array(detections_batch).astype(np.float32)
-            num_columns = detections_batch.shape[-1]
-
-            # Reshape output
-            # [batch, num_detections, (y1, x1, y2, x2, class_score)] in pixels
-            return np.reshape(detections_batch, [self.config.BATCH_SIZE, self.config.DETECTION_MAX_INSTANCES, num_columns])
+            _, _, windows, _ =  parse_image_meta(image_meta)
+            # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score, detect_ind)] in pixels
+            with stage_timer.stage('detection_refine'):
+                return refine_detections_batch(rois, mrcnn_class, mrcnn_bbox, windows, self.config)
 
         # Return wrapped function
         return tf.py_func(wrapper, inputs, tf.float32, name="detections")
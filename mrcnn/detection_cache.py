@@ -0,0 +1,202 @@
+"""
+Mask R-CNN
+On-disk cache of MRCNN detection results (detections, pr_hm, pr_hm_scores, ...)
+
+MRCNN outputs only depend on the MRCNN weights, the MRCNN configuration, the input
+image and the detection method (inference / evaluate method), so FCN evaluations
+can reuse them across FCN checkpoints. Entries are keyed by a SHA1 digest of:
+
+    - MRCNN weights digest       (ModelBase.weights_digest, chained digest of loaded weight files)
+    - MRCNN config digest        (Config.digest(), leaving out CONFIG_DIGEST_EXCLUDE)
+    - detection method           ('inference' or 'evaluate_<EVALUATE_METHOD>')
+    - image tag                  (dataset source + source image id + a digest of the image's
+                                  image_info entry, or a digest of the image and ground truth
+                                  arrays when no id is available)
+
+The image_info digest covers the image spec and annotations (NewShapes shapes and background,
+COCO annotations, file path), so datasets that reuse sources and ids (e.g. NewShapes test
+sets, all source 'shapes' with ids 0..N-1) get distinct entries in a shared cache directory.
+
+Each entry is a pickle file in cache_dir/<key[:2]>/<key>.pkl, holding the MRCNN result
+dict minus the 'image' and 'molded_image' arrays.
+"""
+import os, json, pickle, hashlib
+import numpy as np
+
+from   mrcnn.datagen import data_gen_simulate
+
+## Configuration values that do not change MRCNN outputs
+CONFIG_DIGEST_EXCLUDE = ['NAME', 'BATCH_SIZE', 'IMAGES_PER_GPU', 'GPU_COUNT', 'SYSOUT', 'VERBOSE',
+                         'NEW_LOG_FOLDER', 'TRAINING_PATH', 'DIR_DATASET', 'DIR_TRAINING', 'DIR_PRETRAINED',
+                         'COCO_DATASET_PATH', 'COCO_HEATMAP_PATH', 'COCO_MODEL_PATH', 'RESNET_MODEL_PATH', 'VGG16_MODEL_PATH',
+                         'SHAPES_MODEL_PATH', 'DATAGEN_WORKERS', 'DATAGEN_QUEUE_SIZE', 'FCN_INPUT_QUEUE_SIZE']
+
+## result entries that are not written to the cache
+UNCACHED_KEYS = ['image', 'molded_image']
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def image_info_digest(info):
+    '''
+    Digest of a dataset image_info entry (image spec, annotations, path)
+    '''
+    text = json.dumps(info, sort_keys = True, default = _json_default)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class DetectionCache(object):
+    '''
+    Content-addressed cache of MRCNN results for one MRCNN model state.
+
+    The cache object only holds digests (no reference to the model), so it can be
+    pickled and passed to worker processes that read entries with load().
+    Create a new DetectionCache after loading different MRCNN weights.
+    '''
+
+    def __init__(self, cache_dir, mrcnn_model):
+        if mrcnn_model.weights_digest is None:
+            raise ValueError('DetectionCache: MRCNN model has no weights loaded')
+
+        self.cache_dir      = cache_dir
+        self.weights_digest = mrcnn_model.weights_digest
+        self.config_digest  = mrcnn_model.config.digest(exclude = CONFIG_DIGEST_EXCLUDE)
+        if mrcnn_model.mode == 'evaluate':
+            self.method     = 'evaluate_{}'.format(mrcnn_model.config.EVALUATE_METHOD)
+        else:
+            self.method     = mrcnn_model.mode
+        self.hits           = 0
+        self.misses         = 0
+
+    ##------------------------------------------------------------------------------------
+    ## keys and entries
+    ##------------------------------------------------------------------------------------
+    def key(self, image_tag):
+        h = hashlib.sha1()
+        h.update('{}|{}|{}|{}'.format(self.weights_digest, self.config_digest, self.method, image_tag).encode('utf-8'))
+        return h.hexdigest()
+
+    def image_id_key(self, dataset, image_id):
+        info = dataset.image_info[image_id]
+        return self.key('id:{}:{}:{}:{}'.format(info['source'], info['id'], image_id, image_info_digest(info)))
+
+    def array_key(self, *arrays):
+        h = hashlib.sha1()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            h.update('{}{}'.format(array.dtype, array.shape).encode('utf-8'))
+            h.update(array.tobytes())
+        return self.key('array:' + h.hexdigest())
+
+    def filename(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def contains(self, key):
+        return os.path.isfile(self.filename(key))
+
+    def load(self, key):
+        '''
+        Returns the cached result dict for key, or None on a miss
+        '''
+        try:
+            with open(self.filename(key), 'rb') as infile:
+                result = pickle.load(infile)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def save(self, key, result):
+        filename = self.filename(key)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), exist_ok = True)
+        entry = {k: v for k, v in result.items() if k not in UNCACHED_KEYS}
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as outfile:
+            pickle.dump(entry, outfile, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+
+    def display(self):
+        print(' Detection cache: {}  method: {}  hits: {}  misses: {}'.format(
+                self.cache_dir, self.method, self.hits, self.misses))
+
+    ##------------------------------------------------------------------------------------
+    ## cached MRCNN calls
+    ##------------------------------------------------------------------------------------
+    def evaluate(self, mrcnn_model, dataset, image_ids, verbose = 0):
+        '''
+        MRCNN evaluate() results for a list of dataset image ids. Cached results are read
+        from disk, misses are run through mrcnn_model in batches of config.BATCH_SIZE (the
+        last batch padded by repeating its last image) and written to the cache.
+
+        Cached results do not include the 'image' and 'molded_image' arrays.
+        '''
+        if not isinstance(image_ids, list):
+            image_ids = [image_ids]
+        keys       = [self.image_id_key(dataset, image_id) for image_id in image_ids]
+        results    = [self.load(key) for key in keys]
+        miss_idxs  = [i for i, r in enumerate(results) if r is None]
+        batch_size = mrcnn_model.config.BATCH_SIZE
+
+        for start in range(0, len(miss_idxs), batch_size):
+            batch_idxs = miss_idxs[start : start + batch_size]
+            batch_ids  = [image_ids[i] for i in batch_idxs]
+            batch_ids += [batch_ids[-1]] * (batch_size - len(batch_ids))
+
+            images     = [dataset.load_image(image_id) for image_id in batch_ids]
+            batch_x, _ = data_gen_simulate(dataset, mrcnn_model.config, batch_ids)
+            batch_results = mrcnn_model.evaluate([images, batch_x[0], batch_x[1], batch_x[4], batch_x[5]], verbose = verbose)
+
+            for i, r in zip(batch_idxs, batch_results):
+                self.save(keys[i], r)
+                results[i] = r
+
+        if verbose:
+            print(' DetectionCache.evaluate(): {} images, {} read from cache'.format(len(image_ids), len(image_ids) - len(miss_idxs)))
+        return results
+
+    def evaluate_batch(self, mrcnn_model, evaluate_batch, verbose = 0):
+        '''
+        Cached version of mrcnn_model.evaluate(evaluate_batch), keyed on the contents of
+        each image and its ground truth class ids / boxes. The MRCNN model is only run
+        when at least one image of the batch is not in the cache.
+        '''
+        images, molded_images, image_metas, gt_class_ids, gt_bboxes = evaluate_batch
+        keys    = [self.array_key(images[i], gt_class_ids[i], gt_bboxes[i]) for i in range(len(images))]
+        results = [self.load(key) for key in keys]
+
+        if any(r is None for r in results):
+            results = mrcnn_model.evaluate(evaluate_batch, verbose = verbose)
+            for key, r in zip(keys, results):
+                self.save(key, r)
+        else:
+            for i, r in enumerate(results):
+                r['image']        = images[i]
+                r['molded_image'] = molded_images[i]
+        return results
+
+    def detect(self, mrcnn_model, images, verbose = 0):
+        '''
+        Cached version of mrcnn_model.detect(images), keyed on the contents of each image.
+        The MRCNN model is only run when at least one image is not in the cache.
+        '''
+        keys    = [self.array_key(image) for image in images]
+        results = [self.load(key) for key in keys]
+
+        if any(r is None for r in results):
+            results = mrcnn_model.detect(images, verbose = verbose)
+            for key, r in zip(keys, results):
+                self.save(key, r)
+        else:
+            molded_images, _, _ = mrcnn_model.mold_inputs(images)
+            for i, r in enumerate(results):
+                r['image']        = images[i]
+                r['molded_image'] = molded_images[i]
+        return results
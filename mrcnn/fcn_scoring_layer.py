@@ -7,6 +7,7 @@ import keras.layers as KL
 import keras.engine as KE
 # sys.path.append('..')
 import mrcnn.utils as utils
+import mrcnn.heatmap_kernels as hmk
 from mrcnn.utils   import  logt
 # import tensorflow.contrib.util as tfc
 from mrcnn.chm_layer import build_hm_score_v2, build_hm_score_v3, normalize_scores
@@ -16,6 +17,7 @@ from mrcnn.chm_layer import build_hm_score_v2, build_hm_score_v3, normalize_scor
    
 ##-------------------------------------------------------------------------------------------------------
 ##   score fcn heatmaps : gen scores from heatmap
+##   fcn_scoring_graph_orig: tf.map_fn version - replaced by fcn_scoring_graph (below), kept for reference
 ##-------------------------------------------------------------------------------------------------------
 ##   We use the coordinates of the bounding boxes passed in pr_scores to calculate 
 ##   the score of bounding boxes overlaid on the heatmap produced by the fcn_layer
@@ -25,7 +27,7 @@ from mrcnn.chm_layer import build_hm_score_v2, build_hm_score_v3, normalize_scor
 ##   - calculate the Cy, Cx, and Covar of the bounding boxes 
 ##   - Clip the heatmap by using masks centered on Cy,Cx and +/- Covar_Y, Covar_X
 ##-------------------------------------------------------------------------------------------------------
-def fcn_scoring_graph(input, config, mode):
+def fcn_scoring_graph_orig(input, config, mode):
     in_heatmap, pr_scores = input
     detections_per_image  = pr_scores.shape[2] 
     rois_per_image        = KB.int_shape(pr_scores)[2] 
@@ -200,6 +202,79 @@ def fcn_scoring_graph(input, config, mode):
    
     return fcn_scores_by_class
     
+
+##-------------------------------------------------------------------------------------------------------
+##   fcn_scoring_graph - vectorized
+##-------------------------------------------------------------------------------------------------------
+##   Same inputs / outputs as fcn_scoring_graph_orig. Scores of all boxes are read from summed area
+##   tables of the per-class FCN heatmaps (mrcnn/heatmap_kernels.py) instead of tf.map_fn passes
+##   over a gathered [num_boxes, h, w] heatmap tensor.
+##-------------------------------------------------------------------------------------------------------
+def fcn_scoring_graph(input, config, mode):
+    in_heatmap, pr_scores = input
+    detections_per_image  = pr_scores.shape[2] 
+    rois_per_image        = KB.int_shape(pr_scores)[2] 
+    batch_size            = config.BATCH_SIZE
+    num_classes           = config.NUM_CLASSES  
+    heatmap_scale         = config.HEATMAP_SCALE_FACTOR
+    class_column          = 4
+    norm_score_column     = 7 if mode == 'training' else 8
+    scores_shape          = [batch_size, num_classes, rois_per_image, 3]
+        
+    print('\n ')
+    print('----------------------')
+    print('>>> FCN Scoring Layer - mode:', mode)
+    print('----------------------')
+    logt('in_heatmap.shape  ', in_heatmap)
+    logt('pr_hm_scores.shape', pr_scores)
+    
+    ##---------------------------------------------------------------------------------------------
+    ## Stack non_zero bboxes from PR_SCORES into pt2_dense 
+    ##---------------------------------------------------------------------------------------------
+    pt2_sum = tf.reduce_sum(tf.abs(pr_scores[:,:,:,:class_column]), axis=-1)
+    pt2_ind = tf.where(pt2_sum > 0)
+    pt2_dense = tf.gather_nd(pr_scores, pt2_ind)
+    logt('pt2_ind shape    ', pt2_ind)
+    logt('pt2_dense shape  ', pt2_dense)
+
+    ##---------------------------------------------------------------------------------------------
+    ##  Scores over the per-class heatmaps (alt_scores_1) and the per-class normalized 
+    ##  heatmaps (alt_scores_2)
+    ##---------------------------------------------------------------------------------------------
+    bboxes_scaled   = pt2_dense[...,0:class_column] / heatmap_scale
+    cy, cx, covar   = hmk.gaussian_parms(bboxes_scaled)
+    in_heatmap      = tf.transpose(in_heatmap, [0,3,1,2])
+    in_heatmap_norm = hmk.normalize_heatmaps(in_heatmap)
+
+    old_style_scores, alt_scores_1 = hmk.heatmap_box_scores(in_heatmap, pt2_ind, bboxes_scaled, 
+                                                            pt2_dense[:, norm_score_column], cy, cx, covar)
+    _               , alt_scores_2 = hmk.heatmap_box_scores(in_heatmap_norm, pt2_ind, bboxes_scaled, 
+                                                            pt2_dense[:, norm_score_column], cy, cx, covar)
+    logt('old_style_scores',  old_style_scores)                                 
+    logt('alt_scores_1 ', alt_scores_1 )
+    logt('alt_scores_2 ', alt_scores_2 )
+
+    ##---------------------------------------------------------------------------------------------
+    ##  Scatter back to per-class tensor /  normalize by class / gather back to dense 
+    ##---------------------------------------------------------------------------------------------
+    alt_scores_1_norm = normalize_scores(tf.scatter_nd(pt2_ind, alt_scores_1, scores_shape, name='alt_scores_1_norm'))
+    alt_scores_1_norm = tf.gather_nd(alt_scores_1_norm, pt2_ind)
+    alt_scores_2_norm = normalize_scores(tf.scatter_nd(pt2_ind, alt_scores_2, scores_shape, name='alt_scores_2'))
+    alt_scores_2_norm = tf.gather_nd(alt_scores_2_norm, pt2_ind)
+
+    ##--------------------------------------------------------------------------------------------
+    ##  Append scores to yield fcn_scores_dense, and scatter back to per-class tensor 
+    ##--------------------------------------------------------------------------------------------
+    fcn_scores_dense = tf.concat([pt2_dense[:, : norm_score_column+1], old_style_scores, alt_scores_1, alt_scores_1_norm, alt_scores_2, alt_scores_2_norm], 
+                                  axis = -1, name = 'fcn_scores_dense')
+    fcn_scores_by_class = tf.scatter_nd(pt2_ind, fcn_scores_dense, 
+                                        [batch_size, num_classes, detections_per_image, fcn_scores_dense.shape[-1]], name='fcn_hm_scores')
+    logt('fcn_scores_dense    ', fcn_scores_dense )  
+    logt('fcn_scores_by_class ', fcn_scores_by_class) 
+    logt('complete')    
+   
+    return fcn_scores_by_class
+    
 ##------------------------------------------------------------------------------------------------------------
 ##
 ##------------------------------------------------------------------------------------------------------------
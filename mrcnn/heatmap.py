@@ -27,6 +27,7 @@ from   mrcnn.config import Config
 import mrcnn.utils as utils
 # import mrcnn.model as modellib
 import mrcnn.dataset as dataset
+from   mrcnn.heatmap_store import HeatmapStore, is_heatmap_store
 
 
 # ############################################################
@@ -148,6 +149,15 @@ class HeatmapDataset(dataset.Dataset):
         ##--------------------------------------------------------------
         ## Add images to dataset.image_info structure
         ##-------------------------------------------------------------- 
+        ## If heatmap_dir holds a heatmap store (see heatmap_store.py) read heatmaps 
+        ## from the store instead of the individual hm_*.npz files
+        heatmap_store = None
+        if is_heatmap_store(heatmap_dir):
+            if not hasattr(self, 'heatmap_stores'):
+                self.heatmap_stores = {}
+            heatmap_store = self.heatmap_stores.setdefault(heatmap_dir, HeatmapStore(heatmap_dir))
+            heatmap_store.display()
+            
         heatmap_notfound=  heatmap_found = 0
         print(heatmap_notfound, heatmap_found)
         for i in image_ids:
@@ -156,8 +166,14 @@ class HeatmapDataset(dataset.Dataset):
             heatmap_path = os.path.join(heatmap_dir, heatmap_filename) 
             
             ## Only load image_info data structure for images where the corrsponding 
-            ## heatmap .npz file exist
-            if not os.path.isfile(heatmap_path):
+            ## heatmap .npz file (or heatmap store entry) exist
+            if heatmap_store is not None:
+                heatmap_exists = i in heatmap_store
+                heatmap_path   = heatmap_dir
+            else:
+                heatmap_exists = os.path.isfile(heatmap_path)
+                
+            if not heatmap_exists:
                 # print('file not found:::',heatmap_filename)
                 heatmap_notfound += 1
             else:
@@ -167,6 +183,7 @@ class HeatmapDataset(dataset.Dataset):
                     width=coco.imgs[i]["width"],
                     height=coco.imgs[i]["height"],
                     heatmap_path=heatmap_path,
+                    heatmap_store=heatmap_store is not None,
                     annotations=coco.loadAnns(coco.getAnnIds(
                                                 imgIds=[i], catIds=class_ids, iscrowd=None))
                     
@@ -240,6 +257,8 @@ class HeatmapDataset(dataset.Dataset):
         heatmap_file = self.image_info[image_id]['heatmap_path']
         # print('Read from : ', coco_file) 
         # print('Read from : ', heatmap_file)
+        if self.image_info[image_id].get('heatmap_store', False):
+            return self.heatmap_stores[heatmap_file].read(self.image_info[image_id]['id'])
         loaddata = np.load(heatmap_file)
         # print(loaddata.keys())
         # for i in loaddata.keys():
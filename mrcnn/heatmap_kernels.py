@@ -0,0 +1,330 @@
+"""
+Mask R-CNN
+Vectorized heatmap and score kernels shared by the CHM layers (chm_layer, chm_layer_inf,
+chm_layer_tgt), the FCN scoring layer and the FCN input layer (SPARSE_PR_HEATMAPS).
+
+These replace the per-box tf.map_fn passes (build_hm_score_v2, clip_heatmap, build_hm_score_v3)
+and the dense [batch, classes, rois, h, w] scatter with:
+
+    - separable Gaussians :     the diagonal MultivariateNormal density is the outer product of two
+                                1-D normal densities, so per-box sums and maxima reduce to 1-D sums/maxima
+    - box-masked sums     :     summed area (cumulative sum) tables, one per (image, class) heatmap
+    - per-class heatmaps  :     unsorted_segment_sum / unsorted_segment_max on segment id
+                                (image_index * num_classes + class_index)
+
+Box windows follow the index extents produced by tf.range(start, end) in the map_fn versions:
+rows floor(start) ... floor(start) + ceil(end - start) - 1, so scores are identical to the
+original graph (up to float rounding).
+"""
+import math
+import tensorflow as tf
+import keras.backend as KB
+
+
+##-----------------------------------------------------------------------------------------------------------
+## Box windows and masks
+##-----------------------------------------------------------------------------------------------------------
+def gaussian_parms(bboxes_scaled):
+    '''
+    Center and standard deviations of the Gaussian built for each box
+
+    Inputs:
+    -----------
+        bboxes_scaled  :    [N, (y1, x1, y2, x2)] in heatmap coordinates
+
+    Returns
+    -----------
+        cy, cx         :    [N] box centers
+        covar          :    [N, (sigma_x, sigma_y)] = sqrt(width / 2), sqrt(height / 2)
+    '''
+    width  = bboxes_scaled[:,3] - bboxes_scaled[:,1]
+    height = bboxes_scaled[:,2] - bboxes_scaled[:,0]
+    cx     = bboxes_scaled[:,1] + ( width  / 2.0)
+    cy     = bboxes_scaled[:,0] + ( height / 2.0)
+    covar  = tf.sqrt(tf.stack((width * 0.5 , height * 0.5), axis = -1))
+    return cy, cx, covar
+
+
+def range_window(start, end, size):
+    '''
+    [lo, hi) int32 index extent covered by tf.to_int32(tf.range(start, end)), clipped to [0, size]
+    '''
+    lo = tf.floor(start)
+    hi = lo + tf.maximum(tf.ceil(end - start), 0.0)
+    lo = tf.clip_by_value(lo, 0.0, float(size))
+    hi = tf.clip_by_value(hi, 0.0, float(size))
+    return tf.to_int32(lo), tf.to_int32(hi)
+
+
+def bbox_windows(bboxes_scaled, grid_h, grid_w):
+    '''
+    Windows covering the complete bounding box (as used by build_hm_score_v2)
+    Returns (y_lo, y_hi, x_lo, x_hi), each [N] int32
+    '''
+    y_lo, y_hi = range_window(bboxes_scaled[:,0], bboxes_scaled[:,2], grid_h)
+    x_lo, x_hi = range_window(bboxes_scaled[:,1], bboxes_scaled[:,3], grid_w)
+    return y_lo, y_hi, x_lo, x_hi
+
+
+def clip_windows(cy, cx, covar, grid_h, grid_w):
+    '''
+    Windows of +/- covar around (cy, cx) (as used by clip_heatmap and build_hm_score_v3)
+    Returns (y_lo, y_hi, x_lo, x_hi), each [N] int32
+    '''
+    y_lo, y_hi = range_window(tf.maximum(cy - covar[:,1], 0.0), tf.minimum(cy + covar[:,1], float(grid_h)), grid_h)
+    x_lo, x_hi = range_window(tf.maximum(cx - covar[:,0], 0.0), tf.minimum(cx + covar[:,0], float(grid_w)), grid_w)
+    return y_lo, y_hi, x_lo, x_hi
+
+
+def window_masks(windows, grid_h, grid_w):
+    '''
+    Per-axis 0/1 masks of the windows: mask_y [N, grid_h], mask_x [N, grid_w]
+    The 2-D mask of box n is the outer product mask_y[n] x mask_x[n]
+    '''
+    y_lo, y_hi, x_lo, x_hi = windows
+    Y = tf.range(grid_h, dtype = tf.int32)
+    X = tf.range(grid_w, dtype = tf.int32)
+    mask_y = tf.to_float(tf.logical_and(Y >= y_lo[:, None], Y < y_hi[:, None]))
+    mask_x = tf.to_float(tf.logical_and(X >= x_lo[:, None], X < x_hi[:, None]))
+    return mask_y, mask_x
+
+
+def window_area(windows):
+    '''
+    Number of pixels in each window (the mask_sum of build_hm_score_v3), [N] float32
+    '''
+    y_lo, y_hi, x_lo, x_hi = windows
+    return tf.to_float((y_hi - y_lo) * (x_hi - x_lo))
+
+
+##-----------------------------------------------------------------------------------------------------------
+## Gaussians, summed area tables and per class accumulation
+##-----------------------------------------------------------------------------------------------------------
+def gaussian_1d(center, sigma, size):
+    '''
+    1-D normal densities evaluated at 0 ... size-1 : [N, size]
+    gaussian_1d(cy, sy, h)[:, :, None] * gaussian_1d(cx, sx, w)[:, None, :] equals
+    MultivariateNormalDiag(loc = (cx, cy), scale_diag = (sx, sy)).prob() over the grid
+    '''
+    pos = tf.range(size, dtype = tf.float32)
+    z   = (pos - center[:, None]) / sigma[:, None]
+    return tf.exp(-0.5 * tf.square(z)) / (sigma[:, None] * math.sqrt(2.0 * math.pi))
+
+
+def segment_ids(pt2_ind, num_classes):
+    '''
+    Per-class heatmap segment id (image_index * num_classes + class_index) of each box, [N] int32
+    '''
+    return tf.to_int32(pt2_ind[:,0] * num_classes + pt2_ind[:,1])
+
+
+def summed_area_table(heatmaps):
+    '''
+    Summed area tables of [M, h, w] heatmaps : [M, h+1, w+1], with a leading row and column of zeros.
+    Accumulated in float64 so window sums of large heatmaps don't lose precision.
+    '''
+    table = tf.cumsum(tf.cumsum(tf.to_double(heatmaps), axis = 1), axis = 2)
+    return tf.pad(table, [[0,0], [1,0], [1,0]])
+
+
+def window_sums(table, seg_ids, windows):
+    '''
+    Sum of heatmap seg_ids[n] over window n, read from its summed area table : [N] float32
+    '''
+    y_lo, y_hi, x_lo, x_hi = windows
+    corner = lambda y, x: tf.gather_nd(table, tf.stack([seg_ids, y, x], axis = -1))
+    sums   = corner(y_hi, x_hi) - corner(y_lo, x_hi) - corner(y_hi, x_lo) + corner(y_lo, x_lo)
+    return tf.to_float(sums)
+
+
+def normalize_heatmaps(heatmaps):
+    '''
+    Divide each heatmap by its maximum over the last two axes (left unchanged when the max is ~0)
+    '''
+    normalizer = tf.reduce_max(heatmaps, axis=[-2,-1], keepdims = True)
+    normalizer = tf.where(normalizer < 1.0e-15,  tf.ones_like(normalizer), normalizer)
+    return heatmaps / normalizer
+
+
+##-----------------------------------------------------------------------------------------------------------
+## Scores
+##-----------------------------------------------------------------------------------------------------------
+def hm_scores_v2(gaussian_sum, bboxes_scaled, input_score):
+    '''
+    [N, 3] : gaussian_sum, bbox_area, gaussian_sum * input_score  (same columns as build_hm_score_v2)
+    '''
+    bbox_area = (bboxes_scaled[:,2] - bboxes_scaled[:,0]) * (bboxes_scaled[:,3] - bboxes_scaled[:,1])
+    return tf.stack([gaussian_sum, bbox_area, gaussian_sum * input_score], axis = -1)
+
+
+def hm_scores_v3(score, windows):
+    '''
+    [N, 3] : score, mask_sum, score / mask_sum  (same columns as build_hm_score_v3)
+    '''
+    mask_sum = window_area(windows)
+    return tf.stack([score, mask_sum, score / mask_sum], axis = -1)
+
+
+def heatmap_box_scores(heatmaps, pt2_ind, bboxes_scaled, input_score, cy, cx, covar):
+    '''
+    Vectorized build_hm_score_v2 / build_hm_score_v3 over per-class heatmaps
+
+    Inputs:
+    -----------
+        heatmaps       :    [batch, num_classes, h, w]
+        pt2_ind        :    [N, (image_index, class_index, roi_index)] of the non-zero boxes
+        bboxes_scaled  :    [N, (y1, x1, y2, x2)] in heatmap coordinates
+        input_score    :    [N] score used for the weighted v2 sum
+        cy, cx, covar  :    box gaussian parms (see gaussian_parms())
+
+    Returns
+    -----------
+        v2_scores      :    [N, 3] scores over the bounding box of each box' class heatmap
+        v3_scores      :    [N, 3] scores over the +/- covar window of each box' class heatmap
+    '''
+    num_classes, grid_h, grid_w = KB.int_shape(heatmaps)[1:]
+    seg_ids = segment_ids(pt2_ind, num_classes)
+    table   = summed_area_table(tf.reshape(heatmaps, [-1, grid_h, grid_w]))
+
+    bbox_wins = bbox_windows(bboxes_scaled, grid_h, grid_w)
+    clip_wins = clip_windows(cy, cx, covar, grid_h, grid_w)
+    v2_scores = hm_scores_v2(window_sums(table, seg_ids, bbox_wins), bboxes_scaled, input_score)
+    v3_scores = hm_scores_v3(window_sums(table, seg_ids, clip_wins), clip_wins)
+    return v2_scores, v3_scores
+
+
+##-----------------------------------------------------------------------------------------------------------
+## Heatmap builders
+##-----------------------------------------------------------------------------------------------------------
+def clip_gaussians(gauss_y, gauss_x, clip_wins, norm_score, grid_h, grid_w):
+    '''
+    Clip the per-axis Gaussians to their +/- covar windows and compute the factor that 
+    normalizes each box Gaussian to a max of 1 and scales it by its normalized score
+
+    Returns gauss_y [N, grid_h], gauss_x [N, grid_w], box_scale [N]
+    '''
+    mask_y, mask_x = window_masks(clip_wins, grid_h, grid_w)
+    gauss_y    = gauss_y * mask_y
+    gauss_x    = gauss_x * mask_x
+    normalizer = tf.reduce_max(gauss_y, axis = -1) * tf.reduce_max(gauss_x, axis = -1)
+    normalizer = tf.where(normalizer < 1.0e-15,  tf.ones_like(normalizer), normalizer)
+    return gauss_y, gauss_x, norm_score / normalizer
+
+
+def sum_gaussians(gauss_y, gauss_x, box_scale, seg_ids, num_segments):
+    '''
+    Sum the scaled box Gaussians per (image, class) segment and normalize : [num_segments, grid_h, grid_w]
+    '''
+    prob_grid = (gauss_y * box_scale[:, None])[:, :, None] * gauss_x[:, None, :]
+    heatmaps  = tf.unsorted_segment_sum(prob_grid, seg_ids, num_segments)
+    return normalize_heatmaps(heatmaps)
+
+
+def build_gaussian_heatmaps(bboxes_scaled, norm_score, pt2_ind, batch_size, num_classes, grid_h, grid_w):
+    '''
+    Gaussian heatmaps and scores of the predicted boxes (CHMLayer / CHMLayerInference)
+
+    Each box contributes its Gaussian, clipped to +/- covar around its center, normalized to a
+    max of 1 and multiplied by its per-class normalized score. Contributions are summed per class
+    and each class heatmap is normalized.
+
+    Inputs:
+    -----------
+        bboxes_scaled  :    [N, (y1, x1, y2, x2)] non-zero boxes in heatmap coordinates
+        norm_score     :    [N] per-class normalized scores
+        pt2_ind        :    [N, (image_index, class_index, roi_index)]
+
+    Returns
+    -----------
+        heatmaps       :    [batch, num_classes, grid_h, grid_w] normalized per-class heatmaps
+        old_style_scores :  [N, 3] build_hm_score_v2 over the unclipped Gaussian
+        alt_scores_1   :    [N, 3] build_hm_score_v3 over the clipped/normalized/scaled Gaussian
+        alt_scores_2   :    [N, 3] build_hm_score_v3 over the box' class heatmap
+    '''
+    cy, cx, covar = gaussian_parms(bboxes_scaled)
+    seg_ids   = segment_ids(pt2_ind, num_classes)
+    gauss_y   = gaussian_1d(cy, covar[:,1], grid_h)
+    gauss_x   = gaussian_1d(cx, covar[:,0], grid_w)
+
+    ## v2 scores on the unclipped Gaussian over the bounding box
+    mask_y, mask_x = window_masks(bbox_windows(bboxes_scaled, grid_h, grid_w), grid_h, grid_w)
+    gaussian_sum   = tf.reduce_sum(gauss_y * mask_y, axis = -1) * tf.reduce_sum(gauss_x * mask_x, axis = -1)
+    old_style_scores = hm_scores_v2(gaussian_sum, bboxes_scaled, norm_score)
+
+    ## clip to +/- covar, normalize to max 1 and scale by the normalized score
+    clip_wins  = clip_windows(cy, cx, covar, grid_h, grid_w)
+    gauss_y, gauss_x, box_scale = clip_gaussians(gauss_y, gauss_x, clip_wins, norm_score, grid_h, grid_w)
+
+    clipped_sum  = tf.reduce_sum(gauss_y, axis = -1) * tf.reduce_sum(gauss_x, axis = -1)
+    alt_scores_1 = hm_scores_v3(clipped_sum * box_scale, clip_wins)
+
+    ## sum up per class and normalize
+    heatmaps  = sum_gaussians(gauss_y, gauss_x, box_scale, seg_ids, batch_size * num_classes)
+
+    alt_scores_2 = hm_scores_v3(window_sums(summed_area_table(heatmaps), seg_ids, clip_wins), clip_wins)
+    heatmaps  = tf.reshape(heatmaps, [batch_size, num_classes, grid_h, grid_w])
+    return heatmaps, old_style_scores, alt_scores_1, alt_scores_2
+
+
+def build_mask_heatmaps(bboxes_scaled, norm_score, pt2_ind, batch_size, num_classes, grid_h, grid_w):
+    '''
+    0/1 heatmaps and scores of the ground truth boxes (CHMLayerTarget)
+
+    Each box contributes a mask of ones over +/- covar around its center, and masks are combined
+    per class with a max.
+
+    Inputs / Returns: see build_gaussian_heatmaps(). The returned heatmaps are not normalized.
+    '''
+    cy, cx, covar = gaussian_parms(bboxes_scaled)
+    seg_ids   = segment_ids(pt2_ind, num_classes)
+    bbox_wins = bbox_windows(bboxes_scaled, grid_h, grid_w)
+    clip_wins = clip_windows(cy, cx, covar, grid_h, grid_w)
+
+    old_style_scores = hm_scores_v2(window_area(bbox_wins), bboxes_scaled, norm_score)
+    alt_scores_1     = hm_scores_v3(window_area(clip_wins), clip_wins)
+
+    mask_y, mask_x = window_masks(clip_wins, grid_h, grid_w)
+    masks     = mask_y[:, :, None] * mask_x[:, None, :]
+    heatmaps  = tf.unsorted_segment_max(masks, seg_ids, batch_size * num_classes)
+    heatmaps  = tf.maximum(heatmaps, 0.0)          # empty segments are set to the lowest float
+
+    alt_scores_2 = hm_scores_v3(window_sums(summed_area_table(heatmaps), seg_ids, clip_wins), clip_wins)
+    heatmaps  = tf.reshape(heatmaps, [batch_size, num_classes, grid_h, grid_w])
+    return heatmaps, old_style_scores, alt_scores_1, alt_scores_2
+
+
+def heatmaps_from_scores(scores, heatmap_scale, grid_h, grid_w):
+    '''
+    Rebuild the predicted (build_gaussian_heatmaps) heatmaps from a pr_hm_scores tensor, so the
+    dense heatmaps don't have to be passed around when the boxes are available (SPARSE_PR_HEATMAPS)
+
+    The first columns of pr_hm_scores are the CHM layer input tensor (y1, x1, y2, x2, ..., normalized 
+    score), followed by the 15 score columns added by the CHM layer; the normalized score is the 
+    last input column (column 7 of the 23 column training scores, column 8 of the 24 column 
+    inference scores).
+
+    Inputs:
+    -----------
+        scores         :    [batch, num_classes, rois, columns] pr_hm_scores, boxes in image coordinates
+
+    Returns
+    -----------
+        heatmaps       :    [batch, grid_h, grid_w, num_classes] normalized per-class heatmaps
+    '''
+    num_classes, _, num_columns = KB.int_shape(scores)[1:]
+    norm_score_column = num_columns - 16
+    batch_size = tf.shape(scores)[0]
+
+    pt2_ind    = tf.where(tf.reduce_sum(tf.abs(scores[:,:,:,:4]), axis = -1) > 0)
+    pt2_dense  = tf.gather_nd(scores, pt2_ind)
+    bboxes_scaled = pt2_dense[:,:4] / heatmap_scale
+
+    cy, cx, covar = gaussian_parms(bboxes_scaled)
+    gauss_y    = gaussian_1d(cy, covar[:,1], grid_h)
+    gauss_x    = gaussian_1d(cx, covar[:,0], grid_w)
+    clip_wins  = clip_windows(cy, cx, covar, grid_h, grid_w)
+    gauss_y, gauss_x, box_scale = clip_gaussians(gauss_y, gauss_x, clip_wins, pt2_dense[:, norm_score_column], grid_h, grid_w)
+
+    heatmaps   = sum_gaussians(gauss_y, gauss_x, box_scale, segment_ids(pt2_ind, num_classes), batch_size * num_classes)
+    heatmaps   = tf.reshape(heatmaps, [batch_size, num_classes, grid_h, grid_w])
+    return tf.transpose(heatmaps, [0,2,3,1])
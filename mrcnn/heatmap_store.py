@@ -0,0 +1,329 @@
+"""
+Mask R-CNN
+Sharded, memory-mappable store of the MRCNN heatmap files built by build_heatmap_npz
+
+The per image hm_{coco_id:012d}.npz files hold dense pr/gt heatmaps [H, W, NUM_CLASSES] and
+score tensors [NUM_CLASSES, DETECTION_MAX_INSTANCES, 23] which are mostly zero (only the
+classes detected in the image are populated), and every read has to inflate the zip.
+
+The store keeps the same data in fixed size shards of uncompressed .npy arrays, opened with
+np.load(mmap_mode='r') so an image read only touches the pages holding its own rows:
+
+    store_dir/index.json                    shard list, array shapes and coco_id -> (shard, row)
+    store_dir/shard_00000/meta.npy          [n, META_SIZE]    input_image_meta
+    store_dir/shard_00000/pr_hm_off.npy     [n+1]             start of each image's planes
+    store_dir/shard_00000/pr_hm_cls.npy     [P]               class id of each plane
+    store_dir/shard_00000/pr_hm.npy         [P, H, W]         non-zero class planes (float16 by default)
+    store_dir/shard_00000/pr_sc_off.npy     [n+1]             start of each image's score rows
+    store_dir/shard_00000/pr_sc_idx.npy     [R, 2]            (class, box) of each score row
+    store_dir/shard_00000/pr_sc.npy         [R, 23]           non-zero score rows (float32)
+    store_dir/shard_00000/gt_xxx.npy                          same for the ground truth heatmaps
+
+HeatmapStore.read() rebuilds the dense arrays and returns a dict with the same keys as the
+.npz files, so it can be used in place of np.load(heatmap_file).
+
+Usage:
+    python -m mrcnn.heatmap_store  /path/to/heatmaps/train2014  /path/to/store/train2014  --shard_size 1000
+"""
+import os, sys, re, json, time, argparse
+import numpy as np
+
+INDEX_FILE    = 'index.json'
+STORE_VERSION = 1
+HEATMAP_KEYS  = ['pr', 'gt']
+NPZ_REGEX     = re.compile(r'hm_(\d{12})\.npz$')
+
+
+def shard_name(shard_idx):
+    return 'shard_{:05d}'.format(shard_idx)
+
+
+def is_heatmap_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, INDEX_FILE))
+
+
+##------------------------------------------------------------------------------------
+## sparse encoding of one image
+##------------------------------------------------------------------------------------
+def encode_heatmap(hm, hm_dtype):
+    '''
+    hm:         [H, W, C] heatmap, or None (SPARSE_PR_HEATMAPS heatmap files hold no pr_hm_norm)
+    Returns:    class ids of the non-zero planes [P], planes [P, H, W]
+    '''
+    if hm is None:
+        return np.zeros((0,), np.int16), np.zeros((0, 1, 1), hm_dtype)
+    cls    = np.flatnonzero(np.any(hm != 0, axis = (0,1))).astype(np.int16)
+    planes = np.ascontiguousarray(np.moveaxis(hm[:,:,cls], -1, 0), dtype = hm_dtype)
+    return cls, planes
+
+
+def encode_scores(scores):
+    '''
+    scores:     [C, N, K] score tensor
+    Returns:    (class, box) of the non-zero rows [R, 2], rows [R, K]
+    '''
+    idx  = np.argwhere(np.any(scores != 0, axis = -1)).astype(np.int32)
+    rows = np.ascontiguousarray(scores[idx[:,0], idx[:,1]], dtype = np.float32)
+    return idx, rows
+
+
+##------------------------------------------------------------------------------------
+## Writer
+##------------------------------------------------------------------------------------
+class HeatmapStoreWriter(object):
+    '''
+    Appends images to a heatmap store. Images are buffered in memory and written out
+    shard_size at a time; close() writes the last (partial) shard and the index.
+
+        with HeatmapStoreWriter(store_dir) as writer:
+            writer.add(coco_id, coco_filename, input_image_meta, pr_hm_norm, pr_hm_scores, gt_hm_norm, gt_hm_scores)
+
+    The index is rewritten after each completed shard. Leaving the with block on an exception
+    drops the buffered images without writing them or the index, so the store keeps the
+    shards written so far and can be reopened with append = True.
+
+    hm_dtype:   dtype of the stored heatmap planes. float16 halves the size of the store,
+                use float32 for a lossless copy of the npz heatmaps.
+    append:     open an existing store in store_dir and add shards after its last one
+                (hm_dtype is taken from the store)
+    duplicates: what add() does with a coco id already in the store or the buffer:
+                'error'   - raise ValueError
+                'skip'    - keep the stored image, add() returns False
+                'replace' - the new image replaces it (as rewriting its hm_*.npz file would);
+                            a replaced row of a written shard stays in the shard, unindexed
+    '''
+
+    def __init__(self, store_dir, shard_size = 1000, hm_dtype = 'float16', append = False, duplicates = 'error'):
+        if duplicates not in ('error', 'skip', 'replace'):
+            raise ValueError('HeatmapStoreWriter: duplicates must be error, skip or replace, not {}'.format(duplicates))
+        self.store_dir  = store_dir
+        self.shard_size = shard_size
+        self.duplicates = duplicates
+        self.buffer     = []
+        self.buffer_ids = {}
+
+        if is_heatmap_store(store_dir):
+            if not append:
+                raise ValueError('HeatmapStoreWriter: {} already holds a heatmap store'.format(store_dir))
+            with open(os.path.join(store_dir, INDEX_FILE)) as infile:
+                self.index = json.load(infile)
+            if self.index['version'] != STORE_VERSION:
+                raise ValueError('HeatmapStoreWriter: {} has store version {}, expected {}'.format(
+                                  store_dir, self.index['version'], STORE_VERSION))
+            self.hm_dtype = np.dtype(self.index['hm_dtype'])
+            return
+
+        os.makedirs(store_dir, exist_ok = True)
+        self.hm_dtype   = np.dtype(hm_dtype)
+        self.index      = {'version'     : STORE_VERSION,
+                           'shard_size'  : shard_size,
+                           'hm_dtype'    : self.hm_dtype.name,
+                           'hm_shape'    : None,
+                           'scores_shape': None,
+                           'meta_dtype'  : None,
+                           'sparse_pr_hm': None,
+                           'shards'      : [],
+                           'images'      : {}}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def __len__(self):
+        return len(self.index['images']) + sum(str(coco_id) not in self.index['images'] for coco_id in self.buffer_ids)
+
+    def __contains__(self, coco_id):
+        coco_id = int(coco_id)
+        return coco_id in self.buffer_ids or str(coco_id) in self.index['images']
+
+    def add(self, coco_id, coco_filename, input_image_meta, pr_hm_norm, pr_hm_scores, gt_hm_norm, gt_hm_scores):
+        '''
+        Returns True if the image was added, False if it was skipped (duplicates = 'skip')
+        '''
+        coco_id = int(coco_id)
+        if coco_id in self:
+            if self.duplicates == 'error':
+                raise ValueError('HeatmapStoreWriter: coco id {} is already in the store'.format(coco_id))
+            if self.duplicates == 'skip':
+                return False
+        if self.index['hm_shape'] is None:
+            self.index['hm_shape']     = list(gt_hm_norm.shape)
+            self.index['scores_shape'] = list(pr_hm_scores.shape)
+            self.index['meta_dtype']   = np.asarray(input_image_meta).dtype.name
+            self.index['sparse_pr_hm'] = pr_hm_norm is None
+        assert (pr_hm_norm is None) == self.index['sparse_pr_hm'], 'pr_hm_norm must be provided for all or none of the images'
+        assert pr_hm_norm is None or list(pr_hm_norm.shape) == self.index['hm_shape']
+        assert list(gt_hm_norm.shape)   == self.index['hm_shape']
+        assert list(pr_hm_scores.shape) == self.index['scores_shape'] and list(gt_hm_scores.shape) == self.index['scores_shape']
+
+        entry = {'coco_id': coco_id, 'filename': str(coco_filename), 'meta': np.asarray(input_image_meta)}
+        for key, hm, scores in [('pr', pr_hm_norm, pr_hm_scores), ('gt', gt_hm_norm, gt_hm_scores)]:
+            entry[key+'_hm_cls'], entry[key+'_hm'] = encode_heatmap(hm, self.hm_dtype)
+            entry[key+'_sc_idx'], entry[key+'_sc'] = encode_scores(scores)
+
+        if coco_id in self.buffer_ids:
+            self.buffer[self.buffer_ids[coco_id]] = entry
+            return True
+        self.buffer_ids[coco_id] = len(self.buffer)
+        self.buffer.append(entry)
+
+        if len(self.buffer) == self.shard_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        '''
+        Write the buffered images to a new shard
+        '''
+        if not self.buffer:
+            return
+        ## a shard directory past the indexed ones (left by an interrupted run) is overwritten
+        shard_idx = len(self.index['shards'])
+        shard_dir = os.path.join(self.store_dir, shard_name(shard_idx))
+        os.makedirs(shard_dir, exist_ok = True)
+
+        arrays    = {'meta': np.stack([entry['meta'] for entry in self.buffer])}
+        for key in HEATMAP_KEYS:
+            for name, ids in [('_hm', '_cls'), ('_sc', '_idx')]:
+                arrays[key+name]        = np.concatenate([entry[key+name]     for entry in self.buffer])
+                arrays[key+name+ids]    = np.concatenate([entry[key+name+ids] for entry in self.buffer])
+                arrays[key+name+'_off'] = np.cumsum([0] + [len(entry[key+name]) for entry in self.buffer]).astype(np.int64)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(shard_dir, name + '.npy'), array)
+
+        for row, entry in enumerate(self.buffer):
+            self.index['images'][str(entry['coco_id'])] = [shard_idx, row, entry['filename']]
+        self.index['shards'].append({'name': shard_name(shard_idx), 'count': len(self.buffer)})
+        self.buffer     = []
+        self.buffer_ids = {}
+        self.write_index()
+
+    def write_index(self):
+        index_file = os.path.join(self.store_dir, INDEX_FILE)
+        tmp_file   = '{}.{}.tmp'.format(index_file, os.getpid())
+        with open(tmp_file, 'w') as outfile:
+            json.dump(self.index, outfile)
+        os.replace(tmp_file, index_file)
+
+    def close(self):
+        self.flush()
+
+
+##------------------------------------------------------------------------------------
+## Reader
+##------------------------------------------------------------------------------------
+class HeatmapStore(object):
+    '''
+    Random access reader for a heatmap store. Shards are memory mapped on first use;
+    the object can be pickled (e.g. to datagen worker processes), open shards are
+    not carried over and are mapped again in the receiving process.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE)) as infile:
+            self.index = json.load(infile)
+        if self.index['version'] != STORE_VERSION:
+            raise ValueError('HeatmapStore: {} has store version {}, expected {}'.format(
+                              store_dir, self.index['version'], STORE_VERSION))
+        self.hm_shape     = tuple(self.index['hm_shape'])
+        self.scores_shape = tuple(self.index['scores_shape'])
+        self.shards       = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index['images'])
+
+    def __contains__(self, coco_id):
+        return str(int(coco_id)) in self.index['images']
+
+    def coco_ids(self):
+        return sorted(int(i) for i in self.index['images'])
+
+    def shard(self, shard_idx):
+        if shard_idx not in self.shards:
+            shard_dir = os.path.join(self.store_dir, self.index['shards'][shard_idx]['name'])
+            self.shards[shard_idx] = {os.path.splitext(f)[0]: np.load(os.path.join(shard_dir, f), mmap_mode = 'r')
+                                      for f in os.listdir(shard_dir) if f.endswith('.npy')}
+        return self.shards[shard_idx]
+
+    def read(self, coco_id):
+        '''
+        Returns a dict with the same keys and dense arrays as the hm_{coco_id:012d}.npz file:
+            input_image_meta, pr_hm_norm, pr_hm_scores, gt_hm_norm, gt_hm_scores, coco_info
+        (no pr_hm_norm for stores built from SPARSE_PR_HEATMAPS heatmap files)
+        '''
+        shard_idx, row, filename = self.index['images'][str(int(coco_id))]
+        shard   = self.shard(shard_idx)
+        results = {'input_image_meta': np.array(shard['meta'][row]),
+                   'coco_info'       : np.array([str(int(coco_id)), filename])}
+
+        for key in HEATMAP_KEYS:
+            if key != 'pr' or not self.index.get('sparse_pr_hm', False):
+                start, end = shard[key+'_hm_off'][row:row+2]
+                hm = np.zeros(self.hm_shape, dtype = np.float32)
+                hm[:,:,shard[key+'_hm_cls'][start:end]] = np.moveaxis(shard[key+'_hm'][start:end], 0, -1)
+                results[key+'_hm_norm'] = hm
+
+            start, end = shard[key+'_sc_off'][row:row+2]
+            idx    = shard[key+'_sc_idx'][start:end]
+            scores = np.zeros(self.scores_shape, dtype = np.float32)
+            scores[idx[:,0], idx[:,1]] = shard[key+'_sc'][start:end]
+            results[key+'_hm_scores'] = scores
+        return results
+
+    def display(self):
+        print(' Heatmap store: {}  images: {}  shards: {}  heatmap dtype: {}'.format(
+               self.store_dir, len(self), len(self.index['shards']), self.index['hm_dtype']))
+
+
+##------------------------------------------------------------------------------------
+## npz converter
+##------------------------------------------------------------------------------------
+def convert_npz_files(npz_dir, store_dir, shard_size = 1000, hm_dtype = 'float16', verbose = 1):
+    '''
+    Copy the hm_{coco_id:012d}.npz files in npz_dir into a new heatmap store in store_dir.
+    Files are added in coco id order.
+
+    Returns the number of images written
+    '''
+    npz_files = sorted(f for f in os.listdir(npz_dir) if NPZ_REGEX.match(f))
+    if verbose:
+        print(' convert_npz_files(): {} heatmap files in {} --> {}'.format(len(npz_files), npz_dir, store_dir))
+
+    tm_start = time.time()
+    with HeatmapStoreWriter(store_dir, shard_size = shard_size, hm_dtype = hm_dtype) as writer:
+        for i, npz_file in enumerate(npz_files):
+            with np.load(os.path.join(npz_dir, npz_file)) as loaddata:
+                coco_id, coco_filename = loaddata['coco_info']
+                writer.add(coco_id, coco_filename, loaddata['input_image_meta'],
+                           loaddata['pr_hm_norm'] if 'pr_hm_norm' in loaddata else None, loaddata['pr_hm_scores'],
+                           loaddata['gt_hm_norm'], loaddata['gt_hm_scores'])
+            if verbose and (i+1) % shard_size == 0:
+                print('   {:7d} of {:7d} files converted  {:.1f}s'.format(i+1, len(npz_files), time.time() - tm_start))
+
+    if verbose:
+        print(' convert_npz_files(): {} files converted in {:.1f}s'.format(len(npz_files), time.time() - tm_start))
+    return len(npz_files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert hm_*.npz heatmap files to a sharded heatmap store')
+    parser.add_argument('npz_dir',   help='directory holding the hm_*.npz files')
+    parser.add_argument('store_dir', help='output heatmap store directory')
+    parser.add_argument('--shard_size', type=int, default=1000, help='images per shard (default=1000)')
+    parser.add_argument('--hm_dtype', choices=['float16', 'float32'], default='float16',
+                        help='dtype of the stored heatmaps (default=float16)')
+    args = parser.parse_args()
+
+    convert_npz_files(args.npz_dir, args.store_dir, shard_size = args.shard_size, hm_dtype = args.hm_dtype)
+    HeatmapStore(args.store_dir).display()
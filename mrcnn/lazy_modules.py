@@ -0,0 +1,58 @@
+"""
+Mask R-CNN
+Lazily imported modules
+
+Importing TensorFlow, Keras, matplotlib or scikit-image costs seconds and hundreds of MB
+of memory. Modules that only need them in some functions (utils, visualize, dataset,
+calculate_map) bind a LazyModule instead, so that their NumPy code can be imported and
+used without loading the heavy packages:
+
+    tf  = LazyModule('tensorflow')
+    plt = LazyModule('matplotlib.pyplot', imports = ('mpl_toolkits.mplot3d',))
+
+The module is imported on the first attribute access (tf.stack, plt.figure, ...).
+"""
+import types, importlib
+
+
+class LazyModule(types.ModuleType):
+    '''
+    Stand-in for a module, importing it on first attribute access.
+
+    name:       module to import
+    imports:    other modules imported along with it, e.g. submodules that the package
+                does not import itself (scipy.misc), or modules imported for their side
+                effects (mpl_toolkits.mplot3d registers the 3d projection)
+    on_load:    optional function called once the module is imported, for set up that
+                used to run at import time (e.g. plot styles)
+    '''
+
+    def __init__(self, name, imports = (), on_load = None):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_imports'] = tuple(imports)
+        self.__dict__['_lazy_on_load'] = on_load
+        self.__dict__['_lazy_module']  = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            for name in self.__dict__['_lazy_imports']:
+                importlib.import_module(name)
+            self.__dict__['_lazy_module'] = module
+            if self.__dict__['_lazy_on_load'] is not None:
+                self.__dict__['_lazy_on_load']()
+        return module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') and attr.endswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded'
+        return '<LazyModule {} ({})>'.format(self.__name__, state)
+
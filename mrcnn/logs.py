@@ -0,0 +1,169 @@
+"""
+Mask R-CNN
+Level gated console logging and the step timing sink
+
+Modules log through loggers of the 'mrcnn' hierarchy instead of printing. The 'mrcnn'
+logger writes the bare message to sys.stdout (looked up on each record, so the SYSOUT
+capture of the training scripts still sees it), at INFO level by default:
+
+    logger = get_logger(__name__)
+    logger.info(' Training Start Parameters')
+    logger.debug(' load_heatmap_npz() : image id %s  heatmap path %s', image_id, path)
+
+Per batch messages are logged at DEBUG level, with %-style arguments, so that a disabled
+call is a level check and no formatting. Graph building code written with print() calls
+uses print_function(logger), a print() replacement logging at DEBUG level.
+
+Levels are set per module, by configure_logging() or the MRCNN_LOG_LEVELS environment
+variable, as a comma separated list of [logger=]level:
+
+    MRCNN_LOG_LEVELS=WARNING,mrcnn.datagen_fcn=DEBUG  python train_coco_fcn.py ...
+
+Step timings are written by log_timing() to the 'mrcnn.timing' logger, as one JSON object
+per line, when a timing file has been set with configure_logging(timing_file = ...). The
+timing logger is disabled otherwise; callers that compute timings only for the sink check
+timing_enabled() first.
+
+Usage:
+    configure_logging(levels = 'mrcnn.loss=DEBUG', timing_file = '/path/to/timings.jsonl')
+"""
+import os, sys, json, time, logging
+
+ROOT_LOGGER   = 'mrcnn'
+TIMING_LOGGER = 'mrcnn.timing'
+LEVELS_ENV    = 'MRCNN_LOG_LEVELS'
+DEFAULT_LEVEL = logging.INFO
+
+
+class StdoutHandler(logging.StreamHandler):
+    '''
+    StreamHandler writing to the current sys.stdout
+    '''
+
+    def __init__(self):
+        super(StdoutHandler, self).__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class JsonLinesFormatter(logging.Formatter):
+    '''
+    Formats a record logged with a dict message as one line of JSON
+    '''
+
+    def format(self, record):
+        return json.dumps(record.msg, default = float)
+
+
+def parse_levels(levels):
+    '''
+    'WARNING,mrcnn.loss=DEBUG' --> {'mrcnn': 'WARNING', 'mrcnn.loss': 'DEBUG'}
+    '''
+    result = {}
+    for item in levels.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, level = item.rpartition('=')
+        result[name.strip() or ROOT_LOGGER] = level.strip().upper()
+    return result
+
+
+def get_logger(name):
+    '''
+    Logger of module name, in the 'mrcnn' hierarchy (__main__ scripts log as mrcnn.__main__)
+    '''
+    if name != ROOT_LOGGER and not name.startswith(ROOT_LOGGER + '.'):
+        name = ROOT_LOGGER + '.' + name
+    return logging.getLogger(name)
+
+
+def configure_logging(level = None, levels = None, timing_file = None):
+    '''
+    level:          level of the 'mrcnn' logger (e.g. 'DEBUG', logging.WARNING)
+    levels:         per module levels, as a {logger name: level} dict or a 'name=level,...'
+                    string; names without the 'mrcnn.' prefix are taken as mrcnn modules
+    timing_file:    file the step timings are appended to (JSON lines), enables log_timing()
+    '''
+    if level is not None:
+        logging.getLogger(ROOT_LOGGER).setLevel(level)
+    if isinstance(levels, str):
+        levels = parse_levels(levels)
+    for name, module_level in (levels or {}).items():
+        get_logger(name).setLevel(module_level)
+
+    if timing_file is not None:
+        timing = logging.getLogger(TIMING_LOGGER)
+        for handler in list(timing.handlers):
+            timing.removeHandler(handler)
+            handler.close()
+        handler = logging.FileHandler(timing_file, mode = 'a')
+        handler.setFormatter(JsonLinesFormatter())
+        timing.addHandler(handler)
+        timing.setLevel(logging.INFO)
+
+
+def timing_enabled():
+    return _timing.isEnabledFor(logging.INFO)
+
+
+def log_timing(event, **fields):
+    '''
+    Write one timing record {'event': event, 'time': now, **fields} to the timing file
+    '''
+    if _timing.isEnabledFor(logging.INFO):
+        record = {'event': event, 'time': time.time()}
+        record.update(fields)
+        _timing.info(record)
+
+
+class _PrintArgs(object):
+    '''
+    print() arguments, joined when the record is formatted
+    '''
+    __slots__ = ('args', 'sep')
+
+    def __init__(self, args, sep):
+        self.args = args
+        self.sep  = sep
+
+    def __str__(self):
+        return self.sep.join(str(a) for a in self.args)
+
+
+def print_function(logger, level = logging.DEBUG):
+    '''
+    Returns a print() replacement logging its arguments to logger at level
+    '''
+    def _print(*args, sep = ' ', **kwargs):
+        if logger.isEnabledFor(level):
+            logger.log(level, '%s', _PrintArgs(args, sep))
+    return _print
+
+
+def _setup():
+    root = logging.getLogger(ROOT_LOGGER)
+    if not any(isinstance(h, StdoutHandler) for h in root.handlers):
+        handler = StdoutHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root.addHandler(handler)
+        root.setLevel(DEFAULT_LEVEL)
+        root.propagate = False
+
+    timing = logging.getLogger(TIMING_LOGGER)
+    if not timing.handlers:
+        timing.propagate = False
+        timing.setLevel(logging.CRITICAL + 1)
+
+    levels = os.environ.get(LEVELS_ENV)
+    if levels:
+        configure_logging(levels = levels)
+    return timing
+
+_timing = _setup()
@@ -15,10 +15,16 @@ import keras.initializers as KI
 import keras.engine  as KE
 import keras.losses  as KLosses
 import mrcnn.utils   as utils
-from mrcnn.utils import logt
-import pprint
+from mrcnn.logs  import get_logger, print_function
+import logging, functools, pprint
 pp = pprint.PrettyPrinter(indent=2, width=100)
 
+## loss graphs are built for every model compile: their shape traces go to the
+## mrcnn.loss logger at DEBUG level (MRCNN_LOG_LEVELS=mrcnn.loss=DEBUG to see them)
+logger = get_logger(__name__)
+dprint = print_function(logger)
+logt   = functools.partial(utils.logt, logger = logger, level = logging.DEBUG)
+
 
 ##-----------------------------------------------------------------------
 ##  Loss Functions
@@ -46,9 +52,9 @@ def rpn_class_loss_graph(rpn_match, rpn_class_logits):
                         
     rpn_class_logits:   [batch, anchors, 2]. RPN classifier logits for FG/BG.
     '''
-    print('\n>>> rpn_class_loss_graph' )
-    print('    rpn_match size :', rpn_match.shape)
-    print('    tf default session: ', tf.get_default_session())
+    dprint('\n>>> rpn_class_loss_graph' )
+    dprint('    rpn_match size :', rpn_match.shape)
+    dprint('    tf default session: ', tf.get_default_session())
 
     # Squeeze last dim to simplify
     rpn_match = tf.squeeze(rpn_match, -1)
@@ -69,11 +75,11 @@ def rpn_class_loss_graph(rpn_match, rpn_class_logits):
                                              output=rpn_class_logits,
                                              from_logits=True)
     
-    print('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss = KB.switch(tf.size(loss) > 0, KB.mean(loss), tf.constant(0.0))
-    print('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss = tf.reshape(loss, [1, 1], name = 'rpn_class_loss')    
-    print('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     return loss
 
 
@@ -102,9 +108,9 @@ def rpn_bbox_loss_graph(config, target_bbox, rpn_match, rpn_bbox):
     # neutral anchors (match value of 0 or -1) don't.
     rpn_match = KB.squeeze(rpn_match, -1)
     indices   = tf.where(KB.equal(rpn_match, 1))
-    print('\n>>> rpn_bbox_loss_graph' )
-    print('    rpn_match size :', rpn_match.shape)
-    print('    rpn_bbox  size :', rpn_bbox.shape)
+    dprint('\n>>> rpn_bbox_loss_graph' )
+    dprint('    rpn_match size :', rpn_match.shape)
+    dprint('    rpn_bbox  size :', rpn_bbox.shape)
     # print(rpn_match.eval())
     
     # Pick bbox deltas that contribute to the loss
@@ -119,11 +125,11 @@ def rpn_bbox_loss_graph(config, target_bbox, rpn_match, rpn_bbox):
     loss = KB.switch(tf.size(target_bbox) > 0,
                     smooth_l1_loss(y_true=target_bbox, y_pred=rpn_bbox),
                     tf.constant(0.0))
-    print('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss = KB.mean(loss)
-    print('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss = tf.reshape(loss, [1, 1], name = 'rpn_bbox_loss')
-    print('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     return loss
 
 ##-----------------------------------------------------------------------
@@ -142,10 +148,10 @@ def mrcnn_class_loss_graph(target_class_ids, pred_class_logits, active_class_ids
                             classes that are in the dataset of the image, and 0
                             for classes that are not in the dataset. 
     '''
-    print('\n>>> mrcnn_class_loss_graph ' )
-    print('    target_class_ids  size :', target_class_ids.shape)
-    print('    pred_class_logits size :', pred_class_logits.shape)
-    print('    active_class_ids  size :', active_class_ids.shape)    
+    dprint('\n>>> mrcnn_class_loss_graph ' )
+    dprint('    target_class_ids  size :', target_class_ids.shape)
+    dprint('    pred_class_logits size :', pred_class_logits.shape)
+    dprint('    active_class_ids  size :', active_class_ids.shape)    
     target_class_ids = tf.cast(target_class_ids, 'int64')
     
     # Find predictions of classes that are not in the dataset.
@@ -163,14 +169,14 @@ def mrcnn_class_loss_graph(target_class_ids, pred_class_logits, active_class_ids
     # Erase losses of predictions of classes that are not in the active
     # classes of the image.
     loss = loss * pred_active
-    print('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
 
     # Computer loss mean. Use only predictions that contribute
     # to the loss to get a correct mean.
     loss = tf.reduce_sum(loss) / tf.reduce_sum(pred_active)
-    print('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss = tf.reshape(loss, [1, 1], name = 'mrcnn_class_loss')
-    print('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     return loss
 
 ##-----------------------------------------------------------------------
@@ -184,10 +190,10 @@ def mrcnn_bbox_loss_graph(target_bbox, target_class_ids, pred_bbox):
     pred_bbox:          [batch, num_rois, num_classes,  4: (dy, dx, log(dh), log(dw))]
     
     '''
-    print('\n>>> mrcnn_bbox_loss_graph ' )
-    print('    target_class_ids  size :', target_class_ids.shape)
-    print('    pred_bbox size         :', pred_bbox.shape)
-    print('    target_bbox size       :', target_bbox.shape)    
+    dprint('\n>>> mrcnn_bbox_loss_graph ' )
+    dprint('    target_class_ids  size :', target_class_ids.shape)
+    dprint('    pred_bbox size         :', pred_bbox.shape)
+    dprint('    target_bbox size       :', target_bbox.shape)    
     
     # Reshape to merge batch and roi dimensions for simplicity.
     # target_class_ids:  reshaped into [ (batch * num_rois) ]
@@ -197,8 +203,8 @@ def mrcnn_bbox_loss_graph(target_bbox, target_class_ids, pred_bbox):
     target_class_ids = KB.reshape(target_class_ids, (-1,))
     target_bbox      = KB.reshape(target_bbox, (-1, 4))
     pred_bbox        = KB.reshape(pred_bbox, (-1, KB.int_shape(pred_bbox)[2], 4))
-    print('    reshpaed pred_bbox size         :', pred_bbox.shape)
-    print('    reshaped target_bbox size       :', target_bbox.shape)    
+    dprint('    reshpaed pred_bbox size         :', pred_bbox.shape)
+    dprint('    reshaped target_bbox size       :', target_bbox.shape)    
 
     # Only positive ROIs contribute to the loss. And only
     # the right class_id of each ROI. Get their indicies.
@@ -209,18 +215,18 @@ def mrcnn_bbox_loss_graph(target_bbox, target_class_ids, pred_bbox):
     # Gather the deltas (predicted and true) that contribute to loss
     target_bbox = tf.gather(target_bbox, positive_roi_ix)
     pred_bbox   = tf.gather_nd(pred_bbox, indices)
-    print('    pred_bbox size         :', pred_bbox.shape)
-    print('    target_bbox size       :', target_bbox.shape)    
+    dprint('    pred_bbox size         :', pred_bbox.shape)
+    dprint('    target_bbox size       :', target_bbox.shape)    
     
     # Smooth-L1 Loss
     loss        = KB.switch(tf.size(target_bbox) > 0,
                     smooth_l1_loss(y_true=target_bbox, y_pred=pred_bbox),
                     tf.constant(0.0))
-    print('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss        = KB.mean(loss)
-    print('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss        = tf.reshape(loss, [1, 1], name = 'mrcnn_bbox_loss')
-    print('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     return loss
 
 ##-----------------------------------------------------------------------
@@ -236,25 +242,25 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
                         with values from 0 to 1.
     """
     # Reshape for simplicity. Merge first two dimensions into one.
-    print('\n>>> mrcnn_mask_loss_graph ' )
-    print('    target_class_ids shape :', target_class_ids.shape)
-    print('    target_masks     shape :', target_masks.shape)
-    print('    pred_masks       shape :', pred_masks.shape)    
+    dprint('\n>>> mrcnn_mask_loss_graph ' )
+    dprint('    target_class_ids shape :', target_class_ids.shape)
+    dprint('    target_masks     shape :', target_masks.shape)
+    dprint('    pred_masks       shape :', pred_masks.shape)    
     
     target_class_ids = KB.reshape(target_class_ids, (-1,))
-    print('    target_class_ids shape :', target_class_ids.shape)
+    dprint('    target_class_ids shape :', target_class_ids.shape)
     
     target_shape     = tf.shape(target_masks)
-    print('    target_shape       shape :', target_shape.shape)    
+    dprint('    target_shape       shape :', target_shape.shape)    
     
     target_masks     = KB.reshape(target_masks, (-1, target_shape[2], target_shape[3]))
-    print('    target_masks     shape :', target_masks.shape)        
+    dprint('    target_masks     shape :', target_masks.shape)        
     
     pred_shape       = tf.shape(pred_masks)
-    print('    pred_shape       shape :', pred_shape.shape)        
+    dprint('    pred_shape       shape :', pred_shape.shape)        
     
     pred_masks       = KB.reshape(pred_masks, (-1, pred_shape[2], pred_shape[3], pred_shape[4]))
-    print('    pred_masks       shape :', pred_masks.get_shape())        
+    dprint('    pred_masks       shape :', pred_masks.get_shape())        
     # Permute predicted masks to [N, num_classes, height, width]
     pred_masks = tf.transpose(pred_masks, [0, 3, 1, 2])
 
@@ -267,19 +273,19 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
     # Gather the masks (predicted and true) that contribute to loss
     y_true = tf.gather(target_masks, positive_ix)
     y_pred = tf.gather_nd(pred_masks, indices)
-    print('     y_true shape:', y_true.get_shape())
-    print('     y_pred shape:', y_pred.get_shape())
+    dprint('     y_true shape:', y_true.get_shape())
+    dprint('     y_pred shape:', y_pred.get_shape())
     
     # Compute binary cross entropy. If no positive ROIs, then return 0.
     # shape: [batch, roi, num_classes]
     loss = KB.switch(tf.size(y_true) > 0,
                     KB.binary_crossentropy(target=y_true, output=y_pred),
                     tf.constant(0.0))
-    print('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss      :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss = KB.mean(loss)
-    print('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     loss = tf.reshape(loss, [1, 1], name = 'mrcnn_mask_loss')
-    print('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    reshaped mean loss :', loss.get_shape(), KB.shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
     return loss
  
 
@@ -298,14 +304,14 @@ def fcn_score_loss_graph(input_target,  input_pred):
     pred_scores   = input_pred[:,1:,:,14]
     target_scores = input_target[:,1:,:,9]
     # Reshape for simplicity. Merge first two dimensions into one.
-    print('\n>>> fcn_norm_loss_graph ' )
-    print('    target_scores shape :', target_scores.shape)
-    print('    pred_scores   shape :', pred_scores.shape)    
+    dprint('\n>>> fcn_norm_loss_graph ' )
+    dprint('    target_scores shape :', target_scores.shape)
+    dprint('    pred_scores   shape :', pred_scores.shape)    
 
     target_scores1 = KB.reshape(target_scores, (-1,1))
-    print('    target_scores1 shape :', target_scores1.get_shape(), KB.int_shape(target_scores1))        
+    dprint('    target_scores1 shape :', target_scores1.get_shape(), KB.int_shape(target_scores1))        
     pred_scores1   = KB.reshape(pred_scores  , (-1,1))
-    print('    pred_scores1  shape :', pred_scores1.get_shape())        
+    dprint('    pred_scores1  shape :', pred_scores1.get_shape())        
 
 #     # Compute binary cross entropy. If no positive ROIs, then return 0.
 #     # shape: [batch, roi, num_classes]
@@ -315,7 +321,7 @@ def fcn_score_loss_graph(input_target,  input_pred):
                     tf.constant(0.0))
     loss        = KB.mean(loss)
     loss        = tf.reshape(loss, [1, 1], name = 'fcn_norm_loss')
-    print('    loss type is :', type(loss))
+    dprint('    loss type is :', type(loss))
     return loss
 
     
@@ -333,18 +339,18 @@ def fcn_bbox_loss_graph(target_bbox_deltas, target_class_ids, fcn_bbox_deltas):
     fcn_bbox_deltas     :   [batch, num_classes, num_rois,  (dy, dx, log(dh), log(dw))]
     
     '''
-    print('\n>>> fcn_bbox_loss_graph ' )
-    print('    target_class_ids  :', target_class_ids.shape)
-    print('    fcn_bbox_deltas   :', fcn_bbox_deltas.shape)
-    print('    target_bbox_deltas    :', target_bbox_deltas.shape)    
+    dprint('\n>>> fcn_bbox_loss_graph ' )
+    dprint('    target_class_ids  :', target_class_ids.shape)
+    dprint('    fcn_bbox_deltas   :', fcn_bbox_deltas.shape)
+    dprint('    target_bbox_deltas    :', target_bbox_deltas.shape)    
 
     ## Reshape to merge batch and roi dimensions for simplicity.
     class_array   = KB.reshape(target_bbox_deltas[...,-2]  , (-1, 1))
     tgt_bbox      = KB.reshape(target_bbox_deltas[...,:-2] , (-1, 4))
     pred_bbox     = KB.reshape(fcn_bbox_deltas, (-1, 4))
-    print('    reshaped class_array            :', class_array.shape)
-    print('    reshaped pred_bbox size         :', pred_bbox.shape)
-    print('    reshaped target_bbox size       :', tgt_bbox.shape)    
+    dprint('    reshaped class_array            :', class_array.shape)
+    dprint('    reshaped pred_bbox size         :', pred_bbox.shape)
+    dprint('    reshaped target_bbox size       :', tgt_bbox.shape)    
 
     ## Only positive ROIs contribute to the loss. And only the right 
     ## class_id of each ROI. Get their indicies.
@@ -358,8 +364,8 @@ def fcn_bbox_loss_graph(target_bbox_deltas, target_class_ids, fcn_bbox_deltas):
     y_pred = tf.gather_nd(fcn_bbox_deltas, pos_ix)
     # print(y_pred.eval(session=sess))
     # print(tf.shape(y_pred).eval(session=sess), tf.shape(y_true).eval(session=sess))    
-    print('    y_true shape:', y_true.get_shape())
-    print('    y_pred shape:', y_pred.get_shape())
+    dprint('    y_true shape:', y_true.get_shape())
+    dprint('    y_pred shape:', y_pred.get_shape())
 
     
     ## Smooth-L1 Loss
@@ -381,18 +387,18 @@ def fcn_heatmap_MSE_loss_graph(target_heatmap, pred_heatmap):
     target_heatmap:       [batch, height, width, num_classes].
     pred_heatmap:         [batch, height, width, num_classes] 
     """
-    print()
-    print('-------------------------------' )
-    print('>>> fcn_heatmap_MSE_loss_graph ' )
-    print('-------------------------------' )
-    print('    target_masks :', target_heatmap.get_shape(), KB.int_shape(target_heatmap), 'KerasTensor: ', KB.is_keras_tensor(target_heatmap))
-    print('    pred_heatmap :', pred_heatmap.get_shape()  , KB.int_shape(pred_heatmap)  , 'KerasTensor: ', KB.is_keras_tensor(pred_heatmap))
+    dprint()
+    dprint('-------------------------------' )
+    dprint('>>> fcn_heatmap_MSE_loss_graph ' )
+    dprint('-------------------------------' )
+    dprint('    target_masks :', target_heatmap.get_shape(), KB.int_shape(target_heatmap), 'KerasTensor: ', KB.is_keras_tensor(target_heatmap))
+    dprint('    pred_heatmap :', pred_heatmap.get_shape()  , KB.int_shape(pred_heatmap)  , 'KerasTensor: ', KB.is_keras_tensor(pred_heatmap))
     loss = KLosses.mean_squared_error(target_heatmap[...,1:], pred_heatmap[...,1:])
     loss_mean  = KB.mean(loss)
     loss_final = tf.reshape(loss_mean, [1, 1], name = "fcn_MSE_loss")
-    print('    loss         :', loss.get_shape()       , KB.int_shape(loss)       , 'KerasTensor: ', KB.is_keras_tensor(loss))
-    print('    loss mean    :', loss_mean.get_shape()  , KB.int_shape(loss_mean)  , 'KerasTensor: ', KB.is_keras_tensor(loss_mean))
-    print('    loss final   :', loss_final.get_shape() , KB.int_shape(loss_final) , 'KerasTensor: ', KB.is_keras_tensor(loss_final))
+    dprint('    loss         :', loss.get_shape()       , KB.int_shape(loss)       , 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss mean    :', loss_mean.get_shape()  , KB.int_shape(loss_mean)  , 'KerasTensor: ', KB.is_keras_tensor(loss_mean))
+    dprint('    loss final   :', loss_final.get_shape() , KB.int_shape(loss_final) , 'KerasTensor: ', KB.is_keras_tensor(loss_final))
 
     # Permute predicted & target heatmaps to [N, num_classes, height, width]
     
@@ -449,34 +455,34 @@ def fcn_heatmap_CE_loss_graph(target_heatmap, pred_heatmap, active_class_ids):
                             classes that are in the dataset of the image, and 0
                             for classes that are not in the dataset. 
     '''
-    print()
-    print('-------------------------------' )
-    print('>>> fcn_heatmap_CE_loss_graph  ' )
-    print('-------------------------------' )
-    print('    target_class_ids  :', KB.int_shape(target_heatmap))
-    print('    pred_class_logits :', KB.int_shape(pred_heatmap))
-    print('    active_class_ids  :', KB.int_shape(active_class_ids))
+    dprint()
+    dprint('-------------------------------' )
+    dprint('>>> fcn_heatmap_CE_loss_graph  ' )
+    dprint('-------------------------------' )
+    dprint('    target_class_ids  :', KB.int_shape(target_heatmap))
+    dprint('    pred_class_logits :', KB.int_shape(pred_heatmap))
+    dprint('    active_class_ids  :', KB.int_shape(active_class_ids))
     # target_class_ids = tf.cast(target_class_ids, 'int64')
     
     # Find predictions of classes that are not in the dataset.
     pred_class_ids = KB.argmax(pred_heatmap  , axis=-1)
     gt_class_ids   = KB.argmax(target_heatmap, axis=-1)
-    print('    pred_class_ids    :', KB.int_shape(pred_class_ids), pred_class_ids.dtype ) 
-    print('    gt_class_ids      :', KB.int_shape(gt_class_ids  ), gt_class_ids.dtype) 
+    dprint('    pred_class_ids    :', KB.int_shape(pred_class_ids), pred_class_ids.dtype ) 
+    dprint('    gt_class_ids      :', KB.int_shape(gt_class_ids  ), gt_class_ids.dtype) 
 
     # TODO: Update this line to work with batch > 1. Right now it assumes all
     #       images in a batch have the same active_class_ids
     pred_active = tf.gather(active_class_ids[0], pred_class_ids)
-    print('    pred_active       :', KB.int_shape(pred_active),  pred_active.dtype)  
+    dprint('    pred_active       :', KB.int_shape(pred_active),  pred_active.dtype)  
     
     # Loss
     loss = tf.nn.softmax_cross_entropy_with_logits_v2(labels=target_heatmap, logits=pred_heatmap)
-    print('    loss              :', KB.int_shape(loss), loss.dtype)    
+    dprint('    loss              :', KB.int_shape(loss), loss.dtype)    
 
     # Erase losses of predictions of classes that are not in the active
     # classes of the image.
     loss = loss * pred_active
-    print('    loss*pred_active  :', KB.int_shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss*pred_active  :', KB.int_shape(loss), 'KerasTensor: ', KB.is_keras_tensor(loss))
 
     # Compute  loss mean. Use only predictions that contribute
     # to the loss to get a correct mean.
@@ -484,9 +490,9 @@ def fcn_heatmap_CE_loss_graph(target_heatmap, pred_heatmap, active_class_ids):
     loss_mean  = KB.mean(loss)
     loss_final = tf.reshape(loss_mean, [1, 1], name = "fcn_CE_loss")
     
-    print('    loss              :', loss.get_shape()       , KB.int_shape(loss)       , 'KerasTensor: ', KB.is_keras_tensor(loss))
-    print('    loss mean         :', loss_mean.get_shape()  , KB.int_shape(loss_mean)  , 'KerasTensor: ', KB.is_keras_tensor(loss_mean))
-    print('    loss final        :', loss_final.get_shape() , KB.int_shape(loss_final) , 'KerasTensor: ', KB.is_keras_tensor(loss_final))
+    dprint('    loss              :', loss.get_shape()       , KB.int_shape(loss)       , 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss mean         :', loss_mean.get_shape()  , KB.int_shape(loss_mean)  , 'KerasTensor: ', KB.is_keras_tensor(loss_mean))
+    dprint('    loss final        :', loss_final.get_shape() , KB.int_shape(loss_final) , 'KerasTensor: ', KB.is_keras_tensor(loss_final))
     
     return loss_final
 
@@ -519,10 +525,10 @@ def fcn_heatmap_BCE_loss_graph(target_heatmap, pred_heatmap):
                             # classes that are in the dataset of the image, and 0
                             # for classes that are not in the dataset. 
     '''
-    print()
-    print('-------------------------------' )
-    print('>>> fcn_heatmap_BCE_loss_graph  ' )
-    print('-------------------------------' )
+    dprint()
+    dprint('-------------------------------' )
+    dprint('>>> fcn_heatmap_BCE_loss_graph  ' )
+    dprint('-------------------------------' )
     logt('    target_class_ids  :', target_heatmap)
     logt('    pred_class_logits :', pred_heatmap)
     # target_class_ids = tf.cast(target_class_ids, 'int64')
@@ -557,9 +563,9 @@ def fcn_heatmap_BCE_loss_graph(target_heatmap, pred_heatmap):
     loss_final = tf.reshape(loss_mean, [1, 1], name = 'fcn_BCE_loss')
     logt('loss (final) ', loss_final)
     # return loss    
-    print('    loss              :', loss.get_shape()       , KB.int_shape(loss)       , 'KerasTensor: ', KB.is_keras_tensor(loss))
-    print('    loss mean         :', loss_mean.get_shape()  , KB.int_shape(loss_mean)  , 'KerasTensor: ', KB.is_keras_tensor(loss_mean))
-    print('    loss final        :', loss_final.get_shape() , KB.int_shape(loss_final) , 'KerasTensor: ', KB.is_keras_tensor(loss_final))
+    dprint('    loss              :', loss.get_shape()       , KB.int_shape(loss)       , 'KerasTensor: ', KB.is_keras_tensor(loss))
+    dprint('    loss mean         :', loss_mean.get_shape()  , KB.int_shape(loss_mean)  , 'KerasTensor: ', KB.is_keras_tensor(loss_mean))
+    dprint('    loss final        :', loss_final.get_shape() , KB.int_shape(loss_final) , 'KerasTensor: ', KB.is_keras_tensor(loss_final))
     
     return loss_final
 
@@ -581,10 +587,10 @@ def fcn_heatmap_CE_loss_graph_2(target_heatmap, pred_heatmap, active_class_ids):
                             classes that are in the dataset of the image, and 0
                             for classes that are not in the dataset. 
     '''
-    print()
-    print('--------------------------------' )
-    print('>>> fcn_heatmap_CE_loss_graph_2 ' )
-    print('--------------------------------' )
+    dprint()
+    dprint('--------------------------------' )
+    dprint('>>> fcn_heatmap_CE_loss_graph_2 ' )
+    dprint('--------------------------------' )
     logt('target_class_ids  ', target_heatmap)
     logt('pred_class_logits ', pred_heatmap  )
     logt('active_class_ids  ', active_class_ids)
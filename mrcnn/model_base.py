@@ -7,7 +7,7 @@ Licensed under the MIT License (see LICENSE for details)
 Written by Waleed Abdulla
 """
 
-import os, sys, glob, random, math, datetime, itertools, json, re, logging, pprint
+import os, sys, glob, random, math, datetime, itertools, json, re, logging, pprint, hashlib, time
 from   collections import OrderedDict
 import numpy as np
 import scipy.misc
@@ -26,6 +26,8 @@ import mrcnn.loss             as loss
 from   mrcnn.datagen          import data_generator
 from   mrcnn.utils            import log
 from   mrcnn.utils            import parse_image_meta_graph, parse_image_meta
+from   mrcnn.checkpoint_index import CheckpointIndex, load_layer_digests, save_layer_digests, weights_file_digest
+import mrcnn.stage_timer      as stage_timer
 
 # from   mrcnn.fpn_layers       import fpn_graph, fpn_classifier_graph, fpn_mask_graph
 
@@ -59,6 +61,18 @@ class ModelBase():
         self.config    = config
         self.model_dir = config.TRAINING_PATH
         self.verbose   = config.VERBOSE
+        ## digest of the weight files loaded so far, see load_weights()
+        self.weights_digest = None
+        ## digests of the layer weights currently in the model, see load_weights_diff()
+        self.layer_digests  = {}
+        self.weights_load_rate = None
+        ## compiled backend functions, see get_backend_function()
+        self.function_cache        = OrderedDict()
+        self.function_cache_hits   = 0
+        self.function_cache_misses = 0
+        ## before the graph is built: graph stages are only timed if enabled at build time
+        if config.STAGE_TIMING:
+            stage_timer.enable()
         print('   Mode      : ', self.mode)
         print('   Model dir : ', self.model_dir)
         if mode == 'training':
@@ -76,7 +90,7 @@ class ModelBase():
     ##------------------------------------------------------------------------------------    
     ## LOAD MODEL
     ##------------------------------------------------------------------------------------                
-    def load_model_weights(self,init_with = None, exclude = None, new_folder = False, verbose = 0):
+    def load_model_weights(self,init_with = None, exclude = None, new_folder = False, differential = False, verbose = 0):
         '''
         methods to load weights
         1 - look for a specific weights file 
@@ -84,6 +98,8 @@ class ModelBase():
         2 - look for last checkpoint file in a specific folder (not working correctly)
         3 - Use init_with keyword
         -- Which weights to start with?
+        
+        differential:   load an explicit weight file with load_weights_diff()
         '''    
 
         # Display layers we intent to exclude from loading process
@@ -103,7 +119,15 @@ class ModelBase():
             last_file = self.find_last(verbose = verbose)[1]
             
             print('   Last file is :', last_file, file = sys.__stdout__)
-            loc= self.load_weights(self.find_last()[1], by_name=True, verbose = verbose)
+            loc= self.load_weights(last_file, by_name=True, verbose = verbose)
+            
+        elif init_with == "best":
+            print(' ---> best')
+            # Load the best checkpoint (monitored value) of the last model you trained
+            best_file = self.find_last(verbose = verbose, best = True)[1]
+            
+            print('   Best file is :', best_file, file = sys.__stdout__)
+            loc= self.load_weights(best_file, by_name=True, verbose = verbose)
             
         elif init_with == "init":
             print(' ---> init :', self.config.VGG16_MODEL_PATH)
@@ -140,7 +164,10 @@ class ModelBase():
         else:
             assert init_with != "", "Provide path to trained weights"
             print(" ---> Explicit weight file")
-            loc = self.load_weights(init_with, by_name=True, exclude = exclude, new_folder= new_folder, verbose = verbose)  
+            if differential:
+                loc = self.load_weights_diff(init_with, exclude = exclude, verbose = verbose)
+            else:
+                loc = self.load_weights(init_with, by_name=True, exclude = exclude, new_folder= new_folder, verbose = verbose)  
 
 
         print('==========================================')
@@ -210,7 +237,10 @@ class ModelBase():
             
         if hasattr(f, 'close'):
             f.close()
-            
+        self.clear_function_cache()
+        self.layer_digests = {}
+        self.chain_weights_digest(filepath, exclude)
+        
         print('    Weights file loaded: {} '.format(filepath))        
         print('    Weights file loaded: {} '.format(filepath), file = sys.__stdout__)
 
@@ -221,6 +251,92 @@ class ModelBase():
 
         return(filepath)
 
+        
+    def chain_weights_digest(self, filepath, exclude):
+        '''
+        chain the digest of this file (checkpoint_index.weights_file_digest()) onto the 
+        digest of previously loaded files
+        '''
+        digest = hashlib.sha1()
+        digest.update('{}|{}|{}'.format(self.weights_digest, weights_file_digest(filepath), sorted(exclude or [])).encode('utf-8'))
+        self.weights_digest = digest.hexdigest()
+
+        
+    ##----------------------------------------------------------------------------------------------
+    ## Differential load of weights file
+    ##----------------------------------------------------------------------------------------------                    
+    def load_weights_diff(self, filepath, exclude = None, verbose = 0):
+        '''
+        Name-based load of filepath that only reads and assigns the layers whose stored
+        weights differ from the weights currently in the model, e.g. when evaluating the
+        successive checkpoints of a training run, where frozen layers are identical.
+        
+        The model keeps the content digest of each layer it loaded (self.layer_digests).
+        Each layer of the file is read once, hashed, and only assigned if its digest
+        differs. Layer digests of the file are kept next to it (checkpoint_index.
+        save_layer_digests()), so layers known to be unchanged are not read at all. Layers
+        loaded by load_weights() have no digest, so the first differential load assigns
+        every layer. Weights change while training, so training mode models always do a
+        full load_weights().
+        
+        Returns:
+        --------
+        filepath, and prints a report of the layers transferred, bytes read and the
+        estimated time saved compared to a full load.
+        '''
+        import h5py
+        
+        if self.mode == 'training':
+            return self.load_weights(filepath, by_name = True, exclude = exclude, verbose = verbose)
+            
+        log('>>> load_weights_diff() from : {}'.format(filepath))
+        start_time = time.time()
+        f = h5py.File(filepath, mode='r')
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+
+        keras_model = self.keras_model
+        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
+            else keras_model.layers
+        if exclude:
+            layers = list(filter(lambda l: l.name not in exclude, layers))
+            
+        ## bytes of each hdf5 layer matched by a model layer (dataset metadata only)
+        layer_bytes = {}
+        model_names = set(l.name for l in layers)
+        for name in utils._load_attributes_from_hdf5_group(f, 'layer_names'):
+            if name in model_names:
+                g = f[name]
+                layer_bytes[name] = sum(int(np.prod(g[w].shape)) * g[w].dtype.itemsize
+                                        for w in utils._load_attributes_from_hdf5_group(g, 'weight_names'))
+        
+        file_digests  = load_layer_digests(filepath)
+        known_digests = dict(file_digests)
+        old_digests   = dict(self.layer_digests)
+        read_bytes    = utils.load_weights_from_hdf5_group_by_name(f, layers, verbose = verbose,
+                                                                   layer_digests = self.layer_digests,
+                                                                   file_digests  = file_digests)
+        if hasattr(f, 'close'):
+            f.close()
+        if file_digests != known_digests:
+            save_layer_digests(filepath, file_digests)
+            
+        changed_names = set(name for name in layer_bytes if self.layer_digests.get(name) != old_digests.get(name))
+        if changed_names:
+            self.clear_function_cache()
+        self.chain_weights_digest(filepath, exclude)
+        
+        elapsed      = time.time() - start_time
+        total_bytes  = sum(layer_bytes.values())
+        ## time of a full load, extrapolated from the read rate of the last load that read data
+        if read_bytes:
+            self.weights_load_rate = read_bytes / max(elapsed, 1e-6)
+        full_time    = total_bytes / self.weights_load_rate if self.weights_load_rate else elapsed
+        print('    Weights file loaded: {}  layers transferred: {} of {}  MB read: {:.1f} of {:.1f}'
+              '  time: {:.2f}s  est. saved: {:.2f}s'.format(filepath, len(changed_names), len(layer_bytes),
+               read_bytes / 2**20, total_bytes / 2**20, elapsed, max(full_time - elapsed, 0.0)))
+        return(filepath)
+
 
     ##----------------------------------------------------------------------------------------------
     ##  set checkpoint directory 
@@ -310,7 +426,54 @@ class ModelBase():
     ##----------------------------------------------------------------------------------------------
     ## Search for last checkpoint folder and weight file
     ##----------------------------------------------------------------------------------------------                    
-    def find_last(self, verbose = 0):
+    def find_last(self, verbose = 0, best = False):
+        '''
+        Finds the last checkpoint file of the last trained model in the
+        model directory, using the checkpoint index (checkpoints.json) of the
+        run folders. Folders without an index are listed as in find_last_orig().
+        
+        best:   return the best checkpoint (monitored value) of the folder
+                rather than the last one
+        
+        Returns:
+        --------
+            log_dir: The directory where events and weights are saved
+            checkpoint_path: the path to the last checkpoint file
+        '''
+        key = self.config.NAME.lower()
+        dir_name, checkpoint = None, None
+        dir_names = sorted(filter(lambda f: f.startswith(key), next(os.walk(self.model_dir))[1]))
+        if verbose:
+            print('>>> find_last checkpoint in : ', self.model_dir)
+            print('    Dir starting with       : ' , key, ' :', len(dir_names), 'folders')
+        if not dir_names:
+            return None, None
+            
+        ## Loop over folders to find most recent foder with a valid weights file 
+        for search_dir in dir_names[-1::-1]:
+            dir_name = os.path.join(self.model_dir, search_dir)
+            index    = CheckpointIndex.load(dir_name)
+            if index is not None:
+                checkpoint = index.best_path() if best else index.latest_path()
+                if checkpoint is not None and not os.path.isfile(checkpoint):
+                    ## files removed since the index was written 
+                    index.prune()
+                    checkpoint = index.best_path() if best else index.latest_path()
+            else:
+                checkpoints = sorted(filter(lambda f: f.startswith(key), next(os.walk(dir_name))[2]))
+                checkpoint  = os.path.join(dir_name, checkpoints[-1]) if checkpoints else None
+            if verbose:
+                print('    Folder: ' ,dir_name, ' indexed: ', index is not None, ' checkpoint: ', checkpoint)
+            if checkpoint is not None:
+                break
+                
+        if verbose:
+            log("    find_last():   dir_name: {}".format('NotFound' if dir_name is None else dir_name))
+            log("    find_last(): checkpoint: {}".format('NotFound' if checkpoint is None else checkpoint))
+        return dir_name, checkpoint
+
+        
+    def find_last_orig(self, verbose = 0):
         '''
         Finds the last checkpoint file of the last trained model in the
         model directory.
@@ -459,6 +622,46 @@ class ModelBase():
         return None
 
         
+    ##----------------------------------------------------------------------------------------------
+    ## Compiled backend function cache
+    ##----------------------------------------------------------------------------------------------                    
+    def get_backend_function(self, inputs, outputs):
+        '''
+        Returns KB.function(inputs, outputs) from an LRU cache of compiled backend functions, 
+        keyed by the input and output tensors and the learning phase. Each KB.function() call
+        adds ops to the graph, so get_layer_outputs() / run_graph() calls in a loop over images
+        reuse the function built by the first call.
+
+        The cache holds up to config.FUNCTION_CACHE_SIZE functions (0 disables it). It is
+        cleared by load_weights() and set_trainable(), and by compile() in the subclasses;
+        call clear_function_cache() after changing the model in any other way.
+        '''
+        inputs  = inputs  if isinstance(inputs,  (list, tuple)) else [inputs]
+        outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+        cache_size = self.config.FUNCTION_CACHE_SIZE
+        if cache_size <= 0:
+            return KB.function(inputs, outputs)
+
+        learning_phase = KB.learning_phase()
+        key = (tuple(inputs), tuple(outputs), learning_phase if isinstance(learning_phase, int) else None)
+        if key in self.function_cache:
+            self.function_cache.move_to_end(key)
+            self.function_cache_hits += 1
+            return self.function_cache[key]
+
+        self.function_cache_misses += 1
+        function = KB.function(list(inputs), list(outputs))
+        self.function_cache[key] = function
+        while len(self.function_cache) > cache_size:
+            self.function_cache.popitem(last = False)
+        return function
+
+    def clear_function_cache(self):
+        '''
+        Drop the compiled backend functions held by get_backend_function()
+        '''
+        self.function_cache.clear()
+
     ##----------------------------------------------------------------------------------------------
     ##
     ##----------------------------------------------------------------------------------------------                    
@@ -480,10 +683,10 @@ class ModelBase():
             assert o is not None
 
         # Build a Keras function to run parts of the computation graph
-        inputs = model.inputs
+        inputs = list(model.inputs)
         if model.uses_learning_phase and not isinstance(KB.learning_phase(), int):
             inputs += [KB.learning_phase()]
-        kf = KB.function(model.inputs, list(outputs.values()))
+        kf = self.get_backend_function(inputs, list(outputs.values()))
 
         # Run inference
         molded_images, image_metas, windows = self.mold_inputs(images)
@@ -552,6 +755,8 @@ class ModelBase():
         regular expression.
         '''       
         # Print message on the first call (but not on recursive calls)
+        if keras_model is None:
+            self.clear_function_cache()
         if verbose > 0 and keras_model is None:
             log("\nSelecting layers to train")
             log("-------------------------")
@@ -753,7 +958,7 @@ class ModelBase():
                 print('Layer {:3d}:  ({:40s}) \t  Output shape: {}'.format(i, j.name, j.shape))
                 # print('Layer:  ',i, '   ', j.name, '   ', j.shape)
         
-        get_output = KB.function(self.keras_model.input, requested_layers_tensors)   
+        get_output = self.get_backend_function(self.keras_model.input, requested_layers_tensors)   
         results = get_output(model_input)                    
         
         if verbose:
@@ -780,7 +985,7 @@ class ModelBase():
                 
         requested_layers_tensors = [self.outputs[x] for x in requested_layers]
         
-        get_output = KB.function(self.input, requested_layers_tensors)   
+        get_output = self.get_backend_function(self.input, requested_layers_tensors)   
         results = get_output(model_input)                    
         
         if verbose:
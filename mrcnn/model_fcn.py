@@ -10,7 +10,7 @@ Written by Waleed Abdulla
 ## L2 normalization layers (import fcn_layer_no_L2)
 ##
 ##
-import os, sys, glob, random, math, datetime, itertools, json, re, logging, pprint, warnings
+import os, sys, glob, random, math, datetime, itertools, json, re, logging, pprint, warnings, time, threading, queue
 from   collections import OrderedDict
 import numpy as np
 import scipy.misc
@@ -33,10 +33,14 @@ from   mrcnn.utils                 import (log, logt,  parse_image_meta_graph, p
                                            parse_active_class_ids_graph)
 from   datetime                    import datetime                                           
 from   mrcnn.model_base            import ModelBase
+from   mrcnn.checkpoint_index      import IndexedModelCheckpoint
+from   mrcnn.logs                  import get_logger, log_timing, timing_enabled
+import mrcnn.stage_timer           as stage_timer
 # from   mrcnn.fcn16_layer           import fcn16_graph
 # from   mrcnn.fcn_layer_no_L2       import fcn_graph
 # from   mrcnn.fcn_scoring_layer     import FCNScoringLayer 
 from   mrcnn.fcn_scoring_layer     import fcn_scoring_graph
+from   mrcnn.heatmap_kernels       import heatmaps_from_scores
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -45,6 +49,7 @@ assert LooseVersion(keras.__version__) >= LooseVersion('2.0.8')
 pp = pprint.PrettyPrinter(indent=4, width=100)
 tf.get_variable_scope().reuse_variables()
 warnings.filterwarnings('ignore', '.*output shape of zoom.*')
+logger = get_logger(__name__)
 #  from keras.callbacks import TensorBoard
 #  
 #  class LRTensorBoard(TensorBoard):
@@ -55,6 +60,146 @@ warnings.filterwarnings('ignore', '.*output shape of zoom.*')
 #          logs.update({'lr': KB.eval(self.model.optimizer.lr)})
 #          super().on_epoch_end(epoch, logs)
         
+############################################################
+##  FCN input producer
+############################################################
+class FCNInputProducer(object):
+    '''
+    Runs MRCNN inference on batches pulled from an MRCNN data generator and hands the 
+    resulting FCN inputs [image_meta, pr_hm, pr_hm_scores, gt_hm, gt_hm_scores] to the 
+    FCN training loop.
+
+    With max_queue_size > 0 a background thread keeps up to max_queue_size ready FCN 
+    batches in a bounded queue, so the MRCNN forward pass for the next step runs while
+    the FCN trains on the current one. With max_queue_size = 0 batches are produced in 
+    the caller's thread when get() is called.
+
+    Batches with NaNs in the MRCNN pr_hm_scores output, or failing in MRCNN predict, are 
+    skipped and the next batch from the generator is used.
+
+    With sparse_pr_heatmaps (FCN built with SPARSE_PR_HEATMAPS) pr_hm is left out of the
+    FCN inputs.
+
+    Stall times (seconds) are accumulated until reset_stall_times() is called:
+        producer_stall  :   time the producer waited on a full queue 
+        consumer_stall  :   time get() waited for a ready batch
+    '''
+    def __init__(self, mrcnn_model, generator, dataset, phase = 'training', max_queue_size = 2, sparse_pr_heatmaps = False):
+        self.mrcnn_model    = mrcnn_model
+        self.generator      = generator
+        self.dataset        = dataset
+        self.phase          = phase
+        self.max_queue_size = max_queue_size
+        self.sparse_pr_heatmaps = sparse_pr_heatmaps
+        self.epoch          = 0
+        self.producer_stall = 0.0
+        self.consumer_stall = 0.0
+        self.queue          = queue.Queue(maxsize = max(1, max_queue_size))
+        self.stop_event     = threading.Event()
+        self.thread         = None
+
+        
+    def next_batch(self):
+        '''
+        Pull batches from the generator until MRCNN predict returns a good sample.
+        Returns fcn_x, batch_y, batch_x
+        '''
+        batch_x = None
+        while True:
+            try:
+                batch_x, batch_y = next(self.generator)
+                with stage_timer.stage('mrcnn_predict'):
+                    results = self.mrcnn_model.keras_model.predict(batch_x)
+                if np.any(np.isnan(results[1])):
+                    logger.warning('\n Bad batch_x encountered (%s phase) - epoch %s , image ids: %s -- Retry with next sample',
+                                   self.phase, self.epoch, batch_x[1][:,0])
+                else:
+                    fcn_x = [batch_x[1]]
+                    fcn_x.extend(results[:4])
+                    if self.sparse_pr_heatmaps:
+                        del fcn_x[1]
+                    return fcn_x, batch_y, batch_x
+            except StopIteration:
+                raise
+            except Exception as e :
+                if batch_x is None:
+                    raise
+                img_id =  batch_x[1][0,0]
+                logger.error('\n failure on mrcnn predict (%s phase) - epoch %s , image ids: %s %s', self.phase, self.epoch, img_id, img_id.shape)
+                logger.error('\n dataset image info: %s', self.dataset.image_info[img_id])
+                logger.error('\n Exception information:\n%s', e)
+
+                
+    def run(self):
+        with self.graph.as_default():
+            while not self.stop_event.is_set():
+                try:
+                    item = (self.next_batch(), None)
+                except Exception as e:
+                    item = (None, e)
+                start = time.time()
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(item, timeout = 0.5)
+                        break
+                    except queue.Full:
+                        pass
+                self.producer_stall += time.time() - start
+                if item[1] is not None:
+                    return
+
+                    
+    def start(self):
+        '''
+        Start the producer thread; no-op if it is already running
+        '''
+        if self.max_queue_size <= 0 or self.thread is not None:
+            return self
+        ## build the predict function here, Keras can't do it safely from the worker thread 
+        self.mrcnn_model.keras_model._make_predict_function()
+        self.graph  = tf.get_default_graph()
+        self.thread = threading.Thread(target = self.run, name = 'fcn_input_{}'.format(self.phase))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+        
+    def get(self):
+        '''
+        Returns the next fcn_x, batch_y, batch_x. Exceptions raised by the generator in the 
+        producer thread are re-raised here.
+        '''
+        start = time.time()
+        if self.thread is None:
+            batch = self.next_batch()
+        else:
+            batch, error = self.queue.get()
+            if error is not None:
+                raise error
+        self.consumer_stall += time.time() - start
+        return batch
+
+        
+    def reset_stall_times(self):
+        stall_times = {'producer_stall': self.producer_stall, 'consumer_stall': self.consumer_stall}
+        self.producer_stall = 0.0
+        self.consumer_stall = 0.0
+        return stall_times
+
+        
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout = 0.1)
+        self.thread = None
+
+        
 ############################################################
 ##  FCN Class
 ############################################################
@@ -187,9 +332,17 @@ class FCN(ModelBase):
         ##------------------------------------------------------------------
         # input_image      = KL.Input(shape=config.IMAGE_SHAPE.tolist(), name="input_image")
         input_image_meta = KL.Input(shape=[None], name="input_image_meta")
-        pr_hm            = KL.Input(shape=[h,w, num_classes], name="input_pr_hm_norm" , dtype=tf.float32 )
         pr_hm_scores     = KL.Input(shape=[num_classes, num_bboxes, num_scores_columns], name="input_pr_hm_scores", dtype=tf.float32)
         
+        ## SPARSE_PR_HEATMAPS: pr_hm is not an input, rebuild it from the pr_hm_scores boxes 
+        if config.SPARSE_PR_HEATMAPS:
+            pr_hm        = KL.Lambda(lambda x: heatmaps_from_scores(x, config.HEATMAP_SCALE_FACTOR, h, w), 
+                                     name = 'input_pr_hm_norm')(pr_hm_scores)
+            pr_hm_inputs = [pr_hm_scores]
+        else:
+            pr_hm        = KL.Input(shape=[h,w, num_classes], name="input_pr_hm_norm" , dtype=tf.float32 )
+            pr_hm_inputs = [pr_hm, pr_hm_scores]
+        
         ##----------------------------------------------------------------------------                
         ## FCN Training Mode Layers
         ##----------------------------------------------------------------------------                
@@ -232,7 +385,7 @@ class FCN(ModelBase):
                             ([gt_hm, fcn_hm])
                             
             # Model Inputs 
-            inputs  = [input_image_meta, pr_hm, pr_hm_scores, gt_hm, gt_hm_scores]
+            inputs  = [input_image_meta] + pr_hm_inputs + [gt_hm, gt_hm_scores]
             outputs = [fcn_hm, fcn_sm, fcn_MSE_loss, fcn_BCE_loss, fcn_scores]
             
         # end if Training
@@ -248,7 +401,7 @@ class FCN(ModelBase):
             # logt('* fcn_softmax shape: ', fcn_sm, verbose = verbose)        
             logt('* fcn_scores shape : ', fcn_scores, verbose = verbose )        
             
-            inputs  = [ pr_hm , pr_hm_scores]                                        
+            inputs  = pr_hm_inputs
             outputs = [ fcn_hm, fcn_sm, fcn_scores]
 
         # end if Inference Mode        
@@ -282,7 +435,7 @@ class FCN(ModelBase):
         Runs the FCN detection pipeline on an input batch (heatmaps + scores).
         Input:
         --------    
-        pr_hm :         Heatmap [Bsz, hm_w, hm_h, num_classes]  
+        pr_hm :         Heatmap [Bsz, hm_w, hm_h, num_classes]  (None with SPARSE_PR_HEATMAPS)
         pr_hm_scores:   Heatmap Scores by class [BSz, num_classes, num_detections, columns]
         image_metas:    Image Meta information required for unmolding bounding box coordinates
 
@@ -298,11 +451,12 @@ class FCN(ModelBase):
         sequence_column = 7
         if verbose:
             print('===> call fcn predict()')
-            print('     pr_hm         ', pr_hm.shape)
+            print('     pr_hm         ', None if pr_hm is None else pr_hm.shape)
             print('     pr_hm_scores  ', pr_hm_scores.shape)
             print('     image_metas   ', image_metas.shape)
 
-        fcn_hm, fcn_sm, fcn_hm_scores = self.keras_model.predict([pr_hm, pr_hm_scores], verbose = 0)
+        fcn_inputs = [pr_hm_scores] if self.config.SPARSE_PR_HEATMAPS else [pr_hm, pr_hm_scores]
+        fcn_hm, fcn_sm, fcn_hm_scores = self.keras_model.predict(fcn_inputs, batch_size = self.config.BATCH_SIZE, verbose = 0)
 
         if verbose:
             print('    results from fcn.keras_model.predict()')
@@ -315,7 +469,7 @@ class FCN(ModelBase):
 
         results = []
         
-        for i in range(pr_hm.shape[0]):
+        for i in range(pr_hm_scores.shape[0]):
             
             ## reshape fcn_hm_scores from per_class to per_image tensor
             ## fcn_hm_scores is by class  
@@ -326,7 +480,7 @@ class FCN(ModelBase):
             fcn_scores_by_image = utils.byclass_to_byimage_np(fcn_scores_by_class, sequence_column)
             if verbose:
                 print(' Process input/results ', i)
-                print(' pr_hm              :', pr_hm[i].shape)
+                print(' pr_hm              :', None if pr_hm is None else pr_hm[i].shape)
                 print(' pr_hm_scores       :', pr_hm_scores[i].shape)
                 print(' fcn_hm             :', fcn_hm[i].shape)
                 print(' fcn_hm_scores      :', fcn_hm_scores[i].shape)
@@ -342,15 +496,43 @@ class FCN(ModelBase):
                     
         return results 
         
+    ##-------------------------------------------------------------------------------------
+    ##  SPARSE_PR_HEATMAPS checks
+    ##-------------------------------------------------------------------------------------                
+    def check_sparse_pr_heatmaps(self, mrcnn_config):
+        '''
+        The MRCNN and FCN models must be built with the same SPARSE_PR_HEATMAPS setting: an
+        MRCNN model built with it keeps no dense pr_hm in its results, which a dense FCN needs
+        '''
+        if mrcnn_config.SPARSE_PR_HEATMAPS != self.config.SPARSE_PR_HEATMAPS:
+            raise ValueError('SPARSE_PR_HEATMAPS is {} in the MRCNN config and {} in the FCN config - '
+                             'build both models with the same setting'.format(
+                             mrcnn_config.SPARSE_PR_HEATMAPS, self.config.SPARSE_PR_HEATMAPS))
+
+    def stack_pr_heatmaps(self, results):
+        '''
+        pr_hm FCN input [batch, hm_h, hm_w, num_classes] of a list of MRCNN results,
+        None with SPARSE_PR_HEATMAPS
+        '''
+        if self.config.SPARSE_PR_HEATMAPS:
+            return None
+        if any(r['pr_hm'] is None for r in results):
+            raise ValueError('MRCNN results hold no pr_hm (built with SPARSE_PR_HEATMAPS, or read from a '
+                             'detection cache written by such a model), but the FCN expects dense pr_hm '
+                             'input - set SPARSE_PR_HEATMAPS in the FCN config')
+        return np.stack([r['pr_hm'] for r in results])
+
     ##-------------------------------------------------------------------------------------
     ##  detect_from_images
     ##-------------------------------------------------------------------------------------        
         
-    def detect_from_images(self, mrcnn_model, images, verbose=0):
+    def detect_from_images(self, mrcnn_model, images, verbose=0, detection_cache = None):
         '''
         Runs the detection pipeline from an input of images.
 
         images:         List of images, potentially of different sizes.
+        detection_cache: Optional DetectionCache - MRCNN detections are read from / written
+                        to the cache instead of always running the MRCNN model.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois:           [N, (y1, x1, y2, x2)] detection bounding boxes
@@ -377,18 +559,22 @@ class FCN(ModelBase):
         '''
         
         # print('call fcn.detect_from_images()')
-        results = mrcnn_model.detect(images, verbose = verbose)
+        self.check_sparse_pr_heatmaps(mrcnn_model.config)
+        if detection_cache is None:
+            results = mrcnn_model.detect(images, verbose = verbose)
+        else:
+            results = detection_cache.detect(mrcnn_model, images, verbose = verbose)
 
         if verbose:
             print('===>   fcn.detect_from_images() : return from  mrcnn.detect() : ', len(results))
             for i, r in enumerate(results):
                 print('\noutputs returned from mrcnn.detect()  ', i, '  ',sorted(r.keys()))
                 for key in sorted(r):
-                    print(key.ljust(20), r[key].shape)        
+                    print(key.ljust(20), np.shape(r[key]))        
         
         ## prep results from mrcnn detections to pass to fcn detection
         # for result in results:
-        fcn_input_hm = np.stack([r['pr_hm'] for r in results] )
+        fcn_input_hm = self.stack_pr_heatmaps(results)
         fcn_input_hm_scores = np.stack([r['pr_hm_scores'] for r in results] )
         fcn_input_image_metas = np.stack([r['image_meta'] for r in results] )
 
@@ -424,7 +610,7 @@ class FCN(ModelBase):
     ##-------------------------------------------------------------------------------------
     ##  detect_from_images
     ##-------------------------------------------------------------------------------------                
-    def evaluate(self, mrcnn_model, evaluate_batch, verbose=0):
+    def evaluate(self, mrcnn_model, evaluate_batch, verbose=0, detection_cache = None):
         '''
         Runs the evaluation pipeline:
         Pass Input --> MRCNN (evaluation mode) ---> FCN (inference mode) --> Results
@@ -437,6 +623,8 @@ class FCN(ModelBase):
 
         evaluate_batch:          [input_image, input_image_meta, input_gt_class_ids, input_gt_boxes]
            input_image:          List of images, potentially of different sizes.        
+        detection_cache:         Optional DetectionCache - MRCNN results are read from / written
+                                 to the cache instead of always running the MRCNN model.
         
         Returns a list of dicts, one dict per image. The dict contains:
             N : number of detections 
@@ -458,19 +646,33 @@ class FCN(ModelBase):
 
         assert self.mode   == "inference", "FCN model must be created in inference mode."
         assert len(evaluate_batch) == 5, " length of eval batch must be 4"
-        sequence_column = 7
+        self.check_sparse_pr_heatmaps(mrcnn_model.config)
         
-        results = mrcnn_model.evaluate(evaluate_batch, verbose = verbose)
-
+        if detection_cache is None:
+            results = mrcnn_model.evaluate(evaluate_batch, verbose = verbose)
+        else:
+            results = detection_cache.evaluate_batch(mrcnn_model, evaluate_batch, verbose = verbose)
+        
+        return self.detect_from_mrcnn_results(results, verbose = verbose)
+        
+        
+    ##-------------------------------------------------------------------------------------
+    ##  detect_from_mrcnn_results
+    ##-------------------------------------------------------------------------------------                
+    def detect_from_mrcnn_results(self, results, verbose=0):
+        '''
+        Runs FCN detection on the results returned by MRCNN evaluate() or detect()
+        (or read from a DetectionCache), adding the FCN outputs to each result dict.
+        '''
         if verbose:
             print('===>   return from  MRCNN evaluate() : ', len(results))
             for i, r in enumerate(results):
                 print('\n output ', i, '  ',sorted(r.keys()))
                 for key in sorted(r):
-                    print(key.ljust(20), r[key].shape)        
+                    print(key.ljust(20), np.shape(r[key]))        
         
         ## prep results from mrcnn detections to pass to fcn detection
-        fcn_input_hm          = np.stack([r['pr_hm'] for r in results] )
+        fcn_input_hm          = self.stack_pr_heatmaps(results)
         fcn_input_hm_scores   = np.stack([r['pr_hm_scores'] for r in results] )
         fcn_input_image_metas = np.stack([r['image_meta'] for r in results] )
         
@@ -660,6 +862,7 @@ class FCN(ModelBase):
         metrics. Then calls the Keras compile() function.
         '''
         assert loss_functions is not None  , "A loss function must be defined as the objective"
+        self.clear_function_cache()
 
         if not isinstance(loss_functions, list):
             loss_functions = [loss_functions]
@@ -900,13 +1103,13 @@ class FCN(ModelBase):
                                           # embeddings_layer_names=None,
                                           # embeddings_metadata=None)
                                           
-            , keras.callbacks.ModelCheckpoint(self.checkpoint_path, 
-                                              mode    = 'auto', 
-                                              period  = self.config.CHECKPOINT_PERIOD, 
-                                              monitor = 'val_loss', 
-                                              verbose = 1, 
-                                              save_best_only = True, 
-                                              save_weights_only=True)
+            , IndexedModelCheckpoint(self.checkpoint_path, 
+                                     mode    = 'auto', 
+                                     period  = self.config.CHECKPOINT_PERIOD, 
+                                     monitor = 'val_loss', 
+                                     verbose = 1, 
+                                     save_best_only = True, 
+                                     save_weights_only=True)
 
             , keras.callbacks.ReduceLROnPlateau(monitor='val_loss', 
                                                 mode     = 'auto', 
@@ -1038,6 +1241,7 @@ class FCN(ModelBase):
                         5+: Train Resnet stage 5 and up
         '''
         assert self.mode == "training", "Create model in training mode."
+        self.check_sparse_pr_heatmaps(mrcnn_model.config)
         
         if batch_size == 0 :
             batch_size = self.config.BATCH_SIZE
@@ -1082,6 +1286,15 @@ class FCN(ModelBase):
                                          shuffle = shuffle, 
                                          augment = False,
                                          batch_size=batch_size)
+
+        ## MRCNN inference on the generated batches runs in background threads, keeping up to 
+        ## FCN_INPUT_QUEUE_SIZE FCN input batches ready ahead of the FCN training / validation steps
+        train_producer  = FCNInputProducer(mrcnn_model, train_generator, train_dataset, 'training', 
+                                           max_queue_size = self.config.FCN_INPUT_QUEUE_SIZE,
+                                           sparse_pr_heatmaps = self.config.SPARSE_PR_HEATMAPS)
+        val_producer    = FCNInputProducer(mrcnn_model, val_generator, val_dataset, 'validation', 
+                                           max_queue_size = self.config.FCN_INPUT_QUEUE_SIZE,
+                                           sparse_pr_heatmaps = self.config.SPARSE_PR_HEATMAPS)
                                          
         ##--------------------------------------------------------------------------------
         ## Set trainable layers and compile
@@ -1163,13 +1376,13 @@ class FCN(ModelBase):
                                           # embeddings_layer_names=None,
                                           # embeddings_metadata=None)
 
-            , keras.callbacks.ModelCheckpoint(self.checkpoint_path, 
-                                              mode    = 'auto', 
-                                              period  = self.config.CHECKPOINT_PERIOD, 
-                                              monitor = 'val_loss', 
-                                              verbose = 1, 
-                                              save_best_only = True, 
-                                              save_weights_only=True)
+            , IndexedModelCheckpoint(self.checkpoint_path, 
+                                     mode    = 'auto', 
+                                     period  = self.config.CHECKPOINT_PERIOD, 
+                                     monitor = 'val_loss', 
+                                     verbose = 1, 
+                                     save_best_only = True, 
+                                     save_weights_only=True)
                                             
             , keras.callbacks.ReduceLROnPlateau(monitor='val_loss', 
                                                 mode     = 'auto', 
@@ -1222,6 +1435,7 @@ class FCN(ModelBase):
         log("REDUCE_LR_PATIENCE    {} ".format(self.config.REDUCE_LR_PATIENCE ))
         log("MIN_LR                {} ".format(self.config.MIN_LR             ))
         log("EARLY_STOP_PATIENCE   {} ".format(self.config.EARLY_STOP_PATIENCE))        
+        log("FCN_INPUT_QUEUE_SIZE  {} ".format(self.config.FCN_INPUT_QUEUE_SIZE))        
         log("Checkpoint Path:      {} ".format(self.checkpoint_path))
 
 
@@ -1252,293 +1466,240 @@ class FCN(ModelBase):
         if epoch_idx >= final_epoch:
             print('Final epoch {} has already completed - Training will not proceed'.format(final_epoch))
         else:
-        
-            while epoch_idx < final_epoch :
+            ## The validation producer is started just before the first validation step (see below)
+            train_producer.start()
+            
+            ## the producers are stopped also when training ends on an exception, so their threads
+            ## do not keep running MRCNN predict on the GPU
+            try:
+                while epoch_idx < final_epoch :
                 
-                if self.config.SYSOUT ==  'ALL':                    
-                    start_time_disp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-                    print('{}   epoch {}  of {} epochs  '.format(start_time_disp, epoch_idx, final_epoch), file = sys.__stdout__)
+                    if self.config.SYSOUT ==  'ALL':                    
+                        start_time_disp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+                        print('{}   epoch {}  of {} epochs  '.format(start_time_disp, epoch_idx, final_epoch), file = sys.__stdout__)
                 
-                callbacks.on_epoch_begin(epoch_idx)
-                epoch_logs = {}
-
-                ##------------------------------------------------------------------------
-                ## TRAINING Phase - emulating fit_generator()
-                ##------------------------------------------------------------------------
-                for steps_index in range(steps_per_epoch):
-                    # print(' self.epoch {}   final epoch:{}  step {} '.format(self.epoch, final_epoch, steps_index), file = sys.__stdout__)
-                    batch_logs = {}
-                    batch_logs['batch'] = steps_index
-                    batch_logs['size']  = batch_size    
-
-                    callbacks.on_batch_begin(steps_index, batch_logs)
-
-                    ## Run prediction on MRCNN training sample  
-                    good_sample = False
-                    while not good_sample:
+                    callbacks.on_epoch_begin(epoch_idx)
+                    epoch_logs = {}
+                    train_producer.epoch = epoch_idx
+                    val_producer.epoch   = epoch_idx
+
+                    ##------------------------------------------------------------------------
+                    ## TRAINING Phase - emulating fit_generator()
+                    ##------------------------------------------------------------------------
+                    for steps_index in range(steps_per_epoch):
+                        # print(' self.epoch {}   final epoch:{}  step {} '.format(self.epoch, final_epoch, steps_index), file = sys.__stdout__)
+                        batch_logs = {}
+                        batch_logs['batch'] = steps_index
+                        batch_logs['size']  = batch_size    
+
+                        callbacks.on_batch_begin(steps_index, batch_logs)
+
+                        ## Get FCN inputs (MRCNN predictions on the next good training sample)
+                        step_start = time.perf_counter()
+                        fcn_x, train_batch_y, train_batch_x = train_producer.get()
+                        get_time   = time.perf_counter() - step_start
+                    
+                        ## Train on FCN training sample
                         try:
-                            train_batch_x, train_batch_y = next(train_generator)
-                            # print('len of train batch x' ,len(train_batch_x))
-                            # for idx, i in  enumerate(train_batch_x):
-                                # print(idx, 'type: ', type(i), 'shape: ', i.shape)
-                            results = mrcnn_model.keras_model.predict(train_batch_x)
-                            # for i in results:
-                                # print(i.shape, type(i), np.any(np.isnan(i)))    
-                            if np.any(np.isnan(results[1])):
-                                print('\n Bad train_batch_x encountered (training phase) - epoch {} , image ids: {} -- Retry with next sample'.
-                                        format(epoch_idx, train_batch_x[1][:,0]))
-                            else :
-                                good_sample = True
+                            outs = self.keras_model.train_on_batch(fcn_x , train_batch_y)                                            
                         except Exception as e :
                             img_id =  train_batch_x[1][0,0]
-                            print('\n failure on mrcnn predict - epoch {} , image ids: {} {}'.format(epoch_idx, img_id, img_id.shape))
-                            print('\n dataset image info: ' , train_dataset.image_info[img_id])
-                            print('\n Exception information:')
-                            print(str(e))
-                    else:        
-                        fcn_x = [train_batch_x[1]]
-                        fcn_x.extend(results[:4])
-                        
-                    # Run prediction on MRCNN  
-                    # try:
-                        # train_batch_x, train_batch_y = next(train_generator)
-                        # results = mrcnn_model.keras_model.predict(train_batch_x)
-                        # fcn_x = [train_batch_x[1]]
-                        # fcn_x.extend(results[:4])
-                    
-                    # except Exception as e :
-                        # img_id =  train_batch_x[1][0,0]
-                        # print('\nfailure on mrcnn predict - epoch {} , image ids: {} {}'.format(epoch_idx, img_id, img_id.shape))
-                        # print()
-                        # print('dataset image info: ' , train_dataset.image_info[img_id])
-                        # print()
-                        # print('Exception information:')
-                        # print(str(e))
+                            logger.error('\n failure on fcn train - epoch %s , image ids: %s %s', epoch_idx, img_id, img_id.shape)
+                            logger.error('\n dataset image info: %s', train_dataset.image_info[img_id])
+                            logger.error('\n Exception information:\n%s', e)
+                        train_time = time.perf_counter() - step_start - get_time
                     
-                    # print('size of results : ', len(results))
-                    # for idx, i in  enumerate(x):
-                        # print(idx, 'type: ', type(i), 'shape: ', i.shape)
-                    
-                    ## Train on FCN training sample
-                    try:
-                        outs = self.keras_model.train_on_batch(fcn_x , train_batch_y)                                            
-                    except Exception as e :
-                        img_id =  train_batch_x[1][0,0]
-                        print('\n failure on fcn train - epoch {} , image ids: {} {}'.format(epoch_idx, img_id, img_id.shape))
-                        print('\n dataset image info: ' , train_dataset.image_info[img_id])
-                        print('\n Exception information:')
-                        print(str(e))                
+                        stage_timer.record('fcn_input_wait'    , get_time)
+                        stage_timer.record('fcn_train_on_batch', train_time)
+                        if timing_enabled():
+                            log_timing('fcn_train_step', epoch = epoch_idx, step = steps_index, 
+                                       get = get_time, train = train_time)
                         
-                    # print('size of outputs from train_on_batch : ', len(outs), outs)
-                    # for idx, i in  enumerate(outs):
-                        # print(idx, 'type: ', type(i), 'shape: ', i.shape)
+                        # print('size of outputs from train_on_batch : ', len(outs), outs)
+                        # for idx, i in  enumerate(outs):
+                            # print(idx, 'type: ', type(i), 'shape: ', i.shape)
                         
-                    if not isinstance(outs, list):
-                        outs = [outs]
+                        if not isinstance(outs, list):
+                            outs = [outs]
 
-                    for l, o in zip(out_labels, outs):
-                        # print(' out label: ', l, ' out value: ', o,' shape: ', o.shape)
-                        batch_logs[l] = o
+                        for l, o in zip(out_labels, outs):
+                            # print(' out label: ', l, ' out value: ', o,' shape: ', o.shape)
+                            batch_logs[l] = o
     
-                    callbacks.on_batch_end(steps_index, batch_logs)
-
-                ##------------------------------------------------------------------------
-                ## VALIDATION Phase - emulating evaluate_generator()
-                ##------------------------------------------------------------------------
-                # print(' Start validation ')
-                # print(' ---------------- ')
-                # print(' Stateful metric indices:' )
-                # pp.pprint(stateful_metric_indices)
+                        callbacks.on_batch_end(steps_index, batch_logs)
+
+                    ##------------------------------------------------------------------------
+                    ## VALIDATION Phase - emulating evaluate_generator()
+                    ##------------------------------------------------------------------------
+                    # print(' Start validation ')
+                    # print(' ---------------- ')
+                    # print(' Stateful metric indices:' )
+                    # pp.pprint(stateful_metric_indices)
                 
                 
-                val_steps_done      = 0
-                val_outs_per_batch  = []
-                val_batch_sizes     = []
+                    val_steps_done      = 0
+                    val_outs_per_batch  = []
+                    val_batch_sizes     = []
                 
-                # setup validation progress bar if we wish
-                # progbar = Progbar(target=val_steps)
+                    # setup validation progress bar if we wish
+                    # progbar = Progbar(target=val_steps)
 
-                while val_steps_done < val_steps:
+                    ## Started here rather than with the training producer, so that its MRCNN predict
+                    ## calls don't compete with the first epoch's training steps for the GPU. In later
+                    ## epochs it prefetches up to FCN_INPUT_QUEUE_SIZE batches during training, then waits
+                    val_producer.start()
+
+                    while val_steps_done < val_steps:
                         
-                    ## Run prediction on MRCNN validation sample
-                    good_sample = False
-                    while not good_sample:
+                        ## Get FCN inputs (MRCNN predictions on the next good validation sample)
+                        fcn_val_x, val_batch_y, val_batch_x = val_producer.get()
+                                       
+                        ## Train on FCN validation sample
                         try:
-                            val_batch_x, val_batch_y = next(val_generator)
-                            val_results = mrcnn_model.keras_model.predict(val_batch_x)
-                            # for i in val_results:
-                                # print(i.shape, type(i), np.any(np.isnan(i)))    
-                            if np.any(np.isnan(val_results[1])):
-                                print('\n Bad val_batch_x encountered (validation phase) - epoch {} , image ids: {} -- Retry with next sample'.
-                                        format(epoch_idx, val_batch_x[1][:,0]))
-                            else :
-                                good_sample = True
+                            with stage_timer.stage('fcn_test_on_batch'):
+                                outs2 = self.keras_model.test_on_batch( fcn_val_x , val_batch_y)
+                            val_outs_per_batch.append(outs2)
                         except Exception as e :
-                            img_id =  val_batch_x[1][0,0]
-                            print('\n failure on mrcnn predict (validation stage) - epoch {} , image ids: {} {}'.format(epoch_idx, img_id, img_id.shape))
-                            print('\n dataset image info: ' , val_dataset.image_info[img_id])
-                            print('\n Exception information:')
-                            print(str(e))
-                    else:        
-                        fcn_val_x = [val_batch_x[1]]
-                        fcn_val_x.extend(val_results[:4])
-                        
-                        
-                    # ## Run prediction on MRCNN  
-                    # try:
-                        # mrcnn_val_x, mrcnn_val_y = next(val_generator)
-                        # # print('len of train batch x' ,len(val_x))
-                        # # for idx, i in  enumerate(val_x):
-                        # # print(idx, 'type: ', type(i), 'shape: ', i.shape)
-                        # val_results = mrcnn_model.keras_model.predict(mrcnn_val_x)
-                        # fcn_val_x = [mrcnn_val_x[1]]
-                        # fcn_val_x.extend(val_results[:4])   ## image_meta, pr_hm, pr_hm_scores, gt_hm, gt_hm_scores
-                    # except Exception as e :
-                        # img_id = mrcnn_val_x[1][0,0]
-                        # print('\n failure on mrcnn predict (validation stage)- epoch {} , image ids: {} {}'.format(epoch_idx, img_id, img_id.shape))
-                        # print()
-                        # print('dataset image info: ' , val_dataset.image_info[img_id])
-                        # print()
-                        # print(str(e))                
-
-                    # print('    mrcnn_model.predict() size of results : ', len(val_results))
-                    # for idx, i in  enumerate(xval_results):
-                        # print('    ',idx, 'type: ', type(i), 'shape: ', i.shape)
-                                       
-                    ## Train on FCN validation sample
-                    try:
-                        outs2 = self.keras_model.test_on_batch( fcn_val_x , val_batch_y)
-                        val_outs_per_batch.append(outs2)
-                    except Exception as e :
-                        img_id = val_batch_x[1][0,0]
-                        print('\n failure on fcn test (validation stage)- epoch {} , image ids: {} {}'.format(epoch_idx, img_id, img_id.shape))                    
-                        print('\n dataset image info: ' , val_dataset.image_info[img_id])
-                        print('\n Exception information:')
-                        print(str(e))                
-
-                    # print('fcn_model.test_on_batch() size of results : ', len(outs2))
-                    # for idx, i in  enumerate(outs2):
-                        # print(idx, 'type: ', type(i), 'shape: ', i.shape)
+                            img_id = val_batch_x[1][0,0]
+                            logger.error('\n failure on fcn test (validation stage)- epoch %s , image ids: %s %s', epoch_idx, img_id, img_id.shape)
+                            logger.error('\n dataset image info: %s', val_dataset.image_info[img_id])
+                            logger.error('\n Exception information:\n%s', e)
+
+                        # print('fcn_model.test_on_batch() size of results : ', len(outs2))
+                        # for idx, i in  enumerate(outs2):
+                            # print(idx, 'type: ', type(i), 'shape: ', i.shape)
                     
-                    if isinstance(fcn_val_x, list):
-                        batch_size = fcn_val_x[0].shape[0]
-                    elif isinstance(fcn_val_x, dict):
-                        batch_size = list(fcn_val_x.values())[0].shape[0]
-                    else:
-                        batch_size = fcn_val_x.shape[0]
+                        if isinstance(fcn_val_x, list):
+                            batch_size = fcn_val_x[0].shape[0]
+                        elif isinstance(fcn_val_x, dict):
+                            batch_size = list(fcn_val_x.values())[0].shape[0]
+                        else:
+                            batch_size = fcn_val_x.shape[0]
                         
-                    if batch_size == 0:
-                        raise ValueError('Received an empty batch. '
-                                         'Batches should at least contain one item.')
+                        if batch_size == 0:
+                            raise ValueError('Received an empty batch. '
+                                             'Batches should at least contain one item.')
                         
-                    val_steps_done += 1
-                    val_batch_sizes.append(batch_size)
-                    # print validation progress bar if we wish
-                    # progbar.update(val_steps_done)
-
-                ##------------------------------------------------------------------------
-                ## POST VALIDATION Phase - calculate val_averages after all validations  
-                ## steps complete, which is passed back to fit_generator() as val_outs 
-                ##------------------------------------------------------------------------
-                # print('    val_batch_sizes            :', type(val_batch_sizes),' len :', len(val_batch_sizes), val_batch_sizes)
-                # print('    val_batch_sizes-shape      :', np.asarray(val_batch_sizes).shape)                
-                # print('    val_outs_per_batch:        :', type(val_batch_sizes),' len :', len(val_outs_per_batch))
-                # print('    val_outs_per_batch - shape :', np.asarray(val_outs_per_batch).shape)
-                # for i,j in enumerate(val_outs_per_batch):
-                    # print('        batch: ', i, '  ', j)
+                        val_steps_done += 1
+                        val_batch_sizes.append(batch_size)
+                        # print validation progress bar if we wish
+                        # progbar.update(val_steps_done)
+
+                    ##------------------------------------------------------------------------
+                    ## POST VALIDATION Phase - calculate val_averages after all validations  
+                    ## steps complete, which is passed back to fit_generator() as val_outs 
+                    ##------------------------------------------------------------------------
+                    # print('    val_batch_sizes            :', type(val_batch_sizes),' len :', len(val_batch_sizes), val_batch_sizes)
+                    # print('    val_batch_sizes-shape      :', np.asarray(val_batch_sizes).shape)                
+                    # print('    val_outs_per_batch:        :', type(val_batch_sizes),' len :', len(val_outs_per_batch))
+                    # print('    val_outs_per_batch - shape :', np.asarray(val_outs_per_batch).shape)
+                    # for i,j in enumerate(val_outs_per_batch):
+                        # print('        batch: ', i, '  ', j)
                 
-                val_averages = []
-                for i in range(len(outs2)):
-                    if i not in stateful_metric_indices:
-                        tt = [out[i] for out in val_outs_per_batch]
-                        # print(' tt type: ',type(tt), tt)
-                        # print('val_batch_sizes.shape' , type(val_batch_sizes), len(val_batch_sizes))
-                        val_averages.append(
-                                np.average([out[i] for out in val_outs_per_batch], axis = 0, weights=val_batch_sizes)
-                                           )
-                    else:
-                        val_averages.append(float(val_outs_per_batch[-1][i]))
-                if len(val_averages) == 1:
-                    val_averages = val_averages[0]
+                    val_averages = []
+                    for i in range(len(outs2)):
+                        if i not in stateful_metric_indices:
+                            tt = [out[i] for out in val_outs_per_batch]
+                            # print(' tt type: ',type(tt), tt)
+                            # print('val_batch_sizes.shape' , type(val_batch_sizes), len(val_batch_sizes))
+                            val_averages.append(
+                                    np.average([out[i] for out in val_outs_per_batch], axis = 0, weights=val_batch_sizes)
+                                               )
+                        else:
+                            val_averages.append(float(val_outs_per_batch[-1][i]))
+                    if len(val_averages) == 1:
+                        val_averages = val_averages[0]
                     
-                # print()
-                # print('val_averages :', val_averages)
-                # print()
+                    # print()
+                    # print('val_averages :', val_averages)
+                    # print()
                 
-                #--------------------------------------------------------------------
-                #-- (unsuccessful) attempt to add histogram info to tensoflow summary 
-                #--------------------------------------------------------------------
-                # print(' Tensordlow histogram attempt')
-                # print('-----------------------------')
-                # fcn_val_y = self.keras_model.targets
-                # val_sample_weight = self.keras_model.sample_weights
-                # print(' len(fcn_val_x)  : ',len(fcn_val_x))
-                # print(' len(fcn_val_y)  : ',len(fcn_val_y))
-                # print(' len(mrcnn_val_y): ',len(mrcnn_val_y))
-
-                # fcn_val_x, fcn_val_y, fcn_val_sample_weights = self.keras_model._standardize_user_data(fcn_val_x, fcn_val_y, val_sample_weight)
-                # fcn_val_data = fcn_val_x + fcn_val_y  + fcn_val_sample_weights
-
-                # print(' len(fcn_val_x)             : ',len(fcn_val_x))
-                # print(' len(fcn_val_y)             : ',len(fcn_val_y))
-                # print(' len(fcn_val_sample_weights): ',len(fcn_val_sample_weights))
-                # print(' len(fcn_val_data)          : ',len(fcn_val_data))
-                # if self.keras_model.uses_learning_phase and not isinstance(KB.learning_phase(), int):
-                    # fcn_val_data += [0.]
-                # for cbk in callbacks:
-                    # cbk.validation_data = fcn_val_data
-                #-------------------------------------------------------------------------------
+                    #--------------------------------------------------------------------
+                    #-- (unsuccessful) attempt to add histogram info to tensoflow summary 
+                    #--------------------------------------------------------------------
+                    # print(' Tensordlow histogram attempt')
+                    # print('-----------------------------')
+                    # fcn_val_y = self.keras_model.targets
+                    # val_sample_weight = self.keras_model.sample_weights
+                    # print(' len(fcn_val_x)  : ',len(fcn_val_x))
+                    # print(' len(fcn_val_y)  : ',len(fcn_val_y))
+                    # print(' len(mrcnn_val_y): ',len(mrcnn_val_y))
+
+                    # fcn_val_x, fcn_val_y, fcn_val_sample_weights = self.keras_model._standardize_user_data(fcn_val_x, fcn_val_y, val_sample_weight)
+                    # fcn_val_data = fcn_val_x + fcn_val_y  + fcn_val_sample_weights
+
+                    # print(' len(fcn_val_x)             : ',len(fcn_val_x))
+                    # print(' len(fcn_val_y)             : ',len(fcn_val_y))
+                    # print(' len(fcn_val_sample_weights): ',len(fcn_val_sample_weights))
+                    # print(' len(fcn_val_data)          : ',len(fcn_val_data))
+                    # if self.keras_model.uses_learning_phase and not isinstance(KB.learning_phase(), int):
+                        # fcn_val_data += [0.]
+                    # for cbk in callbacks:
+                        # cbk.validation_data = fcn_val_data
+                    #-------------------------------------------------------------------------------
                 
-                ##------------------------------------------------------------------------
-                ## END OF EPOCH Phase 
-                ##------------------------------------------------------------------------
-                ## end of evaluate_generator() emulation
-                ## val_averages returned back to fit_generator() as val_outs
-                ## calculate val_outs after all validations steps complete
-                ##------------------------------------------------------------------------
-                if not isinstance(val_averages, list):
-                    val_averages = [val_averages]
-                # Same labels assumed.
-                for l, o in zip(out_labels, val_averages):
-                    epoch_logs['val_' + l] = o
+                    ##------------------------------------------------------------------------
+                    ## END OF EPOCH Phase 
+                    ##------------------------------------------------------------------------
+                    ## end of evaluate_generator() emulation
+                    ## val_averages returned back to fit_generator() as val_outs
+                    ## calculate val_outs after all validations steps complete
+                    ##------------------------------------------------------------------------
+                    if not isinstance(val_averages, list):
+                        val_averages = [val_averages]
+                    # Same labels assumed.
+                    for l, o in zip(out_labels, val_averages):
+                        epoch_logs['val_' + l] = o
                     
-                #----commented 31-10-18 replaced with above lines -------------------------------------------
-                # if not isinstance(outs2, list):
-                    # val_outs =  np.average(np.asarray(val_all_outs), weights=val_batch_sizes)
-                # else:
-                    # averages = []
-                    # for i in range(len(outs2)):
-                        # averages.append(np.average([out[i] for out in val_all_outs], axis = 0, weights=val_batch_sizes))
-                    # val_outs = averages
-                # if not isinstance(val_outs, list):
-                    # val_outs = [val_outs]
+                    #----commented 31-10-18 replaced with above lines -------------------------------------------
+                    # if not isinstance(outs2, list):
+                        # val_outs =  np.average(np.asarray(val_all_outs), weights=val_batch_sizes)
+                    # else:
+                        # averages = []
+                        # for i in range(len(outs2)):
+                            # averages.append(np.average([out[i] for out in val_all_outs], axis = 0, weights=val_batch_sizes))
+                        # val_outs = averages
+                    # if not isinstance(val_outs, list):
+                        # val_outs = [val_outs]
                 
-                # # Same labels assumed.
-                # for l, o in zip(out_labels, val_outs):
-                    # # print(' Validations : out label: val_', l, ' out value: ', o)
-                    # epoch_logs['val_' + l] = o
-                #-------------------------------------------------------------------------------------                
-                # write_log(callback, val_names, logs, batch_no//10)
-                # print('\n    validation logs output: ', val_outs)
+                    # # Same labels assumed.
+                    # for l, o in zip(out_labels, val_outs):
+                        # # print(' Validations : out label: val_', l, ' out value: ', o)
+                        # epoch_logs['val_' + l] = o
+                    #-------------------------------------------------------------------------------------                
+                    # write_log(callback, val_names, logs, batch_no//10)
+                    # print('\n    validation logs output: ', val_outs)
                 
                     
-                epoch_logs.update({'lr': KB.eval(self.keras_model.optimizer.lr)})    
-                callbacks.on_epoch_end(epoch_idx, epoch_logs)
-                epoch_idx += 1
+                    epoch_logs.update({'lr': KB.eval(self.keras_model.optimizer.lr)})    
+                    callbacks.on_epoch_end(epoch_idx, epoch_logs)
+
+                    train_stalls = train_producer.reset_stall_times()
+                    val_stalls   = val_producer.reset_stall_times()
+                    log("Epoch {} stall times - training producer: {:.2f}s  consumer: {:.2f}s   validation producer: {:.2f}s  consumer: {:.2f}s".format(
+                        epoch_idx, train_stalls['producer_stall'], train_stalls['consumer_stall'], 
+                        val_stalls['producer_stall'], val_stalls['consumer_stall']), logger = logger)
+                    log_timing('fcn_epoch', epoch = epoch_idx, 
+                               train_producer_stall = train_stalls['producer_stall'], train_consumer_stall = train_stalls['consumer_stall'],
+                               val_producer_stall   = val_stalls['producer_stall']  , val_consumer_stall   = val_stalls['consumer_stall'])
+                    epoch_idx += 1
                 
 
-                for callback in callbacks:
-                    # print(callback)
-                    # pp.pprint(dir(callback.model))
-                    if hasattr(callback.model, 'stop_training') and (callback.model.stop_training ==True):
-                        print(' +++++++++++ ON EPOCH END CALLBACKS TRIGGERED STOP_TRAINING +++++++++++++')
-                        print(callback.model, ' triggered stop_training +++++++++++++')
-                        early_stopping = True
+                    for callback in callbacks:
+                        # print(callback)
+                        # pp.pprint(dir(callback.model))
+                        if hasattr(callback.model, 'stop_training') and (callback.model.stop_training ==True):
+                            print(' +++++++++++ ON EPOCH END CALLBACKS TRIGGERED STOP_TRAINING +++++++++++++')
+                            print(callback.model, ' triggered stop_training +++++++++++++')
+                            early_stopping = True
                         
-                if early_stopping:
-                    print('{}  Early Stopping triggered on epoch {} of {} epoch'.format(callback, epoch_idx, final_epoch))
-                    break    
-                
+                    if early_stopping:
+                        print('{}  Early Stopping triggered on epoch {} of {} epoch'.format(callback, epoch_idx, final_epoch))
+                        break    
+            finally:
+                train_producer.stop()
+                val_producer.stop()
+
             ##-------------------------------
             ## end of training operations
             ##--------------------------------
@@ -1546,6 +1707,10 @@ class FCN(ModelBase):
             self.epoch = max(epoch_idx - 1, final_epoch)
             print('Final : self.epoch {}   epochs {}'.format(self.epoch, final_epoch))
             
+            if self.config.STAGE_TIMING:
+                stage_timer.display('FCN training stage timings')
+                stage_timer.save(os.path.join(self.log_dir, 'stage_timings.json'))
+            
         ##--------------------------------------------------------------------------------
         ## End main training loop
         ##--------------------------------------------------------------------------------
@@ -1703,13 +1868,13 @@ class FCN(ModelBase):
                                           embeddings_layer_names=None,
                                           embeddings_metadata=None)
 
-            , keras.callbacks.ModelCheckpoint(self.checkpoint_path, 
-                                              mode = 'auto', 
-                                              period = 1, 
-                                              monitor='val_loss', 
-                                              verbose=1, 
-                                              save_best_only = True, 
-                                              save_weights_only=True)
+            , IndexedModelCheckpoint(self.checkpoint_path, 
+                                     mode = 'auto', 
+                                     period = 1, 
+                                     monitor='val_loss', 
+                                     verbose=1, 
+                                     save_best_only = True, 
+                                     save_weights_only=True)
                                             
             , keras.callbacks.ReduceLROnPlateau(monitor='val_loss', 
                                                 mode     = 'auto', 
@@ -1783,6 +1948,7 @@ class FCN(ModelBase):
         metrics. Then calls the Keras compile() function.
         '''
         assert isinstance(loss_functions, list) , "A loss function must be defined as the objective"
+        self.clear_function_cache()
         
         # Optimizer object
         print('\n')
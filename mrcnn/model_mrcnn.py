@@ -20,9 +20,11 @@ import keras.models       as KM
 
 import mrcnn.utils                as utils
 import mrcnn.loss                 as loss
-from   mrcnn.datagen              import data_generator
+from   mrcnn.datagen              import data_generator, parallel_data_generator
 from   mrcnn.utils                import log, logt, parse_image_meta_graph, parse_image_meta, write_stdout
 from   mrcnn.model_base           import ModelBase
+from   mrcnn.checkpoint_index     import IndexedModelCheckpoint
+import mrcnn.stage_timer          as stage_timer
 from   mrcnn.RPN_model            import build_rpn_model
 from   mrcnn.resnet_model         import resnet_graph
 from   mrcnn.chm_layer            import CHMLayer
@@ -454,7 +456,30 @@ class MaskRCNN(ModelBase):
         '''
         Runs the detection pipeline.
 
-        images:         List of images, potentially of different sizes.
+        images:         List of images, potentially of different sizes. Any number of 
+                        images can be passed: they are run through the model in batches 
+                        of config.BATCH_SIZE, the last batch padded (see detect_batch()).
+
+        Returns a list of dicts, one dict per image (see detect_batch())
+        '''
+        assert self.mode   == "inference", "Create model in inference mode."
+        batch_size = self.config.BATCH_SIZE
+        
+        results = []
+        for start in range(0, len(images), batch_size):
+            results.extend(self.detect_batch(images[start : start + batch_size], verbose = verbose))
+        return results
+
+        
+    def detect_batch(self, images, verbose=0, molded_inputs = None):
+        '''
+        Runs the detection pipeline on one batch of images.
+
+        images:         List of at most config.BATCH_SIZE images, potentially of different sizes.
+                        A partial batch is padded to BATCH_SIZE by repeating the last molded
+                        image, the outputs for the padding are discarded.
+        molded_inputs:  Optional (molded_images, image_metas, windows) for images, as returned 
+                        by mold_inputs() - allows images to be molded ahead of time.
 
         Returns a list of dicts, one dict per image. The dict contains:
             N : number of detections 
@@ -469,13 +494,13 @@ class MaskRCNN(ModelBase):
             image_meta           (89,)
             molded_image         (1024, 1024, 3)
             molded_rois          (N, 4)
-            pr_hm                (1, 256, 256, 81)
+            pr_hm                (1, 256, 256, 81)   None with SPARSE_PR_HEATMAPS
             pr_scores            (N, 23)
             pr_scores_by_class   (81, 200, 23)
         '''
 
         assert self.mode   == "inference", "Create model in inference mode."
-        assert len(images) == self.config.BATCH_SIZE, "len(images): {:3d} must be equal to BATCH_SIZE: {:3d}".format(len(images),self.config.BATCH_SIZE)
+        assert 0 < len(images) <= self.config.BATCH_SIZE, "len(images): {:3d} must be between 1 and BATCH_SIZE: {:3d}".format(len(images),self.config.BATCH_SIZE)
         sequence_column = 7
         
         if verbose:
@@ -484,16 +509,27 @@ class MaskRCNN(ModelBase):
                 log("image", image)
                 
         # Mold inputs to format expected by the neural network
-        molded_images, image_metas, windows = self.mold_inputs(images)
+        if molded_inputs is None:
+            molded_inputs = self.mold_inputs(images)
+        molded_images, image_metas, windows = molded_inputs
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas"  , image_metas)
             print('===>  call mrcnn_model.keras_model.predict()')
+        
+        # Pad a partial batch to the batch size the graph was built with
+        pad = self.config.BATCH_SIZE - len(images)
+        if pad > 0:
+            batch_images = np.concatenate([molded_images, np.repeat(molded_images[-1:], pad, axis = 0)])
+            batch_metas  = np.concatenate([image_metas  , np.repeat(image_metas[-1:]  , pad, axis = 0)])
+        else:
+            batch_images, batch_metas = molded_images, image_metas
             
         ## Run object detection pipeline
-        detections, rpn_roi_proposals, mrcnn_class, mrcnn_bbox, pr_hm, pr_hm_scores =  \
-                  self.keras_model.predict([molded_images, image_metas], verbose=0)
+        with stage_timer.stage('mrcnn_predict'):
+            detections, rpn_roi_proposals, mrcnn_class, mrcnn_bbox, pr_hm, pr_hm_scores =  \
+                  self.keras_model.predict([batch_images, batch_metas], batch_size = self.config.BATCH_SIZE, verbose=0)
         if verbose:
             print('===> mrcnn.detect() : Return from  predict()')
             print('    Length of detections   : ', len(detections))
@@ -543,7 +579,7 @@ class MaskRCNN(ModelBase):
                 "scores"                : final_scores,
                 "detection_ind"         : final_det_ind,
 
-                "pr_hm"                 : pr_hm[i],
+                "pr_hm"                 : None if self.config.SPARSE_PR_HEATMAPS else pr_hm[i],
                 "pr_hm_scores"          : pr_mod_hm_scores  ,      # <-- bboxes in molded coordinates
                 "pr_scores"             : pr_scores_by_image,   # <-- bboxes in original image coordinates
                 "pr_scores_by_class"    : pr_scores_by_class,   # <-- bboxes in original image coordinates
@@ -581,7 +617,7 @@ class MaskRCNN(ModelBase):
             image_meta           (89,)
             molded_image         (1024, 1024, 3)
             molded_rois          (N, 4)
-            pr_hm                (1, 256, 256, 81)
+            pr_hm                (1, 256, 256, 81)   None with SPARSE_PR_HEATMAPS
             pr_scores            (N, 23)
             pr_scores_by_class   (81, 200, 23)
         '''
@@ -605,8 +641,8 @@ class MaskRCNN(ModelBase):
             print('===>  call mrcnn_model.keras_model.predict()')
             
         ## Run object detection pipeline
-        
-        detections, rpn_roi_proposals, mrcnn_class, mrcnn_bbox, pr_hm, pr_hm_scores =  \
+        with stage_timer.stage('mrcnn_predict'):
+            detections, rpn_roi_proposals, mrcnn_class, mrcnn_bbox, pr_hm, pr_hm_scores =  \
                   self.keras_model.predict(evaluate_batch[1:], verbose=verbose)
 
         # print('Return from  predict()')
@@ -651,7 +687,7 @@ class MaskRCNN(ModelBase):
                 "scores"                : final_scores,
                 "detection_ind"         : final_det_ind,
 
-                "pr_hm"                 : pr_hm[i],                
+                "pr_hm"                 : None if self.config.SPARSE_PR_HEATMAPS else pr_hm[i],                
                 "pr_hm_scores"          : pr_mod_hm_scores  ,  
                 "pr_scores"             : pr_scores_by_image,
                 "pr_scores_by_class"    : pr_scores_by_class,
@@ -664,6 +700,7 @@ class MaskRCNN(ModelBase):
     ##-------------------------------------------------------------------------------------
     ## Mold Inputs
     ##-------------------------------------------------------------------------------------        
+    @stage_timer.timed('mold_inputs')
     def mold_inputs(self, images):
         '''
         Takes a list of images and modifies them to the format expected as an 
@@ -721,6 +758,7 @@ class MaskRCNN(ModelBase):
     ##-------------------------------------------------------------------------------------
     ## Unmold Detections 
     ##-------------------------------------------------------------------------------------        
+    @stage_timer.timed('detect_unmold')
     def unmold_detections(self, detections, pr_hm_scores, image_shape, window, seq_col, verbose = 0):
         '''
         Reformats the detections of one image from the format of the neural
@@ -916,8 +954,15 @@ class MaskRCNN(ModelBase):
         print('type val_dataset:', type(val_dataset))
         
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         batch_size=batch_size)
+        if self.config.DATAGEN_WORKERS > 0:
+            train_generator = parallel_data_generator(train_dataset, self.config, shuffle=True,
+                                                      batch_size     = batch_size,
+                                                      workers        = self.config.DATAGEN_WORKERS,
+                                                      max_queue_size = self.config.DATAGEN_QUEUE_SIZE,
+                                                      seed           = self.config.DATAGEN_SEED)
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             batch_size=batch_size)
         val_generator = data_generator(val_dataset, self.config, shuffle=True,
                                         batch_size=batch_size,
                                         augment=False)
@@ -937,13 +982,13 @@ class MaskRCNN(ModelBase):
                                           embeddings_layer_names=None,
                                           embeddings_metadata=None)
 
-            , keras.callbacks.ModelCheckpoint(self.checkpoint_path, 
-                                              mode = 'auto', 
-                                              period = 1, 
-                                              monitor='val_loss', 
-                                              verbose=1, 
-                                              save_best_only = True, 
-                                              save_weights_only=True)
+            , IndexedModelCheckpoint(self.checkpoint_path, 
+                                     mode = 'auto', 
+                                     period = 1, 
+                                     monitor='val_loss', 
+                                     verbose=1, 
+                                     save_best_only = True, 
+                                     save_weights_only=True)
                                             
             , keras.callbacks.ReduceLROnPlateau(monitor='val_loss', 
                                                 mode     = 'auto', 
@@ -1026,6 +1071,7 @@ class MaskRCNN(ModelBase):
         metrics. Then calls the Keras compile() function.
         '''
         assert isinstance(losses, list) , "A loss function must be defined as the objective"
+        self.clear_function_cache()
 
         ##----------------------------------------------------------------------------------------------
         ## Setup optimizaion method 
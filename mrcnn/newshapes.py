@@ -11,6 +11,7 @@ from mrcnn.visualize import draw_boxes
 from mrcnn.config    import Config
 from mrcnn.dataset   import Dataset
 from mrcnn.utils     import non_max_suppression, mask_string
+from mrcnn.newshapes_store import NewShapesStore, image_seed
 # import mrcnn.utils as utils
 import pprint
 p4 = pprint.PrettyPrinter(indent=4, width=100)
@@ -20,11 +21,15 @@ p8 = pprint.PrettyPrinter(indent=8, width=100)
 ##------------------------------------------------------------------------------------
 ## Build  NewShapes Training and Validation datasets
 ##------------------------------------------------------------------------------------
-def prep_newshape_dataset(config, image_count, shuffle = True, augment = False, generator = False):
+def prep_newshape_dataset(config, image_count, shuffle = True, augment = False, generator = False, store_dir = None):
     '''
+    store_dir:  read the images of a pre-rendered NewShapes store (image_count is ignored)
     '''
     dataset = NewShapesDataset(config)
-    dataset.load_shapes(image_count) 
+    if store_dir is not None:
+        dataset.load_store(store_dir)
+    else:
+        dataset.load_shapes(image_count) 
     dataset.prepare()
 
     results = dataset
@@ -77,6 +82,9 @@ class NewShapesConfig(Config):
     # use small validation steps since the epoch is small
     VALIDATION_STEPS = 5
 
+    # Take GT boxes from the shape boxes cached in image_info instead of drawing the instance masks
+    USE_ANNOTATION_BBOXES = True
+
 
     
 class NewShapesDataset(Dataset):
@@ -93,11 +101,13 @@ class NewShapesDataset(Dataset):
         self.buffer = config.IMAGE_BUFFER
         super().__init__()
     
-    def load_shapes(self, count, buffer = 20):
+    def load_shapes(self, count, buffer = 20, seed = None):
         '''
         Generate the requested number of synthetic images.
         count: number of images to generate.
         height, width: the size of the generated images.
+        seed:  if not None, the specs of image i are generated after random.seed(image_seed(seed, i)),
+               giving the same images as a NewShapes store built with this seed
         '''
         
         # Add classes
@@ -162,10 +172,31 @@ class NewShapesDataset(Dataset):
         for i in range(count):
             # if i % 25 == 0:
                 # print(' Add image ---> ',i )
+            if seed is not None:
+                random.seed(image_seed(seed, i))
             bg_color, shapes = self.random_image(i, height, width)
+            bboxes, visible_area = self.shape_bboxes(shapes, height, width)
             self.add_image("shapes", image_id=i, path=None,
                            width=width, height=height,
-                           bg_color=bg_color, shapes=shapes)
+                           bg_color=bg_color, shapes=shapes,
+                           bboxes=bboxes, visible_area=visible_area)
+
+    def load_store(self, store_dir):
+        '''
+        Load the images of a NewShapes store built by newshapes_store.build_newshapes_store().
+        load_image() and load_mask() read the pre-rendered image and instance label map from
+        the memory mapped store instead of drawing them. Returned images are read-only views.
+        '''
+        self.load_shapes(0)
+        self.store = NewShapesStore(store_dir)
+        if (self.store.height, self.store.width) != (self.height, self.width):
+            raise ValueError('NewShapes store {} image shape {} does not match config IMAGE_SHAPE {}'.format(
+                              store_dir, (self.store.height, self.store.width), (self.height, self.width)))
+
+        for store_index, (image_id, bg_color, shapes) in enumerate(self.store.specs()):
+            self.add_image("shapes", image_id=image_id, path=store_dir,
+                           width=self.width, height=self.height,
+                           bg_color=bg_color, shapes=shapes, store_index=store_index)
 
     def load_image(self, image_id):
         '''
@@ -175,6 +206,9 @@ class NewShapesDataset(Dataset):
         '''
         # print(' ===> Loading image * image_id : ',image_id)
         info = self.image_info[image_id]
+        if 'store_index' in info:
+            return self.store.load_image(info['store_index'])
+
         bg_color = np.array(info['bg_color']).reshape([1, 1, 3])
         
         image = np.ones([info['height'], info['width'], 3], dtype=np.uint8)
@@ -202,6 +236,9 @@ class NewShapesDataset(Dataset):
         '''
         # print(' ===> Loading mask info for image_id : ',image_id)
         info   = self.image_info[image_id]
+        if 'store_index' in info:
+            return self.store.load_mask(info['store_index'])
+
         shapes = info['shapes']
         
         # print('\n Load Mask information (shape, (color rgb), (x_ctr, y_ctr, size) ): ')
@@ -232,7 +269,82 @@ class NewShapesDataset(Dataset):
         class_ids = np.array([self.class_names.index(s[0]) for s in shapes])
         return mask, class_ids.astype(np.int32)
     
+    def load_bboxes(self, image_id):
+        '''
+        GT boxes of the shapes of the given image ID, without drawing the instance masks.
+
+        Boxes are the occluded extents of the shapes (the boxes utils.extract_bboxes() returns
+        for load_mask()), computed once by shape_bboxes() when the image is generated and cached
+        in image_info. Images of datasets pickled before the boxes were cached get them on first use,
+        in a private dict of the dataset: image_info is left unchanged, so its digest (the
+        DetectionCache key) is the same before and after the boxes are computed.
+
+        Returns:
+        bboxes:     [instance count, (y1, x1, y2, x2)] int32 boxes. (y2, x2) lay outside the box.
+        class_ids:  [instance count] int32 class IDs
+        '''
+        info = self.image_info[image_id]
+        if 'store_index' in info:
+            return self.store.load_bboxes(info['store_index'])
+
+        if 'bboxes' in info:
+            bboxes = info['bboxes']
+        else:
+            # unpickled datasets bypass __init__, so the dict is created on first use
+            if not hasattr(self, '_lazy_bboxes'):
+                self._lazy_bboxes = {}
+            if image_id not in self._lazy_bboxes:
+                self._lazy_bboxes[image_id], _ = self.shape_bboxes(info['shapes'], info['height'], info['width'])
+            bboxes = self._lazy_bboxes[image_id]
+        class_ids = np.array([self.class_names.index(s[0]) for s in info['shapes']])
+        return bboxes.copy(), class_ids.astype(np.int32)
+
+    def render_labels(self, shapes, height, width):
+        '''
+        Draw the shapes, in order, into one instance label map [height, width] (uint8):
+        pixels of shape i that are not covered by a later shape are i+1, background is 0.
+        Holds the same occluded masks as load_mask(), in a single plane.
+        '''
+        labels = np.zeros([height, width, 1], dtype=np.uint8)
+        for i, (shape, _, dims) in enumerate(shapes):
+            labels = self.draw_shape(labels, shape, dims, i + 1)
+        return labels.reshape([height, width])
+
+    def shape_bboxes(self, shapes, height, width):
+        '''
+        Occluded extents and visible area of each shape, from one render_labels() pass
+
+        Returns:
+        bboxes:         [count, (y1, x1, y2, x2)] int32, as utils.extract_bboxes() on load_mask(),
+                        all zeros for a shape that is completely hidden
+        visible_area:   [count] int32 number of visible pixels of each shape
+        '''
+        count   = len(shapes)
+        labels  = self.render_labels(shapes, height, width)
+        visible = labels[:, :, np.newaxis] == np.arange(1, count + 1, dtype=np.uint8)
+        rows    = np.any(visible, axis=1)                           # [height, count]
+        cols    = np.any(visible, axis=0)                           # [width , count]
+        
+        bboxes  = np.stack([np.argmax(rows, axis=0), np.argmax(cols, axis=0),
+                            height - np.argmax(rows[::-1], axis=0), width - np.argmax(cols[::-1], axis=0)], axis=1)
+        bboxes[~np.any(rows, axis=0)] = 0
+        visible_area = np.bincount(labels.ravel(), minlength=count + 1)[1:count + 1]
+        return bboxes.astype(np.int32), visible_area.astype(np.int32)
+
     def find_hidden_shapes(self, shapes, height, width):
+        '''
+        Find objects that are completely hidden by other shapes, from one 
+        render_labels() pass instead of a [height, width, count] mask stack
+
+        As find_hidden_shapes_orig(), the last shape is never reported as hidden 
+        '''
+        count   = len(shapes)
+        labels  = self.render_labels(shapes, height, width)
+        visible = np.zeros(count + 1, dtype=bool)
+        visible[np.unique(labels)] = True
+        return [i for i in range(count - 2, -1, -1) if not visible[i + 1]]
+
+    def find_hidden_shapes_orig(self, shapes, height, width):
         '''
         A variation of load_masks customized to find objects that 
         are completely hidden by other shapes 
@@ -0,0 +1,275 @@
+"""
+Mask R-CNN
+Pre-rendered, memory-mappable store of NewShapes images
+
+NewShapesDataset draws every image (load_image) and every instance mask (load_mask, plus
+the occlusion loop) with OpenCV on each access. The store renders a dataset once and keeps
+the results in uncompressed .npy arrays opened with np.load(mmap_mode='r'):
+
+    store_dir/index.json            image count, image shape, seed, and the spec
+                                    (id, bg_color, shapes) of every image
+    store_dir/images.npy            [N, H, W, 3] uint8   rendered images
+    store_dir/labels.npy            [N, H, W]    uint8   instance label map: pixel value i+1
+                                                         is shape i after occlusion, 0 background
+    store_dir/offsets.npy           [N+1]        int64   start of each image's instance rows
+    store_dir/bboxes.npy            [M, 4]       int32   instance boxes (y1, x1, y2, x2), as
+                                                         utils.extract_bboxes() on load_mask()
+    store_dir/class_ids.npy         [M]          int32   instance class ids
+
+Shapes are drawn in order, so the label map holds exactly the occluded masks of load_mask().
+
+Images are rendered by a pool of worker processes, each writing its images straight into
+the memory mapped arrays. When the store generates new images (rather than rendering an
+existing dataset) the specs of image i come from random.seed(image_seed(seed, i)), so the
+store content does not depend on the number of workers, and is the same as
+NewShapesDataset.load_shapes(count, seed = seed).
+
+Usage:
+    python -m mrcnn.newshapes_store  /path/to/store  --count 1000 --seed 1 --workers 4
+    python -m mrcnn.newshapes_store  /path/to/store  --dataset newshapes_test_dataset_1000_B.pkl
+"""
+import os, json, time, random, pickle, argparse, multiprocessing
+import numpy as np
+
+INDEX_FILE    = 'index.json'
+STORE_VERSION = 1
+
+
+def is_newshapes_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, INDEX_FILE))
+
+
+def image_seed(seed, image_id):
+    '''
+    Seed of the random specs of one image
+    '''
+    return 'newshapes:{}:{}'.format(seed, image_id)
+
+
+def spec_to_json(bg_color, shapes):
+    return [int(c) for c in bg_color], [[shape, [int(c) for c in color], [int(d) for d in dims]] for shape, color, dims in shapes]
+
+
+def spec_from_json(bg_color, shapes):
+    return np.array(bg_color), [(shape, tuple(color), tuple(dims)) for shape, color, dims in shapes]
+
+
+##------------------------------------------------------------------------------------
+## Reader
+##------------------------------------------------------------------------------------
+class NewShapesStore(object):
+    '''
+    Read access to a NewShapes store. Arrays are memory mapped on first use, and returned
+    images / label maps are read-only views into the store. The store object only holds
+    the index when pickled, so it can be passed to worker processes.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE), 'r') as infile:
+            self.index = json.load(infile)
+        if self.index['version'] != STORE_VERSION:
+            raise ValueError('NewShapesStore: unsupported store version {} in {}'.format(self.index['version'], store_dir))
+        self.height, self.width = self.index['image_shape'][:2]
+        self.arrays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def __len__(self):
+        return self.index['image_count']
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.store_dir, name + '.npy'), mmap_mode = 'r')
+        return self.arrays[name]
+
+    def specs(self):
+        '''
+        Yields (image id, bg_color, shapes) of the stored images, in store order
+        '''
+        for image_id, bg_color, shapes in self.index['images']:
+            yield (image_id,) + spec_from_json(bg_color, shapes)
+
+    def load_image(self, idx):
+        return self.array('images')[idx]
+
+    def load_bboxes(self, idx):
+        start, end = self.array('offsets')[idx:idx+2]
+        return np.array(self.array('bboxes')[start:end]), np.array(self.array('class_ids')[start:end])
+
+    def load_mask(self, idx):
+        '''
+        Returns the occluded instance masks [H, W, count] and class ids [count], as NewShapesDataset.load_mask()
+        '''
+        start, end = self.array('offsets')[idx:idx+2]
+        labels = self.array('labels')[idx]
+        mask   = (labels[:, :, np.newaxis] == np.arange(1, end - start + 1, dtype = np.uint8)).astype(np.uint8)
+        return mask, np.array(self.array('class_ids')[start:end])
+
+    def display(self):
+        print(' NewShapes store: {}  images: {}  image shape: {}  seed: {}'.format(
+               self.store_dir, len(self), self.index['image_shape'], self.index['seed']))
+
+
+##------------------------------------------------------------------------------------
+## Renderer
+##------------------------------------------------------------------------------------
+_worker = {}
+
+def _render_worker_init(config, store_dir, seed):
+    '''
+    Pool initializer: a NewShapesDataset used to generate and draw shapes, the seed of
+    generated specs and the memory mapped output arrays
+    '''
+    from mrcnn.newshapes import NewShapesDataset
+    dataset = NewShapesDataset(config)
+    dataset.load_shapes(0)
+    dataset.prepare()
+    _worker['dataset'] = dataset
+    _worker['images']  = np.load(os.path.join(store_dir, 'images.npy'), mmap_mode = 'r+')
+    _worker['labels']  = np.load(os.path.join(store_dir, 'labels.npy'), mmap_mode = 'r+')
+    _worker['seed']    = seed
+
+
+def _render_worker_run(task):
+    '''
+    task:       list of (store index, image id, bg_color, shapes); bg_color and shapes are
+                None for images whose specs are generated here
+    Returns:    list of (store index, image id, bg_color, shapes, bboxes, class_ids)
+    '''
+    from mrcnn.utils import extract_bboxes
+    dataset = _worker['dataset']
+    height, width = dataset.height, dataset.width
+    results = []
+    for idx, image_id, bg_color, shapes in task:
+        if shapes is None:
+            random.seed(image_seed(_worker['seed'], image_id))
+            bg_color, shapes = dataset.random_image(image_id, height, width)
+
+        image  = np.ones([height, width, 3], dtype = np.uint8) * np.array(bg_color).reshape([1, 1, 3]).astype(np.uint8)
+        for shape, color, dims in shapes:
+            image  = dataset.draw_shape(image, shape, dims, color)
+        labels = dataset.render_labels(shapes, height, width)
+
+        _worker['images'][idx] = image
+        _worker['labels'][idx] = labels
+
+        mask      = (labels[:, :, np.newaxis] == np.arange(1, len(shapes) + 1, dtype = np.uint8))
+        class_ids = np.array([dataset.class_names.index(s[0]) for s in shapes], dtype = np.int32)
+        results.append((idx, image_id) + spec_to_json(bg_color, shapes) + (extract_bboxes(mask), class_ids))
+
+    _worker['images'].flush()
+    _worker['labels'].flush()
+    return results
+
+
+def build_newshapes_store(config, store_dir, image_count = None, dataset = None, seed = 0,
+                          workers = 0, chunk_size = 100, verbose = 1):
+    '''
+    Render NewShapes images into a new store in store_dir.
+
+    Either renders the images of an existing NewShapesDataset (e.g. one of the pickled
+    test datasets), or generates image_count new images with image ids 0..image_count-1,
+    the specs of each image seeded by image_seed(seed, image_id).
+
+    workers:        number of render processes (0: render in this process)
+    chunk_size:     images per worker task
+
+    Returns a NewShapesStore on the new store
+    '''
+    if dataset is not None:
+        image_count = len(dataset.image_info)
+        tasks = [(i, info['id'], info['bg_color'], info['shapes']) for i, info in enumerate(dataset.image_info)]
+        seed  = None
+    elif image_count is not None:
+        tasks = [(i, i, None, None) for i in range(image_count)]
+    else:
+        raise ValueError('build_newshapes_store: one of image_count or dataset is required')
+
+    height, width = [int(d) for d in config.IMAGE_SHAPE[:2]]
+    if dataset is not None and (dataset.height, dataset.width) != (height, width):
+        raise ValueError('build_newshapes_store: dataset image shape {} does not match config IMAGE_SHAPE {}'.format(
+                          (dataset.height, dataset.width), (height, width)))
+    os.makedirs(store_dir, exist_ok = True)
+    if verbose:
+        print(' build_newshapes_store(): {} images [{}, {}] --> {}  workers: {}'.format(image_count, height, width, store_dir, workers))
+
+    tm_start = time.time()
+    np.lib.format.open_memmap(os.path.join(store_dir, 'images.npy'), mode = 'w+', dtype = np.uint8,
+                              shape = (image_count, height, width, 3)).flush()
+    np.lib.format.open_memmap(os.path.join(store_dir, 'labels.npy'), mode = 'w+', dtype = np.uint8,
+                              shape = (image_count, height, width)).flush()
+
+    chunks  = [tasks[i : i + chunk_size] for i in range(0, image_count, chunk_size)]
+    results = [None] * image_count
+
+    def collect(chunk_results):
+        for result in chunk_results:
+            results[result[0]] = result[1:]
+        if verbose:
+            done = sum(r is not None for r in results)
+            print('   {:7d} of {:7d} images rendered  {:.1f}s'.format(done, image_count, time.time() - tm_start))
+
+    if workers <= 0:
+        _render_worker_init(config, store_dir, seed)
+        for chunk in chunks:
+            collect(_render_worker_run(chunk))
+        _worker.clear()
+    else:
+        pool = multiprocessing.Pool(processes = workers,
+                                    initializer = _render_worker_init,
+                                    initargs = (config, store_dir, seed))
+        try:
+            for chunk_results in pool.imap_unordered(_render_worker_run, chunks):
+                collect(chunk_results)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    ##  instance boxes and class ids, and the index
+    counts  = [len(r[4]) for r in results]
+    offsets = np.zeros(image_count + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(counts)
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(store_dir, 'bboxes.npy') , np.concatenate([r[3] for r in results] + [np.zeros((0, 4), np.int32)]).astype(np.int32))
+    np.save(os.path.join(store_dir, 'class_ids.npy'), np.concatenate([r[4] for r in results] + [np.zeros((0,), np.int32)]).astype(np.int32))
+
+    index = {'version'    : STORE_VERSION,
+             'image_count': image_count,
+             'image_shape': [height, width, 3],
+             'seed'       : seed,
+             'images'     : [[image_id, bg_color, shapes] for image_id, bg_color, shapes, _, _ in results]}
+    tmp_filename = os.path.join(store_dir, INDEX_FILE + '.tmp')
+    with open(tmp_filename, 'w') as outfile:
+        json.dump(index, outfile)
+    os.replace(tmp_filename, os.path.join(store_dir, INDEX_FILE))
+
+    if verbose:
+        print(' build_newshapes_store(): {} images, {} instances rendered in {:.1f}s'.format(
+               image_count, offsets[-1], time.time() - tm_start))
+    return NewShapesStore(store_dir)
+
+
+if __name__ == '__main__':
+    from mrcnn.newshapes import NewShapesConfig
+
+    parser = argparse.ArgumentParser(description='Render NewShapes images into a memory mapped store')
+    parser.add_argument('store_dir', help='output store directory')
+    parser.add_argument('--count', type=int, default=1000, help='number of images to generate (default=1000)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated image specs (default=0)')
+    parser.add_argument('--dataset', default=None, help='render the images of a pickled NewShapesDataset instead')
+    parser.add_argument('--workers', type=int, default=0, help='number of render processes (default=0)')
+    args = parser.parse_args()
+
+    config = NewShapesConfig()
+    if args.dataset is not None:
+        with open(args.dataset, 'rb') as infile:
+            dataset = pickle.load(infile)
+        store = build_newshapes_store(config, args.store_dir, dataset = dataset, workers = args.workers)
+    else:
+        store = build_newshapes_store(config, args.store_dir, image_count = args.count, seed = args.seed, workers = args.workers)
+    store.display()
@@ -35,6 +35,19 @@ import mrcnn.newshapes    as newshapes
 pp = pprint.PrettyPrinter(indent=2, width=100)
 np.set_printoptions(linewidth=100,precision=4,threshold=1000, suppress = True)
 
+
+def clear_session(allow_growth = False):
+    '''
+    KB.clear_session(). With allow_growth the new Keras session allocates GPU memory as
+    needed instead of reserving the whole GPU, so other processes (e.g. the checkpoint
+    sweep workers) can share it.
+    '''
+    KB.clear_session()
+    if allow_growth:
+        session_config = tf.ConfigProto()
+        session_config.gpu_options.allow_growth = True
+        KB.set_session(tf.Session(config = session_config))
+
     
 #######################################################################################    
 ## Build COCO configuration object
@@ -297,7 +310,7 @@ def  build_mrcnn_training_pipeline_newshapes( args = None, mrcnn_config = None,
 ## NEWSHAPES - MRCNN Inference
 ##------------------------------------------------------------------------------------    
 def build_mrcnn_inference_pipeline_newshapes(args = None, mrcnn_config = None,  mode = 'inference', 
-                                             verbose = 0):
+                                             verbose = 0, allow_growth = False):
     start_time = datetime.now().strftime("%m-%d-%Y @ %H:%M:%S")
     print()
     print('--> Execution started at:', start_time)
@@ -315,7 +328,7 @@ def build_mrcnn_inference_pipeline_newshapes(args = None, mrcnn_config = None,
         gc.collect()
     except: 
         pass
-    KB.clear_session()
+    clear_session(allow_growth)
     mrcnn_model = mrcnn_modellib.MaskRCNN(mode= mode, config=mrcnn_config)
         
     # display model layer info
@@ -396,11 +409,12 @@ def build_fcn_training_pipeline_newshapes( args = None, mrcnn_config = None,  mo
 ## NEWSHAPES - FCN Inference
 ##------------------------------------------------------------------------------------    
 def build_fcn_inference_pipeline_newshapes( args = None, mrcnn_config = None,  mode = 'inference', 
-                                           verbose = 0):
+                                           verbose = 0, allow_growth = False):
     print('MODE IS:' , mode)    
     
     ## Build MRCNN Model in Inference mode
-    mrcnn_model  = build_mrcnn_inference_pipeline_newshapes( mode = mode, args = args, verbose = 0)
+    mrcnn_model  = build_mrcnn_inference_pipeline_newshapes( mode = mode, args = args, verbose = 0, 
+                                                             allow_growth = allow_growth)
     
     fcn_config = build_newshapes_config("fcn","inference", args, verbose = verbose)
 
@@ -437,11 +451,11 @@ def build_fcn_inference_pipeline_newshapes( args = None, mrcnn_config = None,  m
 ## NEWSHAPES - FCN Evaluate
 ##------------------------------------------------------------------------------------    
 def build_fcn_evaluate_pipeline_newshapes( args = None, mrcnn_config = None,  mode = 'evaluate', 
-                                           verbose = 0):
+                                           verbose = 0, allow_growth = False):
         
     return build_fcn_inference_pipeline_newshapes( args = args, 
                                          mrcnn_config = mrcnn_config, 
-                                         mode = mode, verbose = verbose)
+                                         mode = mode, verbose = verbose, allow_growth = allow_growth)
 
     
 #######################################################################################    
@@ -726,7 +740,7 @@ def build_fcn_training_pipeline( args = None, batch_size = 2,
 ## FCN inference pipeline
 #######################################################################################
 def build_fcn_inference_pipeline( args = None, mrcnn_config = None, fcn_config = None, 
-                                   mode = 'inference', verbose = 0):
+                                   mode = 'inference', verbose = 0, allow_growth = False):
     
     start_time = datetime.now().strftime("%m-%d-%Y @ %H:%M:%S")
     print()
@@ -754,7 +768,7 @@ def build_fcn_inference_pipeline( args = None, mrcnn_config = None, fcn_config =
         gc.collect()
     except: 
         pass
-    KB.clear_session()
+    clear_session(allow_growth)
     mrcnn_model = mrcnn_modellib.MaskRCNN(mode= mode, config=mrcnn_config)
 
 
@@ -796,12 +810,12 @@ def build_fcn_inference_pipeline( args = None, mrcnn_config = None, fcn_config =
 ## FCN evaluate pipeline
 #######################################################################################
 def build_fcn_evaluate_pipeline( args = None, mrcnn_config = None, fcn_config = None, 
-                                 mode = 'evaluate',  verbose = 0):
+                                 mode = 'evaluate',  verbose = 0, allow_growth = False):
                                  
     return build_fcn_inference_pipeline( args = args, 
                                          mrcnn_config = mrcnn_config, 
                                          fcn_config = fcn_config, 
-                                         mode = mode, verbose = verbose)
+                                         mode = mode, verbose = verbose, allow_growth = allow_growth)
 
 #######################################################################################    
 ## GET BATCH routines
@@ -1349,10 +1363,18 @@ def run_mrcnn_evaluation(mrcnn_model, dataset, image_ids = None, verbose = 0):
 ##------------------------------------------------------------------------------------    
 ## Run FCN evaluation on an image ids
 ##------------------------------------------------------------------------------------            
-def run_fcn_evaluation(fcn_model, mrcnn_model, dataset, image_ids = None, verbose = 0):
+def run_fcn_evaluation(fcn_model, mrcnn_model, dataset, image_ids = None, verbose = 0, detection_cache = None):
+    '''
+    detection_cache:    Optional DetectionCache. MRCNN results for image_ids are read from 
+                        the cache (the MRCNN model only runs on a miss). Results read from
+                        the cache do not include 'image' and 'molded_image'.
+    '''
+    if detection_cache is not None and image_ids is not None:
+        mrcnn_results = detection_cache.evaluate(mrcnn_model, dataset, image_ids, verbose = verbose)
+        return fcn_model.detect_from_mrcnn_results(mrcnn_results, verbose = verbose)
     
     eval_batch = get_evaluate_batch(dataset, mrcnn_model.config, image_ids, display = False)    
-    fcn_results = fcn_model.evaluate(mrcnn_model, eval_batch, verbose = verbose)    
+    fcn_results = fcn_model.evaluate(mrcnn_model, eval_batch, verbose = verbose, detection_cache = detection_cache)    
 
     return fcn_results
     
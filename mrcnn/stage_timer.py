@@ -0,0 +1,224 @@
+"""
+Mask R-CNN
+Per stage wall time of the training and inference pipelines
+
+The data generators, the model entry points and the custom layers record the wall time
+of their stages in one process-wide StageTimer, when it is enabled (config.STAGE_TIMING,
+or enable()). A disabled timer costs an attribute check per stage. Timed stages:
+
+    load_image_gt           datagen.load_image_gt()
+    load_heatmap_npz        datagen_fcn.load_heatmap_npz()
+    mold_image              utils.mold_image()
+    mold_inputs             MaskRCNN.mold_inputs() (resize, mold, image meta)
+    mrcnn_predict           MRCNN keras_model.predict() in detect_batch(), evaluate() and
+                            FCNInputProducer
+    detect_unmold           MaskRCNN.unmold_detections()
+    detection_refine        host side py_func of the detection layers
+    chm_layer               CHM heatmap layers, timed inside the TF graph (see timed_graph())
+    fcn_input_wait          FCN.train_in_batches() waiting for the next FCN input batch
+    fcn_train_on_batch      FCN keras_model.train_on_batch()
+    fcn_test_on_batch       FCN keras_model.test_on_batch() (validation)
+
+Graph stages are timed by py_func markers added around the layer's ops when the graph is
+built, so the timer must be enabled before the model is built; they time the stage as
+scheduled by TF (including waits on other branches), and force a host sync. With
+DATAGEN_WORKERS > 0 the data generator stages run, and are recorded, in the workers.
+
+summary() aggregates the recorded times per stage (count, total, mean and percentiles),
+display() prints them as a table and save() writes them to a JSON file:
+
+    {'stages': {'mrcnn_predict': {'count': 120, 'total': 41.2, 'mean': 0.343, 'p50': 0.338,
+                                  'p90': 0.361, 'p99': 0.402, 'max': 0.455}, ...},
+     'time': 1541001234.5}
+
+Usage:
+    stage_timer.enable()
+    results = model.detect(images)
+    stage_timer.display()
+    stage_timer.save('stage_timings.json')
+"""
+import json, time, array, functools, threading
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+class _NullStage(object):
+    '''
+    Context manager of a disabled timer
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name  = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer(object):
+    '''
+    Wall times (seconds) of named stages, kept per stage in a compact array of doubles
+    '''
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.times   = {}
+        self.lock    = threading.Lock()
+
+    def stage(self, name):
+        '''
+        with timer.stage('mrcnn_predict'): ...
+        '''
+        return _Stage(self, name) if self.enabled else _NULL_STAGE
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        times = self.times.get(name)
+        if times is None:
+            with self.lock:
+                times = self.times.setdefault(name, array.array('d'))
+        times.append(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.times = {}
+
+    def summary(self):
+        '''
+        Returns {stage: {'count', 'total', 'mean', 'p50', 'p90', 'p99', 'max'}}, stages
+        in decreasing total time
+        '''
+        result = {}
+        for name, times in list(self.times.items()):
+            ## a copy: the array may be appended to by another thread
+            times = np.frombuffer(times.tobytes(), dtype = np.float64)
+            if not len(times):
+                continue
+            stats = {'count': len(times),
+                     'total': float(np.sum(times)),
+                     'mean' : float(np.mean(times))}
+            for p, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+                stats['p{}'.format(p)] = float(value)
+            stats['max'] = float(np.max(times))
+            result[name] = stats
+        return dict(sorted(result.items(), key = lambda kv: -kv[1]['total']))
+
+    def display(self, title = 'Stage timings'):
+        summary = self.summary()
+        columns = ['count', 'total', 'mean'] + ['p{}'.format(p) for p in PERCENTILES] + ['max']
+        print()
+        print(' {}  (seconds)'.format(title))
+        print(' {:22s}'.format('stage') + ''.join(['{:>11s}'.format(c) for c in columns]))
+        print(' ' + '-' * (22 + 11 * len(columns)))
+        for name, stats in summary.items():
+            print(' {:22s}{:11d}'.format(name, stats['count']) +
+                  ''.join(['{:11.4f}'.format(stats[c]) for c in columns[1:]]))
+        print()
+        return summary
+
+    def save(self, filename):
+        '''
+        Write the summary to filename (JSON)
+        '''
+        with open(filename, 'w') as outfile:
+            json.dump({'stages': self.summary(), 'time': time.time()}, outfile, indent = 1)
+
+
+## the process-wide timer used by the pipeline
+TIMER = StageTimer()
+
+def enable():
+    TIMER.enabled = True
+
+def disable():
+    TIMER.enabled = False
+
+def enabled():
+    return TIMER.enabled
+
+def stage(name):
+    return TIMER.stage(name)
+
+def record(name, seconds):
+    TIMER.record(name, seconds)
+
+def reset():
+    TIMER.reset()
+
+def summary():
+    return TIMER.summary()
+
+def display(title = 'Stage timings'):
+    return TIMER.display(title)
+
+def save(filename):
+    TIMER.save(filename)
+
+
+def timed(name):
+    '''
+    Decorator recording each call of the function as stage name
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TIMER.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                TIMER.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def timed_graph(name, fn, inputs):
+    '''
+    Build fn(inputs) - the ops of a graph stage - between two py_func time markers when
+    the timer is enabled: the start marker runs once the inputs are computed, the ops of
+    fn depend on it, and the returned outputs depend on the end marker, which records the
+    time since the start marker.
+
+    Returns fn(inputs) (a tensor or a list of tensors)
+    '''
+    if not TIMER.enabled:
+        return fn(inputs)
+    import tensorflow as tf
+
+    def start_marker():
+        return np.float64(time.perf_counter())
+
+    def end_marker(start):
+        TIMER.record(name, time.perf_counter() - start)
+        return np.float64(0)
+
+    flat_inputs = list(inputs) if isinstance(inputs, (list, tuple)) else [inputs]
+    with tf.control_dependencies(flat_inputs):
+        start = tf.py_func(start_marker, [], tf.float64, stateful = True, name = name + '_start')
+    with tf.control_dependencies([start]):
+        outputs = fn(inputs)
+    flat_outputs = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+    with tf.control_dependencies(flat_outputs):
+        end = tf.py_func(end_marker, [start], tf.float64, stateful = True, name = name + '_end')
+    with tf.control_dependencies([end]):
+        flat_outputs = [tf.identity(o) for o in flat_outputs]
+    return flat_outputs if isinstance(outputs, (list, tuple)) else flat_outputs[0]
@@ -123,36 +123,35 @@ for a,b in zip(dataset_test.class_ids, dataset_test.class_names):
 ##----------------------------------------------------------------------------------------------
 num_images = min(len(dataset_test.image_ids), int(sys.argv[1]))
 
-print('Processing {:d} images ......'.format(num_images))
-
-for image_id in range(num_images):
-    keyname = 'newshapes_{:05d}'.format(image_id) 
-    if image_id % 25 == 0:
-        print('image id :', image_id, 'filename :', keyname)
+DETECT_CHUNK = 32     # images passed to each mrcnn_model.detect() call
 
-    image = dataset_test.load_image(image_id)
-    _, image_meta, gt_class_ids, gt_bboxes =\
-            load_image_gt(dataset_test, mrcnn_model.config, image_id, use_mini_mask=False)
+print('Processing {:d} images ......'.format(num_images))
 
-    results = mrcnn_model.detect([image], verbose= 0)
-    r = results[0]    
+for start in range(0, num_images, DETECT_CHUNK):
+    print('image id :', start, 'filename :', 'newshapes_{:05d}'.format(start))
+    chunk_ids = list(range(start, min(start + DETECT_CHUNK, num_images)))
+    images    = [dataset_test.load_image(image_id) for image_id in chunk_ids]
+    results   = mrcnn_model.detect(images, verbose= 0)
+    
+    for image_id, r in zip(chunk_ids, results):
+        keyname = 'newshapes_{:05d}'.format(image_id) 
     
-    # ground_truth_bboxes[keyname] = {'boxes'     : gt_bboxes.tolist(),
-                                    # 'class_ids' : gt_class_ids.tolist()}
+        # ground_truth_bboxes[keyname] = {'boxes'     : gt_bboxes.tolist(),
+                                        # 'class_ids' : gt_class_ids.tolist()}
                                     
-    # predicted_bboxes[keyname] =  {'scores'   : [], 
-                                  # 'boxes'    : [], 
-                                  # 'class_ids': []}    
+        # predicted_bboxes[keyname] =  {'scores'   : [], 
+                                      # 'boxes'    : [], 
+                                      # 'class_ids': []}    
                                   
 
-    for cls, score, bbox in zip(r['class_ids'].tolist(), r['scores'].tolist(), r['molded_rois'].tolist()):
+        for cls, score, bbox in zip(r['class_ids'].tolist(), r['scores'].tolist(), r['molded_rois'].tolist()):
         
-        # predicted_bboxes[keyname]['class_ids'].append(cls)
-        # predicted_bboxes[keyname]['scores'].append(np.round(score,4))
-        # predicted_bboxes[keyname]['boxes'].append(bbox)
+            # predicted_bboxes[keyname]['class_ids'].append(cls)
+            # predicted_bboxes[keyname]['scores'].append(np.round(score,4))
+            # predicted_bboxes[keyname]['boxes'].append(bbox)
         
-        predicted_classes[cls]['scores'].append(np.round(score,4))
-        predicted_classes[cls]['bboxes'].append(bbox)
+            predicted_classes[cls]['scores'].append(np.round(score,4))
+            predicted_classes[cls]['bboxes'].append(bbox)
         
 
 ##----------------------------------------------------------------------------------------------
@@ -22,6 +22,7 @@ import mrcnn.visualize    as visualize
 
 from datetime             import datetime   
 from mrcnn.utils          import command_line_parser, display_input_parms, Paths
+from mrcnn.logs           import configure_logging
 from mrcnn.coco           import prep_coco_dataset 
 from mrcnn.prep_notebook  import mrcnn_coco_train, build_coco_config
                                 
@@ -36,6 +37,7 @@ print("    Tensorflow Version: {}   Keras Version : {} ".format(tf.__version__,k
 ##------------------------------------------------------------------------------------
 parser = command_line_parser()
 args = parser.parse_args()
+configure_logging(levels = args.log_levels, timing_file = args.timing_file)
 display_input_parms(args)
 
 ##----------------------------------------------------------------------------------------------
@@ -7,29 +7,44 @@ Licensed under the MIT License (see LICENSE for details)
 Written by Waleed Abdulla
 """
 
-import os, sys, math, zlib, argparse, random, platform, pprint, datetime
+import os, sys, math, zlib, hashlib, argparse, random, platform, pprint, datetime, logging
 from   sys      import stdout    
 import numpy as np
-import tensorflow as tf
-import scipy.misc
-import skimage.color
-import skimage.io
-import skimage.transform
-import keras.backend as KB
-import keras
-from distutils.version import LooseVersion
-if LooseVersion(keras.__version__) >= LooseVersion('2.2.0'):
-    from keras.engine.saving import load_attributes_from_hdf5_group as _load_attributes_from_hdf5_group
-    from keras.engine.saving import preprocess_weights_for_loading
-else:
-    from keras.engine.topology import _load_attributes_from_hdf5_group, preprocess_weights_for_loading
-
-try:
-    from xhtml2pdf import pisa
-except:
-    pass
+from   mrcnn.lazy_modules import LazyModule
+from   mrcnn.logs         import get_logger
+from   mrcnn.stage_timer  import timed
+
+## TF, Keras, scipy and skimage are imported on first use, so the NumPy box, mask and 
+## AP utilities can be used without them (see lazy_modules)
+tf      = LazyModule('tensorflow')
+keras   = LazyModule('keras')
+KB      = LazyModule('keras.backend')
+scipy   = LazyModule('scipy', imports = ('scipy.misc', 'scipy.ndimage'))
+skimage = LazyModule('skimage', imports = ('skimage.color', 'skimage.io', 'skimage.transform', 'skimage.util'))
 
 pp = pprint.PrettyPrinter(indent=2, width=100)
+_logger = get_logger(__name__)
+
+
+def _keras_hdf5_functions():
+    '''
+    (load_attributes_from_hdf5_group, preprocess_weights_for_loading) of the installed Keras
+    '''
+    from distutils.version import LooseVersion
+    if LooseVersion(keras.__version__) >= LooseVersion('2.2.0'):
+        from keras.engine.saving import load_attributes_from_hdf5_group, preprocess_weights_for_loading
+    else:
+        from keras.engine.topology import _load_attributes_from_hdf5_group as load_attributes_from_hdf5_group
+        from keras.engine.topology import preprocess_weights_for_loading
+    return load_attributes_from_hdf5_group, preprocess_weights_for_loading
+
+
+def _load_attributes_from_hdf5_group(group, name):
+    return _keras_hdf5_functions()[0](group, name)
+
+
+def preprocess_weights_for_loading(*args, **kwargs):
+    return _keras_hdf5_functions()[1](*args, **kwargs)
 
 ### Batch Slicing -------------------------------------------------------------------
 ##   Some custom layers support a batch size of 1 only, and require a lot of work
@@ -190,6 +205,7 @@ def parse_active_class_ids_graph(meta):
     active_class_ids = meta[:, 8:]
     return active_class_ids
 
+@timed('mold_image')
 def mold_image(images, config):
     '''
     Takes RGB images with 0-255 values and subtraces
@@ -387,6 +403,58 @@ def unresize_heatmap(image, image_meta, upscale = None):
 
 
 
+##------------------------------------------------------------------------------------------
+##  pr_heatmap_from_scores - numpy version of heatmap_kernels.heatmaps_from_scores 
+##------------------------------------------------------------------------------------------
+def pr_heatmap_from_scores(pr_hm_scores, heatmap_scale, grid_shape):
+    '''
+    Rebuild the MRCNN predicted heatmap of one image from its pr_hm_scores, when the dense
+    pr_hm was not kept (SPARSE_PR_HEATMAPS). 
+    
+    pr_hm_scores:   [num_classes, num_rois, columns] boxes in molded image coordinates, 
+                    normalized score in column (columns - 16)
+    heatmap_scale:  config.HEATMAP_SCALE_FACTOR
+    grid_shape:     (grid_h, grid_w) heatmap size
+    
+    Returns:
+    --------
+    heatmap:        [grid_h, grid_w, num_classes] normalized per-class heatmap
+    '''
+    grid_h, grid_w = grid_shape
+    num_classes    = pr_hm_scores.shape[0]
+    cls_ix, roi_ix = np.where(np.sum(np.abs(pr_hm_scores[:,:,:4]), axis = -1) > 0)
+    boxes      = pr_hm_scores[cls_ix, roi_ix, :4] / heatmap_scale
+    norm_score = pr_hm_scores[cls_ix, roi_ix, pr_hm_scores.shape[-1] - 16]
+
+    height, width = boxes[:,2] - boxes[:,0], boxes[:,3] - boxes[:,1]
+    cy, cx     = boxes[:,0] + height / 2.0, boxes[:,1] + width / 2.0
+    sy, sx     = np.sqrt(height * 0.5), np.sqrt(width * 0.5)
+
+    def clipped_gaussian(center, sigma, size):
+        ## 1-D gaussian, clipped to the [floor(lo), floor(lo) + ceil(hi - lo)) extent of +/- sigma 
+        pos  = np.arange(size, dtype = np.float32)
+        lo   = np.maximum(center - sigma, 0.0)
+        hi   = np.minimum(center + sigma, float(size))
+        w_lo = np.floor(lo)
+        w_hi = np.clip(w_lo + np.maximum(np.ceil(hi - lo), 0.0), 0, size)
+        w_lo = np.clip(w_lo, 0, size)
+        mask = (pos >= w_lo[:, None]) & (pos < w_hi[:, None])
+        gauss = np.exp(-0.5 * np.square((pos - center[:, None]) / sigma[:, None])) / (sigma[:, None] * math.sqrt(2.0 * math.pi))
+        return gauss * mask
+
+    gauss_y    = clipped_gaussian(cy, sy, grid_h)
+    gauss_x    = clipped_gaussian(cx, sx, grid_w)
+    normalizer = np.max(gauss_y, axis = -1, initial = 0) * np.max(gauss_x, axis = -1, initial = 0)
+    normalizer = np.where(normalizer < 1.0e-15, 1.0, normalizer)
+    gauss_y    = gauss_y * (norm_score / normalizer)[:, None]
+
+    heatmap    = np.zeros((num_classes, grid_h, grid_w), dtype = np.float32)
+    np.add.at(heatmap, cls_ix, gauss_y[:, :, None] * gauss_x[:, None, :])
+    normalizer = np.max(heatmap, axis = (1,2), keepdims = True)
+    heatmap   /= np.where(normalizer < 1.0e-15, 1.0, normalizer)
+    return np.moveaxis(heatmap, 0, -1)
+
+    
 ################################################################################################
 ##  Bounding Box utility functions
 ################################################################################################
@@ -867,6 +935,94 @@ def compute_recall(pred_boxes, gt_boxes, iou):
 ##  Apply non maximal suppression on a set of bounding boxes 
 ##------------------------------------------------------------------------------------------
 def non_max_suppression(boxes, scores, threshold):
+    '''
+    Identify bboxes with an IoU > Threshold for suppression    
+    Performs non-maximum supression and returns indicies of kept boxes, highest score first.
+    (batch_non_max_suppression() on a single group, same kept boxes as non_max_suppression_orig,
+    including tied scores)
+    
+    Input:
+    ------
+    boxes:          [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
+    scores:         1-D array of box scores.
+    threshold:      Float. IoU threshold to use for filtering.
+    '''
+    assert boxes.shape[0] > 0
+    return batch_non_max_suppression(boxes, scores, threshold)
+
+    
+##------------------------------------------------------------------------------------------
+##  Batched non maximal suppression over groups (images / classes) of bounding boxes 
+##------------------------------------------------------------------------------------------
+def batch_non_max_suppression(boxes, scores, threshold, group_ids = None):
+    '''
+    Greedy non-maximum suppression run independently within each group of boxes (e.g. 
+    group = image_index * num_classes + class_id), for all groups at once.
+    
+    The boxes of each group are ranked as non_max_suppression_orig ranks them when given
+    that group's boxes in index order (np.argsort(scores)[::-1], including the order of
+    tied scores), and a box is suppressed when its IoU with a kept, higher ranked box of 
+    the same group is > threshold. IoUs are only computed for pairs of boxes in the 
+    same group, and only boxes that overlap a lower ranked box are swept in order, so
+    the kept set is identical to running non_max_suppression_orig on each group.
+    
+    Input:
+    ------
+    boxes:          [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
+    scores:         [N] box scores.
+    threshold:      Float. IoU threshold to use for filtering.
+    group_ids:      [N] int group of each box, or None for a single group
+    
+    Returns:
+    --------
+    keep:           int32 indices of the kept boxes, ordered by group and highest score first
+    '''
+    N = boxes.shape[0]
+    if N == 0:
+        return np.zeros((0,), dtype = np.int32)
+    if group_ids is None:
+        group_ids = np.zeros(N, dtype = np.int64)
+    boxes = boxes.astype(np.float32) if boxes.dtype.kind != "f" else boxes
+    
+    ## rank boxes by group, then by score within each group with the same argsort as 
+    ## non_max_suppression_orig (argsort is not stable, so ties keep its order)
+    order  = np.argsort(group_ids, kind = 'stable')
+    groups = group_ids[order]
+    bounds = np.flatnonzero(np.diff(groups)) + 1
+    for start, end in zip(np.append(0, bounds), np.append(bounds, N)):
+        group_order      = order[start:end]
+        order[start:end] = group_order[np.argsort(scores[group_order])[::-1]]
+    boxes  = boxes[order]
+    area   = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    
+    ## all pairs (i, j), j ranked after i in the same group
+    group_end = np.searchsorted(groups, groups, side = 'right')
+    counts    = group_end - np.arange(N) - 1
+    pair_i    = np.repeat(np.arange(N), counts)
+    pair_j    = pair_i + 1 + np.arange(pair_i.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    
+    ## IoU of each pair (same arithmetic as compute_iou)
+    y1 = np.maximum(boxes[pair_i, 0], boxes[pair_j, 0])
+    y2 = np.minimum(boxes[pair_i, 2], boxes[pair_j, 2])
+    x1 = np.maximum(boxes[pair_i, 1], boxes[pair_j, 1])
+    x2 = np.minimum(boxes[pair_i, 3], boxes[pair_j, 3])
+    intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        iou = intersection / (area[pair_i] + area[pair_j] - intersection)
+    overlap = iou > threshold
+    pair_i, pair_j = pair_i[overlap], pair_j[overlap]
+    
+    ## sweep the boxes that suppress others in rank order  
+    removed  = np.zeros(N, dtype = bool)
+    starts   = np.flatnonzero(np.diff(pair_i, prepend = -1))
+    ends     = np.append(starts[1:], pair_i.shape[0])
+    for start, end in zip(starts, ends):
+        if not removed[pair_i[start]]:
+            removed[pair_j[start:end]] = True
+    return order[~removed].astype(np.int32)
+
+    
+def non_max_suppression_orig(boxes, scores, threshold):
     '''
     Identify bboxes with an IoU > Threshold for suppression    
     Performs non-maximum supression and returns indicies of kept boxes.
@@ -1142,6 +1298,29 @@ def resize_mask(mask, scale, padding):
     mask = np.pad(mask, padding, mode='constant', constant_values=0)
     return mask
 
+
+def resize_bboxes(bboxes, scale, padding):
+    '''
+    Applies the scale and padding returned by resize_image() to bounding boxes 
+    analytically, producing the boxes extract_bboxes() would return for the
+    resized masks - without building and resizing the masks themselves.
+
+    bboxes:     [N, (y1, x1, y2, x2)] in original image pixel coordinates. 
+                (y2, x2) lay outside the box.
+    scale:      scaling factor, as returned by resize_image()
+    padding:    Padding in the form [(top, bottom), (left, right), (0, 0)] or False
+    
+    Returns: bbox array [N, (y1, x1, y2, x2)] (int32). Boxes which have zero width
+             or height after resizing are set to zeros, as in extract_bboxes().
+    '''
+    boxes = np.round(np.asarray(bboxes, dtype=np.float32).reshape(-1, 4) * scale).astype(np.int32)
+    if padding:
+        top_pad, left_pad = padding[0][0], padding[1][0]
+        boxes += np.array([top_pad, left_pad, top_pad, left_pad], dtype=np.int32)
+    empty = (boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1])
+    boxes[empty] = 0
+    return boxes
+
     
 def minimize_mask(bbox, mask, mini_shape):
     '''
@@ -1349,23 +1528,32 @@ def generate_pyramid_anchors(anchor_scales, anchor_ratios, feature_shapes, featu
     # print('     {:25s} : {}- {}  KerasTensor: {} '.format(x.name, x.shape, KB.int_shape(x), KB.is_keras_tensor(X)))
 
   
-def log(text, array=None):
+def log(text, array=None, logger=None, level=logging.INFO):
     """Prints a text message. And, optionally, if a Numpy array is provided it
     prints it's shape, min, and max values.
+    
+    The message goes to logger (default: the mrcnn.utils logger) at level. Nothing,
+    including the min and max, is computed when the logger is disabled for level.
     """
+    logger = logger or _logger
+    if not logger.isEnabledFor(level):
+        return
     if array is not None:
         text = text.ljust(25)
         text += ("shape: {:20}  min: {:10.5f}  max: {:10.5f}".format(
             str(array.shape),
             array.min() if array.size else "",
             array.max() if array.size else ""))
-    print(text)
+    logger.log(level, text)
 
-def logt(text, tensor=None, indent=1, verbose = 1):
+def logt(text, tensor=None, indent=1, verbose = 1, logger=None, level=logging.INFO):
     """Prints a text message. And, optionally, if a Numpy array is provided it
     prints it's shape, min, and max values.
+    
+    As log(), the message goes to logger at level, and only when verbose.
     """
-    if not verbose:
+    logger = logger or _logger
+    if not verbose or not logger.isEnabledFor(level):
         return
         
     text = '    '*indent+ text.strip()
@@ -1384,7 +1572,7 @@ def logt(text, tensor=None, indent=1, verbose = 1):
             str(tensor.shape),
             str(KB.int_shape(tensor)),
             KB.is_keras_tensor(tensor)))
-    print(text)
+    logger.log(level, text)
 
 def mask_string(mask):
     return np.array2string(np.where(mask,mask,0),max_line_width=134, separator = '')    
@@ -1420,6 +1608,7 @@ def write_zip_stdout(filepath=None,filenm=None,stdout=stdout):
     return
 
 def convertHtmlToPdf(sourceHtml, outputFilename):
+    from xhtml2pdf import pisa
 
     outputFile = open(outputFilename, "w+b")
     pisaStatus = pisa.CreatePDF(sourceHtml, dest = outputFile)
@@ -1567,10 +1756,27 @@ def load_weights_from_hdf5_group(f, layers, reshape=False, verbose = 0):
     KB.batch_set_value(weight_value_tuples)
 
 
+##----------------------------------------------------------------------------------------------
+## layer_digest
+##----------------------------------------------------------------------------------------------
+def layer_digest(weight_names, weight_values):
+    '''
+    SHA1 hex digest of the stored weights of one layer (names, dtypes, shapes and values),
+    as read from a HDF5 weight file
+    '''
+    h = hashlib.sha1()
+    for weight_name, value in zip(weight_names, weight_values):
+        value = np.ascontiguousarray(value)
+        h.update('{}|{}|{}|'.format(weight_name, value.dtype.str, value.shape).encode('utf-8'))
+        h.update(value.data)
+    return h.hexdigest()
+
+    
 ##----------------------------------------------------------------------------------------------
 ## Load weights from hdf5 file
 ##----------------------------------------------------------------------------------------------
-def load_weights_from_hdf5_group_by_name(f, layers, skip_mismatch=False, reshape=False, verbose = 0):
+def load_weights_from_hdf5_group_by_name(f, layers, skip_mismatch=False, reshape=False, verbose = 0,
+                                          layer_digests = None, file_digests = None):
     """Implements name-based weight loading.
 
     (instead of topological weight loading).
@@ -1585,6 +1791,16 @@ def load_weights_from_hdf5_group_by_name(f, layers, skip_mismatch=False, reshape
             or a mismatch in the shape of the weights.
         reshape: Reshape weights to fit the layer when the correct number
             of values are present but the shape does not match.
+        layer_digests: {layer name: layer_digest()} of the weights currently in
+            the layers. When given, a layer is only assigned if the digest of
+            its stored weights differs, and layer_digests is updated in place.
+        file_digests: {layer name: layer_digest()} of the layers of f known
+            beforehand (e.g. cached). Layers whose file digest matches
+            layer_digests are skipped without being read. Digests computed
+            while reading are added in place.
+
+    # Returns
+        Number of bytes read from the datasets of f.
 
     # Raises
         ValueError: in case of mismatch between provided layers
@@ -1660,27 +1876,45 @@ def load_weights_from_hdf5_group_by_name(f, layers, skip_mismatch=False, reshape
     # We batch weight value assignments in a single backend call
     # which provides a speedup in TensorFlow.
     weight_value_tuples = []    
+    bytes_read          = 0
     ## layer_names  : layers names from hdf5 file
     ## weight_names : weight names from hdf5 file
     
     for k, name in enumerate(layer_names):
         g = f[name]
         weight_names = _load_attributes_from_hdf5_group(g, 'weight_names')
-        weight_values = [np.asarray(g[weight_name]) for weight_name in weight_names]
-        
+
         model_layers = index.get(name,[])
         if verbose > 1:
             if not model_layers:
                 print('\n{:3d} {:25s} *** No corresponding layers found in model ***'.format(k,name))
                 print('    HDF5 Weights  : {} \n'.format(weight_names))
-                for i in range(len(weight_values)):
-                    print('{:5d} {:35s}  hdf5 Weights: {}'.format( i, weight_names[i], weight_values[i].shape))
+                for i in range(len(weight_names)):
+                    print('{:5d} {:35s}  hdf5 Weights: {}'.format( i, weight_names[i], g[weight_names[i]].shape))
             else:
                 print('\n{:3d} {:25s} Model Layer Name/Type : {} '.format(k,name, [ [i.name, i.__class__.__name__] for i in model_layers]))
                 print('    HDF5 Weights  : {} \n'.format(weight_names))
+
+        ## only read the datasets of layers that will be assigned (excluded layers
+        ## and layers not in the model are never read from the file)
+        if not model_layers:
+            continue
+        if layer_digests is not None and file_digests is not None and \
+           file_digests.get(name) is not None and file_digests[name] == layer_digests.get(name):
+            continue
+        weight_values = [np.asarray(g[weight_name]) for weight_name in weight_names]
+        bytes_read   += sum(value.nbytes for value in weight_values)
         
-        
-        for layer in index.get(name, []):
+        ## differential load: hash the values just read, assign the layer only if they changed
+        if layer_digests is not None:
+            digest = layer_digest(weight_names, weight_values)
+            if file_digests is not None:
+                file_digests[name] = digest
+            if digest == layer_digests.get(name):
+                continue
+            layer_digests[name] = digest
+
+        for layer in model_layers:
             symbolic_weights = layer.weights
             weight_values = preprocess_weights_for_loading(
                 layer,
@@ -1729,6 +1963,7 @@ def load_weights_from_hdf5_group_by_name(f, layers, skip_mismatch=False, reshape
                         
                 weight_value_tuples.append((symbolic_weights[i], weight_values[i]))
     KB.batch_set_value(weight_value_tuples)
+    return bytes_read
 
     
     
@@ -1913,6 +2148,16 @@ def command_line_parser():
                         metavar="<sysout>",
                         help="sysout destination: 'screen', 'file', 'header' , 'all' (header == file) ")
 
+    parser.add_argument('--log_levels', required=False,
+                        default=None, type=str,
+                        metavar="<log levels>",
+                        help="logging levels: 'LEVEL' or 'module=LEVEL,...' e.g. 'INFO,datagen_fcn=DEBUG' (default=INFO)")
+
+    parser.add_argument('--timing_file', required=False,
+                        default=None, type=str,
+                        metavar="<timing file>",
+                        help="append training step timings to this file (JSON lines)")
+
     parser.add_argument('--new_log_folder', required=False,
                         default=False, action='store_true',
                         help="put logging/weights files in new folder: True or False")
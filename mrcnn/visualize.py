@@ -12,22 +12,20 @@ import random
 import itertools
 import colorsys
 import numpy as np
-import IPython.display
-
-import tensorflow as tf
-import keras.backend as KB
-import matplotlib.pyplot as plt
-from   mpl_toolkits.mplot3d import Axes3D
-import matplotlib.patches as patches
-import matplotlib.lines as lines
-import skimage.util
-from   skimage.measure import find_contours
-from   PIL  import Image
-from   matplotlib.patches import Polygon
-from   matplotlib import cm
-from   matplotlib.ticker import LinearLocator, FormatStrFormatter
 import mrcnn.utils as utils
 from   mrcnn.datagen     import load_image_gt    
+from   mrcnn.lazy_modules import LazyModule
+
+## display packages (and TF / Keras) are imported on first use, see lazy_modules
+IPython = LazyModule('IPython', imports = ('IPython.display',))
+tf      = LazyModule('tensorflow')
+KB      = LazyModule('keras.backend')
+plt     = LazyModule('matplotlib.pyplot', imports = ('mpl_toolkits.mplot3d',))
+patches = LazyModule('matplotlib.patches')
+lines   = LazyModule('matplotlib.lines')
+cm      = LazyModule('matplotlib.cm')
+skimage = LazyModule('skimage', imports = ('skimage.util', 'skimage.measure'))
+Image   = LazyModule('PIL.Image')
 
 
 ############################################################
@@ -384,11 +382,11 @@ def display_instances_with_mask(image, boxes, masks, class_ids, class_names,
         # Pad to ensure proper polygons for masks that touch image edges.
         padded_mask = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
         padded_mask[1:-1, 1:-1] = mask
-        contours = find_contours(padded_mask, 0.5)
+        contours = skimage.measure.find_contours(padded_mask, 0.5)
         for verts in contours:
             # Subtract the padding and flip (y, x) to (x, y)
             verts = np.fliplr(verts) - 1
-            p = Polygon(verts, facecolor="none", edgecolor=color)
+            p = patches.Polygon(verts, facecolor="none", edgecolor=color)
             ax.add_patch(p)
     ax.imshow(masked_image.astype(np.uint8))
     plt.show()
@@ -1067,11 +1065,11 @@ def draw_boxes(image, boxes=None, refined_boxes=None,
             padded_mask = np.zeros(
                 (mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
             padded_mask[1:-1, 1:-1] = mask
-            contours = find_contours(padded_mask, 0.5)
+            contours = skimage.measure.find_contours(padded_mask, 0.5)
             for verts in contours:
                 # Subtract the padding and flip (y, x) to (x, y)
                 verts = np.fliplr(verts) - 1
-                p = Polygon(verts, facecolor="none", edgecolor=color)
+                p = patches.Polygon(verts, facecolor="none", edgecolor=color)
                 ax.add_patch(p)
     ax.imshow(masked_image.astype(np.uint8))
 
@@ -2680,11 +2678,24 @@ def plot_one_bbox_heatmap( Z, boxes, title = 'My figure', width = 7, height =12
     ax.invert_yaxis()    
     plt.show()
 
-    
+
+
+##----------------------------------------------------------------------
+## pr_heatmap()
+##----------------------------------------------------------------------
+def pr_heatmap(results, config):
+    '''
+    MRCNN predicted heatmap of a detect() / evaluate() result. With SPARSE_PR_HEATMAPS
+    results['pr_hm'] is None and the heatmap is rebuilt from results['pr_hm_scores']
+    '''
+    if results['pr_hm'] is not None:
+        return results['pr_hm']
+    return utils.pr_heatmap_from_scores(results['pr_hm_scores'], config.HEATMAP_SCALE_FACTOR, config.FCN_INPUT_SHAPE)
+
 
 ##----------------------------------------------------------------------
 ## inference_heatmaps_display()
-##----------------------------------------------------------------------     
+##----------------------------------------------------------------------
 def inference_heatmaps_display( input, image_id, hm = 'fcn_hm' ,  heatmaps = None, 
                       class_ids = None, 
                       class_names = None,
@@ -2714,7 +2725,7 @@ def inference_heatmaps_display( input, image_id, hm = 'fcn_hm' ,  heatmaps = Non
         Z1    =  results['fcn_sm']
         title = 'Image: {:2d} - FCN Softmax '.format(image_id)
     else :
-        Z1    =  results['pr_hm']
+        Z1    =  pr_heatmap(results, config)
         title = 'Image: {:2d} - MRCNN Heatmaps '.format(image_id)
 
     print(' heatmap shape: ', Z1.shape,' Bounding boxes shape: ', boxes.shape)
@@ -2857,7 +2868,7 @@ def inference_heatmaps_compare(input, image_id = 0, hm = 'hm' ,
     image      = results['image']
     image_meta = results['image_meta']
     
-    Z1    =  results['pr_hm']        
+    Z1    =  pr_heatmap(results, config)        
     boxes =  results['fcn_scores_by_class'] 
 
     if hm == 'fcn_hm':